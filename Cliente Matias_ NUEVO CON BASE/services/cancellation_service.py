@@ -5,8 +5,11 @@ Maneja cancelaciones de órdenes ML con recálculo de depósito ganador
 """
 from __future__ import annotations
 
+import importlib
 import json
+import os
 import re
+import sys
 import time
 import requests
 import pyodbc
@@ -20,6 +23,22 @@ from utils.logger import get_logger
 
 log = get_logger(__name__)
 
+# Raíz del repo: de ahí se toman los módulos compartidos (modules/dragon_sql_stock, ...)
+_REPO_ROOT = Path(__file__).resolve().parents[2]
+
+
+def _shared_module(name: str):
+    """Importa modules.<name> de la raíz del repo; None si no está disponible
+    (p.ej. en el ejecutable empaquetado, donde sólo viaja este cliente)."""
+    try:
+        if str(_REPO_ROOT) not in sys.path:
+            sys.path.append(str(_REPO_ROOT))
+        return importlib.import_module(f"modules.{name}")
+    except Exception as e:
+        log.debug("Módulo compartido modules.%s no disponible: %s", name, e)
+        return None
+
+
 class CancellationService:
     """Servicio integrado para cancelaciones ML con recálculo de depósito ganador."""
     
@@ -31,7 +50,9 @@ class CancellationService:
     TOKEN_PATH = Path(r"C:\Users\Mundo Outdoor\Desktop\Develop_Mati\Escritor Meli\token.json")
     
     # ───────── PRIORIDADES INTEGRADAS ─────────────────────────────
-    # Prioridades integradas directamente (no depende de archivos externos)
+    # Pesos propios de la cancelación (puntos + cantidad * multiplicador). Qué depósitos
+    # compiten sale de la lista compartida con el asignador
+    # (modules/depot_recommender.assign_priority, derivada de RECOMMEND_DEPOT_ORDER).
     PRIORIDADES_PUNTOS = {
         "DEP": 10000000,
         "MDQ": 0,
@@ -63,23 +84,7 @@ class CancellationService:
         "NQNALB": 0.2,
         "NQNSHOP": 0.3,
     }
-    
-    PRIORIDADES_MULTIPLICADORES = {
-        "DEP": 1,
-        "MDQ": 1,
-        "MONBAHIA": 1,
-        "MTGBBPS": 1,
-        "MTGCBA": 1,
-        "MTGCOM": 1,
-        "MTGJBJ": 1,
-        "MTGROCA": 1,
-        "MUNDOAL": 1,
-        "MUNDOCAB": 1,
-        "MUNDOROC": 1,
-        "NQNALB": 1,
-        "NQNSHOP": 1,
-    }
-    
+
     # Mapeo de depósitos para notas de cancelación
     DEPOS_MAP = {
         "DEP": "BBLANCADE",
@@ -125,23 +130,28 @@ class CancellationService:
     def __init__(self):
         self.puntos: Dict[str, float] = {}
         self.mult: Dict[str, float] = {}
+        self.habilitados: set[str] = set()
+        self._sql_engine = None
         self._load_priorities()
     
     def _load_priorities(self) -> None:
-        """Carga prioridades de depósitos desde datos integrados."""
-        try:
-            # Cargar prioridades integradas directamente
-            self.puntos = self.PRIORIDADES_PUNTOS.copy()
-            self.mult = self.PRIORIDADES_MULT.copy()
-            
-            log.info("✅ Prioridades integradas cargadas: %d puntos, %d multiplicadores", 
-                    len(self.puntos), len(self.mult))
-        except Exception as e:
-            log.error("❌ Error cargando prioridades integradas: %s", e)
-            # Fallback a valores por defecto
-            self.puntos = {"DEP": 10000000}
-            self.mult = {"DEP": 1.0}
-    
+        """Carga los pesos integrados y la lista de depósitos habilitados (la del asignador, vía
+        depot_recommender; sin módulos compartidos, RECOMMEND_DEPOT_ORDER)."""
+        self.puntos = self.PRIORIDADES_PUNTOS.copy()
+        self.mult = self.PRIORIDADES_MULT.copy()
+        order = []
+        reco = _shared_module("depot_recommender")
+        if reco is not None:
+            try:
+                order = [str(d).strip().upper() for d in reco.assign_priority() if str(d).strip()]
+            except Exception as e:
+                log.warning("No se pudo obtener la prioridad del asignador: %s", e)
+        if not order:
+            order = [d.strip().upper() for d in os.getenv("RECOMMEND_DEPOT_ORDER", "").split(",") if d.strip()]
+        self.habilitados = {"DEP" if d == "DEPO" else d for d in order}
+        log.info("✅ Prioridades integradas cargadas: %d puntos, %d multiplicadores; habilitados: %s",
+                 len(self.puntos), len(self.mult), ", ".join(order) or "todos")
+
     def _val_for(self, dep: str, tab: Dict[str, float], default: float = 0.0) -> float:
         """Obtiene valor de prioridad para depósito."""
         return tab.get(dep.upper(), tab.get(dep[:3].upper(), default))
@@ -203,6 +213,23 @@ class CancellationService:
                 it.get("item", {}).get("seller_sku") or 
                 it.get("item", {}).get("seller_custom_field") or "").strip()
     
+    def _engine_sql(self):
+        """Motor compartido de stock SQL (bases en paralelo, timeout y backoff por base).
+        Usa DRAGON_SQL_CONN_STR si está configurado; si no, CONN_STR de este servicio."""
+        if self._sql_engine is None:
+            mod = _shared_module("dragon_sql_stock")
+            if mod is None:
+                return None
+            try:
+                if os.getenv("DRAGON_SQL_CONN_STR"):
+                    self._sql_engine = mod.get_engine()
+                else:
+                    self._sql_engine = mod.DragonSqlStock(self.CONN_STR)
+            except Exception as e:
+                log.warning("Motor SQL de stock no disponible, se usa la consulta secuencial: %s", e)
+                return None
+        return self._sql_engine
+
     def _stock_por_deposito(self, sku: str) -> Dict[str, int]:
         """Consulta stock por depósito desde SQL Server."""
         try:
@@ -210,7 +237,17 @@ class CancellationService:
         except ValueError:
             log.warning("SKU inválido (debe tener formato ART-COL-TAL): %s", sku)
             return {}
-        
+
+        engine = self._engine_sql()
+        if engine is not None:
+            try:
+                stock = engine.stock_per_deposit(sku)
+                res = {d.strip().upper(): int((v or {}).get("total") or 0) for d, v in stock.items()}
+                return {d: q for d, q in res.items() if d not in self.BASES_EXCLUIDAS}
+            except Exception as e:
+                log.warning("Stock SQL en paralelo falló para %s, consulta secuencial: %s", sku, e)
+
+        # Fallback: recorrer las bases de a una (sin módulos compartidos)
         query = (
             "SELECT RTRIM(BDALTAFW), SUM(COCANT) FROM [{db}].[ZooLogic].[COMB] "
             "WHERE RTRIM(COART)=? AND RTRIM(COCOL)=? AND RTRIM(TALLE)=? "
@@ -258,6 +295,9 @@ class CancellationService:
         """Lista depósitos ganadores ordenados por score."""
         g = []
         for dep, stk in mat.items():
+            # Con la lista compartida cargada, los depósitos fuera de ella (deshabilitados) no compiten
+            if self.habilitados and dep.upper() not in self.habilitados and dep[:3].upper() not in self.habilitados:
+                continue
             score = self._combo_score(req, (dep,), mat)
             if score > 0:
                 g.append((dep, sum(stk.values()), score))
@@ -21,10 +21,11 @@ import importlib.util
 import logging
 import os
 import sys
+import threading
 import time
 from typing import Optional, Set, Iterable
 import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 try:
     from dotenv import load_dotenv  # type: ignore
 except Exception:
@@ -59,6 +60,7 @@ try:
     mod8 = importlib.util.module_from_spec(spec8)
     spec8.loader.exec_module(mod8)
     assign_pending = getattr(mod8, 'assign_pending')
+    assign_orders = getattr(mod8, 'assign_orders')
     backfill_stock_columns = getattr(mod8, 'backfill_stock_columns')
 except Exception as e:
     print("Error importando asignador PASO 08:", e)
@@ -70,9 +72,17 @@ try:
 except Exception:
     backfill_barcode_all = None  # type: ignore
 
+from modules import pipeline_metrics as _metrics
+
+try:
+    # Cola de asignación por evento (webhook/sync encolan órdenes que pasan a ready_to_print)
+    from modules import assign_queue as _assign_queue
+except Exception:
+    _assign_queue = None
+
 try:
     # Importar ruteo de conexión multi-DB para notas, lecturas/escrituras
-    from PIPELINE_5_CONSOLIDADO.database_utils import get_connection_for_meli
+    from PIPELINE_5_CONSOLIDADO.database_utils import get_connection_for_meli, ensure_schema_once, _conn_str_for_meli
 except Exception as e:
     print("Error importando get_connection_for_meli:", e)
     raise
@@ -153,83 +163,142 @@ def _should_process_token(token_path: str, disabled: Iterable[str], only: Iterab
     return not bool(ids & set(disabled))
 
 
-def _sync_multi_accounts(limit_acc1: int, limit_acc2: int, *, cycle_no: int = 0) -> None:
-    """Sincroniza órdenes recientes por cada cuenta (si hay segundo token).
-    Usa la lógica probada de scripts/process_last_sales_per_meli.py.
-    """
-    try:
-        base_dir = os.path.dirname(os.path.dirname(__file__))
-        script_path = os.path.join(base_dir, 'scripts', 'process_last_sales_per_meli.py')
-        spec = importlib.util.spec_from_file_location('scripts.process_last_sales_per_meli', script_path)
-        if not spec or not spec.loader:
-            logger.info("Multi-cuenta: no se pudo cargar process_last_sales_per_meli.py; continuo con pipeline 5 estándar")
-            return
-        mod = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(mod)  # type: ignore[attr-defined]
+def _load_sync_script():
+    """Carga scripts/process_last_sales_per_meli.py (lógica probada de sync por cuenta)."""
+    base_dir = os.path.dirname(os.path.dirname(__file__))
+    script_path = os.path.join(base_dir, 'scripts', 'process_last_sales_per_meli.py')
+    spec = importlib.util.spec_from_file_location('scripts.process_last_sales_per_meli', script_path)
+    if not spec or not spec.loader:
+        return None
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)  # type: ignore[attr-defined]
+    return mod
 
-        token1 = os.path.join(base_dir, 'config', 'token.json')
-        token2 = os.path.join(base_dir, 'config', 'token_02.json')
-        disabled, only = _load_id_filters()
 
-        logger.info(f"👥 Sync multi-cuenta: acc1={limit_acc1}, acc2={limit_acc2} (ciclo={cycle_no})")
+def _sync_account_jobs(limit_acc1: int, limit_acc2: int, *, cycle_no: int = 0) -> list:
+    """Cuentas a sincronizar este ciclo como [(label, token_path, limit)], aplicando
+    filtros (disabled/only), límites <= 0 y la frecuencia de la cuenta de tráfico bajo."""
+    base_dir = os.path.dirname(os.path.dirname(__file__))
+    token1 = os.path.join(base_dir, 'config', 'token.json')
+    token2 = os.path.join(base_dir, 'config', 'token_02.json')
+    disabled, only = _load_id_filters()
 
-        jobs = []
-        max_workers = int(os.getenv("MAX_WORKERS_ACCOUNTS", "2"))
+    logger.info(f"👥 Sync multi-cuenta: acc1={limit_acc1}, acc2={limit_acc2} (ciclo={cycle_no})")
 
-        # Política de frecuencia para user 756086955 (tráfico bajo)
-        every_n = int(os.getenv("PROCESS_EVERY_N_CYCLES_756086955", "1"))
-        def _skip_low_traffic(token_path: str) -> bool:
-            try:
-                ids = _file_user_ids(token_path)
-                if "756086955" in ids and every_n > 1 and (cycle_no % every_n) != 0:
-                    logger.info(f"Cuenta con user_id 756086955: salteada este ciclo (cada {every_n})")
-                    return True
-            except Exception:
-                pass
-            return False
-
-        with ThreadPoolExecutor(max_workers=max_workers) as ex:
-            # Cuenta 1
-            if os.path.exists(token1):
-                if _should_process_token(token1, disabled, only):
-                    if (limit_acc1 is not None) and (int(limit_acc1) <= 0):
-                        logger.info("Cuenta 1: deshabilitada por límite <= 0")
-                    else:
-                        logger.info("Cuenta 1: usando config/token.json")
-                        jobs.append(ex.submit(mod.process_orders_from_token, token1, int(limit_acc1)))
-                else:
-                    logger.info("Cuenta 1: saltada por filtros (disabled/only)")
+    jobs = []
+
+    # Política de frecuencia para user 756086955 (tráfico bajo)
+    every_n = int(os.getenv("PROCESS_EVERY_N_CYCLES_756086955", "1"))
+    def _skip_low_traffic(token_path: str) -> bool:
+        try:
+            ids = _file_user_ids(token_path)
+            if "756086955" in ids and every_n > 1 and (cycle_no % every_n) != 0:
+                logger.info(f"Cuenta con user_id 756086955: salteada este ciclo (cada {every_n})")
+                return True
+        except Exception:
+            pass
+        return False
+
+    # Cuenta 1
+    if os.path.exists(token1):
+        if _should_process_token(token1, disabled, only):
+            if (limit_acc1 is not None) and (int(limit_acc1) <= 0):
+                logger.info("Cuenta 1: deshabilitada por límite <= 0")
             else:
-                logger.warning("Cuenta 1: config/token.json no encontrado")
-
-            # Cuenta 2
-            if os.path.exists(token2):
-                if _should_process_token(token2, disabled, only) and not _skip_low_traffic(token2):
-                    if (limit_acc2 is not None) and (int(limit_acc2) <= 0):
-                        logger.info("Cuenta 2: deshabilitada por límite <= 0")
-                    else:
-                        logger.info("Cuenta 2: usando config/token_02.json")
-                        jobs.append(ex.submit(mod.process_orders_from_token, token2, int(limit_acc2)))
-                else:
-                    logger.info("Cuenta 2: saltada (filtros o frecuencia)")
+                logger.info("Cuenta 1: usando config/token.json")
+                jobs.append(('acc1', token1, int(limit_acc1)))
+        else:
+            logger.info("Cuenta 1: saltada por filtros (disabled/only)")
+    else:
+        logger.warning("Cuenta 1: config/token.json no encontrado")
+
+    # Cuenta 2
+    if os.path.exists(token2):
+        if _should_process_token(token2, disabled, only) and not _skip_low_traffic(token2):
+            if (limit_acc2 is not None) and (int(limit_acc2) <= 0):
+                logger.info("Cuenta 2: deshabilitada por límite <= 0")
             else:
-                logger.info("Cuenta 2: token_02.json no presente; si lo agregás se sincroniza también")
-
-            # Esperar a todas las cuentas
-            for f in as_completed(jobs):
-                try:
-                    f.result()
-                except Exception as e:
-                    logger.warning(f"Multi-cuenta: error en tarea: {e}")
-    except Exception as e:
-        logger.warning(f"Multi-cuenta: error durante sync por cuenta: {e}")
+                logger.info("Cuenta 2: usando config/token_02.json")
+                jobs.append(('acc2', token2, int(limit_acc2)))
+        else:
+            logger.info("Cuenta 2: saltada (filtros o frecuencia)")
+    else:
+        logger.info("Cuenta 2: token_02.json no presente; si lo agregás se sincroniza también")
+    return jobs
+
+
+# Fetchers de notas por (token, cuenta): token y seller_id cacheados entre ciclos
+_NOTES_FETCHERS: dict = {}
+
+
+def _notes_fetcher(mod, token_path: str, uid: Optional[str], timeout: float, workers: int):
+    key = (token_path, uid)
+    f = _NOTES_FETCHERS.get(key)
+    if f is None:
+        f = mod.NotesFetcher(token_path, user_id=uid, timeout=timeout, pool_size=workers)
+        _NOTES_FETCHERS[key] = f
+    return f
+
+
+# Candidatas a refrescar, priorizadas: ready_to_print sin asignar primero. Cada orden se
+# vuelve a consultar según su intervalo (ready_to_print / activa / terminal), tomado de
+# notas_frescura.fetched_at; las nunca consultadas entran enseguida. Las que fallaron
+# (fallos > 0) esperan además un backoff exponencial (retry * 2^(fallos-1), tope 2^6) para
+# no ocupar el TOP de cada ciclo.
+_NOTES_CANDIDATES_SQL = """
+WITH o AS (
+    SELECT CAST(order_id AS NVARCHAR(50)) AS order_id, nota, date_created, asignado_flag,
+           shipping_subestado,
+           CASE WHEN estado = 'cancelled'
+                  OR shipping_estado IN ('delivered', 'not_delivered', 'cancelled')
+                THEN 1 ELSE 0 END AS terminal
+    FROM orders_meli
+    WHERE date_created >= DATEADD(DAY, -?, GETDATE())
+)
+SELECT TOP (?) o.order_id, o.nota, f.nota_hash,
+       CASE WHEN f.order_id IS NULL THEN 0 ELSE 1 END AS indexed
+FROM o
+LEFT JOIN notas_frescura f ON f.order_id = o.order_id
+WHERE (f.fetched_at IS NULL
+       OR (o.terminal = 0 AND o.shipping_subestado = 'ready_to_print'
+           AND f.fetched_at < DATEADD(SECOND, -?, GETDATE()))
+       OR (o.terminal = 0 AND ISNULL(o.shipping_subestado, '') <> 'ready_to_print'
+           AND f.fetched_at < DATEADD(SECOND, -?, GETDATE()))
+       OR (o.terminal = 1 AND ? = 1 AND f.fetched_at < DATEADD(SECOND, -?, GETDATE())))
+  AND (f.order_id IS NULL OR f.fallos = 0
+       OR f.fetched_at < DATEADD(SECOND, -? * POWER(2, CASE WHEN f.fallos > 6 THEN 6 ELSE f.fallos - 1 END), GETDATE()))
+ORDER BY
+    CASE WHEN o.terminal = 1 THEN 3
+         WHEN o.shipping_subestado = 'ready_to_print' AND ISNULL(o.asignado_flag, 0) = 0 THEN 0
+         WHEN o.shipping_subestado = 'ready_to_print' THEN 1
+         ELSE 2 END,
+    f.fetched_at ASC,
+    o.date_created DESC
+"""
 
 
 def update_notes_recent(limit: int) -> int:
-    """Actualiza la columna 'nota' para las últimas N órdenes usando
-    las mismas estrategias del script `backfill_notes_once.py`.
-
-    Devuelve la cantidad de órdenes actualizadas.
+    """Actualiza la columna 'nota' de las órdenes recientes de cada cuenta usando
+    la misma cadena de fuentes que `backfill_notes_once.py` (notes → comments →
+    merchant_orders del pack → mensajes del pack).
+
+    - Índice de frescura (tabla notas_frescura: hash + fetched_at por orden): en cada ciclo
+      se eligen hasta N órdenes vencidas, ready_to_print sin asignar primero.
+      Intervalos: PIPE10_NOTES_RTP_SECS (ready_to_print), PIPE10_NOTES_ACTIVE_SECS (resto
+      de activas) y PIPE10_NOTES_TERMINAL_SECS (entregadas/canceladas; <= 0 = nunca más).
+      Una orden cuyo fetch falla queda registrada (fallos + 1) y se reintenta con backoff
+      exponencial desde PIPE10_NOTES_RETRY_SECS.
+    - Un NotesFetcher por cuenta (su propio token y seller_id, cacheados entre ciclos; la
+      memo de textos por pack se limpia en cada corrida).
+    - Si ML no responde bien (red, 401, 429, 5xx) el fetcher levanta NotesFetchError: la
+      orden va a fallidas (fallos + 1) y su nota en orders_meli no se toca.
+    - La ola de consultas y las escrituras viven en backfill_notes_once (refresh_notes /
+      write_notes_results), junto al fetcher.
+    - Pool acotado por cuenta (PIPE10_NOTES_WORKERS) y tope total PIPE10_NOTES_DEADLINE_SECS.
+    - /orders/{id}/notes primero: si su hash coincide con el guardado no se sigue consultando.
+    - orders_meli sólo se escribe cuando la nota cambió (un UPDATE por chunk).
+
+    Devuelve la cantidad de órdenes cuya nota cambió.
     """
     try:
         # Cargar helpers de backfill_notes_once.py vía importlib
@@ -242,123 +311,93 @@ def update_notes_recent(limit: int) -> int:
         mod = importlib.util.module_from_spec(spec)
         spec.loader.exec_module(mod)  # type: ignore[attr-defined]
 
-        # Reutilizar las funciones internas ya probadas
-        _fetch_notes = getattr(mod, '_fetch_notes')
-        _fetch_comments_fallback = getattr(mod, '_fetch_comments_fallback')
-        _fetch_merchant_comments_from_pack = getattr(mod, '_fetch_merchant_comments_from_pack')
-        _fetch_messages_from_pack = getattr(mod, '_fetch_messages_from_pack')
-
-        # Determinar los user_ids disponibles desde token.json y token_02.json
-        base_dir = os.path.dirname(os.path.dirname(__file__))
+        # Cuenta -> archivo de token (token.json / token_02.json)
         token1 = os.path.join(base_dir, 'config', 'token.json')
         token2 = os.path.join(base_dir, 'config', 'token_02.json')
-        user_ids = set()
-        try:
-            user_ids |= _file_user_ids(token1)
-        except Exception:
-            pass
-        try:
-            user_ids |= _file_user_ids(token2)
-        except Exception:
-            pass
+        accounts: dict = {}
+        for tp in (token1, token2):
+            if not os.path.exists(tp):
+                continue
+            try:
+                for uid in _file_user_ids(tp):
+                    accounts.setdefault(uid, tp)
+            except Exception:
+                pass
 
         # Si no pudimos determinar IDs, procesar contra base por defecto (None)
-        if not user_ids:
-            user_ids = {None}
+        if not accounts:
+            accounts = {None: token1}
 
         # Config de timeouts/caps por entorno
-        try:
-            per_order_timeout = float(os.getenv("PIPE10_NOTES_PER_ORDER_TIMEOUT", "12"))
-        except Exception:
-            per_order_timeout = 12.0
-        try:
-            max_per_account = int(os.getenv("PIPE10_NOTES_MAX_PER_ACCOUNT", str(limit)))
-        except Exception:
-            max_per_account = limit
+        def _env_num(name: str, default: float) -> float:
+            try:
+                return float(os.getenv(name, str(default)))
+            except Exception:
+                return default
+
+        per_order_timeout = _env_num("PIPE10_NOTES_PER_ORDER_TIMEOUT", 12)
+        max_per_account = int(_env_num("PIPE10_NOTES_MAX_PER_ACCOUNT", limit))
+        workers = max(1, int(_env_num("PIPE10_NOTES_WORKERS", 8)))
+        deadline_secs = _env_num("PIPE10_NOTES_DEADLINE_SECS", 120)
+        rtp_secs = int(_env_num("PIPE10_NOTES_RTP_SECS", 0))
+        active_secs = int(_env_num("PIPE10_NOTES_ACTIVE_SECS", 900))
+        terminal_secs = int(_env_num("PIPE10_NOTES_TERMINAL_SECS", 86400))
+        window_days = int(_env_num("PIPE10_NOTES_WINDOW_DAYS", 30))
+        retry_secs = max(1, int(_env_num("PIPE10_NOTES_RETRY_SECS", 120)))
 
         notes_debug = str(os.getenv("PIPE10_NOTES_DEBUG", "0")).strip().lower() in {"1", "true", "yes"}
 
-        def _get_note_with_fallback(oid: str) -> str | None:
-            # Ejecuta la cadena de fetchers en un hilo para poder aplicar timeout por orden
-            def _runner():
-                import time as _t
-                if notes_debug:
-                    logger.info(f"Notas[{oid}]: inicio fetch")
-                # 1) notes
-                t0 = _t.time()
-                try:
-                    n = _fetch_notes(oid)
-                    if n:
-                        if notes_debug:
-                            logger.info(f"Notas[{oid}]: _fetch_notes OK en {(_t.time()-t0):.2f}s")
-                        return n
-                except Exception as e:
-                    logger.warning(f"Notas[{oid}]: _fetch_notes error: {e}")
-                # 2) comments fallback
-                t1 = _t.time()
-                try:
-                    n = _fetch_comments_fallback(oid)
-                    if n:
-                        if notes_debug:
-                            logger.info(f"Notas[{oid}]: _fetch_comments_fallback OK en {(_t.time()-t1):.2f}s")
-                        return n
-                except Exception as e:
-                    logger.warning(f"Notas[{oid}]: _fetch_comments_fallback error: {e}")
-                # 3) merchant comments by pack
-                t2 = _t.time()
-                try:
-                    n = _fetch_merchant_comments_from_pack(oid)
-                    if n:
-                        if notes_debug:
-                            logger.info(f"Notas[{oid}]: _fetch_merchant_comments_from_pack OK en {(_t.time()-t2):.2f}s")
-                        return n
-                except Exception as e:
-                    logger.warning(f"Notas[{oid}]: _fetch_merchant_comments_from_pack error: {e}")
-                # 4) messages by pack
-                t3 = _t.time()
-                try:
-                    n = _fetch_messages_from_pack(oid)
-                    if n:
-                        if notes_debug:
-                            logger.info(f"Notas[{oid}]: _fetch_messages_from_pack OK en {(_t.time()-t3):.2f}s")
-                        return n
-                except Exception as e:
-                    logger.warning(f"Notas[{oid}]: _fetch_messages_from_pack error: {e}")
-                if notes_debug:
-                    logger.info(f"Notas[{oid}]: sin nota tras {(_t.time()-t0):.2f}s")
-                return None
-            from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutTimeout
-            with ThreadPoolExecutor(max_workers=1) as ex:
-                fut = ex.submit(_runner)
-                try:
-                    return fut.result(timeout=per_order_timeout)
-                except FutTimeout:
-                    logger.warning(f"Notas: timeout por orden {oid} (> {per_order_timeout}s). Se omite.")
-                    return None
-                except Exception as e:
-                    logger.warning(f"Notas: error obteniendo nota para {oid}: {e}")
-                    return None
+        def _norm(v) -> Optional[str]:
+            v = (v or '').strip() if isinstance(v, str) else v
+            return v or None
 
         total_updated = 0
-        for uid in user_ids:
+        for uid, token_path in accounts.items():
             try:
+                t0 = time.monotonic()
+                fetcher = _notes_fetcher(mod, token_path, uid, per_order_timeout, workers)
                 # Abrir conexión ruteada por cuenta
                 with get_connection_for_meli(uid) as conn:
                     cur = conn.cursor()
-                    cur.execute("SELECT TOP (?) order_id FROM orders_meli ORDER BY date_created DESC", (max_per_account,))
-                    ids = [str(r[0]) for r in cur.fetchall()]
-                    if not ids:
+                    ensure_schema_once(cur, _conn_str_for_meli(uid))
+                    cur.execute(
+                        _NOTES_CANDIDATES_SQL,
+                        (window_days, max_per_account, rtp_secs, active_secs,
+                         1 if terminal_secs > 0 else 0, max(terminal_secs, 0), retry_secs),
+                    )
+                    current: dict = {}
+                    known_hash: dict = {}
+                    for oid, nota, nota_hash, indexed in cur.fetchall():
+                        oid = str(oid)
+                        current[oid] = _norm(nota)
+                        # Sin fila en el índice: el hash de referencia es el de la nota guardada
+                        if nota_hash:
+                            known_hash[oid] = str(nota_hash).strip()
+                        else:
+                            known_hash[oid] = None if indexed else mod.nota_hash(current[oid])
+                    if not current:
                         continue
                     if notes_debug:
-                        logger.info(f"Notas[cta={uid}]: procesando {len(ids)} ids (TOP {max_per_account})")
-                    for oid in ids:
-                        nota = _get_note_with_fallback(oid)
-                        cur.execute(
-                            "UPDATE orders_meli SET nota = ?, fecha_actualizacion = GETDATE() WHERE order_id = ?",
-                            (nota, oid),
-                        )
-                        conn.commit()
-                        total_updated += 1
+                        logger.info(f"Notas[cta={uid}]: {len(current)} órdenes vencidas (TOP {max_per_account})")
+
+                    res = mod.refresh_notes(fetcher, current, known_hash, workers, deadline_secs)
+                    changes, fetched, failed = res['changes'], res['fetched'], res['failed']
+                    for oid, err in res['errors']:
+                        logger.warning(f"Notas: error obteniendo nota {oid}: {err}")
+                    if res['pending']:
+                        logger.warning(f"Notas[cta={uid}]: {res['pending']} órdenes sin respuesta en {deadline_secs:.0f}s; se reintentan el próximo ciclo")
+                    if fetched or failed:
+                        with _metrics.timed('app_db'):
+                            mod.write_notes_results(cur, res)
+                            conn.commit()
+                    total_updated += len(changes)
+                    _metrics.record_stage(f"notes:{uid}", time.monotonic() - t0, True,
+                                          {'due': len(current), 'fetched': len(fetched), 'failed': len(failed),
+                                           'updated': len(changes)})
+                    logger.info(
+                        f"Notas[cta={uid}]: {len(fetched)}/{len(current)} consultadas, {res['probed_same']} sin cambios (probe), "
+                        f"{len(changes)} actualizadas en {time.monotonic() - t0:.1f}s"
+                    )
             except Exception as _e:
                 logger.warning(f"Notas: error procesando notas para cuenta {uid}: {_e}")
                 continue
@@ -370,6 +409,60 @@ def update_notes_recent(limit: int) -> int:
 
 _CYCLE_NO = 0  # contador global de ciclos
 
+# Asignación por evento y barrido del ciclo no corren a la vez (mismas órdenes / reservas)
+_ASSIGN_LOCK = threading.Lock()
+
+
+def _drain_assign_queue(batch: int) -> int:
+    """Reclama hasta `batch` órdenes de dbo.assign_queue (en la base que usa 08_assign_tx) y
+    las asigna con sus packs vía assign_orders. Devuelve cuántas se reclamaron.
+    Si la asignación levanta no se confirman: se vuelven a tomar pasado el TTL del claim."""
+    engine = getattr(getattr(mod8, '_mod_local_db', None), 'engine', None)
+    if _assign_queue is None or engine is None:
+        return 0
+    conn = engine.raw_connection()
+    try:
+        items = _assign_queue.claim(conn, batch, key='pipeline10')
+        if not items:
+            return 0
+        ids = [oid for oid, _pid in items]
+        packs = {pid for _oid, pid in items if pid}
+        t0 = time.monotonic()
+        with _ASSIGN_LOCK:
+            n = assign_orders(ids)
+        _assign_queue.ack(conn, ids)
+        logger.info(
+            f"⚡ Asignación por evento: {len(ids)} órdenes en cola ({len(packs)} packs), "
+            f"{n} asignadas en {time.monotonic() - t0:.1f}s"
+        )
+        return len(items)
+    finally:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def _event_assign_loop(stop: threading.Event) -> None:
+    """Hilo de asignación por evento: atiende la cola cada PIPE10_EVENT_POLL_SECS mientras el
+    loop principal corre ciclos (que quedan como barrido de reconciliación)."""
+    def _env_num(name: str, default: float) -> float:
+        try:
+            return float(os.getenv(name, str(default)))
+        except Exception:
+            return default
+
+    while not stop.is_set():
+        poll = max(0.5, _env_num("PIPE10_EVENT_POLL_SECS", 5))
+        batch = max(1, int(_env_num("PIPE10_EVENT_BATCH", 50)))
+        try:
+            claimed = _drain_assign_queue(batch)
+        except Exception as e:
+            logger.warning(f"⚡ Asignación por evento: error atendiendo la cola: {e}")
+            claimed = 0
+        if claimed < batch:
+            stop.wait(poll)
+
 
 def run_cycle(limit: Optional[int], limit_acc1: Optional[int] = None, limit_acc2: Optional[int] = None) -> None:
     """
@@ -377,7 +470,75 @@ def run_cycle(limit: Optional[int], limit_acc1: Optional[int] = None, limit_acc2
     1) Sync de órdenes reales ML (PIPELINE 5): inserta/actualiza estados, shipping, notas, atributos.
     2) Asignación + movimiento WOO→WOO para ready_to_print no asignadas (PASO 08, idempotente).
     3) Backfill de columnas de stock por depósito para visibilidad.
+
+    Cada etapa (y cada cuenta) queda medida en modules.pipeline_metrics junto con las
+    llamadas a ML / Dragonfish API / Dragonfish SQL / base propia; al terminar se agrega
+    el resumen del ciclo a logs/pipeline_metrics.jsonl.
     """
+    _metrics.start_cycle(_CYCLE_NO)
+    try:
+        _run_cycle_stages(limit, limit_acc1, limit_acc2)
+    finally:
+        summary = _metrics.finish_cycle()
+        if summary:
+            stages = ", ".join(f"{k}={v['secs']:.1f}s" for k, v in summary['stages'].items())
+            deps = ", ".join(
+                f"{k}: {v['calls']} llamadas p50={v['p50_ms']:.0f}ms p95={v['p95_ms']:.0f}ms err={v['errors']}"
+                for k, v in summary['deps'].items()
+            )
+            logger.info(f"⏱️ Ciclo {summary['cycle']}: {summary['total_secs']:.1f}s | {stages}")
+            if deps:
+                logger.info(f"⏱️ Dependencias: {deps}")
+
+
+class _Stage:
+    """Nodo del DAG de un ciclo: corre cuando terminaron todas sus dependencias."""
+
+    def __init__(self, name: str, fn, deps: Iterable[str] = ()):
+        self.name = name
+        self.fn = fn
+        self.deps = set(deps)
+
+
+def _run_stages(stages: list, max_workers: int) -> dict:
+    """Ejecuta el DAG con hasta `max_workers` etapas a la vez. Una etapa que falla no
+    frena a sus dependientes (igual que el ciclo secuencial: cada paso tolera los errores
+    de los anteriores); sólo se registra. Devuelve {nombre: ok}."""
+    from concurrent.futures import FIRST_COMPLETED, wait as _wait
+
+    by_name = {st.name: st for st in stages}
+    for st in stages:
+        st.deps &= set(by_name)  # dependencias de etapas no planificadas este ciclo
+    pending = dict(by_name)
+    done: dict = {}
+    running: dict = {}
+
+    def _run(st: _Stage) -> None:
+        with _metrics.stage(st.name) as holder:
+            holder['info'] = st.fn()
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='pipe10-stage') as ex:
+        while pending or running:
+            for name in [n for n, st in pending.items() if st.deps <= set(done)]:
+                st = pending.pop(name)
+                running[ex.submit(_run, st)] = name
+            if not running:
+                # Ciclo en las dependencias: no debería pasar, no colgar el loop
+                logger.error(f"Etapas con dependencias irresolubles: {sorted(pending)}")
+                break
+            finished, _ = _wait(list(running), return_when=FIRST_COMPLETED)
+            for fut in finished:
+                name = running.pop(fut)
+                try:
+                    fut.result()
+                    done[name] = True
+                except Exception as e:
+                    done[name] = False
+                    logger.debug(f"Etapa {name} terminó con error: {e}")
+    return done
+
+
+def _run_cycle_stages(limit: Optional[int], limit_acc1: Optional[int], limit_acc2: Optional[int]) -> None:
     # Recargar .env en cada ciclo para tomar cambios en caliente
     try:
         if load_dotenv is not None:
@@ -390,134 +551,116 @@ def run_cycle(limit: Optional[int], limit_acc1: Optional[int] = None, limit_acc2
 
     logger.info("🚀 PIPELINE 10 - Inicio de ciclo")
 
-    # 0) Sync multi-cuenta (paralelo) para asegurar columna MELI de ambas cuentas
-    try:
-        lim_mc = limit if limit is not None else 20
-        # Resolver límites por cuenta (CLI > ENV > global)
-        lim1 = limit_acc1 if limit_acc1 is not None else int(os.getenv("LIMIT_ACC1", str(lim_mc)))
-        lim2 = limit_acc2 if limit_acc2 is not None else int(os.getenv("LIMIT_ACC2", str(lim_mc)))
-        global _CYCLE_NO
-        _sync_multi_accounts(lim1, lim2, cycle_no=_CYCLE_NO)
-    except Exception as e:
-        logger.warning(f"Multi-cuenta: error previo al pipeline 5: {e}")
-
-    # 1) Sync ML (PIPELINE 5). Reprocesa y actualiza si ya existen
-    try:
-        logger.info("📥 Sync ML: obteniendo/actualizando últimas órdenes...")
-
-        # Aplicar filtros por cuenta también a Pipeline 5 usando ONLY_ML_USER_IDS
-        # Detectar user_ids desde los archivos de token
-        base_dir = os.path.dirname(os.path.dirname(__file__))
-        token1 = os.path.join(base_dir, 'config', 'token.json')
-        token2 = os.path.join(base_dir, 'config', 'token_02.json')
-
-        ids_acc1 = _file_user_ids(token1) if os.path.exists(token1) else set()
-        ids_acc2 = _file_user_ids(token2) if os.path.exists(token2) else set()
-        id1 = next(iter(ids_acc1)) if ids_acc1 else '209611492'  # fallback conocido
-        id2 = next(iter(ids_acc2)) if ids_acc2 else '756086955'  # fallback conocido
+    base_dir = os.path.dirname(os.path.dirname(__file__))
+    token1 = os.path.join(base_dir, 'config', 'token.json')
+    token2 = os.path.join(base_dir, 'config', 'token_02.json')
+    token_for = {'acc1': token1, 'acc2': token2}
 
-        # Resolver límites efectivos
-        lim1_eff = limit_acc1 if limit_acc1 is not None else int(os.getenv("LIMIT_ACC1", str(limit if limit is not None else 20)))
-        lim2_eff = limit_acc2 if limit_acc2 is not None else int(os.getenv("LIMIT_ACC2", str(limit if limit is not None else 20)))
+    # Resolver límites por cuenta (CLI > ENV > global)
+    lim_global = limit if limit is not None else 20
+    lim1 = limit_acc1 if limit_acc1 is not None else int(os.getenv("LIMIT_ACC1", str(lim_global)))
+    lim2 = limit_acc2 if limit_acc2 is not None else int(os.getenv("LIMIT_ACC2", str(lim_global)))
 
-        # Si el usuario provee límites por cuenta, damos prioridad y ejecutamos por cuenta
-        per_account_cli = (limit_acc1 is not None) or (limit_acc2 is not None)
+    stages: list = []
 
-        # Guardar valor previo de ONLY_ML_USER_IDS y TOKEN_PATH para restaurar luego
-        only_ids_env_before = os.environ.get('ONLY_ML_USER_IDS')
-        token_path_before = os.environ.get('TOKEN_PATH')
+    # 0) Sync multi-cuenta: una etapa por cuenta, cada una con su token explícito
+    try:
+        sync_mod = _load_sync_script()
+        if sync_mod is None:
+            logger.info("Multi-cuenta: no se pudo cargar process_last_sales_per_meli.py; continuo con pipeline 5 estándar")
+            sync_jobs = []
+        else:
+            sync_jobs = _sync_account_jobs(lim1, lim2, cycle_no=_CYCLE_NO)
+    except Exception as e:
+        logger.warning(f"Multi-cuenta: error previo al pipeline 5: {e}")
+        sync_jobs = []
 
+    def _sync_stage(label: str, token_path: str, lim: int):
+        def _fn():
+            try:
+                return sync_mod.process_orders_from_token(token_path, lim)
+            except Exception as e:
+                logger.warning(f"Multi-cuenta: error en tarea {label}: {e}")
+                raise
+        return _fn
+
+    for label, token_path, lim in sync_jobs:
+        stages.append(_Stage(f"sync:{label}", _sync_stage(label, token_path, lim)))
+
+    # 1) Sync ML (PIPELINE 5). Reprocesa y actualiza si ya existen.
+    #    La cuenta viaja como token_path explícito (antes: ONLY_ML_USER_IDS/TOKEN_PATH en os.environ),
+    #    así acc1 y acc2 pueden correr en paralelo. Cada una espera sólo a su propio sync multi-cuenta.
+    def _p5_stage(label: Optional[str], lim: Optional[int]):
+        token_path = token_for.get(label) if label else None
+        if label and not os.path.exists(token_path):
+            logger.warning(f"TOKEN {label} no encontrado en {token_path}; se usará default")
+            token_path = None
+
+        def _fn():
+            logger.info(f"📥 Sync ML ({label or 'default'}): obteniendo/actualizando últimas órdenes | token={token_path or 'default'} | limit={lim}")
+            try:
+                ok = main_pipeline_5(limit=lim, token_path=token_path) if lim is not None else main_pipeline_5(token_path=token_path)
+                logger.info(f"✅ Sync ML ({label or 'default'}) completado")
+                return ok
+            except Exception as e:
+                logger.error(f"❌ Error en sync ML ({label or 'default'}): {e}")
+                raise
+        return _fn
+
+    per_account_cli = (limit_acc1 is not None) or (limit_acc2 is not None)
+    p5_plan: list = []  # [(label | None, limit | None)]
+    if lim1 <= 0 and lim2 <= 0:
+        logger.info("📥 Pipeline 5 omitido: limit-acc1<=0 y limit-acc2<=0")
+    elif per_account_cli:
+        # Límites por cuenta desde CLI: una corrida por cuenta con su límite efectivo
+        if lim1 > 0:
+            p5_plan.append(('acc1', lim1))
+        if lim2 > 0:
+            p5_plan.append(('acc2', lim2))
+    elif lim1 <= 0:
+        p5_plan.append(('acc2', limit))  # sólo acc2 activa: su token
+    elif lim2 <= 0:
+        p5_plan.append(('acc1', limit))
+    else:
+        # Ambas activas: una sola corrida con el token por defecto y el límite global
+        p5_plan.append((None, limit))
+
+    sync_names = {f"sync:{label}" for label, _tp, _lim in sync_jobs}
+    p5_names = []
+    for label, lim in p5_plan:
+        name = f"pipeline5:{label}" if label else "pipeline5"
+        deps = {f"sync:{label}"} if label else sync_names
+        stages.append(_Stage(name, _p5_stage(label, lim), deps & sync_names))
+        p5_names.append(name)
+    synced = set(p5_names) or sync_names
+
+    # 1.0) Backfill de BARCODES (preferido + todos los alias): necesita las órdenes ya sincronizadas
+    def _barcodes():
         try:
-            if lim1_eff <= 0 and lim2_eff <= 0:
-                logger.info("📥 Pipeline 5 omitido: limit-acc1<=0 y limit-acc2<=0")
-                # no ejecutamos pipeline 5
-            else:
-                if per_account_cli:
-                    # Ejecutar por cuenta según límites efectivos
-                    if lim1_eff > 0:
-                        os.environ['ONLY_ML_USER_IDS'] = str(id1)
-                        # Forzar token de cuenta 1
-                        if os.path.exists(token1):
-                            os.environ['TOKEN_PATH'] = token1
-                            logger.info(f"Pipeline 5 (acc1): ONLY_ML_USER_IDS={id1} | TOKEN_PATH={token1} | limit={lim1_eff}")
-                        else:
-                            logger.warning(f"TOKEN cuenta 1 no encontrado en {token1}; se usará default")
-                        main_pipeline_5(limit=lim1_eff)
-                    if lim2_eff > 0:
-                        os.environ['ONLY_ML_USER_IDS'] = str(id2)
-                        # Forzar token de cuenta 2
-                        if os.path.exists(token2):
-                            os.environ['TOKEN_PATH'] = token2
-                            logger.info(f"Pipeline 5 (acc2): ONLY_ML_USER_IDS={id2} | TOKEN_PATH={token2} | limit={lim2_eff}")
-                        else:
-                            logger.warning(f"TOKEN cuenta 2 no encontrado en {token2}; se usará default")
-                        main_pipeline_5(limit=lim2_eff)
+            if backfill_barcode_all:
+                max_rows = int(os.getenv("PIPE10_BARCODE_MAX_ROWS", "100"))
+                days_win = int(os.getenv("PIPE10_BARCODE_DAYS", "60"))
+                logger.info(f"🧾 Barcodes: completando hasta {max_rows} órdenes (últimos {days_win} días)...")
+                n = backfill_barcode_all(max_rows=max_rows, days_window=days_win, account=None)
+                if n:
+                    logger.info(f"🧾 Barcodes: completadas {n} órdenes")
                 else:
-                    # Mantener comportamiento previo usando --limit global
-                    if lim1_eff <= 0 and lim2_eff > 0:
-                        os.environ['ONLY_ML_USER_IDS'] = str(id2)
-                        # Si solo acc2 activa, preferir su token
-                        if os.path.exists(token2):
-                            os.environ['TOKEN_PATH'] = token2
-                            logger.info(f"TOKEN_PATH forzado para acc2: {token2}")
-                        logger.info(f"Filtro aplicado a Pipeline 5: ONLY_ML_USER_IDS={id2} (acc1 deshabilitada)")
-                    elif lim2_eff <= 0 and lim1_eff > 0:
-                        os.environ['ONLY_ML_USER_IDS'] = str(id1)
-                        if os.path.exists(token1):
-                            os.environ['TOKEN_PATH'] = token1
-                            logger.info(f"TOKEN_PATH forzado para acc1: {token1}")
-                        logger.info(f"Filtro aplicado a Pipeline 5: ONLY_ML_USER_IDS={id1} (acc2 deshabilitada)")
-                    else:
-                        # Ambas activas: limpiar filtro para que procese ambas
-                        if 'ONLY_ML_USER_IDS' in os.environ:
-                            os.environ.pop('ONLY_ML_USER_IDS', None)
-                            logger.info("Filtro ONLY_ML_USER_IDS limpiado para Pipeline 5 (ambas cuentas activas)")
-
-                    # Ejecutar Pipeline 5 una sola vez con el límite global
-                    if limit is None:
-                        main_pipeline_5()  # usa defaults internos
-                    else:
-                        main_pipeline_5(limit=limit)
-        finally:
-            # Restaurar ONLY_ML_USER_IDS/TOKEN_PATH previos si existían, si no, limpiar
-            if only_ids_env_before is not None:
-                os.environ['ONLY_ML_USER_IDS'] = only_ids_env_before
-            else:
-                if 'ONLY_ML_USER_IDS' in os.environ:
-                    os.environ.pop('ONLY_ML_USER_IDS', None)
-            if token_path_before is not None:
-                os.environ['TOKEN_PATH'] = token_path_before
-            else:
-                if 'TOKEN_PATH' in os.environ:
-                    os.environ.pop('TOKEN_PATH', None)
-        logger.info("✅ Sync ML completado")
-    except Exception as e:
-        logger.error(f"❌ Error en sync ML: {e}")
-
-    # 1.0) Backfill de BARCODES (preferido + todos los alias)
-    try:
-        if backfill_barcode_all:
-            max_rows = int(os.getenv("PIPE10_BARCODE_MAX_ROWS", "100"))
-            days_win = int(os.getenv("PIPE10_BARCODE_DAYS", "60"))
-            logger.info(f"🧾 Barcodes: completando hasta {max_rows} órdenes (últimos {days_win} días)...")
-            n = backfill_barcode_all(max_rows=max_rows, days_window=days_win, account=None)
-            if n:
-                logger.info(f"🧾 Barcodes: completadas {n} órdenes")
-            else:
-                logger.info("🧾 Barcodes: no había pendientes para completar")
-        else:
+                    logger.info("🧾 Barcodes: no había pendientes para completar")
+                return n
             logger.debug("🧾 Barcodes: módulo no disponible; se omite")
-    except Exception as e:
-        logger.warning(f"🧾 Barcodes: error en backfill: {e}")
+        except Exception as e:
+            logger.warning(f"🧾 Barcodes: error en backfill: {e}")
+            raise
 
-    # 1.1) Backfill de NOTAS para las últimas N órdenes sincronizadas
-    try:
-        lim = limit if limit is not None else 50
-        skip_notes = str(os.getenv("PIPE10_SKIP_NOTES", "0")).strip().lower() in {"1", "true", "yes"}
-        logger.debug(f"Notas: PIPE10_SKIP_NOTES efectivo = {os.getenv('PIPE10_SKIP_NOTES')}")
-        if skip_notes:
-            logger.info("📝 Notas: salteadas por PIPE10_SKIP_NOTES=1")
-        else:
+    # 1.1) Backfill de NOTAS: independiente de barcodes/asignación
+    def _notes():
+        try:
+            lim = limit if limit is not None else 50
+            skip_notes = str(os.getenv("PIPE10_SKIP_NOTES", "0")).strip().lower() in {"1", "true", "yes"}
+            logger.debug(f"Notas: PIPE10_SKIP_NOTES efectivo = {os.getenv('PIPE10_SKIP_NOTES')}")
+            if skip_notes:
+                logger.info("📝 Notas: salteadas por PIPE10_SKIP_NOTES=1")
+                return None
             logger.info(f"📝 Notas: iniciando actualización para últimas {lim} órdenes...")
             n = update_notes_recent(lim)
             logger.info("📝 Notas: finalizó actualización")
@@ -525,29 +668,79 @@ def run_cycle(limit: Optional[int], limit_acc1: Optional[int] = None, limit_acc2
                 logger.info(f"📝 Notas actualizadas para {n} órdenes recientes")
             else:
                 logger.info("📝 Notas: no hubo órdenes para actualizar o no se encontraron notas")
-    except Exception as e:
-        logger.error(f"❌ Error actualizando notas: {e}")
+            return n
+        except Exception as e:
+            logger.error(f"❌ Error actualizando notas: {e}")
+            raise
 
-    # 2) Asignación + Movimiento (idempotente, espera respuesta Dragonfish)
-    try:
-        logger.info("🏷️ Asignación + Movimiento: procesando pendientes...")
-        processed = assign_pending()
-        logger.info(f"✅ Asignación/Movimiento completado. Órdenes procesadas: {processed}")
-    except Exception as e:
-        logger.error(f"❌ Error en asignación/movimiento: {e}")
+    # 2) Asignación + Movimiento (idempotente, espera respuesta Dragonfish): usa el barcode de la orden
+    def _assign():
+        try:
+            logger.info("🏷️ Asignación + Movimiento: procesando pendientes...")
+            with _ASSIGN_LOCK:
+                processed = assign_pending()
+            logger.info(f"✅ Asignación/Movimiento completado. Órdenes procesadas: {processed}")
+            return processed
+        except Exception as e:
+            logger.error(f"❌ Error en asignación/movimiento: {e}")
+            raise
+
+    # 3) Backfill de visibilidad de stock por depósito (no toca flags): después de asignar
+    def _stock_backfill():
+        try:
+            updated = backfill_stock_columns(max_rows=20)
+            if updated:
+                logger.info(f"🧩 Backfill de stock por depósito aplicado a {updated} órdenes")
+            return updated
+        except Exception as e:
+            logger.error(f"❌ Error en backfill de stock: {e}")
+            raise
+
+    stages.append(_Stage('barcodes', _barcodes, synced))
+    stages.append(_Stage('notes', _notes, synced))
+    stages.append(_Stage('assign', _assign, synced | {'barcodes'}))
+    stages.append(_Stage('stock_backfill', _stock_backfill, {'assign'}))
 
-    # 3) Backfill de visibilidad de stock por depósito (no toca flags)
     try:
-        updated = backfill_stock_columns(max_rows=20)
-        if updated:
-            logger.info(f"🧩 Backfill de stock por depósito aplicado a {updated} órdenes")
-    except Exception as e:
-        logger.error(f"❌ Error en backfill de stock: {e}")
+        workers = max(1, int(os.getenv("PIPE10_STAGE_WORKERS", "3")))
+    except Exception:
+        workers = 3
+    _run_stages(stages, workers)
 
     logger.info(f"🎯 MOVIMIENTO_TARGET actual: {MOVIMIENTO_TARGET}")
     logger.info("🏁 PIPELINE 10 - Fin de ciclo")
 
 
+def _profile_cycle(limit: Optional[int], limit_acc1: Optional[int], limit_acc2: Optional[int]) -> None:
+    """Un ciclo bajo cProfile. Deja en logs/ el .prof (abrible con snakeviz o flameprof)
+    y un .txt con las funciones ordenadas por tiempo acumulado y propio."""
+    import cProfile
+    import io
+    import pstats
+
+    out_dir = os.path.join(BASE_DIR, 'logs')
+    os.makedirs(out_dir, exist_ok=True)
+    stamp = time.strftime('%Y%m%d_%H%M%S')
+    prof_path = os.path.join(out_dir, f'pipeline10_cycle_{stamp}.prof')
+    txt_path = os.path.join(out_dir, f'pipeline10_cycle_{stamp}.txt')
+
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        run_cycle(limit=limit, limit_acc1=limit_acc1, limit_acc2=limit_acc2)
+    finally:
+        prof.disable()
+        prof.dump_stats(prof_path)
+        buf = io.StringIO()
+        stats = pstats.Stats(prof, stream=buf).strip_dirs()
+        buf.write("==== Por tiempo acumulado ====\n")
+        stats.sort_stats('cumulative').print_stats(60)
+        buf.write("\n==== Por tiempo propio ====\n")
+        stats.sort_stats('tottime').print_stats(40)
+        with open(txt_path, 'w', encoding='utf-8') as f:
+            f.write(buf.getvalue())
+        logger.info(f"🔬 Perfil del ciclo: {prof_path} | {txt_path}")
+
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="PIPELINE 10 ESTABLE - Loop de sync+asignación+movimiento")
@@ -557,6 +750,7 @@ def main() -> None:
     parser.add_argument("--once", action="store_true", help="Ejecuta un solo ciclo y termina")
     parser.add_argument("--limit-acc1", dest="limit_acc1", type=int, default=None, help="Límite por ciclo para la cuenta 1 (config/token.json)")
     parser.add_argument("--limit-acc2", dest="limit_acc2", type=int, default=None, help="Límite por ciclo para la cuenta 2 (config/token_02.json)")
+    parser.add_argument("--profile", action="store_true", help="Ejecuta un solo ciclo bajo cProfile y guarda el reporte en logs/")
     args = parser.parse_args()
 
     setup_logging(args.log)
@@ -570,9 +764,16 @@ def main() -> None:
     logger.info("============================================")
 
     try:
-        if args.once:
+        if args.profile:
+            _profile_cycle(limit=args.limit, limit_acc1=args.limit_acc1, limit_acc2=args.limit_acc2)
+        elif args.once:
             run_cycle(limit=args.limit, limit_acc1=args.limit_acc1, limit_acc2=args.limit_acc2)
         else:
+            # Asignación por evento en paralelo al loop (PIPE10_EVENT_ASSIGN=0 la desactiva)
+            stop_events = threading.Event()
+            if str(os.getenv("PIPE10_EVENT_ASSIGN", "1")).strip().lower() in {"1", "true", "yes"} and _assign_queue is not None:
+                threading.Thread(target=_event_assign_loop, args=(stop_events,), name='pipe10-event-assign', daemon=True).start()
+                logger.info("⚡ Asignación por evento activa (cola dbo.assign_queue); el ciclo queda como barrido de reconciliación")
             while True:
                 # Usar reloj monotónico para evitar problemas si el reloj del sistema cambia
                 start = time.monotonic()
@@ -22,6 +22,7 @@ Versión: Pipeline 5 Consolidado
 
 import sys
 import os
+import threading
 from datetime import datetime
 
 # Agregar paths priorizando este directorio (local) para usar el cliente correcto
@@ -35,9 +36,16 @@ MODULES_DIR = os.path.join(ROOT_DIR, 'modules')
 if MODULES_DIR not in sys.path:
     sys.path.insert(1, MODULES_DIR)
 
-def main_pipeline_5(limit: int = 20):
+# PIPELINE_10 puede correr una instancia por cuenta en paralelo: la normalización de
+# multiventa recorre toda la base, mejor de a una
+_NORMALIZE_LOCK = threading.Lock()
+
+def main_pipeline_5(limit: int = 20, token_path: str = None):
     """
     Ejecuta el pipeline 5 consolidado completo.
+
+    token_path: token de la cuenta a sincronizar. Si no se indica, MeliClient usa
+    TOKEN_PATH / el token por defecto (comportamiento anterior).
     
     Funcionalidades:
     - Obtiene órdenes reales de MercadoLibre
@@ -58,9 +66,13 @@ def main_pipeline_5(limit: int = 20):
         print("-" * 60)
         
         from meli_client_pure_real import get_recent_orders_pure_real
+        from meli_client_01 import MeliClient
+        
+        # Un solo cliente (y su token) para toda la corrida de esta cuenta
+        meli_client = MeliClient(config_path=token_path)
         
         # Obtener N órdenes reales (param)
-        recent_orders = get_recent_orders_pure_real(limit=limit)
+        recent_orders = get_recent_orders_pure_real(limit=limit, client=meli_client)
         
         if not recent_orders:
             print("❌ No se pudieron obtener órdenes reales")
@@ -74,11 +86,6 @@ def main_pipeline_5(limit: int = 20):
         
         # Importar módulos necesarios
         from pipeline_processor import process_orders_batch
-        from meli_client_01 import MeliClient
-        
-        # 🔥 CREAR CLIENTE MERCADOLIBRE PARA CONSULTAS ADICIONALES
-        print("🚀 Inicializando cliente MercadoLibre para consultas de shipping y multiventas...")
-        meli_client = MeliClient()
         
         # 🔥 PROCESAR TODAS LAS ÓRDENES CON CLIENTE MERCADOLIBRE
         result = process_orders_batch(recent_orders, meli_client)
@@ -97,7 +104,8 @@ def main_pipeline_5(limit: int = 20):
         print(f"\n🔗 PASO 4: Normalizando multiventa y relaciones en base...")
         print("-" * 60)
         from database_utils import normalize_multiventa_and_relacion
-        norm = normalize_multiventa_and_relacion()
+        with _NORMALIZE_LOCK:
+            norm = normalize_multiventa_and_relacion()
         print(
             f"   Packs>1: {norm.get('set_multiventa_pack',0)}; Qty>1: {norm.get('set_multiventa_qty',0)}; "
             f"Rel(pack): {norm.get('set_rel_pack',0)}; Rel(qty): {norm.get('set_rel_qty',0)}; Limpios(singletons): {norm.get('cleared_singleton_rel',0)}"
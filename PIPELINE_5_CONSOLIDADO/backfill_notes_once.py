@@ -11,6 +11,7 @@ Uso:
   python backfill_notes_once.py --order <id>  # actualiza una orden específica
 """
 import argparse
+import hashlib
 import os
 import json
 import requests
@@ -309,6 +310,337 @@ def _fetch_merchant_comments_from_pack(order_id: str) -> str:
         return ''
 
 
+class NotesFetchError(Exception):
+    """La consulta a ML no dio una respuesta utilizable (sin token, red, 401, 429, 5xx, JSON
+    inválido). Distinto de una nota vacía: quien llama no debe pisar la nota guardada."""
+
+
+class NotesFetcher:
+    """Cadena de fetchers de notas para UNA cuenta, pensada para usarse desde varios hilos.
+
+    A diferencia de las funciones sueltas de arriba (que releen token.json en cada llamada):
+    - token y seller_id se cargan una vez y se cachean (refresh serializado ante 401);
+    - una requests.Session con pool para todos los hilos;
+    - /orders/{id} se pide una sola vez por orden y se reutiliza para comments, pack_id,
+      merchant_orders y mensajes; los textos por pack se memoizan (órdenes del mismo pack)
+      hasta el próximo reset_pack_cache() (uno por corrida).
+
+    Los fetchers devuelven '' sólo cuando ML responde que no hay texto (200 vacío, 403/404);
+    cualquier otra falla levanta NotesFetchError.
+    """
+
+    # Respuestas que significan "no hay nada para esta orden/pack", no una falla
+    _EMPTY_STATUSES = (403, 404)
+
+    _ML = "https://api.mercadolibre.com"
+
+    def __init__(self, token_path: str, user_id: str | None = None, timeout: float = 20.0, pool_size: int = 8):
+        import threading
+        from requests.adapters import HTTPAdapter
+        self.token_path = token_path
+        self.user_id = str(user_id) if user_id else None
+        self.timeout = float(timeout)
+        self._lock = threading.Lock()
+        self._token = ''
+        self._seller_id: str | None = None
+        self._pack_text_cache: dict[str, str] = {}
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max(2, pool_size))
+        self.session.mount('https://', adapter)
+        try:
+            from modules import pipeline_metrics as _metrics  # type: ignore
+            _metrics.instrument_session(self.session, 'ml')
+        except Exception:
+            pass
+        self._load_token()
+
+    # ---- auth ----
+    def _read_file(self) -> dict:
+        try:
+            with open(self.token_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except Exception:
+            return {}
+
+    def _load_token(self) -> None:
+        data = self._read_file()
+        tok = data.get('access_token') or ''
+        if not tok and self.user_id:
+            # Formato {"user_tokens": {"<uid>": {...}}} o {"<uid>": {...}}
+            nested = (data.get('user_tokens') or {}).get(self.user_id) or data.get(self.user_id) or {}
+            tok = nested.get('access_token') or '' if isinstance(nested, dict) else ''
+        self._token = str(tok).replace('\n', '').replace('\r', '').strip()
+        if not self._seller_id and data.get('user_id'):
+            self._seller_id = str(data.get('user_id'))
+
+    def _refresh(self, token_before: str) -> bool:
+        with self._lock:
+            if self._token and self._token != token_before:
+                return True  # otro hilo ya refrescó
+            data = self._read_file()
+            file_tok = str(data.get('access_token') or '').strip()
+            if file_tok and file_tok != token_before:
+                # Otro proceso ya refrescó y guardó el archivo
+                self._token = file_tok
+                return True
+            rt = data.get('refresh_token')
+            cid = data.get('client_id') or os.getenv('ML_CLIENT_ID') or DEFAULT_CLIENT_ID
+            cs = data.get('client_secret') or os.getenv('ML_CLIENT_SECRET') or DEFAULT_CLIENT_SECRET
+            if not (rt and cid and cs):
+                return False
+            try:
+                resp = self.session.post(
+                    f'{self._ML}/oauth/token',
+                    data={'grant_type': 'refresh_token', 'client_id': cid, 'client_secret': cs, 'refresh_token': rt},
+                    timeout=self.timeout,
+                )
+                if resp.status_code != 200:
+                    print(f"[auth] Refresh falló {resp.status_code}: {resp.text[:200]}")
+                    return False
+                td = resp.json()
+                data['access_token'] = td.get('access_token', data.get('access_token', ''))
+                if 'refresh_token' in td:
+                    data['refresh_token'] = td.get('refresh_token')
+                with open(self.token_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, indent=2, ensure_ascii=False)
+                self._token = str(data['access_token'] or '').strip()
+                return bool(self._token)
+            except Exception as e:
+                print(f"[auth] Excepción refrescando token: {e}")
+                return False
+
+    def _get(self, url: str, params: dict | None = None):
+        """GET autenticado con un reintento tras refresh; None si no hay token o falla la red."""
+        tok = self._token
+        if not tok:
+            return None
+        try:
+            resp = self.session.get(url, headers={'Authorization': f'Bearer {tok}'}, params=params, timeout=self.timeout)
+            if resp.status_code == 401 and self._refresh(tok):
+                resp = self.session.get(url, headers={'Authorization': f'Bearer {self._token}'}, params=params, timeout=self.timeout)
+            if DEBUG:
+                print(f"[get] {url} status={resp.status_code} body={resp.text[:400]}")
+            return resp
+        except Exception:
+            return None
+
+    def _get_json(self, url: str, params: dict | None = None):
+        """Como _get pero clasificando la respuesta: JSON si 200, None si ML dice que no hay
+        nada (403/404) y NotesFetchError ante cualquier otra cosa (sin respuesta, 401 tras
+        refresh, 429, 5xx, cuerpo no JSON)."""
+        resp = self._get(url, params)
+        if resp is None:
+            raise NotesFetchError(f"sin respuesta de {url}")
+        if resp.status_code in self._EMPTY_STATUSES:
+            return None
+        if resp.status_code != 200:
+            raise NotesFetchError(f"HTTP {resp.status_code} en {url}")
+        try:
+            return resp.json()
+        except Exception as e:
+            raise NotesFetchError(f"JSON inválido en {url}: {e}") from e
+
+    def seller_id(self) -> str | None:
+        if self._seller_id:
+            return self._seller_id
+        data = self._get_json(f"{self._ML}/users/me")
+        if isinstance(data, dict):
+            with self._lock:
+                self._seller_id = str(data.get('id') or '') or None
+        return self._seller_id
+
+    def reset_pack_cache(self) -> None:
+        """Olvida los textos memoizados por pack (el fetcher vive entre ciclos)."""
+        with self._lock:
+            self._pack_text_cache.clear()
+
+    # ---- fetchers ----
+    def probe_notes(self, order_id: str) -> str:
+        """/orders/{id}/notes (role=seller): la consulta barata que se hace primero."""
+        data = self._get_json(f"{self._ML}/orders/{order_id}/notes", {"role": "seller"})
+        if data is None:
+            return ''
+        notes_list: list[dict] = []
+        for item in (data if isinstance(data, list) else [data]):
+            if not isinstance(item, dict):
+                continue
+            res = item.get('results') if 'results' in item else item
+            if isinstance(res, list):
+                notes_list.extend([r for r in res if isinstance(r, dict)])
+            elif isinstance(res, dict):
+                notes_list.append(res)
+        texts = [(n.get('note') or n.get('text') or n.get('plain_text') or '').strip() for n in notes_list]
+        return ' | '.join(t for t in texts if t)
+
+    def _pack_merchant_comments(self, pack_id: str) -> str:
+        m_js = self._get_json(f"{self._ML}/merchant_orders/search", {"pack_id": pack_id}) or {}
+        results = m_js.get('results') if isinstance(m_js, dict) else None
+        texts = [it.get('comments') for it in (results or []) if isinstance(it, dict)]
+        return ' | '.join(t for t in texts if isinstance(t, str) and t)
+
+    def _pack_last_message(self, pack_id: str) -> str:
+        seller = self.seller_id()
+        if not seller:
+            raise NotesFetchError("seller_id no disponible para leer mensajes del pack")
+        mjs = self._get_json(f"{self._ML}/messages/packs/{pack_id}/sellers/{seller}")
+        texts: list[str] = []
+        arr = None
+        if isinstance(mjs, dict):
+            if isinstance(mjs.get('messages'), list):
+                arr = mjs['messages']
+            elif isinstance(mjs.get('results'), list):
+                arr = mjs['results']
+        for it in arr or []:
+            if isinstance(it, dict):
+                t = (it.get('text') or it.get('plain') or it.get('message') or '')
+                if isinstance(t, dict):
+                    t = t.get('text') or t.get('plain') or ''
+                t = str(t).strip()
+                if t:
+                    texts.append(t)
+        return texts[-1] if texts else ''
+
+    def _pack_text(self, pack_id: str) -> str:
+        # Si alguna consulta falla la excepción sale antes de memoizar: no se cachean fallas
+        with self._lock:
+            if pack_id in self._pack_text_cache:
+                return self._pack_text_cache[pack_id]
+        text = self._pack_merchant_comments(pack_id) or self._pack_last_message(pack_id)
+        with self._lock:
+            self._pack_text_cache[pack_id] = text
+        return text
+
+    def fetch(self, order_id: str, probe: str | None = None) -> str:
+        """Misma prioridad que el script: notes → comments → merchant_orders del pack → mensajes del pack.
+
+        Levanta NotesFetchError si alguna consulta de la cadena falla."""
+        n = self.probe_notes(order_id) if probe is None else probe
+        if n:
+            return n
+        o_js = self._get_json(f"{self._ML}/orders/{order_id}") or {}
+        if not isinstance(o_js, dict):
+            return ''
+        comments = o_js.get('comments')
+        if isinstance(comments, str) and comments:
+            return comments
+        pack_id = o_js.get('pack_id')
+        return self._pack_text(str(pack_id)) if pack_id else ''
+
+
+def nota_hash(nota: str | None) -> str | None:
+    return hashlib.sha1(nota.encode('utf-8')).hexdigest() if nota else None
+
+
+def _norm_nota(v) -> str | None:
+    v = (v or '').strip() if isinstance(v, str) else v
+    return v or None
+
+
+def refresh_notes(fetcher: NotesFetcher, current: dict, known_hash: dict, workers: int = 8,
+                  deadline_secs: float = 120.0) -> dict:
+    """Una ola de refresco para una cuenta (lo que usa PIPELINE_10 en cada ciclo).
+
+    current: order_id -> nota guardada; known_hash: order_id -> hash de referencia.
+    Primero /notes: si su hash coincide con el conocido no se sigue la cadena.
+    Devuelve dict con:
+    - changes: [(order_id, nota)] cuya nota cambió (para orders_meli);
+    - fetched: [(order_id, hash)] consultadas bien (índice de frescura, fallos = 0);
+    - failed:  [(order_id, hash conocido)] cuyo fetch levantó (fallos + 1, nota intacta);
+    - errors:  [(order_id, mensaje)], probed_same y pending (sin respuesta en el deadline).
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait
+
+    fetcher.reset_pack_cache()  # textos por pack: válidos sólo dentro de esta corrida
+
+    def _one(oid: str):
+        probe = _norm_nota(fetcher.probe_notes(oid))
+        if probe is not None and nota_hash(probe) == known_hash.get(oid):
+            return oid, probe, True  # sin cambios: no seguir la cadena
+        return oid, _norm_nota(fetcher.fetch(oid, probe or '')), False
+
+    out: dict = {'changes': [], 'fetched': [], 'failed': [], 'errors': [], 'probed_same': 0, 'pending': 0}
+    if not current:
+        return out
+    ex = ThreadPoolExecutor(max_workers=max(1, min(workers, len(current))))
+    try:
+        fut_oid = {ex.submit(_one, oid): oid for oid in current}
+        done, pending = wait(list(fut_oid), timeout=deadline_secs)
+        for fut in pending:
+            fut.cancel()
+        out['pending'] = len(pending)
+        for fut in done:
+            try:
+                oid, nota, same = fut.result()
+            except Exception as e:
+                oid = fut_oid[fut]
+                out['errors'].append((oid, str(e)))
+                out['failed'].append((oid, known_hash.get(oid)))
+                continue
+            out['fetched'].append((oid, nota_hash(nota)))
+            if same:
+                out['probed_same'] += 1
+            elif nota != current.get(oid):
+                out['changes'].append((oid, nota))
+    finally:
+        ex.shutdown(wait=False, cancel_futures=True)
+    return out
+
+
+def write_notes_batch(cur, changes: list) -> None:
+    """Un UPDATE por chunk (JOIN contra VALUES) en lugar de un UPDATE+commit por orden."""
+    for i in range(0, len(changes), 500):
+        chunk = changes[i:i + 500]
+        values = ",".join(["(?, ?)"] * len(chunk))
+        params = [p for oid, nota in chunk for p in (oid, nota)]
+        cur.execute(
+            "UPDATE o SET nota = CAST(v.nota AS NVARCHAR(MAX)), fecha_actualizacion = GETDATE() "
+            f"FROM orders_meli o JOIN (VALUES {values}) v(order_id, nota) ON o.order_id = v.order_id",
+            params,
+        )
+
+
+def touch_notes_index(cur, fetched: list) -> None:
+    """Registra (order_id, hash) consultados en notas_frescura con fetched_at = ahora."""
+    for i in range(0, len(fetched), 500):
+        chunk = fetched[i:i + 500]
+        values = ",".join(["(?, ?)"] * len(chunk))
+        params = [p for oid, h in chunk for p in (oid, h)]
+        cur.execute(
+            "MERGE notas_frescura WITH (HOLDLOCK) AS t "
+            f"USING (VALUES {values}) AS v(order_id, nota_hash) ON t.order_id = v.order_id "
+            "WHEN MATCHED THEN UPDATE SET nota_hash = v.nota_hash, fetched_at = GETDATE(), fallos = 0 "
+            "WHEN NOT MATCHED THEN INSERT (order_id, nota_hash, fetched_at) VALUES (v.order_id, v.nota_hash, GETDATE());",
+            params,
+        )
+
+
+def touch_notes_failed(cur, failed: list) -> None:
+    """Registra intentos fallidos (order_id, hash de la nota guardada): fetched_at = ahora y
+    fallos + 1, conservando el hash previo. Así no vuelven a ordenarse primeras cada ciclo."""
+    for i in range(0, len(failed), 500):
+        chunk = failed[i:i + 500]
+        values = ",".join(["(?, ?)"] * len(chunk))
+        params = [p for oid, h in chunk for p in (oid, h)]
+        cur.execute(
+            "MERGE notas_frescura WITH (HOLDLOCK) AS t "
+            f"USING (VALUES {values}) AS v(order_id, nota_hash) ON t.order_id = v.order_id "
+            "WHEN MATCHED THEN UPDATE SET fetched_at = GETDATE(), fallos = t.fallos + 1 "
+            "WHEN NOT MATCHED THEN INSERT (order_id, nota_hash, fetched_at, fallos) VALUES (v.order_id, v.nota_hash, GETDATE(), 1);",
+            params,
+        )
+
+
+def write_notes_results(cur, result: dict) -> None:
+    """Persiste una ola de refresh_notes (sin commit): notas cambiadas, índice y fallidas."""
+    if result.get('changes'):
+        write_notes_batch(cur, result['changes'])
+    if result.get('fetched'):
+        touch_notes_index(cur, result['fetched'])
+    if result.get('failed'):
+        touch_notes_failed(cur, result['failed'])
+
+
 essql_last = (
     "SELECT TOP 1 order_id FROM orders_meli ORDER BY date_created DESC"
 )
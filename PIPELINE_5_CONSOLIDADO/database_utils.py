@@ -6,9 +6,23 @@ Manejo de base de datos para órdenes reales de MercadoLibre.
 """
 
 import os
+import threading
+import time
 import pyodbc
 from typing import Dict, Optional, List
-from datetime import datetime
+from datetime import datetime, timedelta
+
+# Métricas por ciclo de PIPELINE_10 (opcional)
+try:
+    from modules import pipeline_metrics as _metrics  # type: ignore
+except Exception:
+    _metrics = None
+
+# Cola de asignación inmediata para órdenes que pasan a ready_to_print (opcional)
+try:
+    from modules import assign_queue as _assign_queue  # type: ignore
+except Exception:
+    _assign_queue = None
 
 # Connection string para SQL Server Express
 CONNECTION_STRING = (
@@ -27,22 +41,42 @@ CONNECTION_STRING_ACC2 = os.getenv(
     CONNECTION_STRING.replace("DATABASE=meli_stock", "DATABASE=meli_stock_acc2"),
 )
 
+# Bases (connection strings) en las que ensure_schema ya corrió en este proceso
+_SCHEMA_READY: set = set()
+_SCHEMA_LOCK = threading.Lock()
+
 def get_connection() -> pyodbc.Connection:
     """Obtiene conexión a la base por defecto (meli_stock)."""
     return pyodbc.connect(CONNECTION_STRING)
 
-def get_connection_for_meli(meli_user_id: Optional[int]) -> pyodbc.Connection:
-    """
-    Devuelve una conexión según el seller (MELI). Si está habilitado acc2 y el user coincide,
-    usa la base meli_stock_acc2; si no, usa la base por defecto meli_stock.
-    """
+def _conn_str_for_meli(meli_user_id: Optional[int]) -> str:
+    """Connection string según el seller (MELI): acc2 si está habilitado y coincide, si no meli_stock."""
     try:
         if ACC2_ENABLED and meli_user_id is not None and int(meli_user_id) == int(ACC2_USER_ID):
-            return pyodbc.connect(CONNECTION_STRING_ACC2)
+            return CONNECTION_STRING_ACC2
     except Exception:
         # fallback seguro
         pass
-    return pyodbc.connect(CONNECTION_STRING)
+    return CONNECTION_STRING
+
+def get_connection_for_meli(meli_user_id: Optional[int]) -> pyodbc.Connection:
+    """
+    Devuelve una conexión según el seller (MELI). Si está habilitado acc2 y el user coincide,
+    usa la base meli_stock_acc2; si no, usa la base por defecto meli_stock.
+    """
+    return pyodbc.connect(_conn_str_for_meli(meli_user_id))
+
+def ensure_schema_once(cursor, conn_str: str = CONNECTION_STRING) -> None:
+    """Corre ensure_schema una sola vez por proceso y por base (las ~25 verificaciones de
+    INFORMATION_SCHEMA no se repiten en cada orden). Si falla, se reintenta la próxima vez."""
+    if conn_str in _SCHEMA_READY:
+        return
+    with _SCHEMA_LOCK:
+        if conn_str in _SCHEMA_READY:
+            return
+        ensure_schema(cursor)
+        cursor.commit()
+        _SCHEMA_READY.add(conn_str)
 
 def ensure_schema(cursor) -> None:
     """Asegura columnas requeridas en orders_meli."""
@@ -388,6 +422,37 @@ def ensure_schema(cursor) -> None:
         """
     )
 
+    # Índice de frescura de notas (PIPELINE_10 update_notes_recent): hash de la última nota
+    # leída de ML y cuándo se consultó (o se intentó: fallos = intentos fallidos seguidos,
+    # para espaciar los reintentos). Tabla aparte para no reescribir filas de orders_meli
+    # cuando la nota no cambió.
+    cursor.execute(
+        """
+        IF NOT EXISTS (
+            SELECT 1 FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'notas_frescura'
+        )
+        BEGIN
+            CREATE TABLE notas_frescura (
+                order_id NVARCHAR(50) NOT NULL PRIMARY KEY,
+                nota_hash CHAR(40) NULL,
+                fetched_at DATETIME NOT NULL DEFAULT(GETDATE()),
+                fallos INT NOT NULL DEFAULT(0)
+            );
+        END
+        """
+    )
+    cursor.execute(
+        """
+        IF NOT EXISTS (
+            SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
+            WHERE TABLE_NAME = 'notas_frescura' AND COLUMN_NAME = 'fallos'
+        )
+        BEGIN
+            ALTER TABLE notas_frescura ADD fallos INT NOT NULL DEFAULT(0);
+        END
+        """
+    )
+
 def insert_or_update_order(order_data: Dict) -> str:
     """
     Inserta o actualiza una orden en la base de datos.
@@ -404,7 +469,7 @@ def insert_or_update_order(order_data: Dict) -> str:
         meli_user_id = order_data.get('meli_user_id')
         with get_connection_for_meli(meli_user_id) as conn:
             cursor = conn.cursor()
-            ensure_schema(cursor)
+            ensure_schema_once(cursor, _conn_str_for_meli(meli_user_id))
             
             # Verificar si la orden existe
             cursor.execute(
@@ -619,13 +684,217 @@ def insert_or_update_order(order_data: Dict) -> str:
         print(f"❌ Error insert/update: {e}")
         return 'error'
 
+# Columnas que se cargan en la tabla temporal de upsert_orders (mismo orden que _stage_row)
+_STAGE_COLS = [
+    'order_id', 'MELI', 'sku', 'seller_sku', 'barcode', 'item_id', 'pack_id', 'qty', 'total_amount',
+    'multiventa_grupo', 'is_pack_complete', 'venta_tipo',
+    'estado', 'subestado', 'shipping_id', 'shipping_estado', 'shipping_subestado',
+    'date_created', 'date_closed', 'display_color', 'nombre', 'ARTICULO', 'COLOR', 'TALLE',
+    'asignado_flag', 'movimiento_realizado', 'fecha_actualizacion',
+]
+
+def _date_created_adj(order_data: Dict):
+    """Ajuste horario: sumar +1 hora a date_created si es parseable (igual que insert_or_update_order)."""
+    try:
+        dc_val = order_data.get('date_created')
+        dc_dt = datetime.fromisoformat(dc_val) if isinstance(dc_val, str) else dc_val
+        return dc_dt + timedelta(hours=1) if dc_dt is not None else dc_val
+    except Exception:
+        return order_data.get('date_created')
+
+def _stage_row(order_data: Dict) -> tuple:
+    return (
+        order_data['order_id'],
+        order_data.get('meli_user_id'),
+        order_data['sku'],
+        order_data['seller_sku'],
+        order_data['barcode'],
+        order_data['item_id'],
+        order_data['pack_id'],
+        order_data['quantity'],
+        order_data['total_amount'],
+        order_data.get('multiventa_grupo'),
+        1 if order_data.get('is_pack_complete') else 0,
+        order_data.get('venta_tipo'),
+        order_data['status'],
+        order_data['substatus'],
+        order_data['shipping_id'],
+        order_data['shipping_estado'],
+        order_data['shipping_subestado'],
+        order_data['date_created'],
+        order_data['date_closed'],
+        order_data['display_color'],
+        order_data.get('nombre'),
+        order_data.get('articulo'),
+        order_data.get('color'),
+        order_data.get('talle'),
+        order_data['asignado_flag'],
+        order_data['movimiento_realizado'],
+        order_data['fecha_actualizacion'],
+        _date_created_adj(order_data),
+    )
+
+# Un solo MERGE con la misma lógica que insert_or_update_order:
+# - orden ya asignada (alguna fila con asignado_flag=1): sólo estado/shipping/fechas/color/nombre,
+#   liberar reserva si pasa a printed y CAMBIO_ESTADO=1 en la transición a printed
+# - orden sin asignar: actualización completa (date_created con +1h)
+# - orden nueva: INSERT con CAMBIO_ESTADO=0 y mov_depo_* en NULL
+_UPSERT_MERGE_SQL = """
+MERGE orders_meli WITH (HOLDLOCK) AS t
+USING (
+    SELECT s.*,
+           COALESCE(a.assigned, 0) AS _assigned,
+           CASE WHEN s.shipping_subestado = 'printed' AND COALESCE(a.not_printed, 0) = 1 THEN 1 ELSE 0 END AS _becomes_printed
+    FROM #orders_stage s
+    LEFT JOIN (
+        SELECT order_id,
+               MAX(CASE WHEN asignado_flag = 1 THEN 1 ELSE 0 END) AS assigned,
+               MAX(CASE WHEN shipping_subestado IS NOT NULL AND shipping_subestado <> 'printed' THEN 1 ELSE 0 END) AS not_printed
+        FROM orders_meli
+        WHERE order_id IN (SELECT order_id FROM #orders_stage)
+        GROUP BY order_id
+    ) a ON a.order_id = s.order_id
+) AS src
+ON t.order_id = src.order_id
+WHEN MATCHED THEN UPDATE SET
+    sku = CASE WHEN src._assigned = 1 THEN t.sku ELSE src.sku END,
+    seller_sku = CASE WHEN src._assigned = 1 THEN t.seller_sku ELSE src.seller_sku END,
+    barcode = CASE WHEN src._assigned = 1 THEN t.barcode ELSE src.barcode END,
+    item_id = CASE WHEN src._assigned = 1 THEN t.item_id ELSE src.item_id END,
+    pack_id = CASE WHEN src._assigned = 1 THEN t.pack_id ELSE src.pack_id END,
+    multiventa_grupo = CASE WHEN src._assigned = 1 THEN t.multiventa_grupo ELSE src.multiventa_grupo END,
+    is_pack_complete = CASE WHEN src._assigned = 1 THEN t.is_pack_complete ELSE src.is_pack_complete END,
+    venta_tipo = CASE WHEN src._assigned = 1 THEN t.venta_tipo ELSE src.venta_tipo END,
+    qty = CASE WHEN src._assigned = 1 THEN t.qty ELSE src.qty END,
+    total_amount = CASE WHEN src._assigned = 1 THEN t.total_amount ELSE src.total_amount END,
+    estado = src.estado,
+    subestado = src.subestado,
+    shipping_id = src.shipping_id,
+    shipping_estado = src.shipping_estado,
+    shipping_subestado = src.shipping_subestado,
+    stock_reservado = CASE WHEN src._assigned = 1 AND src.shipping_subestado = 'printed' THEN 0 ELSE t.stock_reservado END,
+    resultante = CASE WHEN src._assigned = 1 AND src.shipping_subestado = 'printed' AND t.stock_real IS NOT NULL
+                      THEN t.stock_real ELSE t.resultante END,
+    CAMBIO_ESTADO = CASE WHEN src._assigned = 1 AND src._becomes_printed = 1 THEN 1 ELSE t.CAMBIO_ESTADO END,
+    date_created = CASE WHEN src._assigned = 1 THEN src.date_created ELSE src._date_created_adj END,
+    date_closed = src.date_closed,
+    display_color = src.display_color,
+    nombre = CASE WHEN src._assigned = 1 THEN COALESCE(src.nombre, t.nombre) ELSE src.nombre END,
+    ARTICULO = CASE WHEN src._assigned = 1 THEN t.ARTICULO ELSE src.ARTICULO END,
+    COLOR = CASE WHEN src._assigned = 1 THEN t.COLOR ELSE src.COLOR END,
+    TALLE = CASE WHEN src._assigned = 1 THEN t.TALLE ELSE src.TALLE END,
+    fecha_actualizacion = src.fecha_actualizacion,
+    MELI = CASE WHEN src._assigned = 1 THEN COALESCE(t.MELI, src.MELI) ELSE COALESCE(src.MELI, t.MELI) END
+WHEN NOT MATCHED BY TARGET THEN INSERT (
+    order_id, MELI, sku, seller_sku, barcode, item_id, pack_id, qty, total_amount,
+    multiventa_grupo, is_pack_complete, venta_tipo,
+    estado, subestado, shipping_id, shipping_estado, shipping_subestado,
+    date_created, date_closed, display_color, nombre, ARTICULO, COLOR, TALLE, asignado_flag,
+    movimiento_realizado, fecha_actualizacion, CAMBIO_ESTADO,
+    mov_depo_hecho, mov_depo_obs, mov_depo_numero
+) VALUES (
+    src.order_id, src.MELI, src.sku, src.seller_sku, src.barcode, src.item_id, src.pack_id, src.qty, src.total_amount,
+    src.multiventa_grupo, src.is_pack_complete, src.venta_tipo,
+    src.estado, src.subestado, src.shipping_id, src.shipping_estado, src.shipping_subestado,
+    src._date_created_adj, src.date_closed, src.display_color, src.nombre, src.ARTICULO, src.COLOR, src.TALLE, src.asignado_flag,
+    src.movimiento_realizado, src.fecha_actualizacion, 0,
+    NULL, NULL, NULL
+)
+OUTPUT $action, inserted.order_id, inserted.pack_id, inserted.shipping_subestado, inserted.asignado_flag,
+       deleted.shipping_subestado, deleted.sku;
+"""
+
+def _upsert_batch(conn_str: str, batch: List[Dict]) -> Dict[str, str]:
+    """Aplica un lote de órdenes (misma base) con tabla temporal + un MERGE. Levanta si falla."""
+    rows = [_stage_row(od) for od in batch]
+    with pyodbc.connect(conn_str) as conn:
+        cursor = conn.cursor()
+        ensure_schema_once(cursor, conn_str)
+        # La temporal copia tipos/largos de orders_meli (mismas conversiones que el INSERT/UPDATE por orden)
+        cursor.execute(
+            "SELECT TOP 0 " + ", ".join(_STAGE_COLS) + ", date_created AS _date_created_adj "
+            "INTO #orders_stage FROM orders_meli"
+        )
+        insert_sql = (
+            "INSERT INTO #orders_stage (" + ", ".join(_STAGE_COLS) + ", _date_created_adj) VALUES ("
+            + ", ".join(["?"] * (len(_STAGE_COLS) + 1)) + ")"
+        )
+        try:
+            cursor.fast_executemany = True
+            cursor.executemany(insert_sql, rows)
+        except Exception as e:
+            # fast_executemany es estricto con los tipos (p.ej. fechas como texto): reintentar fila a fila
+            print(f"⚠️ fast_executemany falló ({e}), cargando lote sin fast_executemany")
+            cursor.execute("TRUNCATE TABLE #orders_stage")
+            cursor.fast_executemany = False
+            cursor.executemany(insert_sql, rows)
+        cursor.execute(_UPSERT_MERGE_SQL)
+        actions: Dict[str, str] = {}
+        to_assign = []
+        for action, oid, pack_id, new_sub, assigned, old_sub, old_sku in cursor.fetchall():
+            actions[str(oid)] = 'inserted' if str(action).upper() == 'INSERT' else 'updated'
+            # Pasó a ready_to_print (o llegó su SKU, si el webhook la insertó mínima antes) y sin asignar
+            if new_sub == 'ready_to_print' and not assigned and (old_sub != 'ready_to_print' or old_sku is None):
+                to_assign.append((oid, pack_id))
+        cursor.execute("DROP TABLE #orders_stage")
+        conn.commit()
+        # La cola sólo se atiende en la base por defecto (la que lee 08_assign_tx); en la de
+        # acc2 no hay consumidor y crecería sin límite
+        if to_assign and _assign_queue is not None and conn_str == CONNECTION_STRING:
+            try:
+                _assign_queue.enqueue_many(conn, to_assign, 'sync', key=conn_str)
+            except Exception as e:
+                print(f"⚠️ upsert_orders: no se pudieron encolar {len(to_assign)} órdenes para asignación: {e}")
+    return actions
+
+def upsert_orders(orders: List[Dict]) -> Dict[str, str]:
+    """
+    Inserta/actualiza un lote de órdenes con una tabla temporal y un único MERGE por base,
+    en lugar de una conexión y 4+ consultas por orden (insert_or_update_order).
+
+    Mantiene la misma lógica: filas ya asignadas sólo actualizan estado/shipping, y CAMBIO_ESTADO
+    se marca en la transición a printed. Si el lote falla se cae a insert_or_update_order por orden.
+
+    Args:
+        orders: lista de order_data (salida de extract_order_data)
+
+    Returns:
+        {order_id: 'inserted' | 'updated' | 'error'}
+    """
+    result: Dict[str, str] = {}
+    # Última versión de cada orden, agrupada por base (acc1/acc2)
+    by_conn: Dict[str, Dict[str, Dict]] = {}
+    for od in orders or []:
+        if not od or not od.get('order_id'):
+            continue
+        by_conn.setdefault(_conn_str_for_meli(od.get('meli_user_id')), {})[str(od['order_id'])] = od
+    for conn_str, group in by_conn.items():
+        batch = list(group.values())
+        try:
+            t0 = time.monotonic()
+            try:
+                actions = _upsert_batch(conn_str, batch)
+            except Exception:
+                if _metrics is not None:
+                    _metrics.record('app_db', time.monotonic() - t0, ok=False)
+                raise
+            if _metrics is not None:
+                _metrics.record('app_db', time.monotonic() - t0)
+            for oid in group:
+                result[oid] = actions.get(oid, 'error')
+        except Exception as e:
+            print(f"⚠️ upsert_orders: lote de {len(batch)} órdenes falló ({e}), aplicando orden por orden")
+            for oid, od in group.items():
+                result[oid] = insert_or_update_order(od)
+    return result
+
 def log_movement(order_id: str, sku: str, qty: int, accion: str, deposito: str = None,
                  disponible: int = None, resultante: int = None, nota: str = None) -> None:
     """Inserta un registro en tabla movimientos."""
     try:
         with get_connection() as conn:
             cur = conn.cursor()
-            ensure_schema(cur)
+            ensure_schema_once(cur)
             cur.execute(
                 """
                 INSERT INTO movimientos(order_id, sku, qty, accion, deposito, disponible, resultante, nota)
@@ -645,7 +914,7 @@ def clear_movimientos() -> bool:
     try:
         with get_connection() as conn:
             cur = conn.cursor()
-            ensure_schema(cur)
+            ensure_schema_once(cur)
             cur.execute("DELETE FROM movimientos")
             conn.commit()
             return True
@@ -768,7 +1037,7 @@ def get_latest_order_for_meli(meli_user_id: int) -> Optional[Dict]:
         # Elegir base en función del seller solicitado
         with get_connection_for_meli(meli_user_id) as conn:
             cur = conn.cursor()
-            ensure_schema(cur)
+            ensure_schema_once(cur, _conn_str_for_meli(meli_user_id))
             cur.execute(
                 """
                 SELECT TOP 1 order_id, MELI, date_created, fecha_actualizacion
@@ -798,7 +1067,7 @@ def get_order_row(order_id: str) -> Optional[Dict]:
     try:
         with get_connection() as conn:
             cur = conn.cursor()
-            ensure_schema(cur)
+            ensure_schema_once(cur)
             cur.execute(
                 """
                 SELECT TOP 1 order_id, MELI, pack_id, shipping_id, estado, subestado, shipping_estado, shipping_subestado, date_created, fecha_actualizacion
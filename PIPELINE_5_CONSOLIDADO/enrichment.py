@@ -0,0 +1,188 @@
+"""
+ENRIQUECIMIENTO CONCURRENTE DE ÓRDENES
+======================================
+
+En lugar de que extract_order_data haga, orden por orden y en serie,
+get_shipping_details → get_item → get_pack_details → get_item_details,
+se junta primero una página de /orders/search y:
+
+1. Se recolectan los IDs de shipments, items y packs (sin duplicados).
+2. Se consultan en paralelo (ENRICH_MAX_WORKERS) respetando un límite de llamadas
+   por segundo compartido (RATE_LIMIT_QPS); un 429 frena a todos los hilos.
+   Los items van por el multiget /items?ids= (20 por llamada) si el cliente lo soporta.
+3. extract_order_data corre después contra un cliente "precargado" que responde
+   desde memoria: la transformación queda sin I/O. Lo que no se haya precargado
+   (o falló) se consulta en el momento con el cliente real, como antes.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    ENRICH_MAX_WORKERS = max(1, int(os.getenv('ENRICH_MAX_WORKERS', os.getenv('MAX_WORKERS_ENRICH', '8'))))
+except Exception:
+    ENRICH_MAX_WORKERS = 8
+try:
+    ENRICH_QPS = float(os.getenv('RATE_LIMIT_QPS', '5'))
+    if ENRICH_QPS <= 0:
+        ENRICH_QPS = 5.0
+except Exception:
+    ENRICH_QPS = 5.0
+try:
+    ENRICH_429_BACKOFF_SECS = float(os.getenv('ENRICH_429_BACKOFF_SECS', '2'))
+except Exception:
+    ENRICH_429_BACKOFF_SECS = 2.0
+
+
+class _RateLimiter:
+    """Intervalo mínimo entre llamadas, compartido por todos los hilos; pause() frena a todos."""
+
+    def __init__(self, qps: float):
+        self.min_interval = 1.0 / qps
+        self._lock = threading.Lock()
+        self._next_at = 0.0
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next_at)
+            self._next_at = at + self.min_interval
+        if at > now:
+            time.sleep(at - now)
+
+    def pause(self, secs: float) -> None:
+        with self._lock:
+            self._next_at = max(self._next_at, time.monotonic() + secs)
+
+
+def _is_429(resp: Any) -> bool:
+    return isinstance(resp, dict) and 'error' in resp and '429' in str(resp.get('error'))
+
+
+def collect_ids(orders: Iterable[Dict[str, Any]]) -> Tuple[List[str], List[str], List[str]]:
+    """(shipping_ids, item_ids, pack_ids) sin duplicados, tal como los usa extract_order_data."""
+    ships: Dict[str, None] = {}
+    items: Dict[str, None] = {}
+    packs: Dict[str, None] = {}
+    for order in orders or []:
+        try:
+            sid = (order.get('shipping') or {}).get('id')
+            if sid and sid != 'unknown':
+                ships[str(sid)] = None
+            order_items = order.get('order_items') or []
+            if order_items:
+                iid = (order_items[0].get('item') or {}).get('id')
+                if iid:
+                    items[str(iid)] = None
+            pid = order.get('pack_id')
+            if pid:
+                packs[str(pid)] = None
+        except Exception:
+            continue
+    return list(ships), list(items), list(packs)
+
+
+class PrefetchedClient:
+    """Misma interfaz que MeliClient para lo que usa extract_order_data, respondiendo desde memoria."""
+
+    def __init__(self, inner: Any, shipments: Dict[str, Any], items: Dict[str, Any], packs: Dict[str, Any]):
+        self._inner = inner
+        self._shipments = shipments
+        self._items = items
+        self._packs = packs
+        # Propagar atributos comunes (p.ej. user_id)
+        for k in ('user_id', 'api_base'):
+            if hasattr(inner, k):
+                setattr(self, k, getattr(inner, k))
+
+    @staticmethod
+    def _usable(v: Any) -> bool:
+        return isinstance(v, dict) and 'error' not in v
+
+    def _get(self, cache: Dict[str, Any], key: Any, fallback: Callable[[Any], Any]) -> Any:
+        v = cache.get(str(key))
+        if self._usable(v):
+            return v
+        return fallback(key)
+
+    def get_shipping_details(self, shipping_id):
+        return self._get(self._shipments, shipping_id, self._inner.get_shipping_details)
+
+    def get_item(self, item_id):
+        return self._get(self._items, item_id, self._inner.get_item)
+
+    def get_item_details(self, item_id):
+        return self._get(self._items, item_id, self._inner.get_item_details)
+
+    def get_pack_details(self, pack_id):
+        return self._get(self._packs, pack_id, self._inner.get_pack_details)
+
+    def __getattr__(self, name):
+        return getattr(self._inner, name)
+
+
+def prefetch_enrichment(orders: List[Dict[str, Any]], meli_client: Any,
+                        max_workers: Optional[int] = None, qps: Optional[float] = None,
+                        fallback: Any = None) -> Any:
+    """
+    Descarga en paralelo shipments, items y packs de un lote de órdenes y devuelve un
+    PrefetchedClient para pasarle a extract_order_data. Sin cliente devuelve None.
+    fallback: cliente para lo no precargado (por defecto meli_client).
+    """
+    if not meli_client:
+        return None
+    ship_ids, item_ids, pack_ids = collect_ids(orders)
+    limiter = _RateLimiter(qps or ENRICH_QPS)
+    shipments: Dict[str, Any] = {}
+    items: Dict[str, Any] = {}
+    packs: Dict[str, Any] = {}
+
+    def _call(fn: Callable[..., Any], *args) -> Any:
+        for attempt in range(2):
+            limiter.wait()
+            try:
+                resp = fn(*args)
+            except Exception as e:
+                return {'error': str(e)}
+            if _is_429(resp) and attempt == 0:
+                # Rate limit de ML: frenar a todos los hilos y reintentar una vez
+                limiter.pause(ENRICH_429_BACKOFF_SECS)
+                continue
+            return resp
+        return resp
+
+    tasks: List[Tuple[Dict[str, Any], Any, Callable[..., Any], Tuple[Any, ...]]] = []
+    for sid in ship_ids:
+        tasks.append((shipments, sid, meli_client.get_shipping_details, (sid,)))
+    for pid in pack_ids:
+        tasks.append((packs, pid, meli_client.get_pack_details, (pid,)))
+    multiget = getattr(meli_client, 'get_items_multi', None)
+    if callable(multiget):
+        for i in range(0, len(item_ids), 20):
+            tasks.append((items, None, multiget, (item_ids[i:i + 20],)))
+    else:
+        for iid in item_ids:
+            tasks.append((items, iid, meli_client.get_item_details, (iid,)))
+
+    def _run(task) -> None:
+        target, key, fn, args = task
+        resp = _call(fn, *args)
+        if key is None:
+            # multiget: {item_id: body}
+            if isinstance(resp, dict) and 'error' not in resp:
+                target.update({str(k): v for k, v in resp.items()})
+        else:
+            target[str(key)] = resp
+
+    t0 = time.monotonic()
+    if tasks:
+        with ThreadPoolExecutor(max_workers=min(max_workers or ENRICH_MAX_WORKERS, len(tasks))) as ex:
+            list(ex.map(_run, tasks))
+    print(
+        f"⚡ Enriquecimiento precargado: {len(ship_ids)} shipments, {len(item_ids)} items, "
+        f"{len(pack_ids)} packs en {time.monotonic() - t0:.1f}s ({len(tasks)} llamadas)"
+    )
+    return PrefetchedClient(fallback or meli_client, shipments, items, packs)
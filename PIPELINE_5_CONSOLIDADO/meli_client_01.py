@@ -13,12 +13,33 @@ Fecha: 2025-08-07
 """
 
 import requests
+from requests.adapters import HTTPAdapter
 import json
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Iterable
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import os
+import threading
 import time
 
+# Pool HTTP compartido por cliente (keep-alive) y concurrencia para notas de órdenes
+try:
+    ML_HTTP_POOL_SIZE = max(1, int(os.getenv('ML_HTTP_POOL_SIZE', '16')))
+except Exception:
+    ML_HTTP_POOL_SIZE = 16
+try:
+    ML_NOTES_WORKERS = max(1, int(os.getenv('ML_NOTES_WORKERS', '6')))
+except Exception:
+    ML_NOTES_WORKERS = 6
+# /items?ids= admite hasta 20 ids por llamada
+ML_ITEMS_MULTIGET_MAX = 20
+
+# Métricas por ciclo de PIPELINE_10 (opcional)
+try:
+    from modules import pipeline_metrics as _metrics  # type: ignore
+except Exception:
+    _metrics = None
+
 class MeliClientError(Exception):
     """Excepción personalizada para errores del cliente MercadoLibre."""
     pass
@@ -39,6 +60,15 @@ class MeliClient:
         self.config_path = config_path or env_token_path or project_token_path or r'C:\Users\Mundo Outdoor\Desktop\Develop_Mati\Escritor Meli\token.json'
         self.api_base = "https://api.mercadolibre.com"
         self.token_url = "https://api.mercadolibre.com/oauth/token"
+        # Session con pool de conexiones: los hilos de enriquecimiento reutilizan conexiones TLS
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=ML_HTTP_POOL_SIZE)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        if _metrics is not None:
+            _metrics.instrument_session(self._session, 'ml')
+        # Un solo refresh de token a la vez aunque varios hilos reciban 401
+        self._refresh_lock = threading.Lock()
         
         # Cargar configuración
         self._load_config()
@@ -117,7 +147,7 @@ class MeliClient:
         try:
             # Refresh proactivo si está vencido o por vencer (skew 60s)
             self.ensure_valid_token()
-            response = requests.get(url, headers=headers, params=params, timeout=15)
+            response = self._session.get(url, headers=headers, params=params, timeout=15)
             
             if response.status_code == 401:
                 # Token expirado, intentar refresh
@@ -125,7 +155,7 @@ class MeliClient:
                 if self._refresh_token():
                     # Actualizar headers con nuevo token
                     headers['Authorization'] = f'Bearer {self.access_token}'
-                    response = requests.get(url, headers=headers, params=params, timeout=15)
+                    response = self._session.get(url, headers=headers, params=params, timeout=15)
                     print(f"✅ Token refrescado y petición reintentada")
                 else:
                     raise Exception("No se pudo refrescar el token")
@@ -140,6 +170,14 @@ class MeliClient:
     
     def _refresh_token(self) -> bool:
         """Refrescar el access token usando refresh token y guardar automáticamente."""
+        token_before = self.access_token
+        with self._refresh_lock:
+            if self.access_token and self.access_token != token_before:
+                # Otro hilo ya refrescó mientras esperábamos
+                return True
+            return self._refresh_token_locked()
+
+    def _refresh_token_locked(self) -> bool:
         if not self.refresh_token or not self.client_id or not self.client_secret:
             print(f"❌ Faltan credenciales para refresh:")
             print(f"   client_id: {bool(self.client_id)}")
@@ -155,7 +193,7 @@ class MeliClient:
                 'refresh_token': self.refresh_token
             }
             
-            response = requests.post(self.token_url, data=data, timeout=15)
+            response = self._session.post(self.token_url, data=data, timeout=15)
             
             if response.status_code == 200:
                 token_data = response.json()
@@ -275,8 +313,8 @@ class MeliClient:
                 except Exception:
                     pass
 
-                # Enriquecer cada orden con notas
-                for order in page_orders:
+                # Enriquecer cada orden con notas (en paralelo, acotado por ML_NOTES_WORKERS)
+                def _attach_notes(order):
                     order_id = str(order.get('id', ''))
                     if order_id:
                         notes = self.get_order_notes(order_id)
@@ -287,6 +325,9 @@ class MeliClient:
                         else:
                             order['nota'] = None
 
+                with ThreadPoolExecutor(max_workers=min(ML_NOTES_WORKERS, len(page_orders))) as ex:
+                    list(ex.map(_attach_notes, page_orders))
+
                 all_orders.extend(page_orders)
                 remaining -= len(page_orders)
                 current_offset += len(page_orders)
@@ -311,6 +352,32 @@ class MeliClient:
         except Exception as e:
             return {'error': str(e)}
     
+    def get_items_multi(self, item_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Obtiene varios items con el multiget /items?ids=a,b,... (hasta 20 por llamada).
+        Devuelve {item_id: json del item} con el mismo formato que get_item/get_item_details;
+        los que fallan vienen como {'error': ...}.
+        """
+        ids = list(dict.fromkeys(str(i) for i in item_ids if i))
+        out: Dict[str, Dict[str, Any]] = {}
+        for i in range(0, len(ids), ML_ITEMS_MULTIGET_MAX):
+            chunk = ids[i:i + ML_ITEMS_MULTIGET_MAX]
+            try:
+                data = self._make_request(f"{self.api_base}/items", {'ids': ','.join(chunk)})
+                for entry in data if isinstance(data, list) else []:
+                    body = entry.get('body') or {}
+                    iid = str(body.get('id') or '')
+                    if entry.get('code') == 200 and iid:
+                        out[iid] = body
+                    elif iid:
+                        out[iid] = {'error': f"Error {entry.get('code')}: {body.get('message') or body}"}
+            except Exception as e:
+                for iid in chunk:
+                    out.setdefault(iid, {'error': f"Error consultando items {','.join(chunk)}: {e}"})
+            for iid in chunk:
+                out.setdefault(iid, {'error': f"Item {iid} no devuelto por /items?ids="})
+        return out
+
     def get_order_notes(self, order_id: str) -> List[Dict[str, Any]]:
         """Obtener notas de una orden específica con manejo correcto de estructura."""
         try:
@@ -382,13 +449,13 @@ class MeliClient:
                 'Content-Type': 'application/json'
             }
             
-            response = requests.get(url, headers=headers, timeout=30)
+            response = self._session.get(url, headers=headers, timeout=30)
             
             if response.status_code == 401:
                 print("🔄 Token expirado, refrescando...")
                 if self._refresh_token():
                     headers['Authorization'] = f'Bearer {self.access_token}'
-                    response = requests.get(url, headers=headers, timeout=30)
+                    response = self._session.get(url, headers=headers, timeout=30)
                 else:
                     return {'error': 'No se pudo refrescar el token'}
             
@@ -428,19 +495,18 @@ class MeliClient:
         Devuelve el JSON completo; el título está en 'title'.
         """
         try:
-            import requests
             print(f"🧾 Consultando item: {item_id}")
             url = f"{self.api_base}/items/{item_id}"
             headers = {
                 'Authorization': f'Bearer {self.access_token}',
                 'Content-Type': 'application/json'
             }
-            resp = requests.get(url, headers=headers, timeout=30)
+            resp = self._session.get(url, headers=headers, timeout=30)
             if resp.status_code == 401:
                 print("🔄 Token expirado, refrescando...")
                 if self._refresh_token():
                     headers['Authorization'] = f'Bearer {self.access_token}'
-                    resp = requests.get(url, headers=headers, timeout=30)
+                    resp = self._session.get(url, headers=headers, timeout=30)
                 else:
                     return {'error': 'No se pudo refrescar el token'}
             if resp.status_code == 200:
@@ -478,7 +544,7 @@ class MeliClient:
             else:
                 print("⚠️ 'user_id' no está configurado; la API de packs puede responder 403 Invalid caller.id")
             
-            response = requests.get(url, headers=headers, params=params, timeout=30)
+            response = self._session.get(url, headers=headers, params=params, timeout=30)
             
             if response.status_code == 401:
                 print("🔄 Token expirado, refrescando...")
@@ -488,7 +554,7 @@ class MeliClient:
                     if getattr(self, 'user_id', None):
                         headers['X-Caller-Id'] = str(self.user_id)
                         params = {'caller.id': str(self.user_id)}
-                    response = requests.get(url, headers=headers, params=params, timeout=30)
+                    response = self._session.get(url, headers=headers, params=params, timeout=30)
                 else:
                     return {'error': 'No se pudo refrescar el token'}
             
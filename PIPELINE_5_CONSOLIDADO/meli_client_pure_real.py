@@ -12,12 +12,13 @@ import os
 # Agregar path al módulo real
 sys.path.append(r'C:\Users\Mundo Outdoor\Desktop\meli_dragon_pipeline\modules')
 
-def get_recent_orders_pure_real(limit: int = 20) -> list:
+def get_recent_orders_pure_real(limit: int = 20, client=None) -> list:
     """
     Obtiene órdenes reales de MercadoLibre sin ningún mock.
     
     Args:
         limit: Número máximo de órdenes a obtener
+        client: MeliClient ya creado (p.ej. con el token de una cuenta); si no, uno por defecto
         
     Returns:
         Lista de órdenes reales de MercadoLibre
@@ -27,12 +28,13 @@ def get_recent_orders_pure_real(limit: int = 20) -> list:
         print(f"🔥 OBTENIENDO {limit} ÓRDENES REALES DE MERCADOLIBRE")
         print("=" * 60)
         
-        # Importar el cliente real original
-        from meli_client_01 import MeliClient
-        
-        # Crear cliente
-        client = MeliClient()
-        print("✅ Cliente MercadoLibre inicializado")
+        if client is None:
+            # Importar el cliente real original
+            from meli_client_01 import MeliClient
+            
+            # Crear cliente
+            client = MeliClient()
+            print("✅ Cliente MercadoLibre inicializado")
         
         # Obtener órdenes reales con paginación (limit por request <= 51)
         print(f"🔄 Consultando últimas {limit} órdenes con paginación...")
@@ -22,6 +22,7 @@ try:
     dragon_db = importlib.util.module_from_spec(spec)
     spec.loader.exec_module(dragon_db)
     get_barcode_with_fallback = dragon_db.get_barcode_with_fallback
+    prefetch_barcodes = dragon_db.prefetch_barcodes
     print(f"✅ Módulo de barcode cargado correctamente")
 except Exception as e:
     print(f"⚠️ Error cargando módulo de barcode: {e}")
@@ -30,6 +31,9 @@ except Exception as e:
         print(f"⚠️ Módulo de barcode no disponible")
         return None
 
+    def prefetch_barcodes(skus):
+        return None
+
 def extract_seller_sku_from_item(item_data: dict) -> Optional[str]:
     """
     Extrae SELLER_SKU del item de MercadoLibre.
@@ -84,6 +88,29 @@ def extract_seller_sku_from_item(item_data: dict) -> Optional[str]:
         print(f"❌ Error extrayendo SELLER_SKU: {e}")
         return None
 
+def prefetch_order_barcodes(orders: list) -> None:
+    """
+    Resuelve en lote (una consulta por batch) los barcodes de todos los SKUs del lote de órdenes,
+    para que extract_order_data encuentre cada búsqueda en la caché del resolver.
+    """
+    skus = []
+    for order in orders or []:
+        try:
+            for oi in (order.get('order_items') or [])[:1]:
+                item_data = oi.get('item', {}) or {}
+                scf = item_data.get('seller_custom_field')
+                if scf and str(scf).strip():
+                    parts = [p for p in str(scf).strip().split('-') if p != '']
+                    skus.append('-'.join(parts) if parts else scf)
+                ssku = item_data.get('seller_sku')
+                if ssku and str(ssku).strip():
+                    skus.append(str(ssku).strip())
+        except Exception:
+            continue
+    if skus:
+        prefetch_barcodes(skus)
+
+
 def determine_shipping_estado(order: dict, shipping: dict, shipping_status: str, shipping_substatus: str, status: str, substatus: str) -> str:
     """
     Determina el estado de shipping usando la lógica que funcionaba en VERSION 2.
@@ -38,8 +38,9 @@ def process_orders_batch(orders: list, meli_client=None) -> dict:
     
     try:
         # Importar módulos necesarios
-        from database_utils import insert_or_update_order
-        from order_processor import extract_order_data
+        from database_utils import upsert_orders
+        from order_processor import extract_order_data, prefetch_order_barcodes
+        from enrichment import prefetch_enrichment
 
         # Config de paralelismo y rate limit
         try:
@@ -107,39 +108,62 @@ def process_orders_batch(orders: list, meli_client=None) -> dict:
         else:
             print(f"⚠️ Sin cliente MercadoLibre - usando datos básicos")
         
-        # Worker por orden
+        # Barcodes del lote en una sola consulta (las búsquedas por orden salen de caché)
+        try:
+            prefetch_order_barcodes(orders)
+        except Exception as e:
+            print(f"⚠️ Precarga de barcodes falló: {e}")
+
+        # Shipments/items/packs del lote en paralelo y sin duplicados; extract_order_data
+        # responde desde memoria (lo no precargado cae al cliente rate-limitado)
+        enrich_client = rl_client
+        try:
+            enrich_client = prefetch_enrichment(orders, meli_client, max_workers=max_workers, qps=qps,
+                                                fallback=rl_client) or rl_client
+        except Exception as e:
+            print(f"⚠️ Precarga de enriquecimiento falló, se consulta orden por orden: {e}")
+
+        # Worker por orden: sólo transformación (la escritura va en lote)
         def _process_one(idx_order_tuple):
             idx, order = idx_order_tuple
             order_id = order.get('id', 'unknown')
             print(f"\n🔍 Procesando orden {idx}/{len(orders)}: {order_id}")
-            order_data = extract_order_data(order, rl_client)
+            order_data = extract_order_data(order, enrich_client)
             if not order_data:
                 print("   ⚠️  No se pudieron extraer datos")
-                return ('error', order_id, 'extract_failed', None)
-            action = insert_or_update_order(order_data)
-            return (action, order_id, order_data.get('shipping_subestado'), order_data)
+            return order_id, order_data
 
+        extracted = []
         # Ejecutar en paralelo con límite de workers
         with ThreadPoolExecutor(max_workers=max_workers) as ex:
             futures = [ex.submit(_process_one, (i, o)) for i, o in enumerate(orders, 1)]
             for fut in as_completed(futures):
                 try:
-                    action, order_id, subest, od = fut.result()
-                    if action == 'inserted':
-                        result['new_orders'] += 1
-                        print("   ✅ Nueva orden insertada")
-                    elif action == 'updated':
-                        result['updated_orders'] += 1
-                        print("   🔄 Orden actualizada")
-                    elif action == 'error':
+                    order_id, od = fut.result()
+                    if not od:
                         result['errors'].append(f"Orden {order_id}: error worker")
-                    if od and (od.get('shipping_subestado') == 'ready_to_print'):
-                        result['ready_orders'] += 1
-                    result['total_processed'] += 1
+                        result['total_processed'] += 1
+                        continue
+                    extracted.append(od)
                 except Exception as e:
                     msg = f"Error en futuro de orden: {e}"
                     print(f"   ❌ {msg}")
                     result['errors'].append(msg)
+
+        # Un único upsert (tabla temporal + MERGE) por base para todo el lote
+        actions = upsert_orders(extracted) if extracted else {}
+        for od in extracted:
+            order_id = str(od.get('order_id'))
+            action = actions.get(order_id, 'error')
+            if action == 'inserted':
+                result['new_orders'] += 1
+            elif action == 'updated':
+                result['updated_orders'] += 1
+            else:
+                result['errors'].append(f"Orden {order_id}: error worker")
+            if od.get('shipping_subestado') == 'ready_to_print':
+                result['ready_orders'] += 1
+            result['total_processed'] += 1
         
         print(f"\n✅ Procesamiento completado:")
         print(f"   Total: {result['total_processed']}")
@@ -0,0 +1,118 @@
+"""
+Test de NotesFetcher.fetch por el camino de packs (sin red ni SQL)
+=================================================================
+
+Orden sin notas ni comments pero con pack_id: debe caer a merchant_orders del pack
+y, si no hay comments ahí, al último mensaje del pack. El texto por pack se memoiza
+dentro de una corrida (reset_pack_cache) y las fallas HTTP levantan NotesFetchError
+en lugar de devolver una nota vacía.
+"""
+
+import json
+import os
+import sys
+import types
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# backfill_notes_once importa pyodbc a nivel módulo; acá no se usa
+sys.modules.setdefault('pyodbc', types.ModuleType('pyodbc'))
+
+import backfill_notes_once as bno  # noqa: E402
+
+
+class _Resp:
+    def __init__(self, status_code, payload):
+        self.status_code = status_code
+        self._payload = payload
+        self.text = json.dumps(payload)
+
+    def json(self):
+        return self._payload
+
+
+def _fetcher(tmp_path, routes):
+    token = tmp_path / 'token.json'
+    token.write_text(json.dumps({'access_token': 'TOK', 'user_id': 999}), encoding='utf-8')
+    f = bno.NotesFetcher(str(token))
+    calls = []
+
+    def _get(url, params=None):
+        path = url.replace(f.__class__._ML, '')
+        calls.append(path)
+        status, payload = routes.get(path, (404, {}))
+        return _Resp(status, payload)
+
+    f._get = _get
+    return f, calls
+
+
+def _routes(merchant_results, messages):
+    return {
+        '/orders/1/notes': (200, [{'results': []}]),
+        '/orders/1': (200, {'id': 1, 'comments': None, 'pack_id': 555}),
+        '/orders/2/notes': (200, [{'results': []}]),
+        '/orders/2': (200, {'id': 2, 'comments': None, 'pack_id': 555}),
+        '/merchant_orders/search': (200, {'results': merchant_results}),
+        '/messages/packs/555/sellers/999': (200, {'messages': messages}),
+    }
+
+
+def test_pack_merchant_comments(tmp_path):
+    f, calls = _fetcher(tmp_path, _routes([{'comments': 'talle M'}], []))
+    assert f.fetch('1') == 'talle M'
+    assert '/messages/packs/555/sellers/999' not in calls
+
+
+def test_pack_last_message_fallback_and_cache(tmp_path):
+    f, calls = _fetcher(tmp_path, _routes([{'comments': None}], [{'text': 'hola'}, {'text': {'plain': 'color negro'}}]))
+    assert f.fetch('1') == 'color negro'
+    # Segunda orden del mismo pack: no vuelve a pedir merchant_orders ni mensajes
+    assert f.fetch('2') == 'color negro'
+    assert calls.count('/merchant_orders/search') == 1
+    assert calls.count('/messages/packs/555/sellers/999') == 1
+
+
+def test_pack_cache_reset_between_runs(tmp_path):
+    routes = _routes([{'comments': 'talle M'}], [])
+    f, calls = _fetcher(tmp_path, routes)
+    assert f.fetch('1') == 'talle M'
+    routes['/merchant_orders/search'] = (200, {'results': [{'comments': 'talle L'}]})
+    f.reset_pack_cache()
+    assert f.fetch('2') == 'talle L'
+    assert calls.count('/merchant_orders/search') == 2
+
+
+def test_http_failures_raise_and_are_not_cached(tmp_path):
+    routes = _routes([{'comments': 'talle M'}], [])
+    routes['/orders/1/notes'] = (429, {'message': 'too many requests'})
+    routes['/merchant_orders/search'] = (503, {})
+    f, calls = _fetcher(tmp_path, routes)
+    for call in (lambda: f.probe_notes('1'), lambda: f.fetch('2')):
+        try:
+            call()
+        except bno.NotesFetchError:
+            pass
+        else:
+            raise AssertionError('se esperaba NotesFetchError')
+    # La falla del pack no quedó memoizada: cuando ML responde, se vuelve a pedir
+    routes['/merchant_orders/search'] = (200, {'results': [{'comments': 'talle M'}]})
+    assert f.fetch('2') == 'talle M'
+    assert calls.count('/merchant_orders/search') == 2
+
+
+def test_not_found_is_empty_note(tmp_path):
+    f, _ = _fetcher(tmp_path, {'/orders/3/notes': (404, {}), '/orders/3': (200, {'id': 3})})
+    assert f.fetch('3') == ''
+
+
+if __name__ == '__main__':
+    import pathlib
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        test_pack_merchant_comments(pathlib.Path(d))
+        test_pack_last_message_fallback_and_cache(pathlib.Path(d))
+        test_pack_cache_reset_between_runs(pathlib.Path(d))
+        test_http_failures_raise_and_are_not_cached(pathlib.Path(d))
+        test_not_found_is_empty_note(pathlib.Path(d))
+    print('OK')
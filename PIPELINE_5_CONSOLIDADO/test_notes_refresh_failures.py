@@ -0,0 +1,90 @@
+"""
+Test de refresh_notes + write_notes_results ante fallas de ML (sin red ni SQL)
+==============================================================================
+
+Si el probe de /notes devuelve 5xx o 429 la orden va a 'failed': no se escribe la nota
+en orders_meli y notas_frescura registra fallos + 1. Las que responden bien siguen el
+camino normal (nota actualizada, índice con fallos = 0).
+"""
+
+import json
+import os
+import sys
+import types
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# backfill_notes_once importa pyodbc a nivel módulo; acá no se usa
+sys.modules.setdefault('pyodbc', types.ModuleType('pyodbc'))
+
+import backfill_notes_once as bno  # noqa: E402
+
+
+class _Resp:
+    def __init__(self, status_code, payload):
+        self.status_code = status_code
+        self._payload = payload
+        self.text = json.dumps(payload)
+
+    def json(self):
+        return self._payload
+
+
+class _Cursor:
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, list(params or [])))
+
+
+def _fetcher(tmp_path, routes):
+    token = tmp_path / 'token.json'
+    token.write_text(json.dumps({'access_token': 'TOK', 'user_id': 999}), encoding='utf-8')
+    f = bno.NotesFetcher(str(token))
+    f._get = lambda url, params=None: _Resp(*routes.get(url.replace(bno.NotesFetcher._ML, ''), (404, {})))
+    return f
+
+
+def _run(tmp_path, probe_status):
+    routes = {
+        '/orders/1/notes': (probe_status, {'message': 'error'}),
+        '/orders/2/notes': (200, [{'results': [{'note': 'talle L'}]}]),
+    }
+    current = {'1': 'nota guardada', '2': None}
+    known = {'1': bno.nota_hash('nota guardada'), '2': None}
+    res = bno.refresh_notes(_fetcher(tmp_path, routes), current, known, workers=2, deadline_secs=10)
+    cur = _Cursor()
+    bno.write_notes_results(cur, res)
+    return res, cur, known
+
+
+def _check(res, cur, known):
+    assert res['failed'] == [('1', known['1'])]
+    assert [oid for oid, _ in res['errors']] == ['1']
+    assert res['changes'] == [('2', 'talle L')]
+    assert [oid for oid, _ in res['fetched']] == ['2']
+
+    updates = [p for sql, p in cur.executed if sql.startswith('UPDATE o SET nota')]
+    assert updates == [['2', 'talle L']]  # la orden 1 no se pisa
+    failed = [p for sql, p in cur.executed if 'fallos = t.fallos + 1' in sql]
+    assert failed == [['1', known['1']]]
+    indexed = [p for sql, p in cur.executed if 'fallos = 0' in sql]
+    assert indexed == [['2', bno.nota_hash('talle L')]]
+
+
+def test_probe_5xx_goes_to_failed(tmp_path):
+    _check(*_run(tmp_path, 503))
+
+
+def test_probe_429_goes_to_failed(tmp_path):
+    _check(*_run(tmp_path, 429))
+
+
+if __name__ == '__main__':
+    import pathlib
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        test_probe_5xx_goes_to_failed(pathlib.Path(d))
+        test_probe_429_goes_to_failed(pathlib.Path(d))
+    print('OK')
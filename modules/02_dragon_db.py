@@ -96,66 +96,58 @@ def get_barcode_with_fallback(seller_custom_field: Optional[str], seller_sku: Op
     print(f"   ❌ Barcode no encontrado con ningún SKU")
     return None
 
+def _resolver():
+    """Resolver compartido (pool + caché SKU↔barcode↔ARTDES), ver modules/article_resolver.py."""
+    try:
+        from modules.article_resolver import get_resolver
+    except ImportError:
+        from article_resolver import get_resolver
+    return get_resolver()
+
+
 def _search_barcode_in_db(sku: str) -> Optional[str]:
     if not sku or not sku.strip():
         return None
     
-    conn_str = SQLSERVER_CONN_STR
-    database_name = os.environ.get('DATABASE_NAME', 'DRAGONFISH_DEPOSITO')
-    
-    if not conn_str:
+    if not SQLSERVER_CONN_STR:
         print("❌ Error: SQLSERVER_CONN_STR no configurado")
         return None
     
-    connection = None
     try:
-        # Conectar a SQL Server
-        connection = pyodbc.connect(conn_str)
-        cursor = connection.cursor()
-        
+        resolver = _resolver()
         # Determinar tipo de búsqueda
         if '-' in sku and len(sku.split('-')) >= 3:
             # Búsqueda por artículo, color y talle separados
-            art, col, tal = sku.split('-', 2)
-            query = (
-                "SELECT RTRIM(equi.CCOLOR) AS CODIGO_COLOR, RTRIM(equi.CTALLE) AS CODIGO_TALLE, "
-                "RTRIM(equi.CARTICUL) AS CODIGO_ARTICULO, RTRIM(equi.CCODIGO) AS CODIGO_BARRA, "
-                "RTRIM(c_art.ARTDES) AS ARTDES "
-                f"FROM {database_name}.ZooLogic.EQUI AS equi "
-                f"LEFT JOIN {database_name}.ZooLogic.ART AS c_art ON equi.CARTICUL = c_art.ARTCOD "
-                "WHERE RTRIM(equi.CARTICUL) = ? AND RTRIM(equi.CCOLOR) = ? AND RTRIM(equi.CTALLE) = ?"
-            )
-            cursor.execute(query, (art, col, tal))
+            info = resolver.resolve(sku)
         else:
             # Búsqueda por código de barra directo
-            query = (
-                "SELECT RTRIM(equi.CCOLOR) AS CODIGO_COLOR, RTRIM(equi.CTALLE) AS CODIGO_TALLE, "
-                "RTRIM(equi.CARTICUL) AS CODIGO_ARTICULO, RTRIM(equi.CCODIGO) AS CODIGO_BARRA, "
-                "RTRIM(c_art.ARTDES) AS ARTDES "
-                f"FROM {database_name}.ZooLogic.EQUI AS equi "
-                f"LEFT JOIN {database_name}.ZooLogic.ART AS c_art ON equi.CARTICUL = c_art.ARTCOD "
-                "WHERE RTRIM(equi.CCODIGO) = ?"
-            )
-            cursor.execute(query, (sku.strip(),))
+            info = resolver.by_barcode(sku.strip())
         
-        row = cursor.fetchone()
-        if row and row[3]:  # CODIGO_BARRA está en la posición 3
-            barcode = str(row[3]).strip()
+        if info and info.get("CODIGO_BARRA"):
+            barcode = str(info["CODIGO_BARRA"]).strip()
             print(f"✅ SKU encontrado: {sku} → {barcode}")
             return barcode
         else:
             print(f"⚠️ SKU no encontrado: {sku}")
             return None
             
-    except pyodbc.Error as e:
-        print(f"❌ Error de base de datos para SKU {sku}: {e}")
-        return None
     except Exception as e:
         print(f"❌ Error inesperado para SKU {sku}: {e}")
         return None
-    finally:
-        if connection:
-            connection.close()
+
+
+def prefetch_barcodes(skus) -> None:
+    """Precarga en la caché del resolver un lote de SKUs/códigos (una consulta por lote),
+    para que las búsquedas individuales posteriores no vayan a SQL Server."""
+    try:
+        vals = [str(s).strip() for s in (skus or []) if s and str(s).strip()]
+        if not vals or not SQLSERVER_CONN_STR:
+            return
+        resolver = _resolver()
+        resolver.resolve_many([s for s in vals if len(s.split('-')) >= 3])
+        resolver.by_barcode_many([s for s in vals if len(s.split('-')) < 3])
+    except Exception as e:
+        print(f"⚠️ Precarga de barcodes falló: {e}")
 
 
 def get_article_info_by_barcode(barcode: str) -> Optional[dict]:
@@ -174,48 +166,18 @@ def get_article_info_by_barcode(barcode: str) -> Optional[dict]:
     if not barcode or not str(barcode).strip():
         return None
 
-    conn_str = SQLSERVER_CONN_STR
-    database_name = os.environ.get('DATABASE_NAME', 'DRAGONFISH_DEPOSITO')
-
-    if not conn_str:
+    if not SQLSERVER_CONN_STR:
         print("❌ Error: SQLSERVER_CONN_STR no configurado")
         return None
 
-    connection = None
     try:
-        connection = pyodbc.connect(conn_str)
-        cursor = connection.cursor()
-
-        query = (
-            "SELECT RTRIM(equi.CCOLOR) AS CODIGO_COLOR, RTRIM(equi.CTALLE) AS CODIGO_TALLE, "
-            "RTRIM(equi.CARTICUL) AS CODIGO_ARTICULO, RTRIM(equi.CCODIGO) AS CODIGO_BARRA, "
-            "RTRIM(c_art.ARTDES) AS ARTDES "
-            f"FROM {database_name}.ZooLogic.EQUI AS equi "
-            f"LEFT JOIN {database_name}.ZooLogic.ART AS c_art ON equi.CARTICUL = c_art.ARTCOD "
-            "WHERE RTRIM(equi.CCODIGO) = ?"
-        )
-        cursor.execute(query, (str(barcode).strip(),))
-
-        row = cursor.fetchone()
-        if not row:
+        info = _resolver().by_barcode(str(barcode).strip())
+        if not info:
             return None
-
-        return {
-            "CODIGO_COLOR": (row[0].strip() if row[0] is not None else ""),
-            "CODIGO_TALLE": (row[1].strip() if row[1] is not None else ""),
-            "CODIGO_ARTICULO": (row[2].strip() if row[2] is not None else ""),
-            "CODIGO_BARRA": (row[3].strip() if row[3] is not None else ""),
-            "ARTDES": (row[4].strip() if row[4] is not None else ""),
-        }
-    except pyodbc.Error as e:
-        print(f"❌ Error de base de datos buscando info por barcode {barcode}: {e}")
-        return None
+        return {k: info.get(k, "") for k in ("CODIGO_COLOR", "CODIGO_TALLE", "CODIGO_ARTICULO", "CODIGO_BARRA", "ARTDES")}
     except Exception as e:
         print(f"❌ Error inesperado buscando info por barcode {barcode}: {e}")
         return None
-    finally:
-        if connection:
-            connection.close()
 
 def test_connection() -> bool:
     """
@@ -6,7 +6,7 @@ Filtra órdenes que están listas para asignar depósito.
 """
 
 import logging
-from typing import List
+from typing import Iterable, List, Optional
 from sqlalchemy import or_
 
 from modules import local_db
@@ -18,16 +18,20 @@ OrderItem = models.OrderItem
 logger = logging.getLogger(__name__)
 
 
-def get_pending_ready() -> List[OrderItem]:
+def get_pending_ready(order_ids: Optional[Iterable[str]] = None) -> List[OrderItem]:
     """
     Obtiene órdenes pendientes de asignación que están ready_to_print.
     Excluye órdenes ya asignadas con agotamiento_flag=1 para evitar reasignaciones.
+
+    Args:
+        order_ids: si se indica, sólo esas órdenes y las demás pendientes de sus packs
+            (asignación disparada por evento: el pack se asigna completo).
     
     Returns:
         List[OrderItem]: Lista de órdenes listas para asignar
     """
     with SessionLocal() as s:
-        result = (
+        q = (
             s.query(OrderItem)
             .filter(
                 OrderItem.shipping_subestado == 'ready_to_print',
@@ -35,9 +39,17 @@ def get_pending_ready() -> List[OrderItem]:
                 # Evitar reasignar órdenes ya agotadas (problema de doble asignación)
                 or_(OrderItem.agotamiento_flag == False, OrderItem.agotamiento_flag.is_(None))
             )
-            .order_by(OrderItem.fecha_orden.asc())
-            .all()
         )
+        if order_ids is not None:
+            ids = sorted({str(x) for x in order_ids if x})
+            if not ids:
+                return []
+            packs = (
+                s.query(OrderItem.pack_id)
+                .filter(OrderItem.order_id.in_(ids), OrderItem.pack_id.isnot(None))
+            )
+            q = q.filter(or_(OrderItem.order_id.in_(ids), OrderItem.pack_id.in_(packs)))
+        result = q.order_by(OrderItem.fecha_orden.asc()).all()
     
     logger.debug("Pendientes: %s", len(result))
     return result
@@ -12,24 +12,39 @@ from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
-# Configuración de prioridades (basada en prioridades_depositos.txt)
-# Nuevo orden de prioridades por puntos (individual):
-#  - MDQ y MTGCBA deshabilitados (no deben entrar en cálculos de ganador)
-PUNTOS: Dict[str, float] = {
-    'DEP': 20000000,
-    'MDQ': 0,          # deshabilitado
-    'MONBAHIA': 10000000,
-    'MTGBBPS': 4000000,
-    'MTGCBA': 0,       # deshabilitado
-    'MTGCOM': 1000003,
-    'MTGJBJ': 0,
-    'MTGROCA': 6000000,
-    'MUNDOAL': 8000000,
-    'MUNDOCAB': 10000,
-    'MUNDOROC': 2000000,
-    'NQNALB': 1000002,
-    'NQNSHOP': 1000001,
-}
+# Depósitos deshabilitados para selección de ganador (no participan)
+# Se agrega 'WOO' para evitar cualquier asignación a la base WOO
+DISABLED_DEPOTS = {'MDQ', 'MTGCBA', 'WOO', 'OUTLET','MTGJBJ'}
+
+# Orden de prioridad: lista única configurada (config.RECOMMEND_DEPOT_ORDER), la misma que
+# usan los listados (depot_recommender) y las cancelaciones. 'DEPO' es el alias de DEP.
+_DEFAULT_ORDER = ['DEP', 'MONBAHIA', 'MUNDOAL', 'MTGROCA', 'MTGBBPS', 'MUNDOROC',
+                  'MTGCOM', 'NQNALB', 'NQNSHOP', 'MUNDOCAB']
+try:
+    from modules.config import RECOMMEND_DEPOT_ORDER as _CFG_ORDER  # type: ignore
+except Exception:
+    try:
+        from config import RECOMMEND_DEPOT_ORDER as _CFG_ORDER  # type: ignore
+    except Exception:
+        _CFG_ORDER = []
+
+
+def _order_from(depots) -> list:
+    out: list = []
+    for d in depots or []:
+        code = str(d).strip().upper()
+        code = 'DEP' if code == 'DEPO' else code
+        if code and code != 'MELI' and code not in DISABLED_DEPOTS and code not in out:
+            out.append(code)
+    return out
+
+
+# Orden de prioridad simple (fallback y fuente de PUNTOS), sin deshabilitados
+DEPOSIT_PRIORITY = _order_from(_CFG_ORDER) or list(_DEFAULT_ORDER)
+
+# PUNTOS por posición en DEPOSIT_PRIORITY: un escalón por puesto, así el orden manda y la
+# cantidad (qty * multiplicador, muy por debajo del escalón) sólo desempata.
+PUNTOS_ESCALON = 1000000
 
 MULTIPLICADORES: Dict[str, float] = {
     'DEP': 1.0,
@@ -47,23 +62,8 @@ MULTIPLICADORES: Dict[str, float] = {
     'NQNSHOP': 0.3,
 }
 
-# Depósitos deshabilitados para selección de ganador (no participan)
-# Se agrega 'WOO' para evitar cualquier asignación a la base WOO
-DISABLED_DEPOTS = {'MDQ', 'MTGCBA', 'WOO', 'OUTLET','MTGJBJ'}
-
-# Orden de prioridad simple (fallback) alineado a los nuevos puntos y excluyendo deshabilitados
-DEPOSIT_PRIORITY = [
-    'DEP',         # 20000000
-    'MONBAHIA',    # 10000000
-    'MUNDOAL',     # 8000000
-    'MTGROCA',     # 6000000
-    'MTGBBPS',     # 4000000
-    'MUNDOROC',    # 2000000
-    'MTGCOM',      # 1000003
-    'NQNALB',      # 1000002
-    'NQNSHOP',     # 1000001
-    'MUNDOCAB',    # 10000
-]
+PUNTOS: Dict[str, float] = {d: 0 for d in MULTIPLICADORES}  # deshabilitados / fuera del orden
+PUNTOS.update({d: float((len(DEPOSIT_PRIORITY) - i) * PUNTOS_ESCALON) for i, d in enumerate(DEPOSIT_PRIORITY)})
 
 
 def calculate_depot_score(depot: str, available: int, qty: int) -> float:
@@ -6,8 +6,10 @@ Consulta stock en API Dragonfish y maneja timeouts/errores.
 """
 
 import logging
+import os
 import requests
-from typing import Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Optional, Tuple
 import re
 from modules.config import (
     DRAGON_API_BASE,
@@ -19,6 +21,8 @@ from modules.config import (
     DRAGON_ALT_ID_CLIENTE,
     DRAGON_DEPOT_CANDIDATES,
 )
+from modules.stock_cache import stock_cache, article_base
+from modules.dragon_http import client as _http
 
 logger = logging.getLogger(__name__)
 
@@ -41,23 +45,184 @@ def _eq_talle(a: str, b: str) -> bool:
     return a == b or a_n == b_n
 
 
-def get_stock_per_deposit(sku: str, timeout: int = 30) -> Dict[str, Dict[str, int]]:
+# Lista blanca de bases permitidas (nombres crudos tal como vienen en JSON)
+_ALLOWED_RAW = {
+    'DEPOSITO',
+    'MONBAHIA',
+    'MTGBBPS',
+    'BBPS',  # alias histórico, se mapea a MTGBBPS
+    'MTGROCA',
+    'MUNDOAL',
+    'MUNDOCAB',
+    'MUNDOROC',
+    'NQNALB',
+}
+
+try:
+    DRAGON_STOCK_MAX_PAGES = max(1, int(os.getenv('DRAGON_STOCK_MAX_PAGES', '10')))
+except Exception:
+    DRAGON_STOCK_MAX_PAGES = 10
+
+# Matriz de stock de un artículo: {(color, talle): {depósito: total}} con color/talle normalizados (_norm)
+StockMatrix = Dict[Tuple[str, str], Dict[str, int]]
+
+
+def _follow_siguiente(data: Any, headers: Dict[str, str], timeout: int, query_val: str) -> Any:
+    """Si la respuesta trae 'Siguiente' (URL absoluta), seguir las páginas y juntar los
+    'Resultados' en un único payload (hasta DRAGON_STOCK_MAX_PAGES)."""
+    if not isinstance(data, dict):
+        return data
+    resultados = data.get("Resultados")
+    if not isinstance(resultados, list):
+        return data
+    merged = list(resultados)
+    siguiente = data.get('Siguiente') or data.get('siguiente')
+    pages = 1
+    seen = set()
+    while isinstance(siguiente, str) and siguiente.strip() and pages < DRAGON_STOCK_MAX_PAGES:
+        next_url = siguiente.strip()
+        if next_url in seen:
+            break
+        seen.add(next_url)
+        try:
+            resp = _http.get(next_url, headers=headers, read_timeout=timeout)
+            resp.raise_for_status()
+            page = resp.json()
+        except Exception as e:
+            # No romper: quedarse con lo ya leído (mismo comportamiento que sin paginar)
+            logger.warning(f"Dragonfish paginación cortada para {query_val} en página {pages + 1}: {e}")
+            break
+        pages += 1
+        if not isinstance(page, dict) or not isinstance(page.get("Resultados"), list):
+            break
+        merged.extend(page["Resultados"])
+        siguiente = page.get('Siguiente') or page.get('siguiente')
+    if pages > 1:
+        logger.debug(f"Dragonfish EntreLocales {query_val}: {pages} páginas, {len(merged)} resultados")
+        data = {**data, "Resultados": merged, "Siguiente": None}
+    return data
+
+
+def _depot_code(depot_raw: str) -> Optional[str]:
+    """Código interno para una BaseDeDatos de Dragonfish, o None si no está permitida."""
+    if not depot_raw or depot_raw not in _ALLOWED_RAW:
+        return None
+    # Mapear nombre interno: DEPOSITO -> DEP, BBPS -> MTGBBPS
+    if depot_raw == 'DEPOSITO':
+        return 'DEP'
+    if depot_raw == 'BBPS':
+        return 'MTGBBPS'
+    return depot_raw
+
+
+def _build_matrix(data: Any, query_art: str) -> StockMatrix:
+    """Parsea Resultados[...].Stock[{ BaseDeDatos, Stock }] a la matriz por variante.
+    Sólo el artículo exacto; otros artículos que devuelva la búsqueda se ignoran."""
+    matrix: StockMatrix = {}
+    resultados = data.get("Resultados") if isinstance(data, dict) else None
+    if not isinstance(resultados, list):
+        logger.debug("Respuesta Dragonfish sin 'Resultados' lista")
+        return matrix
+    query_art = (query_art or '').strip().upper()
+    for item in resultados:
+        if not isinstance(item, dict):
+            continue
+        art = str(item.get('Articulo', '')).strip().upper()
+        if art != query_art:
+            continue
+        key = (
+            _norm(item.get('Color') or item.get('COLOR') or item.get('color')),
+            _norm(item.get('Talle') or item.get('TALLE') or item.get('talle')),
+        )
+        depots = matrix.setdefault(key, {})
+        for st in item.get("Stock", []) or []:
+            depot = _depot_code(str(st.get("BaseDeDatos", "")).strip().upper())
+            if not depot:
+                continue
+            try:
+                total = int(st.get("Stock") or 0)
+            except Exception:
+                continue
+            # Usar el mayor total reportado por seguridad (si vinieran múltiples líneas por depósito)
+            depots[depot] = max(depots.get(depot, 0), total)
+    return matrix
+
+
+def _load_matrix(query_val: str, sku: str, timeout: int) -> StockMatrix:
+    return _build_matrix(_fetch_entre_locales(query_val, sku, timeout), query_val)
+
+
+def stock_for_variant(matrix: StockMatrix, sku: str) -> Dict[str, Dict[str, int]]:
+    """Stock por depósito de un SKU (ART-COLOR-TALLE) a partir de la matriz del artículo,
+    con el mismo formato que get_stock_per_deposit. Sin color/talle se toman todas las variantes."""
+    parts = (sku or '').strip().split('-')
+    color_q = parts[1].strip() if len(parts) >= 3 else None
+    talle_q = parts[2].strip() if len(parts) >= 3 else None
+    color_norm = _norm(color_q) if color_q else None
+    talle_norm = _norm(talle_q) if talle_q else None
+    result: Dict[str, Dict[str, int]] = {}
+    for (it_color, it_talle), depots in (matrix or {}).items():
+        if color_norm or talle_norm:
+            color_ok = (color_norm is None) or (it_color == color_norm)
+            talle_ok = (talle_norm is None) or _eq_talle(it_talle, talle_norm)
+            if not (color_ok and talle_ok):
+                continue
+        for depot, total in depots.items():
+            cur = result.get(depot, {"total": 0, "reserved": 0})
+            cur["total"] = max(cur["total"], int(total))
+            result[depot] = cur
+    return result
+
+
+def get_article_stock(sku_or_article: str, timeout: int = 30) -> StockMatrix:
+    """Matriz completa de stock del artículo en una sola consulta (paginada vía 'Siguiente'):
+    {(color, talle): {depósito: total}}. Acepta el artículo base o cualquier SKU del artículo.
+
+    Sale de la misma caché que get_stock_per_deposit. No usa el fallback SQL:
+    levanta la excepción de la API si no respondió.
     """
-    Consulta stock por depósito en API Dragonfish.
-    
-    Args:
-        sku: SKU a consultar
-        timeout: Timeout en segundos
-        
-    Returns:
-        Dict con formato: {'DEP1': {'total': 10, 'reserved': 2}, ...}
-        
-    Raises:
-        requests.Timeout: Si la consulta supera el timeout
-        requests.HTTPError: Si hay error HTTP
+    query_val = article_base(sku_or_article)
+    matrix = stock_cache.get_or_load(query_val, lambda: _load_matrix(query_val, sku_or_article, timeout))
+    # Copia: la matriz cacheada es compartida entre hilos
+    return {k: dict(v) for k, v in matrix.items()}
+
+
+def prefetch_article_stock(skus: Iterable[str], timeout: int = 30, max_workers: int = 4) -> Dict[str, StockMatrix]:
+    """Trae por adelantado la matriz de cada artículo base distinto de la lista (en paralelo,
+    acotado). Deja la caché caliente para los get_stock_per_deposit siguientes y devuelve
+    {artículo_base: matriz}; los artículos que fallaron no aparecen."""
+    bases = []
+    for sku in skus or []:
+        b = article_base(sku)
+        if b and b.upper() not in {x.upper() for x in bases}:
+            bases.append(b)
+    out: Dict[str, StockMatrix] = {}
+    if not bases:
+        return out
+
+    def _one(b: str):
+        try:
+            return b, get_article_stock(b, timeout=timeout)
+        except Exception as e:
+            logger.warning(f"Prefetch de stock falló para {b}: {e}")
+            return b, None
+
+    if len(bases) == 1 or max_workers <= 1:
+        results = [_one(b) for b in bases]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(bases))) as ex:
+            results = list(ex.map(_one, bases))
+    for b, m in results:
+        if m is not None:
+            out[b.upper()] = m
+    return out
+
+
+def _fetch_entre_locales(query_val: str, sku: str, timeout: int = 30) -> Any:
+    """GET a ConsultaStockYPreciosEntreLocales por artículo base, probando bases y
+    credenciales en orden. Devuelve el JSON crudo; levanta el último error si ninguna respondió.
     """
     # Construir listas de bases/credenciales en orden de preferencia (primaria → alternativa)
-    global _LAST_METHOD
     bases_all = []
     if DRAGON_API_BASES:
         bases_all.extend(DRAGON_API_BASES)
@@ -69,32 +234,19 @@ def get_stock_per_deposit(sku: str, timeout: int = 30) -> Dict[str, Dict[str, in
     cred_options = [
         {
             "IdCliente": DRAGON_ID_CLIENTE or "",
-            "Authorization": DRAGON_API_KEY or "",
+            "Token": DRAGON_API_KEY or "",
+            "Label": "primary",
         },
     ]
     if DRAGON_ALT_ID_CLIENTE or DRAGON_ALT_API_KEY:
         cred_options.append({
             "IdCliente": DRAGON_ALT_ID_CLIENTE or DRAGON_ID_CLIENTE or "",
-            "Authorization": DRAGON_ALT_API_KEY or DRAGON_API_KEY or "",
+            "Token": DRAGON_ALT_API_KEY or DRAGON_API_KEY or "",
+            "Label": "alt",
         })
 
-    # Derivar ARTÍCULO BASE para la consulta (antes del primer '-')
-    # Ej: 'NWQRDHBRDV-VCF-04' -> 'NWQRDHBRDV'
-    s_in = (sku or '').strip()
-    if s_in.upper().startswith('TDRK20'):
-        query_val = 'TDRK20'
-    else:
-        query_val = s_in.split('-')[0] if '-' in s_in else s_in
-    # Intentar extraer color/talle de SKU completo (ART-COLOR-TALLE)
-    parts = s_in.split('-')
-    color_q = parts[1].strip() if len(parts) >= 3 else None
-    talle_q = parts[2].strip() if len(parts) >= 3 else None
-
-    # La base debe apuntar a .../ConsultaStockYPreciosEntreLocales
-    # 1) Intento principal: ConsultaStockYPreciosEntreLocales (sin BaseDeDatos)
-    last_exc: Optional[Exception] = None
-    data = None
-    entre_locales_worked = False
+    # La base debe apuntar a .../ConsultaStockYPreciosEntreLocales (sin BaseDeDatos)
+    urls = []
     for base in bases_all or ([DRAGON_API_BASE] if DRAGON_API_BASE else []):
         if not base:
             continue
@@ -102,39 +254,65 @@ def get_stock_per_deposit(sku: str, timeout: int = 30) -> Dict[str, Dict[str, in
         # Asegurar que el path apunte al recurso EntreLocales si la base termina en ConsultaStockYPrecios
         if url.lower().endswith('/consultastockyprecios'):
             url = url + 'EntreLocales'
-        logger.debug(f"Consultando Dragonfish EntreLocales: url={url} params={{'query': '{query_val}', 'page': 1, 'limit': 100}}")
-        params = {"query": query_val, "page": 1, "limit": 100}
-        for cred in cred_options:
-            headers = {
-                "accept": "application/json",
-                "IdCliente": cred["IdCliente"],
-                "Authorization": cred["Authorization"],
-            }
-            try:
-                resp = requests.get(url, headers=headers, params=params, timeout=timeout, allow_redirects=True)
-                if resp.status_code in (400, 401, 404, 405):
-                    safe_auth = (headers.get("Authorization") or "")[0:6] + "..."
-                    logger.warning(f"Dragonfish {resp.status_code} en {url} query={query_val} IdCliente={headers.get('IdCliente')} Auth={safe_auth}")
-                    last_exc = requests.HTTPError(f"HTTP {resp.status_code}")
-                    continue
-                resp.raise_for_status()
-                data = resp.json()
-                entre_locales_worked = True
-                break
-            except requests.Timeout as e:
-                last_exc = e
-                logger.error(f"Timeout consultando stock EntreLocales para {sku} en {url}")
-                continue
-            except requests.HTTPError as e:
-                last_exc = e
-                logger.error(f"HTTP error consultando stock EntreLocales para {sku} en {url}: {e}")
-                continue
-            except Exception as e:
-                last_exc = e
-                logger.error(f"Error inesperado consultando stock EntreLocales en {url}: {e}")
-                continue
-        if entre_locales_worked:
-            break
+        if url not in urls:
+            urls.append(url)
+    params = {"query": query_val, "page": 1, "limit": 100}
+    logger.debug(f"Consultando Dragonfish EntreLocales: urls={urls} params={params}")
+    # Cliente compartido: prueba primero la última base/credencial que funcionó y saltea
+    # bases con el circuito abierto; 400/401/404/405 pasan a la siguiente combinación
+    try:
+        resp = _http.request(
+            "GET",
+            purpose="stock",
+            urls=urls,
+            creds=cred_options,
+            params=params,
+            read_timeout=timeout,
+        )
+    except requests.Timeout:
+        logger.error(f"Timeout consultando stock EntreLocales para {sku} en {urls}")
+        raise
+    except Exception as e:
+        logger.error(f"Error consultando stock EntreLocales para {sku} en {urls}: {e}")
+        raise
+    if resp.status_code != 200:
+        logger.error(f"HTTP error consultando stock EntreLocales para {sku}: {resp.status_code}")
+        raise requests.HTTPError(f"HTTP {resp.status_code}")
+    hdrs_used = {k: v for k, v in resp.request.headers.items() if k in ("accept", "IdCliente", "Authorization")}
+    return _follow_siguiente(resp.json(), hdrs_used, timeout, query_val)
+
+
+def get_stock_per_deposit(sku: str, timeout: int = 30) -> Dict[str, Dict[str, int]]:
+    """
+    Consulta stock por depósito en API Dragonfish.
+    
+    Args:
+        sku: SKU a consultar
+        timeout: Timeout en segundos
+        
+    Returns:
+        Dict con formato: {'DEP1': {'total': 10, 'reserved': 2}, ...}
+        
+    Raises:
+        requests.Timeout: Si la consulta supera el timeout
+        requests.HTTPError: Si hay error HTTP
+    """
+    global _LAST_METHOD
+    # Derivar ARTÍCULO BASE para la consulta (antes del primer '-')
+    # Ej: 'NWQRDHBRDV-VCF-04' -> 'NWQRDHBRDV'
+    s_in = (sku or '').strip()
+    query_val = article_base(s_in)
+
+    # 1) Intento principal: EntreLocales por artículo base, compartido vía caché TTL
+    #    (todas las variantes del artículo filtran sobre la misma respuesta)
+    last_exc: Optional[Exception] = None
+    matrix: StockMatrix = {}
+    entre_locales_worked = False
+    try:
+        matrix = stock_cache.get_or_load(query_val, lambda: _load_matrix(query_val, sku, timeout))
+        entre_locales_worked = True
+    except Exception as e:
+        last_exc = e
 
     # Si EntreLocales no funcionó, fallback a SQL directo (pyodbc)
     if not entre_locales_worked:
@@ -151,65 +329,9 @@ def get_stock_per_deposit(sku: str, timeout: int = 30) -> Dict[str, Dict[str, in
             raise last_exc
         raise requests.HTTPError("Dragonfish EntreLocales y SQL sin resultados")
 
-    # Parsear estructura Dragonfish: Resultados[...].Stock[{ BaseDeDatos, Stock }]
-    result: Dict[str, Dict[str, int]] = {}
-    # Lista blanca de bases permitidas (nombres crudos tal como vienen en JSON)
-    allowed_raw = {
-        'DEPOSITO',
-        'MONBAHIA',
-        'MTGBBPS',
-        'BBPS',  # alias histórico, se mapea a MTGBBPS
-        'MTGROCA',
-        'MUNDOAL',
-        'MUNDOCAB',
-        'MUNDOROC',
-        'NQNALB',
-    }
+    # Filtrar la matriz del artículo por Color/Talle
     try:
-        resultados = data.get("Resultados") if isinstance(data, dict) else None
-        if not isinstance(resultados, list):
-            # Si no viene en el formato esperado, registrar y devolver vacío
-            logger.debug("Respuesta Dragonfish sin 'Resultados' lista")
-            return result
-        # Filtrar por artículo exacto y, si se provee, por Color/Talle
-        query_art = (query_val or '').strip().upper()
-        color_norm = _norm(color_q) if color_q else None
-        talle_norm = _norm(talle_q) if talle_q else None
-        for item in resultados:
-            if not isinstance(item, dict):
-                continue
-            art = str(item.get('Articulo', '')).strip().upper()
-            if art != query_art:
-                # Ignorar otros artículos para evitar contaminar el stock
-                continue
-            # Si se especificó variante, filtrar por Color/Talle
-            if color_norm or talle_norm:
-                it_color = _norm(item.get('Color') or item.get('COLOR') or item.get('color'))
-                it_talle = _norm(item.get('Talle') or item.get('TALLE') or item.get('talle'))
-                color_ok = (color_norm is None) or (it_color == color_norm)
-                talle_ok = (talle_norm is None) or _eq_talle(it_talle, talle_norm)
-                if not (color_ok and talle_ok):
-                    continue
-            stocks = item.get("Stock", []) if isinstance(item, dict) else []
-            for s in stocks:
-                depot_raw = str(s.get("BaseDeDatos", "")).strip().upper()
-                if not depot_raw:
-                    continue
-                # Ignorar bases no permitidas
-                if depot_raw not in allowed_raw:
-                    continue
-                # Mapear nombre interno: DEPOSITO -> DEP, BBPS -> MTGBBPS
-                if depot_raw == 'DEPOSITO':
-                    depot = 'DEP'
-                elif depot_raw == 'BBPS':
-                    depot = 'MTGBBPS'
-                else:
-                    depot = depot_raw
-                total = int(s.get("Stock") or 0)
-                cur = result.get(depot, {"total": 0, "reserved": 0})
-                # Usar el mayor total reportado por seguridad (si vinieran múltiples líneas por depósito)
-                cur["total"] = max(cur["total"], total)
-                result[depot] = cur
+        result = stock_for_variant(matrix, s_in)
     except Exception as e:
         logger.error(f"Error parseando respuesta Dragonfish para {sku}: {e}")
         return {}
@@ -221,45 +343,28 @@ def get_stock_per_deposit(sku: str, timeout: int = 30) -> Dict[str, Dict[str, in
 def _get_stock_per_deposit_sql(sku: str) -> Dict[str, Dict[str, int]]:
     """Consulta stock por depósito usando SQL Server (pyodbc), sumando todas las bases DRAGONFISH_*
     que estén ONLINE, excluyendo las bases especiales comunes.
+    Las bases se consultan en paralelo con timeout por base (modules/dragon_sql_stock.py).
     Retorna {'DEPOT': {'total': X, 'reserved': 0}, ...}
     """
     try:
-        import os, pyodbc
-        conn_str = os.getenv('DRAGON_SQL_CONN_STR')
-        if not conn_str:
-            raise RuntimeError('DRAGON_SQL_CONN_STR no configurado')
-        art, col, tal = sku.split('-', 2) if '-' in sku else (sku, '', '')
-        sql_tpl = (
-            "SELECT RTRIM(BDALTAFW) AS dep, SUM(COCANT) "
-            "FROM   [{base}].[ZooLogic].[COMB] "
-            "WHERE  RTRIM(COART)=? AND RTRIM(COCOL)=? AND RTRIM(TALLE)=? "
-            "GROUP BY BDALTAFW HAVING SUM(COCANT)<>0"
-        )
-        exclude = {'MELI','ADMIN','WOO','TN'}
-        res: Dict[str, Dict[str, int]] = {}
-        with pyodbc.connect(conn_str, autocommit=True) as con:
-            cur = con.cursor()
-            bases = [
-                n for (n,) in cur.execute(
-                    "SELECT name FROM sys.databases WHERE name LIKE 'DRAGONFISH_%' AND state_desc='ONLINE'"
-                )
-                if not any(bad in n.upper() for bad in exclude)
-            ]
-            for base in bases:
-                try:
-                    rows = cur.execute(sql_tpl.format(base=base), art, col, tal).fetchall()
-                    for dep, qty in rows:
-                        dep_up = str(dep).strip().upper()
-                        total_prev = int((res.get(dep_up) or {}).get('total') or 0)
-                        res[dep_up] = {'total': total_prev + int(qty), 'reserved': 0}
-                except Exception:
-                    continue
-        return res
+        from modules.dragon_sql_stock import get_engine
+        return get_engine().stock_per_deposit(sku)
     except Exception as e:
         logger.warning(f"SQL fallback error para {sku}: {e}")
         return {}
 
 
+def get_stock_per_deposit_sql_many(skus: Iterable[str]) -> Dict[str, Dict[str, Dict[str, int]]]:
+    """Fallback SQL para muchos SKUs en un solo batch UNION ALL sobre todas las bases.
+    Retorna {sku: {'DEPOT': {'total': X, 'reserved': 0}}}; vacío si SQL no está disponible."""
+    try:
+        from modules.dragon_sql_stock import get_engine
+        return get_engine().stock_per_deposit_many(skus)
+    except Exception as e:
+        logger.warning(f"SQL fallback batch error: {e}")
+        return {}
+
+
 def get_stock_per_deposit_paged(sku: str, timeout: int = 30, max_pages: int = 10) -> Dict[str, Dict[str, int]]:
     """
     Variante paginada: itera páginas si la API lo indica.
@@ -12,9 +12,12 @@ import time
 import requests
 import os
 import importlib.util
-from typing import Optional, List, Dict, Tuple
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Iterable, Optional, List, Dict, Tuple
 import json
-from sqlalchemy import text
+from sqlalchemy import text, bindparam
 
 # Cargar módulos con nombre de archivo que comienzan con dígitos usando importlib
 BASE_DIR = os.path.dirname(__file__)
@@ -42,6 +45,11 @@ get_stock_by_sku = None
 _mod_dragon_api = _load_module('07_dragon_api.py', 'modules.07_dragon_api')
 get_stock_per_deposit = getattr(_mod_dragon_api, 'get_stock_per_deposit', None)
 get_last_method = getattr(_mod_dragon_api, 'get_last_method', lambda: 'API')
+# Matriz por artículo (una consulta sirve a todas las variantes color/talle)
+prefetch_article_stock = getattr(_mod_dragon_api, 'prefetch_article_stock', None)
+stock_for_variant = getattr(_mod_dragon_api, 'stock_for_variant', None)
+get_stock_per_deposit_sql_many = getattr(_mod_dragon_api, 'get_stock_per_deposit_sql_many', None)
+article_base = getattr(_mod_dragon_api, 'article_base', lambda s: str(s or '').split('-')[0])
 
 _mod_assigner = _load_module('07_assigner.py', 'modules.07_assigner')
 choose_winner = _mod_assigner.choose_winner
@@ -58,11 +66,17 @@ alert_stock_zero = _mod_notifier.alert_stock_zero
 
 _mod_move = _load_module('09_dragon_movement.py', 'modules.09_dragon_movement')
 move_stock_woo_to_woo = _mod_move.move_stock_woo_to_woo
+# Movimiento con N líneas (un POST por pack/depósito)
+move_stock_lines = _mod_move.move_stock_lines
 
 # Publicador de notas ML (idempotente)
 _mod_notes = _load_module('10_note_publisher.py', 'modules.10_note_publisher')
 publish_note_upsert = _mod_notes.publish_note_upsert
 
+# Orden de prioridad de depósitos compartido (RECOMMEND_DEPOT_ORDER vía 07_assigner, sin deshabilitados)
+_mod_reco = _load_module('depot_recommender.py', 'modules.depot_recommender')
+assign_priority = _mod_reco.assign_priority
+
 logger = logging.getLogger(__name__)
 
 
@@ -142,15 +156,98 @@ def _detect_seller_id(order) -> Optional[int]:
     return None
 
 
-def assign_pending() -> int:
+try:
+    ASSIGN_CONCURRENCY = max(1, int(os.getenv('ASSIGN_CONCURRENCY', '4')))
+except Exception:
+    ASSIGN_CONCURRENCY = 4
+try:
+    ASSIGN_CYCLE_DEADLINE_SECS = float(os.getenv('ASSIGN_CYCLE_DEADLINE_SECS', '300'))
+except Exception:
+    ASSIGN_CYCLE_DEADLINE_SECS = 300.0
+
+# Locks por SKU: las lecturas de reservas y escrituras de asignación de un mismo SKU
+# van de a una aunque el ciclo procese órdenes en paralelo
+_SKU_LOCKS: Dict[str, threading.Lock] = {}
+_SKU_LOCKS_GUARD = threading.Lock()
+
+
+@contextlib.contextmanager
+def _sku_locks(skus: List[str]):
+    keys = sorted({str(s or '').strip().upper() for s in skus if s})
+    with _SKU_LOCKS_GUARD:
+        locks = [_SKU_LOCKS.setdefault(k, threading.Lock()) for k in keys]
+    with contextlib.ExitStack() as stack:
+        # Orden fijo (alfabético) para no generar deadlocks entre packs con SKUs cruzados
+        for lk in locks:
+            stack.enter_context(lk)
+        yield
+
+
+def _run_unit(kind: str, key: str, items: List) -> int:
+    """Procesa un pack o una orden individual y devuelve cuántas órdenes quedaron asignadas.
+    El stock se trae fuera del lock (en paralelo con otros SKUs); reservas + asignación
+    + movimiento corren con el lock de los SKUs involucrados."""
+    t0 = time.monotonic()
+    skus = [getattr(it, 'sku', None) for it in items]
+    ok_count = 0
+    try:
+        if prefetch_article_stock is not None:
+            try:
+                prefetch_article_stock([s for s in skus if s], timeout=120)
+            except Exception:
+                pass
+        t_stock = time.monotonic()
+        with _sku_locks(skus):
+            t_lock = time.monotonic()
+            if kind == 'pack':
+                ok = assign_pack_multiventa(key, items)
+                ok_count = len(items) if ok else 0
+            else:
+                # Sin reintentos con sleep: un timeout difiere la orden al próximo ciclo
+                ok_count = 1 if assign_single_order(items[0], max_retries=1) else 0
+        t1 = time.monotonic()
+        logger.info(
+            f"⏱️ {kind} {key}: {int((t1 - t0) * 1000)} ms (stock {int((t_stock - t0) * 1000)} ms, "
+            f"espera lock {int((t_lock - t_stock) * 1000)} ms) asignadas={ok_count}/{len(items)}"
+        )
+    except Exception as e:
+        logger.error(f"Error procesando {kind} {key}: {e} ({int((time.monotonic() - t0) * 1000)} ms)")
+    return ok_count
+
+
+def assign_pending(concurrency: Optional[int] = None, deadline_secs: Optional[float] = None) -> int:
     """
     Asigna depósitos a todas las órdenes pendientes.
-    
+
+    Con concurrency > 1 (ASSIGN_CONCURRENCY) packs e individuales se procesan en paralelo
+    con locks por SKU y un deadline por ciclo (ASSIGN_CYCLE_DEADLINE_SECS): lo que no
+    arrancó a tiempo queda para el próximo ciclo. concurrency=1 mantiene el modo secuencial.
+
     Returns:
         int: Número de órdenes procesadas exitosamente
     """
-    processed = 0
-    pending_orders = get_pending_ready()
+    return _assign_pending_orders(get_pending_ready(), concurrency, deadline_secs)
+
+
+def assign_orders(order_ids: Iterable[str], concurrency: Optional[int] = None, deadline_secs: Optional[float] = None) -> int:
+    """
+    Asignación disparada por evento (orden que pasó a ready_to_print): procesa sólo esas
+    órdenes, con sus packs completos, con la misma lógica que assign_pending
+    (assign_pack_multiventa / assign_single_order, locks por SKU). Las que ya estaban
+    asignadas o agotadas no se tocan.
+
+    Returns:
+        int: Número de órdenes procesadas exitosamente
+    """
+    pending = get_pending_ready(order_ids=order_ids)
+    if not pending:
+        return 0
+    return _assign_pending_orders(pending, concurrency, deadline_secs)
+
+
+def _assign_pending_orders(pending_orders: List, concurrency: Optional[int], deadline_secs: Optional[float]) -> int:
+    workers = int(concurrency if concurrency is not None else ASSIGN_CONCURRENCY)
+    deadline = float(deadline_secs if deadline_secs is not None else ASSIGN_CYCLE_DEADLINE_SECS)
 
     # Agrupar por pack_id y separar en 'packs' reales (>1 ítem) vs 'individuales'
     tmp_groups: Dict[str, List] = {}
@@ -171,9 +268,52 @@ def assign_pending() -> int:
             singles.extend(items)
 
     total_units = len(pending_orders)
-    logger.info(f"Procesando {total_units} órdenes pendientes (packs={len(packs)}, individuales={len(singles)})")
+    logger.info(f"Procesando {total_units} órdenes pendientes (packs={len(packs)}, individuales={len(singles)}, workers={workers})")
 
-    # Primero procesar packs multiventa
+    # Reservas/agotados de todo el lote en una consulta; se mantiene en memoria durante el ciclo
+    try:
+        _RESERVATIONS.begin([getattr(o, 'sku', None) for o in pending_orders])
+    except Exception as e:
+        logger.warning(f"Snapshot de reservas no disponible, se consulta por SKU: {e}")
+    try:
+        return _assign_units(packs, singles, workers, deadline, len(pending_orders))
+    finally:
+        _RESERVATIONS.end()
+
+
+def _assign_units(packs: Dict[str, List], singles: List, workers: int, deadline: float, total_orders: int) -> int:
+    processed = 0
+
+    if workers > 1 and (len(packs) + len(singles)) > 1:
+        # Packs primero en la cola, igual que el modo secuencial
+        units = [('pack', pid, items) for pid, items in packs.items()]
+        units += [('orden', str(o.order_id), [o]) for o in singles]
+        t_start = time.monotonic()
+        deferred = 0
+        ex = ThreadPoolExecutor(max_workers=min(workers, len(units)), thread_name_prefix='assign')
+        try:
+            futs = {ex.submit(_run_unit, *u): u for u in units}
+            remaining = deadline - (time.monotonic() - t_start) if deadline > 0 else None
+            done, not_done = wait(futs, timeout=remaining)
+            for fut in not_done:
+                # Las que no arrancaron se difieren; las que están corriendo se esperan
+                # (tienen timeouts HTTP acotados) para no pisarse con el próximo ciclo
+                if fut.cancel():
+                    deferred += len(futs[fut][2])
+            for fut in futs:
+                if not fut.cancelled():
+                    try:
+                        processed += int(fut.result() or 0)
+                    except Exception:
+                        pass
+        finally:
+            ex.shutdown(wait=True)
+        if deferred:
+            logger.warning(f"⏳ Deadline de ciclo ({deadline:.0f}s) alcanzado: {deferred} órdenes diferidas al próximo ciclo")
+        logger.info(f"Procesadas exitosamente: {processed}/{total_orders} órdenes en {int((time.monotonic() - t_start) * 1000)} ms")
+        return processed
+
+    # Modo secuencial: primero packs multiventa
     for pid, items in packs.items():
         try:
             if len(items) <= 1:
@@ -196,13 +336,125 @@ def assign_pending() -> int:
             logger.error(f"Error procesando orden {order.order_id}: {e}")
             continue
     
-    logger.info(f"Procesadas exitosamente: {processed}/{len(pending_orders)} órdenes")
+    logger.info(f"Procesadas exitosamente: {processed}/{total_orders} órdenes")
     return processed
 
 
+def _norm_depot(dep) -> str:
+    d = str(dep or '').strip().upper()
+    return 'MTGBBPS' if d == 'BBPS' else d
+
+
+class _ReservationSnapshot:
+    """Reservas activas y depósitos agotados por SKU, cargados con UNA consulta agrupada
+    para todo el lote pendiente (en lugar de dos consultas por SKU).
+
+    assign_pending la carga al empezar el ciclo (begin) y la descarta al terminar (end).
+    Durante el ciclo se actualiza en memoria cuando se reservan unidades
+    (_assign_with_values / assign_single_order), así las órdenes siguientes del mismo SKU
+    ven las reservas recién hechas. Fuera de un ciclo cada consulta va directo a la DB.
+    La reserva definitiva se sigue recalculando con UPDLOCK dentro de la transacción.
+    """
+
+    _SQL = """
+        SELECT sku, deposito_asignado AS depot,
+               SUM(CASE WHEN ISNULL(shipping_subestado, '') NOT IN ('printed','shipped','delivered','canceled')
+                         AND ISNULL(shipping_estado, '') NOT IN ('printed','shipped','delivered','canceled')
+                        THEN qty ELSE 0 END) AS qty_res,
+               MAX(CASE WHEN ISNULL(agotamiento_flag, 0) = 1 AND ISNULL(resultante, 1) <= 0
+                        THEN 1 ELSE 0 END) AS agotado
+        FROM orders_meli WITH (READPAST)
+        WHERE asignado_flag = 1
+          AND sku IN :skus
+        GROUP BY sku, deposito_asignado
+    """
+    _CHUNK = 500
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = False
+        self._reserved: Dict[str, Dict[str, int]] = {}
+        self._exhausted: Dict[str, set] = {}
+
+    @classmethod
+    def _query(cls, skus: List[str]) -> Tuple[Dict[str, Dict[str, int]], Dict[str, set]]:
+        reserved: Dict[str, Dict[str, int]] = {s: {} for s in skus}
+        exhausted: Dict[str, set] = {s: set() for s in skus}
+        stmt = text(cls._SQL).bindparams(bindparam('skus', expanding=True))
+        with SessionLocal() as session:
+            for i in range(0, len(skus), cls._CHUNK):
+                chunk = skus[i:i + cls._CHUNK]
+                for r in session.execute(stmt, {"skus": chunk}).fetchall():
+                    if not r.depot or r.sku not in reserved:
+                        continue
+                    dep = _norm_depot(r.depot)
+                    res = reserved[r.sku]
+                    res[dep] = res.get(dep, 0) + int(r.qty_res or 0)
+                    if int(r.agotado or 0):
+                        exhausted[r.sku].add(dep)
+        return reserved, exhausted
+
+    def begin(self, skus: List[str]) -> None:
+        uniq = sorted({str(s) for s in skus if s})
+        reserved, exhausted = self._query(uniq) if uniq else ({}, {})
+        with self._lock:
+            self._reserved, self._exhausted = reserved, exhausted
+            self._active = True
+        logger.debug(f"Snapshot de reservas: {len(uniq)} SKUs en una consulta")
+
+    def end(self) -> None:
+        with self._lock:
+            self._active = False
+            self._reserved, self._exhausted = {}, {}
+
+    def _get(self, sku: str) -> Tuple[Dict[str, int], set]:
+        with self._lock:
+            if self._active and sku in self._reserved:
+                return dict(self._reserved[sku]), set(self._exhausted.get(sku) or ())
+        reserved, exhausted = self._query([sku])
+        with self._lock:
+            if self._active:
+                # SKU que no estaba en el lote: incorporarlo para el resto del ciclo
+                self._reserved.setdefault(sku, reserved[sku])
+                self._exhausted.setdefault(sku, exhausted[sku])
+        return dict(reserved[sku]), set(exhausted[sku])
+
+    def apply(self, sku: str, stock: dict) -> dict:
+        """Aplica reservas y agotados del SKU sobre el stock por depósito (in place)."""
+        reserved, exhausted = self._get(sku)
+        # Aplicar reservas (agregado por depósito) normalizando alias BBPS -> MTGBBPS
+        for dep, qty in reserved.items():
+            vals = stock.get(dep) or {}
+            cur = int(vals.get('reserved') or 0)
+            stock[dep] = {**vals, 'reserved': cur + int(qty)}
+        # Marcar depósitos agotados como no disponibles
+        for dep in exhausted:
+            if dep in stock:
+                vals = stock[dep] or {}
+                # Forzar reserved = total para que available = 0
+                stock[dep] = {**vals, 'reserved': int(vals.get('total') or 0)}
+                logger.info(f"Depósito {dep} marcado como agotado para SKU {sku} (resultante <= 0)")
+        return stock
+
+    def reserve(self, sku: str, depot: str, qty: int, agotado: bool = False) -> None:
+        """Registrar una reserva recién escrita en DB (sólo tiene efecto durante un ciclo)."""
+        with self._lock:
+            if not self._active or sku not in self._reserved:
+                return
+            dep = _norm_depot(depot)
+            res = self._reserved[sku]
+            res[dep] = res.get(dep, 0) + int(qty or 0)
+            if agotado:
+                self._exhausted.setdefault(sku, set()).add(dep)
+
+
+_RESERVATIONS = _ReservationSnapshot()
+
+
 def _get_stock_with_reserves(sku: str) -> dict:
-    """Obtiene stock por depósito para un SKU aplicando reservas activas en DB.
-    También marca como agotados los depósitos que ya tienen resultante=0.
+    """Obtiene stock por depósito para un SKU aplicando reservas activas en DB
+    (snapshot del ciclo si está activo). También marca como agotados los depósitos
+    que ya tienen resultante=0.
     """
     if get_stock_per_deposit is None:
         raise RuntimeError('No hay cliente Dragonfish disponible')
@@ -210,61 +462,7 @@ def _get_stock_with_reserves(sku: str) -> dict:
     
     # aplicar reservas de DB para ese SKU y detectar depósitos agotados
     try:
-        with SessionLocal() as session:
-            # Obtener reservas activas por depósito (todas las órdenes asignadas y no impresas)
-            rows = session.execute(
-                text(
-                    """
-                    SELECT deposito_asignado AS depot, SUM(qty) AS qty_res
-                    FROM orders_meli WITH (READPAST)
-                    WHERE sku = :sku
-                      AND asignado_flag = 1
-                      AND ISNULL(shipping_subestado, '') NOT IN ('printed','shipped','delivered','canceled')
-                      AND ISNULL(shipping_estado, '') NOT IN ('printed','shipped','delivered','canceled')
-                    GROUP BY deposito_asignado
-                    """
-                ),
-                {"sku": sku},
-            ).fetchall()
-            
-            # Obtener depósitos ya agotados (resultante <= 0)
-            agotados = session.execute(
-                text(
-                    """
-                    SELECT DISTINCT deposito_asignado AS depot
-                    FROM orders_meli WITH (READPAST)
-                    WHERE sku = :sku
-                      AND asignado_flag = 1
-                      AND ISNULL(agotamiento_flag, 0) = 1
-                      AND ISNULL(resultante, 1) <= 0
-                    """
-                ),
-                {"sku": sku},
-            ).fetchall()
-            
-        # Aplicar reservas (agregado por depósito) normalizando alias BBPS -> MTGBBPS
-        for r in rows:
-            if r.depot:
-                dep = str(r.depot).strip().upper()
-                if dep == 'BBPS':
-                    dep = 'MTGBBPS'
-                vals = stock.get(dep) or {}
-                cur = int(vals.get('reserved') or 0)
-                stock[dep] = {**vals, 'reserved': cur + int(r.qty_res or 0)}
-                
-        # Marcar depósitos agotados como no disponibles (normalizando alias)
-        for r in agotados:
-            if r.depot:
-                dep = str(r.depot).strip().upper()
-                if dep == 'BBPS':
-                    dep = 'MTGBBPS'
-                if dep in stock:
-                    vals = stock[dep] or {}
-                    total = int(vals.get('total') or 0)
-                    # Forzar reserved = total para que available = 0
-                    stock[dep] = {**vals, 'reserved': total}
-                    logger.info(f"Depósito {dep} marcado como agotado para SKU {sku} (resultante <= 0)")
-                    
+        _RESERVATIONS.apply(sku, stock)
     except Exception as e:
         logger.warning(f"Error aplicando reservas/agotamiento para SKU {sku}: {e}")
         
@@ -293,6 +491,126 @@ def _sanitize_obs_for_note(s: Optional[str]) -> Optional[str]:
         return s
 
 
+def _pack_entry(it, sku: str, qty: int, depot: str, total: int, reserved: int, observacion: str) -> dict:
+    try:
+        _titulo = (getattr(it, 'nombre', None) or '').strip()
+        if _titulo:
+            observacion += f" | nombre={_titulo[:120]}"
+    except Exception:
+        pass
+    return {"it": it, "sku": sku, "qty": int(qty or 0), "depot": str(depot),
+            "total": int(total), "reserved": int(reserved), "observacion": observacion}
+
+
+def _pack_movements(pack_id: str, entries: List[dict], opcion: int, items_desc: str, label: str) -> None:
+    """Registra en Dragonfish UN movimiento por depósito del pack, con una línea (NroItem) por ítem,
+    y refleja el resultado (numero_movimiento, nota ML) en cada fila de orders_meli.
+    La Observacion del movimiento es estable por pack+depósito: un reintento devuelve 409 (éxito idempotente).
+    """
+    by_depot: Dict[str, List[dict]] = {}
+    for e in entries:
+        by_depot.setdefault(e["depot"], []).append(e)
+    for depot, group in by_depot.items():
+        order_ids = ",".join(str(e["it"].order_id) for e in group)
+        observacion_mov = f"MULTIVENTA OPCION:{opcion} | pack_id={pack_id} | items={items_desc} | " \
+                          f"MATIAPP MELI A MELI | order_ids={order_ids} | depo={depot} | op={opcion}"
+        lines = [{
+            "sku": e["sku"],
+            "qty": e["qty"],
+            "barcode": getattr(e["it"], 'barcode', None) or None,
+            "articulo_detalle": getattr(e["it"], 'nombre', None) or "",
+        } for e in group]
+        try:
+            mv = move_stock_lines(lines=lines, observacion=observacion_mov, tipo=2)
+        except Exception as ex:
+            mv = {"ok": False, "error": f"unexpected: {ex}"}
+        # Líneas omitidas por SKU inválido: esas órdenes quedan con su error y sin movimiento
+        skipped = {s.get("index"): s.get("error") for s in (mv.get("skipped") or [])}
+        logger.info(f"Pack {pack_id}: movimiento {depot} con {len(lines)} líneas ok={mv.get('ok')} "
+                    f"numero={mv.get('numero')} omitidas={len(skipped)}")
+        for idx, e in enumerate(group):
+            line_mv = {"ok": False, "error": skipped[idx]} if idx in skipped else mv
+            try:
+                _record_pack_movement(e, line_mv, label)
+            except Exception as ex:
+                logger.error(f"Error registrando movimiento de order_id={e['it'].order_id} (pack {pack_id}): {ex}")
+
+
+def _record_pack_movement(e: dict, mv: dict, label: str) -> None:
+    it, qty, depot, observacion = e["it"], e["qty"], e["depot"], e["observacion"]
+    with SessionLocal() as session:
+        with session.begin():
+            numero = mv.get('numero') or None
+            numero_str = str(numero) if numero is not None else ''
+            nota_mov = observacion + (f" | numero_movimiento={numero_str}" if numero_str else '')
+            if mv.get('ok'):
+                session.execute(
+                    text(
+                        """
+                        UPDATE orders_meli
+                        SET movimiento_realizado = 1,
+                            fecha_movimiento = SYSUTCDATETIME(),
+                            fecha_actualizacion = SYSUTCDATETIME(),
+                            observacion_movimiento = LEFT(:nota, 500),
+                            numero_movimiento = LEFT(:num, 100)
+                        WHERE id = :id AND (movimiento_realizado = 0 OR movimiento_realizado IS NULL)
+                        """
+                    ),
+                    {"id": it.id, "nota": nota_mov, "num": numero_str},
+                )
+                # Publicar nota ML idempotente
+                try:
+                    new_reserved = e["reserved"] + int(qty or 0)
+                    agotado = (e["total"] - new_reserved) <= 0
+                    res_note = publish_note_upsert(
+                        order_id=str(it.order_id),
+                        seller_id=(_detect_seller_id(it) or getattr(it, 'seller_id', None)),
+                        deposito_asignado=str(depot),
+                        qty=int(qty or 0),
+                        agotado=agotado,
+                        observacion_mov=_sanitize_obs_for_note(observacion),
+                        numero_mov=numero if numero is not None else None,
+                    )
+                    try:
+                        logger.info(
+                            f"Nota ML ({label}) order_id={it.order_id} seller_id={getattr(it, 'seller_id', None)} "
+                            f"depo={str(depot)} qty={int(qty or 0)} status={res_note.get('status')} ok={res_note.get('ok')} err={res_note.get('error')}"
+                        )
+                    except Exception:
+                        pass
+                    # Persistir bandera y texto si la publicación fue OK (columnas opcionales)
+                    try:
+                        if res_note.get('ok'):
+                            session.execute(
+                                text(
+                                    """
+                                    UPDATE orders_meli
+                                    SET nota_hecha = 1,
+                                        nota_texto_publicada = COALESCE(:texto, nota_texto_publicada),
+                                        fecha_nota = SYSUTCDATETIME()
+                                    WHERE id = :id
+                                    """
+                                ),
+                                {"id": it.id, "texto": (res_note.get('note') or '')[:2000]},
+                            )
+                    except Exception:
+                        # Columnas pueden no existir aún; ignorar
+                        pass
+                except Exception as ex:
+                    logger.warning(f"Nota ML ({label}) falló para {it.order_id}: {ex}")
+            else:
+                session.execute(
+                    text(
+                        """
+                        UPDATE orders_meli
+                        SET observacion_movimiento = LEFT(:nota, 500)
+                        WHERE id = :id
+                        """
+                    ),
+                    {"id": it.id, "nota": f"{observacion} | ERROR: {mv.get('error')}"},
+                )
+
+
 def assign_pack_multiventa(pack_id: str, items: List) -> bool:
     """
     Intenta asignar un pack completo siguiendo prioridades:
@@ -303,6 +621,12 @@ def assign_pack_multiventa(pack_id: str, items: List) -> bool:
     logger.info(f"🧺 Pack {pack_id}: {len(items)} ítems pendientes")
     # Preparar stocks por SKU
     sku_list = [(it, it.sku, int(it.qty or 0)) for it in items]
+    # Traer una vez cada artículo del pack (varios talles del mismo artículo = 1 consulta)
+    if prefetch_article_stock is not None:
+        try:
+            prefetch_article_stock([sku for _, sku, _ in sku_list], timeout=120)
+        except Exception as e:
+            logger.warning(f"Pack {pack_id}: prefetch de stock falló, se consulta por SKU: {e}")
     stocks: Dict[str, dict] = {}
     for _, sku, _qty in sku_list:
         stocks[sku] = _get_stock_with_reserves(sku)
@@ -319,124 +643,38 @@ def assign_pack_multiventa(pack_id: str, items: List) -> bool:
         all_caba = False
     if all_caba:
         logger.info(f"Pack {pack_id}: regla seller=756086955 → asignar MUNDOCAB sin evaluar clusters")
-        for it, sku, qty in sku_list:
-            vals = (stocks.get(sku) or {}).get('MUNDOCAB') or {}
-            total = int(vals.get('total') or 0)
-            reserved = int(vals.get('reserved') or 0)
-            _assign_with_values(
-                it,
-                depot='MUNDOCAB',
-                stock=stocks.get(sku) or {},
-                total=total,
-                reserved=reserved,
-                asignacion_detalle=json.dumps({
-                    "opcion": 1,
-                    "tipo": "single",
-                    "depo": "MUNDOCAB",
-                    "qty": int(qty),
-                    "method": str(get_last_method() or 'API'),
-                }, ensure_ascii=False),
-                opcion_elegida=1,
-            )
-            # Movimiento
-            observacion = f"MULTIVENTA OPCION:1 | pack_id={pack_id} | items={_items_desc} | " \
-                          f"MATIAPP MELI A MELI | order_id={it.order_id} | pack_id={pack_id} | op=1"
-            try:
-                _titulo = (getattr(it, 'nombre', None) or '').strip()
-                if _titulo:
-                    observacion += f" | nombre={_titulo[:120]}"
-            except Exception:
-                pass
-            sid_eff = _detect_seller_id(it)
-            mv = move_stock_woo_to_woo(
-                sku=sku,
-                qty=qty,
-                observacion=observacion,
-                tipo=2,
-                barcode=getattr(it, 'barcode', None) or None,
-                articulo_detalle=getattr(it, 'nombre', None) or "",
-            )
-            # Marcar movimiento
-            with SessionLocal() as session:
-                with session.begin():
-                    numero = mv.get('numero') or None
-                    numero_str = str(numero) if numero is not None else ''
-                    nota_mov = observacion + (f" | numero_movimiento={numero_str}" if numero_str else '')
-                    if mv.get('ok'):
-                        session.execute(
-                            text(
-                                """
-                                UPDATE orders_meli
-                                SET movimiento_realizado = 1,
-                                    fecha_movimiento = SYSUTCDATETIME(),
-                                    fecha_actualizacion = SYSUTCDATETIME(),
-                                    observacion_movimiento = LEFT(:nota, 500),
-                                    numero_movimiento = LEFT(:num, 100)
-                                WHERE id = :id AND (movimiento_realizado = 0 OR movimiento_realizado IS NULL)
-                                """
-                            ),
-                            {"id": it.id, "nota": nota_mov, "num": numero_str},
-                        )
-                        # Publicar nota ML idempotente
-                        try:
-                            # Calcular agotado con los valores usados en la asignación
-                            vals = (stocks.get(sku) or {}).get('MUNDOCAB') or {}
-                            total = int(vals.get('total') or 0)
-                            reserved = int(vals.get('reserved') or 0)
-                            new_reserved = reserved + int(qty or 0)
-                            agotado = (total - new_reserved) <= 0
-                            res_note = publish_note_upsert(
-                                order_id=str(it.order_id),
-                                seller_id=(_detect_seller_id(it) or getattr(it, 'seller_id', None)),
-                                deposito_asignado='MUNDOCAB',
-                                qty=int(qty or 0),
-                                agotado=agotado,
-                                observacion_mov=_sanitize_obs_for_note(observacion),
-                                numero_mov=numero if numero is not None else None,
-                            )
-                            try:
-                                logger.info(
-                                    f"Nota ML (pack regla 756086955) order_id={it.order_id} seller_id={getattr(it, 'seller_id', None)} "
-                                    f"depo=MUNDOCAB qty={int(qty or 0)} status={res_note.get('status')} ok={res_note.get('ok')} err={res_note.get('error')}"
-                                )
-                            except Exception:
-                                pass
-                            # Persistir bandera y texto si la publicación fue OK (columnas opcionales)
-                            try:
-                                if res_note.get('ok'):
-                                    session.execute(
-                                        text(
-                                            """
-                                            UPDATE orders_meli
-                                            SET nota_hecha = 1,
-                                                nota_texto_publicada = COALESCE(:texto, nota_texto_publicada),
-                                                fecha_nota = SYSUTCDATETIME()
-                                            WHERE id = :id
-                                            """
-                                        ),
-                                        {"id": it.id, "texto": (res_note.get('note') or '')[:2000]},
-                                    )
-                            except Exception:
-                                # Columnas pueden no existir aún; ignorar
-                                pass
-                        except Exception as e:
-                            logger.warning(f"Nota ML (pack regla 756086955) falló para {it.order_id}: {e}")
-                    else:
-                        session.execute(
-                            text(
-                                """
-                                UPDATE orders_meli
-                                SET observacion_movimiento = LEFT(:nota, 500)
-                                WHERE id = :id
-                                """
-                            ),
-                            {"id": it.id, "nota": f"{observacion} | ERROR: {mv.get('error')}"},
-                        )
+        entries: List[dict] = []
+        try:
+            for it, sku, qty in sku_list:
+                vals = (stocks.get(sku) or {}).get('MUNDOCAB') or {}
+                total = int(vals.get('total') or 0)
+                reserved = int(vals.get('reserved') or 0)
+                _assign_with_values(
+                    it,
+                    depot='MUNDOCAB',
+                    stock=stocks.get(sku) or {},
+                    total=total,
+                    reserved=reserved,
+                    asignacion_detalle=json.dumps({
+                        "opcion": 1,
+                        "tipo": "single",
+                        "depo": "MUNDOCAB",
+                        "qty": int(qty),
+                        "method": str(get_last_method() or 'API'),
+                    }, ensure_ascii=False),
+                    opcion_elegida=1,
+                )
+                observacion = f"MULTIVENTA OPCION:1 | pack_id={pack_id} | items={_items_desc} | " \
+                              f"MATIAPP MELI A MELI | order_id={it.order_id} | pack_id={pack_id} | op=1"
+                entries.append(_pack_entry(it, sku, qty, 'MUNDOCAB', total, reserved, observacion))
+        finally:
+            # Un movimiento con N líneas para lo que se llegó a asignar
+            _pack_movements(pack_id, entries, 1, _items_desc, "pack regla 756086955")
         return True
 
     # 1) Un único depósito que cubra todos
-    allowed = set(getattr(_mod_assigner, 'PUNTOS', {}).keys())
-    candidate_depots = [d for d in list(allowed) if str(d).upper() != 'MELI']
+    # Recorrer en orden de prioridad (antes se iteraba un set, sin orden definido)
+    candidate_depots = assign_priority()
     def _avail(depot: str, sku: str) -> int:
         d = stocks[sku].get(depot) or {}
         return max(int(d.get('total') or 0) - int(d.get('reserved') or 0), 0)
@@ -450,113 +688,31 @@ def assign_pack_multiventa(pack_id: str, items: List) -> bool:
     if single_ok:
         logger.info(f"Pack {pack_id}: opción 1 (single) en {single_ok}")
         # Asignar cada ítem al mismo depósito, con detalle opción 1 + movimiento
-        for it, sku, qty in sku_list:
-            _assign_with_values(
-                it,
-                depot=single_ok,
-                stock=stocks[sku],
-                total=int(stocks[sku].get(single_ok, {}).get('total') or 0),
-                reserved=int(stocks[sku].get(single_ok, {}).get('reserved') or 0),
-                asignacion_detalle=json.dumps({
-                    "opcion": 1,
-                    "tipo": "single",
-                    "depo": str(single_ok),
-                    "qty": int(qty),
-                    "method": str(get_last_method() or 'API'),
-                }, ensure_ascii=False),
-                opcion_elegida=1,
-            )
-            # Movimiento
-            observacion = f"MULTIVENTA OPCION:1 | pack_id={pack_id} | items={_items_desc} | " \
-                          f"MATIAPP MELI A MELI | order_id={it.order_id} | pack_id={pack_id} | op=1"
-            try:
-                _titulo = (getattr(it, 'nombre', None) or '').strip()
-                if _titulo:
-                    observacion += f" | nombre={_titulo[:120]}"
-            except Exception:
-                pass
-            sid_eff = _detect_seller_id(it)
-            mv = move_stock_woo_to_woo(
-                sku=sku,
-                qty=qty,
-                observacion=observacion,
-                tipo=2,
-                barcode=getattr(it, 'barcode', None) or None,
-                articulo_detalle=getattr(it, 'nombre', None) or "",
-            )
-            # Marcar movimiento
-            with SessionLocal() as session:
-                with session.begin():
-                    numero = mv.get('numero') or None
-                    numero_str = str(numero) if numero is not None else ''
-                    nota_mov = observacion + (f" | numero_movimiento={numero_str}" if numero_str else '')
-                    if mv.get('ok'):
-                        session.execute(
-                            text(
-                                """
-                                UPDATE orders_meli
-                                SET movimiento_realizado = 1,
-                                    fecha_movimiento = SYSUTCDATETIME(),
-                                    fecha_actualizacion = SYSUTCDATETIME(),
-                                    observacion_movimiento = LEFT(:nota, 500),
-                                    numero_movimiento = LEFT(:num, 100)
-                                WHERE id = :id AND (movimiento_realizado = 0 OR movimiento_realizado IS NULL)
-                                """
-                            ),
-                            {"id": it.id, "nota": nota_mov, "num": numero_str},
-                        )
-                        # Publicar nota ML idempotente (pack opción single_ok)
-                        try:
-                            tot = int(stocks[sku].get(single_ok, {}).get('total') or 0)
-                            res = int(stocks[sku].get(single_ok, {}).get('reserved') or 0)
-                            new_reserved = res + int(qty or 0)
-                            agotado = (tot - new_reserved) <= 0
-                            res_note = publish_note_upsert(
-                                order_id=str(it.order_id),
-                                seller_id=(sid_eff or getattr(it, 'seller_id', None)),
-                                deposito_asignado=str(single_ok),
-                                qty=int(qty or 0),
-                                agotado=agotado,
-                                observacion_mov=_sanitize_obs_for_note(observacion),
-                                numero_mov=numero if numero is not None else None,
-                            )
-                            try:
-                                logger.info(
-                                    f"Nota ML (pack single) order_id={it.order_id} seller_id={getattr(it, 'seller_id', None)} "
-                                    f"depo={str(single_ok)} qty={int(qty or 0)} status={res_note.get('status')} ok={res_note.get('ok')} err={res_note.get('error')}"
-                                )
-                            except Exception:
-                                pass
-                            # Persistir bandera y texto si la publicación fue OK (columnas opcionales)
-                            try:
-                                if res_note.get('ok'):
-                                    session.execute(
-                                        text(
-                                            """
-                                            UPDATE orders_meli
-                                            SET nota_hecha = 1,
-                                                nota_texto_publicada = COALESCE(:texto, nota_texto_publicada),
-                                                fecha_nota = SYSUTCDATETIME()
-                                            WHERE id = :id
-                                            """
-                                        ),
-                                        {"id": it.id, "texto": (res_note.get('note') or '')[:2000]},
-                                    )
-                            except Exception:
-                                pass
-                        except Exception as e:
-                            logger.warning(f"Nota ML (pack single_ok) falló para {it.order_id}: {e}")
-                    else:
-                        session.execute(
-                            text(
-                                """
-                                UPDATE orders_meli
-                                SET observacion_movimiento = LEFT(:nota, 500)
-                                WHERE id = :id
-                                """
-                            ),
-                            {"id": it.id, "nota": f"{observacion} | ERROR: {mv.get('error')}"},
-                        )
+        entries = []
+        try:
+            for it, sku, qty in sku_list:
+                tot = int(stocks[sku].get(single_ok, {}).get('total') or 0)
+                res = int(stocks[sku].get(single_ok, {}).get('reserved') or 0)
+                _assign_with_values(
+                    it,
+                    depot=single_ok,
+                    stock=stocks[sku],
+                    total=tot,
+                    reserved=res,
+                    asignacion_detalle=json.dumps({
+                        "opcion": 1,
+                        "tipo": "single",
+                        "depo": str(single_ok),
+                        "qty": int(qty),
+                        "method": str(get_last_method() or 'API'),
+                    }, ensure_ascii=False),
+                    opcion_elegida=1,
+                )
+                observacion = f"MULTIVENTA OPCION:1 | pack_id={pack_id} | items={_items_desc} | " \
+                              f"MATIAPP MELI A MELI | order_id={it.order_id} | pack_id={pack_id} | op=1"
+                entries.append(_pack_entry(it, sku, qty, str(single_ok), tot, res, observacion))
+        finally:
+            _pack_movements(pack_id, entries, 1, _items_desc, "pack single")
         return True
 
     # 2) Un solo cluster que cubra todos (pueden ser distintos depósitos dentro del cluster)
@@ -587,117 +743,34 @@ def assign_pack_multiventa(pack_id: str, items: List) -> bool:
             if possible and choices:
                 logger.info(f"Pack {pack_id}: opción 2 (cluster {cname})")
                 # Asignar cada ítem en su depósito elegido dentro del cluster + movimiento
-                for it, sku, qty, d in choices:
-                    det = {
-                        "opcion": 2,
-                        "tipo": "cluster",
-                        "cluster": cname,
-                        "qty": int(qty),
-                        "distribucion": [{"depo": d, "qty": int(qty)}],
-                        "method": str(get_last_method() or 'API'),
-                    }
-                    vals = stocks[sku].get(d) or {}
-                    _assign_with_values(
-                        it,
-                        depot=d,
-                        stock=stocks[sku],
-                        total=int(vals.get('total') or 0),
-                        reserved=int(vals.get('reserved') or 0),
-                        asignacion_detalle=json.dumps(det, ensure_ascii=False),
-                        opcion_elegida=2,
-                    )
-                    # Movimiento con dist info
-                    observacion = f"MULTIVENTA OPCION:2 | pack_id={pack_id} | items={_items_desc} | " \
-                                  f"MATIAPP MELI A MELI | order_id={it.order_id} | pack_id={pack_id} | dist={d}:{int(qty)} | op=2"
-                    try:
-                        _titulo = (getattr(it, 'nombre', None) or '').strip()
-                        if _titulo:
-                            observacion += f" | nombre={_titulo[:120]}"
-                    except Exception:
-                        pass
-                    sid_eff2 = _detect_seller_id(it)
-                    mv = move_stock_woo_to_woo(
-                        sku=sku,
-                        qty=qty,
-                        observacion=observacion,
-                        tipo=2,
-                        barcode=getattr(it, 'barcode', None) or None,
-                        articulo_detalle=getattr(it, 'nombre', None) or "",
-                    )
-                    with SessionLocal() as session:
-                        with session.begin():
-                            numero = mv.get('numero') or None
-                            numero_str = str(numero) if numero is not None else ''
-                            nota_mov = observacion + (f" | numero_movimiento={numero_str}" if numero_str else '')
-                            if mv.get('ok'):
-                                session.execute(
-                                    text(
-                                        """
-                                        UPDATE orders_meli
-                                        SET movimiento_realizado = 1,
-                                            fecha_movimiento = SYSUTCDATETIME(),
-{{ ... }}
-                                            fecha_actualizacion = SYSUTCDATETIME(),
-                                            observacion_movimiento = LEFT(:nota, 500),
-                                            numero_movimiento = LEFT(:num, 100)
-                                        WHERE id = :id AND (movimiento_realizado = 0 OR movimiento_realizado IS NULL)
-                                        """
-                                    ),
-                                    {"id": it.id, "nota": nota_mov, "num": numero_str},
-                                )
-                                # Publicar nota ML idempotente
-                                try:
-                                    vals2 = stocks[sku].get(d) or {}
-                                    tot2 = int(vals2.get('total') or 0)
-                                    res2 = int(vals2.get('reserved') or 0)
-                                    new_reserved2 = res2 + int(qty or 0)
-                                    agotado2 = (tot2 - new_reserved2) <= 0
-                                    res_note = publish_note_upsert(
-                                        order_id=str(it.order_id),
-                                        seller_id=(sid_eff2 or getattr(it, 'seller_id', None)),
-                                        deposito_asignado=str(d),
-                                        qty=int(qty or 0),
-                                        agotado=agotado2,
-                                        observacion_mov=_sanitize_obs_for_note(observacion),
-                                        numero_mov=numero if numero is not None else None,
-                                    )
-                                    try:
-                                        logger.info(
-                                            f"Nota ML (pack cluster) order_id={it.order_id} seller_id={getattr(it, 'seller_id', None)} "
-                                            f"depo={str(d)} qty={int(qty or 0)} status={res_note.get('status')} ok={res_note.get('ok')} err={res_note.get('error')}"
-                                        )
-                                    except Exception:
-                                        pass
-                                    # Persistir bandera y texto si la publicación fue OK (columnas opcionales)
-                                    try:
-                                        if res_note.get('ok'):
-                                            session.execute(
-                                                text(
-                                                    """
-                                                    UPDATE orders_meli
-                                                    SET nota_hecha = 1,
-                                                        nota_texto_publicada = COALESCE(:texto, nota_texto_publicada),
-                                                        fecha_nota = SYSUTCDATETIME()
-                                                    WHERE id = :id
-                                                    """
-                                                ),
-                                                {"id": it.id, "texto": (res_note.get('note') or '')[:2000]},
-                                            )
-                                    except Exception:
-                                        pass
-                                except Exception as e:
-                                    logger.warning(f"Nota ML (pack cluster) falló para {it.order_id}: {e}")
-                            else:
-                                session.execute(
-                                    text(
-                                        """
-                                        UPDATE orders_meli
-                                        SET observacion_movimiento = LEFT(:nota, 500)
-                                        WHERE id = :id
-                                        """
-                                    ),
-                                    {"id": it.id, "nota": f"{observacion} | ERROR: {mv.get('error')}"},
-                                )
+                entries = []
+                try:
+                    for it, sku, qty, d in choices:
+                        det = {
+                            "opcion": 2,
+                            "tipo": "cluster",
+                            "cluster": cname,
+                            "qty": int(qty),
+                            "distribucion": [{"depo": d, "qty": int(qty)}],
+                            "method": str(get_last_method() or 'API'),
+                        }
+                        vals = stocks[sku].get(d) or {}
+                        _assign_with_values(
+                            it,
+                            depot=d,
+                            stock=stocks[sku],
+                            total=int(vals.get('total') or 0),
+                            reserved=int(vals.get('reserved') or 0),
+                            asignacion_detalle=json.dumps(det, ensure_ascii=False),
+                            opcion_elegida=2,
+                        )
+                        observacion = f"MULTIVENTA OPCION:2 | pack_id={pack_id} | items={_items_desc} | " \
+                                      f"MATIAPP MELI A MELI | order_id={it.order_id} | pack_id={pack_id} | dist={d}:{int(qty)} | op=2"
+                        entries.append(_pack_entry(it, sku, qty, d, int(vals.get('total') or 0),
+                                                   int(vals.get('reserved') or 0), observacion))
+                finally:
+                    # Un movimiento por depósito del cluster, con una línea por ítem
+                    _pack_movements(pack_id, entries, 2, _items_desc, "pack cluster")
                 return True
 
     # 3) No se puede sin partir. Si está habilitado, generar split detallado por SKU y publicar nota; si ni dividido alcanza, opción 4
@@ -867,6 +940,7 @@ def _assign_with_values(order, depot: str, stock: dict, total: int, reserved: in
         'stock_mtgroca': _tot('MTGROCA'),
         'stock_mundoroc': _tot('MUNDOROC'),
     }
+    reserved_now = False
     with SessionLocal() as session:
         with session.begin():
             locked_row = session.execute(
@@ -949,22 +1023,26 @@ def _assign_with_values(order, depot: str, stock: dict, total: int, reserved: in
                     }
                 )
                 logger.info(f"✅ Orden {order.order_id} asignada a {depot} (pack-aware)")
+                reserved_now = True
+    if reserved_now:
+        _RESERVATIONS.reserve(order.sku, depot, int(order.qty or 0), agotamiento_flag)
 
 
-def assign_single_order(order) -> bool:
+def assign_single_order(order, max_retries: int = 3) -> bool:
     """
     Asigna un depósito a una orden específica.
     
     Args:
         order: Objeto OrderItem de la orden a procesar
+        max_retries: Intentos ante timeout de stock (con espera entre intentos)
         
     Returns:
         bool: True si se asignó exitosamente
     """
     logger.debug(f"Procesando orden {order.order_id}, SKU: {order.sku}, qty: {order.qty}")
     
-    # Reintentos para obtener stock (manejo de timeouts)
-    max_retries = 3
+    # Reintentos para obtener stock (manejo de timeouts); assign_pending en paralelo usa 1
+    max_retries = max(1, int(max_retries))
     retry_delay = 60  # segundos
     
     for attempt in range(max_retries):
@@ -1315,6 +1393,7 @@ def assign_single_order(order) -> bool:
     # Si la asignación no se realizó (ya estaba asignada), no continuar con movimiento
     if not assigned_ok:
         return True
+    _RESERVATIONS.reserve(order.sku, depot, int(order.qty or 0), agotamiento_flag)
 
     # Fuera de la transacción: ejecutar movimiento MELI→MELI en Dragonfish
     # Observación para idempotencia (debe ser estable por orden)
@@ -1469,13 +1548,35 @@ def backfill_stock_columns(max_rows: int = 20) -> int:
             {"maxr": max_rows},
         ).fetchall()
 
+        # Prefetch: una consulta por artículo base para todo el lote
+        matrices: Dict[str, dict] = {}
+        if get_stock_by_sku is None and prefetch_article_stock is not None and rows:
+            try:
+                matrices = prefetch_article_stock([r.sku for r in rows if r.sku], timeout=120)
+            except Exception as e:
+                logger.warning(f"Backfill: prefetch de stock falló, se consulta por SKU: {e}")
+        # Artículos que la API no devolvió: un solo batch SQL para todos en lugar de N fallbacks
+        sql_stocks: Dict[str, dict] = {}
+        if get_stock_by_sku is None and get_stock_per_deposit_sql_many is not None and rows:
+            missing = [r.sku for r in rows if r.sku and str(article_base(r.sku) or '').upper() not in matrices]
+            if missing:
+                try:
+                    sql_stocks = get_stock_per_deposit_sql_many(missing)
+                except Exception as e:
+                    logger.warning(f"Backfill: batch SQL de stock falló: {e}")
+
         for r in rows:
             oid = r.id
             sku = r.sku
             try:
                 # Obtener stock actual por depósito para el SKU
+                base = str(article_base(sku) or '').upper()
                 if get_stock_by_sku is not None:
                     stock = get_stock_by_sku(sku)
+                elif base in matrices and stock_for_variant is not None:
+                    stock = stock_for_variant(matrices[base], sku)
+                elif sql_stocks.get(sku):
+                    stock = sql_stocks[sku]
                 elif get_stock_per_deposit is not None:
                     stock = get_stock_per_deposit(sku, timeout=120)
                 else:
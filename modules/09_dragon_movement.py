@@ -3,14 +3,16 @@ Módulo 09: Movimiento de stock MELI→MELI (Dragonfish)
 =====================================================
 
 Realiza el POST a Dragonfish /Movimientodestock/ para registrar un movimiento
-MELI→MELI. Sin reintentos, timeout largo, esperando siempre respuesta.
+MELI→MELI, vía el cliente compartido modules/dragon_http: timeout de lectura acotado
+(DRAGON_MOV_READ_TIMEOUT) y reintento entre estilos de Authorization y credenciales
+sólo ante 400/401. Un 5xx o un read timeout no se reintentan (evita movimientos duplicados).
 
 Campos editables de cabecera: OrigenDestino y Tipo (2=resta, 1=suma).
 """
 from __future__ import annotations
 
 import requests
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from datetime import datetime, timezone, timedelta
 import json
 
@@ -24,25 +26,19 @@ from modules.config import (
     DRAGON_ALT_API_KEY,
     DRAGON_ALT_ID_CLIENTE,
 )
+from modules.stock_cache import invalidate_sku as _invalidate_stock_cache
+from modules.dragon_http import client as _http
 import logging
-import importlib.util
 import os
 
 
 def _get_article_info_from_db(barcode: str):
-    """Carga dinámica de modules/02_dragon_db.py para obtener ARTDES por barcode.
-    Evita importar con nombre inválido (módulo que comienza con dígitos).
+    """ARTDES/color/talle por barcode desde el resolver compartido (pool + caché),
+    en lugar de recargar modules/02_dragon_db.py y abrir una conexión por línea.
     """
     try:
-        base_dir = os.path.dirname(__file__)
-        mod_path = os.path.join(base_dir, "02_dragon_db.py")
-        spec = importlib.util.spec_from_file_location("dragon_db_helper", mod_path)
-        if spec and spec.loader:
-            mod = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(mod)  # type: ignore[attr-defined]
-            func = getattr(mod, "get_article_info_by_barcode", None)
-            if callable(func):
-                return func(barcode)
+        from modules.article_resolver import get_resolver
+        return get_resolver().by_barcode(barcode)
     except Exception:
         pass
     return None
@@ -72,6 +68,12 @@ def _parse_sku(sku: str) -> tuple[str, Optional[str], Optional[str]]:
 
 logger = logging.getLogger(__name__)
 
+try:
+    # Lectura larga: Dragonfish puede tardar en confirmar el movimiento, pero nunca sin límite
+    DRAGON_MOV_READ_TIMEOUT = float(os.getenv('DRAGON_MOV_READ_TIMEOUT', '120'))
+except Exception:
+    DRAGON_MOV_READ_TIMEOUT = 120.0
+
 
 def _normalize_code(code: str) -> str:
     """Colapsa guiones redundantes y remueve sufijos vacíos.
@@ -84,62 +86,20 @@ def _normalize_code(code: str) -> str:
         return str(code or '').strip().upper()
 
 
-def move_stock_woo_to_woo(
+def _build_detail_line(
     *,
     sku: str,
     qty: int,
-    observacion: str,
-    origen_destino: Optional[str] = None,
-    tipo: Optional[int] = None,
-    base_datos_header: Optional[str] = None,
+    nro_item: int,
     barcode: Optional[str] = None,
     articulo_detalle: Optional[str] = None,
     color_codigo: Optional[str] = None,
     talle_codigo: Optional[str] = None,
-) -> Dict[str, Any]:
-    """
-    Ejecuta movimiento MELI→MELI en Dragonfish.
-
-    Args:
-        sku: SKU estilo ART-COLOR-TALLE
-        qty: cantidad a mover (positiva). Tipo=2 restará, Tipo=1 sumará.
-        observacion: texto a enviar en el campo Observacion (idempotencia sugerida)
-        origen_destino: valor para OrigenDestino (default config)
-        tipo: 2=resta, 1=suma (default config)
-        base_datos_header: header BaseDeDatos (default 'MELI' si no hay config)
-
-    Returns:
-        dict con { 'ok': bool, 'status': int, 'data': any, 'error': str|None }
-    """
-    if not DRAGON_MOV_URL:
-        return {"ok": False, "status": 0, "data": None, "error": "DRAGON_MOV_URL no configurada"}
-
+) -> Optional[Dict[str, Any]]:
+    """Arma una línea de MovimientoDetalle; None si el SKU/artículo es inválido."""
     articulo_raw, color_raw, talle_raw = _parse_sku(sku)
     if not articulo_raw:
-        return {"ok": False, "status": 0, "data": None, "error": "SKU/artículo inválido"}
-
-    od = (origen_destino or MOV_ORIGENDESTINO_DEFAULT or "MELI").strip()
-    tp = int(tipo if tipo is not None else MOV_TIPO_DEFAULT)
-    base_db = (base_datos_header or DRAGON_BASEDEDATOS or "MELI").strip()
-
-    # Autorización: algunos servidores aceptan token crudo, otros requieren 'Bearer <token>'.
-    # Además, soportar credenciales alternativas.
-    cred_list = [
-        {
-            "IdCliente": (DRAGON_ID_CLIENTE or "").strip(),
-            "Token": (DRAGON_API_KEY or "").strip(),
-            "Label": "primary",
-        }
-    ]
-    if (DRAGON_ALT_ID_CLIENTE or DRAGON_ALT_API_KEY):
-        cred_list.append({
-            "IdCliente": (DRAGON_ALT_ID_CLIENTE or DRAGON_ID_CLIENTE or "").strip(),
-            "Token": (DRAGON_ALT_API_KEY or DRAGON_API_KEY or "").strip(),
-            "Label": "alt",
-        })
-
-    fecha = _dragon_date()
-    hora = _dragon_time()
+        return None
 
     # Elegir código a enviar (priorizar barcode) y normalizar si viene del SKU
     code_input = barcode or sku
@@ -179,6 +139,106 @@ def move_stock_woo_to_woo(
             # No romper por errores de DB: seguimos con valores actuales
             pass
 
+    return {
+        # Según payload de referencia del usuario: usar el código de barras como Articulo
+        # y NO incluir el campo "Codigo" en absoluto. Mantener ArticuloDetalle, Color y Talle.
+        "Articulo": code_norm,
+        "ArticuloDetalle": articulo_detalle_final,
+        "Color": (color_codigo_final or color_send),
+        "Talle": (talle_codigo_final or talle_send),
+        "Cantidad": qty,
+        "NroItem": int(nro_item),
+    }
+
+
+def move_stock_lines(
+    *,
+    lines: List[Dict[str, Any]],
+    observacion: str,
+    origen_destino: Optional[str] = None,
+    tipo: Optional[int] = None,
+    base_datos_header: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Ejecuta UN movimiento MELI→MELI con N líneas de detalle (NroItem 1..N).
+    Una línea con SKU/artículo inválido no frena al resto: se omite, queda registrada en
+    'skipped' y se postean las demás (si no queda ninguna válida, no hay POST).
+
+    Args:
+        lines: [{'sku', 'qty', 'barcode'?, 'articulo_detalle'?, 'color_codigo'?, 'talle_codigo'?}, ...]
+        observacion: texto del campo Observacion; debe ser estable por movimiento
+            (un reintento con la misma observación devuelve 409 y se toma como éxito)
+        origen_destino, tipo, base_datos_header: igual que move_stock_woo_to_woo
+
+    Returns:
+        dict con { 'ok', 'status', 'data', 'numero', 'od', 'base_db', 'lines', 'skipped', 'error' }
+        El mismo 'numero' corresponde a todas las líneas posteadas. 'skipped' es
+        [{'index': i, 'sku', 'error'}] con el índice (base 0) de cada línea omitida en `lines`.
+    """
+    if not DRAGON_MOV_URL:
+        return {"ok": False, "status": 0, "data": None, "error": "DRAGON_MOV_URL no configurada"}
+    if not lines:
+        return {"ok": False, "status": 0, "data": None, "error": "sin líneas de movimiento"}
+
+    # Una sola consulta de ARTDES para todas las líneas que la necesitan (el resto sale de caché)
+    try:
+        need = [ln.get("barcode") for ln in lines if ln.get("barcode") and not (ln.get("articulo_detalle") or "").strip()]
+        if len(need) > 1:
+            from modules.article_resolver import get_resolver
+            get_resolver().by_barcode_many(need)
+    except Exception:
+        pass
+
+    detalle: List[Dict[str, Any]] = []
+    posted: List[Dict[str, Any]] = []
+    skipped: List[Dict[str, Any]] = []
+    for i, ln in enumerate(lines):
+        try:
+            det = _build_detail_line(
+                sku=ln.get("sku") or "",
+                qty=ln.get("qty"),
+                nro_item=len(detalle) + 1,
+                barcode=ln.get("barcode"),
+                articulo_detalle=ln.get("articulo_detalle"),
+                color_codigo=ln.get("color_codigo"),
+                talle_codigo=ln.get("talle_codigo"),
+            )
+            err = None if det is not None else f"SKU/artículo inválido: {ln.get('sku')}"
+        except Exception as e:
+            det, err = None, f"línea inválida ({ln.get('sku')}): {e}"
+        if det is None:
+            logger.warning(f"Dragon MOVE: línea {i + 1} omitida: {err}")
+            skipped.append({"index": i, "sku": ln.get("sku"), "error": err})
+            continue
+        detalle.append(det)
+        posted.append(ln)
+    if not detalle:
+        return {"ok": False, "status": 0, "data": None, "skipped": skipped,
+                "error": "; ".join(s["error"] for s in skipped) or "sin líneas válidas"}
+
+    od = (origen_destino or MOV_ORIGENDESTINO_DEFAULT or "MELI").strip()
+    tp = int(tipo if tipo is not None else MOV_TIPO_DEFAULT)
+    base_db = (base_datos_header or DRAGON_BASEDEDATOS or "MELI").strip()
+
+    # Autorización: algunos servidores aceptan token crudo, otros requieren 'Bearer <token>'.
+    # Además, soportar credenciales alternativas.
+    cred_list = [
+        {
+            "IdCliente": (DRAGON_ID_CLIENTE or "").strip(),
+            "Token": (DRAGON_API_KEY or "").strip(),
+            "Label": "primary",
+        }
+    ]
+    if (DRAGON_ALT_ID_CLIENTE or DRAGON_ALT_API_KEY):
+        cred_list.append({
+            "IdCliente": (DRAGON_ALT_ID_CLIENTE or DRAGON_ID_CLIENTE or "").strip(),
+            "Token": (DRAGON_ALT_API_KEY or DRAGON_API_KEY or "").strip(),
+            "Label": "alt",
+        })
+
+    fecha = _dragon_date()
+    hora = _dragon_time()
+
     body = {
         # Cabecera
         "OrigenDestino": od,
@@ -190,18 +250,7 @@ def move_stock_woo_to_woo(
         "Fecha": fecha,
         "Observacion": observacion,
         # Detalle
-        "MovimientoDetalle": [
-            {
-                # Según payload de referencia del usuario: usar el código de barras como Articulo
-                # y NO incluir el campo "Codigo" en absoluto. Mantener ArticuloDetalle, Color y Talle.
-                "Articulo": code_norm,
-                "ArticuloDetalle": articulo_detalle_final,
-                "Color": (color_codigo_final or color_send),
-                "Talle": (talle_codigo_final or talle_send),
-                "Cantidad": qty,
-                "NroItem": 1,
-            }
-        ],
+        "MovimientoDetalle": detalle,
         # Info adicional
         "InformacionAdicional": {
             "FechaAltaFW": fecha,
@@ -219,77 +268,56 @@ def move_stock_woo_to_woo(
     # Debug/Info: mostrar payload antes del POST (sin credenciales)
     try:
         # INFO compacto y seguro
-        safe_det = body.get("MovimientoDetalle", [{}])[0]
         safe_info = {
             "OrigenDestino": body.get("OrigenDestino"),
             "Tipo": body.get("Tipo"),
             "Observacion": body.get("Observacion"),
-            "Articulo": safe_det.get("Articulo"),
-            "ArticuloDetalle": safe_det.get("ArticuloDetalle"),
-            "Color": safe_det.get("Color"),
-            "Talle": safe_det.get("Talle"),
-            "Cantidad": safe_det.get("Cantidad"),
-            "BaseDeDatos": headers.get("BaseDeDatos"),
+            "Lineas": [
+                {k: d.get(k) for k in ("NroItem", "Articulo", "ArticuloDetalle", "Color", "Talle", "Cantidad")}
+                for d in detalle
+            ],
+            "BaseDeDatos": base_db,
         }
         logger.info(f"Dragon MOVE → request: {json.dumps(safe_info, ensure_ascii=False)}")
         # DEBUG completo
-        dbg_headers = {k: v for k, v in headers.items() if k.lower() != 'authorization'}
-        logger.debug(f"Dragon MOVE headers: {dbg_headers}")
         logger.debug(f"Dragon MOVE body: {json.dumps(body, ensure_ascii=False)}")
     except Exception:
         # No romper por logging
         pass
 
-    def _do_post(hdrs):
-        r = requests.post(DRAGON_MOV_URL, headers=hdrs, data=json.dumps(body), timeout=None)
-        st = r.status_code
-        try:
-            dt = r.json() if r.content else None
-        except Exception:
-            dt = r.text
-        return st, dt
-
     try:
         status = 0
         data = None
         ok = False
         numero = None
-        last_err = None
-        for cred in cred_list:
-            tok = cred["Token"]
-            idc = cred["IdCliente"]
-            # headers raw
-            headers_raw = {
-                "accept": "application/json",
-                "IdCliente": idc,
-                "Authorization": tok,
-                "Content-Type": "application/json",
-                "BaseDeDatos": base_db,
-            }
-            # headers bearer
-            headers_bearer = {
-                **headers_raw,
-                "Authorization": tok if tok.lower().startswith("bearer ") else (f"Bearer {tok}" if tok else ""),
-            }
-            # 1) raw
-            status, data = _do_post(headers_raw)
-            if status in (200, 201, 409):
-                ok = True
-                break
-            if status in (400, 401) and tok:
-                # 2) bearer
-                logger.info(f"Dragon MOVE retry con Authorization Bearer (cred={cred['Label']}, IdCliente={idc})")
-                try:
-                    status, data = _do_post(headers_bearer)
-                except Exception as e:
-                    last_err = e
-                    status, data = 0, None
-                if status in (200, 201, 409):
-                    ok = True
-                    break
+        # Cliente compartido: Session con keep-alive, timeouts acotados (antes timeout=None),
+        # primero la credencial/estilo de Authorization que funcionó la última vez
+        # (token crudo o 'Bearer') y circuit breaker si el endpoint está caído
+        resp = _http.request(
+            "POST",
+            purpose="mov",
+            urls=[DRAGON_MOV_URL],
+            creds=cred_list,
+            styles=("raw", "bearer"),
+            accept=(200, 201, 409),
+            data=json.dumps(body),
+            headers={"Content-Type": "application/json", "BaseDeDatos": base_db},
+            read_timeout=DRAGON_MOV_READ_TIMEOUT,
+            # POST no idempotente: otra credencial/estilo sólo si ésta fue rechazada
+            retry_on=(400, 401),
+        )
+        status = resp.status_code
+        try:
+            data = resp.json() if resp.content else None
+        except Exception:
+            data = resp.text
 
         # Tratar 201 (creado), 200 (algunas variantes) y 409 (duplicado idempotente) como éxito
         ok = ok or (status in (200, 201, 409))
+        if ok:
+            # El stock de los artículos cambió en Dragonfish: no servirlo más desde caché
+            for ln in posted:
+                _invalidate_stock_cache(ln.get("sku") or "")
 
         # Intentar extraer el número de movimiento como en los scripts de referencia
         if isinstance(data, dict):
@@ -326,11 +354,63 @@ def move_stock_woo_to_woo(
             "numero": numero,
             "od": od,
             "base_db": base_db,
+            "lines": len(detalle),
+            "skipped": skipped,
             "error": None if ok else (str(data)[:500] if data is not None else "")
         }
     except requests.Timeout as e:
-        return {"ok": False, "status": 0, "data": None, "error": f"timeout: {e}"}
+        return {"ok": False, "status": 0, "data": None, "skipped": skipped, "error": f"timeout: {e}"}
     except requests.RequestException as e:
-        return {"ok": False, "status": 0, "data": None, "error": f"request_error: {e}"}
+        return {"ok": False, "status": 0, "data": None, "skipped": skipped, "error": f"request_error: {e}"}
     except Exception as e:
-        return {"ok": False, "status": 0, "data": None, "error": f"unexpected: {e}"}
+        return {"ok": False, "status": 0, "data": None, "skipped": skipped, "error": f"unexpected: {e}"}
+
+
+def move_stock_woo_to_woo(
+    *,
+    sku: str,
+    qty: int,
+    observacion: str,
+    origen_destino: Optional[str] = None,
+    tipo: Optional[int] = None,
+    base_datos_header: Optional[str] = None,
+    barcode: Optional[str] = None,
+    articulo_detalle: Optional[str] = None,
+    color_codigo: Optional[str] = None,
+    talle_codigo: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Ejecuta movimiento MELI→MELI en Dragonfish.
+
+    Args:
+        sku: SKU estilo ART-COLOR-TALLE
+        qty: cantidad a mover (positiva). Tipo=2 restará, Tipo=1 sumará.
+        observacion: texto a enviar en el campo Observacion (idempotencia sugerida)
+        origen_destino: valor para OrigenDestino (default config)
+        tipo: 2=resta, 1=suma (default config)
+        base_datos_header: header BaseDeDatos (default 'MELI' si no hay config)
+
+    Returns:
+        dict con { 'ok': bool, 'status': int, 'data': any, 'error': str|None }
+    """
+    if not DRAGON_MOV_URL:
+        return {"ok": False, "status": 0, "data": None, "error": "DRAGON_MOV_URL no configurada"}
+
+    articulo_raw, _color_raw, _talle_raw = _parse_sku(sku)
+    if not articulo_raw:
+        return {"ok": False, "status": 0, "data": None, "error": "SKU/artículo inválido"}
+
+    return move_stock_lines(
+        lines=[{
+            "sku": sku,
+            "qty": qty,
+            "barcode": barcode,
+            "articulo_detalle": articulo_detalle,
+            "color_codigo": color_codigo,
+            "talle_codigo": talle_codigo,
+        }],
+        observacion=observacion,
+        origen_destino=origen_destino,
+        tipo=tipo,
+        base_datos_header=base_datos_header,
+    )
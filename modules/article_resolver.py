@@ -0,0 +1,363 @@
+"""
+Resolución SKU ↔ código de barras ↔ ARTDES (Dragonfish ZooLogic.EQUI / ART)
+===========================================================================
+
+Reemplaza las conexiones pyodbc nuevas por cada búsqueda que abrían 02_dragon_db
+(_search_barcode_in_db, get_article_info_by_barcode), 09_dragon_movement y
+backfill_barcodes:
+
+- Pool de conexiones tibio sobre SQLSERVER_CONN_STR (ARTICLE_POOL_SIZE).
+- resolve_many(skus) / by_barcode_many(codes): una consulta por lote
+  (VALUES + JOIN para ART-COLOR-TALLE, IN (...) para códigos de barras).
+- Caché en memoria + archivo JSON (ARTICLE_CACHE_FILE) de los artículos encontrados,
+  con TTL ARTICLE_CACHE_TTL (segundos). Los "no encontrado" sólo se recuerdan en
+  memoria durante ARTICLE_CACHE_NEG_TTL. Los errores de SQL no se cachean.
+
+Registro devuelto (mismas claves que get_article_info_by_barcode, más 'BARCODES'):
+  CODIGO_ARTICULO, CODIGO_COLOR, CODIGO_TALLE, CODIGO_BARRA, ARTDES,
+  BARCODES (todos los CCODIGO del SKU, primero los que empiezan con dígito, luego el más largo).
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+try:
+    from modules.dragon_sql_stock import _ConnPool, _timed_fetch  # type: ignore
+except Exception:
+    from dragon_sql_stock import _ConnPool, _timed_fetch  # type: ignore
+
+try:
+    from modules.config import SQLSERVER_CONN_STR as _CFG_CONN_STR  # type: ignore
+except Exception:
+    try:
+        from config import SQLSERVER_CONN_STR as _CFG_CONN_STR  # type: ignore
+    except Exception:
+        _CFG_CONN_STR = os.getenv('SQLSERVER_CONN_STR')
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+ARTICLE_POOL_SIZE = max(1, int(_env_float('ARTICLE_POOL_SIZE', 4)))
+ARTICLE_QUERY_TIMEOUT = max(1, int(_env_float('ARTICLE_QUERY_TIMEOUT', 15)))
+ARTICLE_CACHE_TTL = _env_float('ARTICLE_CACHE_TTL', 7 * 24 * 3600)
+ARTICLE_CACHE_NEG_TTL = _env_float('ARTICLE_CACHE_NEG_TTL', 600)
+ARTICLE_CACHE_FILE = os.getenv(
+    'ARTICLE_CACHE_FILE',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config', 'article_cache.json'),
+)
+# Guardar a disco como mucho cada N segundos (y al salir del proceso)
+ARTICLE_CACHE_FLUSH_SECS = _env_float('ARTICLE_CACHE_FLUSH_SECS', 30)
+# Parámetros por lote: 3 por SKU / 1 por código, SQL Server admite hasta 2100
+_SKU_CHUNK = 500
+_CODE_CHUNK = 1000
+
+Record = Dict[str, Any]
+SkuKey = Tuple[str, str, str]
+
+
+def split_sku(sku: Optional[str]) -> Optional[SkuKey]:
+    """'ART-COLOR-TALLE' -> (art, col, tal); None si no tiene las tres partes."""
+    s = str(sku or '').strip()
+    if s.count('-') < 2:
+        return None
+    art, col, tal = (p.strip() for p in s.split('-', 2))
+    if not art or not col or not tal:
+        return None
+    return art, col, tal
+
+
+def _prefer_order_sql(alias: str = 'equi') -> str:
+    # Orden: primero los que inician con dígito, luego más largo
+    return f"CASE WHEN {alias}.CCODIGO LIKE '[0-9]%' THEN 0 ELSE 1 END, LEN(RTRIM({alias}.CCODIGO)) DESC"
+
+
+def _s(v: Any) -> str:
+    return str(v).strip() if v is not None else ''
+
+
+class ArticleResolver:
+    def __init__(self, conn_str: str, database: str, cache_file: Optional[str] = ARTICLE_CACHE_FILE):
+        self.conn_str = conn_str
+        self.database = database
+        self.cache_file = cache_file
+        self._pool = _ConnPool(conn_str, ARTICLE_POOL_SIZE)
+        self._lock = threading.Lock()
+        # clave (mayúsculas) -> (ts epoch, registro o None)
+        self._by_sku: Dict[str, Tuple[float, Optional[Record]]] = {}
+        self._by_code: Dict[str, Tuple[float, Optional[Record]]] = {}
+        self._loaded = False
+        self._dirty = False
+        self._saved_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.queries = 0
+        self.errors = 0
+
+    # ---- caché ----
+    @staticmethod
+    def _key(v: str) -> str:
+        return str(v or '').strip().upper()
+
+    def _fresh(self, ent: Optional[Tuple[float, Optional[Record]]]) -> bool:
+        if ent is None:
+            return False
+        ttl = ARTICLE_CACHE_TTL if ent[1] is not None else ARTICLE_CACHE_NEG_TTL
+        return (time.time() - ent[0]) < ttl
+
+    def _load_disk(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                raw = json.load(f)
+            for name, target in (('sku', self._by_sku), ('barcode', self._by_code)):
+                for k, (ts, rec) in (raw.get(name) or {}).items():
+                    if rec:
+                        target[k] = (float(ts), rec)
+        except Exception as e:
+            # Archivo corrupto/viejo: se reconstruye desde SQL
+            logger.warning(f"Caché de artículos {self.cache_file} ignorada: {e}")
+
+    def flush(self, force: bool = False) -> None:
+        """Guarda a disco los registros encontrados (no los negativos)."""
+        if not self.cache_file:
+            return
+        with self._lock:
+            if not self._dirty or (not force and (time.time() - self._saved_at) < ARTICLE_CACHE_FLUSH_SECS):
+                return
+            data = {
+                'sku': {k: [ts, rec] for k, (ts, rec) in self._by_sku.items() if rec is not None and self._fresh((ts, rec))},
+                'barcode': {k: [ts, rec] for k, (ts, rec) in self._by_code.items() if rec is not None and self._fresh((ts, rec))},
+            }
+            self._dirty = False
+            self._saved_at = time.time()
+        try:
+            os.makedirs(os.path.dirname(self.cache_file) or '.', exist_ok=True)
+            tmp = f"{self.cache_file}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp, self.cache_file)
+        except Exception as e:
+            logger.warning(f"No se pudo guardar la caché de artículos: {e}")
+
+    def _store(self, sku_recs: Dict[str, Optional[Record]], code_recs: Dict[str, Optional[Record]]) -> None:
+        now = time.time()
+        with self._lock:
+            for k, rec in sku_recs.items():
+                self._by_sku[k] = (now, rec)
+            for k, rec in code_recs.items():
+                self._by_code[k] = (now, rec)
+            if any(r is not None for r in sku_recs.values()) or any(r is not None for r in code_recs.values()):
+                self._dirty = True
+        self.flush()
+
+    # ---- SQL ----
+    def _select(self) -> str:
+        db = self.database
+        return (
+            "RTRIM(equi.CARTICUL), RTRIM(equi.CCOLOR), RTRIM(equi.CTALLE), RTRIM(equi.CCODIGO), RTRIM(c_art.ARTDES) "
+            f"FROM {db}.ZooLogic.EQUI AS equi "
+            f"LEFT JOIN {db}.ZooLogic.ART AS c_art ON equi.CARTICUL = c_art.ARTCOD "
+        )
+
+    def _run(self, sql: str, params: List[str]) -> List[tuple]:
+        cn = self._pool.acquire(ARTICLE_QUERY_TIMEOUT)
+        broken = False
+        try:
+            self.queries += 1
+            return [tuple(r) for r in _timed_fetch(cn.cursor(), sql, params)]
+        except Exception:
+            broken = True
+            raise
+        finally:
+            self._pool.release(cn, broken=broken)
+
+    def _query_skus(self, keys: List[SkuKey]) -> Dict[SkuKey, Optional[Record]]:
+        out: Dict[SkuKey, Optional[Record]] = {k: None for k in keys}
+        values = ",".join(["(?,?,?)"] * len(keys))
+        sql = (
+            f"WITH k(art, col, tal) AS (SELECT art, col, tal FROM (VALUES {values}) v(art, col, tal)) "
+            f"SELECT k.art, k.col, k.tal, {self._select()}"
+            "JOIN k ON RTRIM(equi.CARTICUL)=k.art AND RTRIM(equi.CCOLOR)=k.col AND RTRIM(equi.CTALLE)=k.tal "
+            f"ORDER BY k.art, k.col, k.tal, {_prefer_order_sql()}"
+        )
+        upper = {tuple(p.upper() for p in k): k for k in keys}
+        for art, col, tal, c_art, c_col, c_tal, code, artdes in self._run(sql, [p for k in keys for p in k]):
+            k = upper.get((_s(art).upper(), _s(col).upper(), _s(tal).upper()))
+            code = _s(code)
+            if k is None or not code:
+                continue
+            rec = out.get(k)
+            if rec is None:
+                out[k] = {
+                    "CODIGO_COLOR": _s(c_col),
+                    "CODIGO_TALLE": _s(c_tal),
+                    "CODIGO_ARTICULO": _s(c_art),
+                    "CODIGO_BARRA": code,
+                    "ARTDES": _s(artdes),
+                    "BARCODES": [code],
+                }
+            elif code not in rec["BARCODES"]:
+                rec["BARCODES"].append(code)
+        return out
+
+    def _query_codes(self, codes: List[str]) -> Dict[str, Optional[Record]]:
+        out: Dict[str, Optional[Record]] = {self._key(c): None for c in codes}
+        marks = ",".join(["?"] * len(codes))
+        sql = f"SELECT {self._select()}WHERE RTRIM(equi.CCODIGO) IN ({marks})"
+        for c_art, c_col, c_tal, code, artdes in self._run(sql, list(codes)):
+            k = self._key(code)
+            if k in out and out[k] is None:
+                out[k] = {
+                    "CODIGO_COLOR": _s(c_col),
+                    "CODIGO_TALLE": _s(c_tal),
+                    "CODIGO_ARTICULO": _s(c_art),
+                    "CODIGO_BARRA": _s(code),
+                    "ARTDES": _s(artdes),
+                }
+        return out
+
+    # ---- API ----
+    def resolve_many(self, skus: Iterable[Optional[str]]) -> Dict[str, Optional[Record]]:
+        """{sku: registro | None} para SKUs ART-COLOR-TALLE (los demás devuelven None).
+        Sólo va a SQL Server por los que no están en caché, en lotes de una consulta."""
+        out: Dict[str, Optional[Record]] = {}
+        todo: Dict[str, SkuKey] = {}
+        with self._lock:
+            self._load_disk()
+            for s in skus or []:
+                if not s or s in out:
+                    continue
+                parts = split_sku(s)
+                if parts is None:
+                    out[s] = None
+                    continue
+                k = self._key('-'.join(parts))
+                ent = self._by_sku.get(k)
+                if self._fresh(ent):
+                    self.hits += 1
+                    out[s] = ent[1]  # type: ignore[index]
+                else:
+                    if k not in todo:
+                        self.misses += 1
+                    todo.setdefault(k, parts)
+                    out[s] = None
+        if todo:
+            keys = list(todo.values())
+            found: Dict[str, Optional[Record]] = {}
+            for i in range(0, len(keys), _SKU_CHUNK):
+                chunk = keys[i:i + _SKU_CHUNK]
+                try:
+                    res = self._query_skus(chunk)
+                except Exception as e:
+                    self.errors += 1
+                    logger.warning(f"Resolución de {len(chunk)} SKUs falló: {e}")
+                    continue
+                for parts, rec in res.items():
+                    found[self._key('-'.join(parts))] = rec
+            self._store(found, {})
+            for s in out:
+                parts = split_sku(s)
+                if parts is not None:
+                    k = self._key('-'.join(parts))
+                    if k in found:
+                        out[s] = found[k]
+        return out
+
+    def resolve(self, sku: Optional[str]) -> Optional[Record]:
+        return self.resolve_many([sku]).get(sku) if sku else None  # type: ignore[arg-type]
+
+    def by_barcode_many(self, codes: Iterable[Optional[str]]) -> Dict[str, Optional[Record]]:
+        """{código: registro | None} buscando por CCODIGO exacto, en lotes IN (...)."""
+        out: Dict[str, Optional[Record]] = {}
+        todo: Dict[str, str] = {}
+        with self._lock:
+            self._load_disk()
+            for c in codes or []:
+                code = str(c or '').strip()
+                if not code or c in out:
+                    continue
+                k = self._key(code)
+                ent = self._by_code.get(k)
+                if self._fresh(ent):
+                    self.hits += 1
+                    out[c] = ent[1]  # type: ignore[index]
+                else:
+                    if k not in todo:
+                        self.misses += 1
+                    todo.setdefault(k, code)
+                    out[c] = None
+        if todo:
+            pending = list(todo.values())
+            found: Dict[str, Optional[Record]] = {}
+            for i in range(0, len(pending), _CODE_CHUNK):
+                chunk = pending[i:i + _CODE_CHUNK]
+                try:
+                    found.update(self._query_codes(chunk))
+                except Exception as e:
+                    self.errors += 1
+                    logger.warning(f"Resolución de {len(chunk)} códigos de barras falló: {e}")
+            self._store({}, found)
+            for c in out:
+                k = self._key(str(c or ''))
+                if k in found:
+                    out[c] = found[k]
+        return out
+
+    def by_barcode(self, code: Optional[str]) -> Optional[Record]:
+        return self.by_barcode_many([code]).get(code) if code else None  # type: ignore[arg-type]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'skus': len(self._by_sku),
+                'barcodes': len(self._by_code),
+                'hits': self.hits,
+                'misses': self.misses,
+                'queries': self.queries,
+                'errors': self.errors,
+                'cache_file': self.cache_file,
+            }
+
+
+_RESOLVER: Optional[ArticleResolver] = None
+_RESOLVER_LOCK = threading.Lock()
+
+
+def get_resolver() -> ArticleResolver:
+    """Resolver compartido del proceso; requiere SQLSERVER_CONN_STR."""
+    global _RESOLVER
+    conn_str = _CFG_CONN_STR or os.getenv('SQLSERVER_CONN_STR')
+    if not conn_str:
+        raise RuntimeError('SQLSERVER_CONN_STR no configurado')
+    database = os.environ.get('DATABASE_NAME', 'DRAGONFISH_DEPOSITO')
+    with _RESOLVER_LOCK:
+        if _RESOLVER is None or _RESOLVER.conn_str != conn_str or _RESOLVER.database != database:
+            if _RESOLVER is not None:
+                _RESOLVER.flush(force=True)
+            _RESOLVER = ArticleResolver(conn_str, database)
+        return _RESOLVER
+
+
+@atexit.register
+def _flush_at_exit() -> None:
+    try:
+        if _RESOLVER is not None:
+            _RESOLVER.flush(force=True)
+    except Exception:
+        pass
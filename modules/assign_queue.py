@@ -0,0 +1,133 @@
+"""
+Cola de asignación disparada por evento
+=======================================
+
+Cuando una orden pasa a ready_to_print (visto por el worker de webhooks del server o por
+el sync de PIPELINE_5) se encola en dbo.assign_queue. PIPELINE_10, entre ciclos, reclama
+la cola cada pocos segundos y asigna esas órdenes (con su pack completo) con la misma
+lógica de 08_assign_tx; el ciclo periódico queda como barrido de reconciliación para lo
+que la cola no cubra.
+
+El único consumidor lee la base de 08_assign_tx (meli_stock / SQLSERVER_APP_CONN_STR), así
+que sólo se encola ahí: las órdenes de acc2 (meli_stock_acc2) no pasan por la cola.
+
+Funciones sobre una conexión DB-API estilo pyodbc (parámetros '?'):
+- enqueue_many(conn, [(order_id, pack_id)], source): idempotente (MERGE por order_id);
+  si la orden ya estaba reclamada vuelve a quedar pendiente.
+- claim(conn, limit): toma atómicamente hasta `limit` filas pendientes (READPAST/UPDLOCK,
+  como la cola de webhooks); las reclamadas hace más de ASSIGN_QUEUE_CLAIM_TTL_SECS se
+  consideran abandonadas y se vuelven a tomar.
+- ack(conn, order_ids): borra las procesadas (si no se re-encolaron mientras tanto).
+"""
+
+import os
+import threading
+from typing import Any, Iterable, List, Optional, Tuple
+
+try:
+    ASSIGN_QUEUE_CLAIM_TTL_SECS = int(os.getenv('ASSIGN_QUEUE_CLAIM_TTL_SECS', '300'))
+except Exception:
+    ASSIGN_QUEUE_CLAIM_TTL_SECS = 300
+try:
+    ASSIGN_QUEUE_MAX_ATTEMPTS = max(1, int(os.getenv('ASSIGN_QUEUE_MAX_ATTEMPTS', '3')))
+except Exception:
+    ASSIGN_QUEUE_MAX_ATTEMPTS = 3
+
+_DDL = """
+IF OBJECT_ID('dbo.assign_queue', 'U') IS NULL
+BEGIN
+    CREATE TABLE dbo.assign_queue (
+        order_id NVARCHAR(50) NOT NULL PRIMARY KEY,
+        pack_id NVARCHAR(50) NULL,
+        source NVARCHAR(20) NULL,
+        enqueued_at DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME(),
+        claimed_at DATETIME2 NULL,
+        attempts INT NOT NULL DEFAULT 0
+    );
+END
+"""
+
+# Bases (connection string) donde la tabla ya se verificó en este proceso
+_READY: set = set()
+_READY_LOCK = threading.Lock()
+
+
+def _ensure_table(conn: Any, key: Optional[str] = None) -> None:
+    """Crea la tabla si falta; con `key` (p.ej. la connection string) una sola vez por proceso."""
+    if key and key in _READY:
+        return
+    with _READY_LOCK:
+        if key and key in _READY:
+            return
+        cur = conn.cursor()
+        cur.execute(_DDL)
+        conn.commit()
+        if key:
+            _READY.add(key)
+
+
+def enqueue_many(conn: Any, items: Iterable[Tuple[Any, Any]], source: str, key: Optional[str] = None) -> int:
+    """Encola [(order_id, pack_id)]. `key` identifica la base para no repetir el DDL."""
+    rows = []
+    seen = set()
+    for oid, pid in items or []:
+        if oid is None or str(oid) in seen:
+            continue
+        seen.add(str(oid))
+        rows.append((str(oid), str(pid) if pid not in (None, '') else None))
+    if not rows:
+        return 0
+    _ensure_table(conn, key)
+    cur = conn.cursor()
+    for i in range(0, len(rows), 500):
+        chunk = rows[i:i + 500]
+        values = ",".join(["(?, ?, ?)"] * len(chunk))
+        params: List[Any] = [p for oid, pid in chunk for p in (oid, pid, source)]
+        cur.execute(
+            "MERGE dbo.assign_queue WITH (HOLDLOCK) AS t "
+            f"USING (VALUES {values}) AS v(order_id, pack_id, source) ON t.order_id = v.order_id "
+            "WHEN MATCHED THEN UPDATE SET pack_id = COALESCE(v.pack_id, t.pack_id), source = v.source, "
+            "enqueued_at = SYSUTCDATETIME(), claimed_at = NULL, attempts = 0 "
+            "WHEN NOT MATCHED THEN INSERT (order_id, pack_id, source) VALUES (v.order_id, v.pack_id, v.source);",
+            params,
+        )
+    conn.commit()
+    return len(rows)
+
+
+def enqueue(conn: Any, order_id: Any, pack_id: Any = None, source: str = 'webhook', key: Optional[str] = None) -> int:
+    return enqueue_many(conn, [(order_id, pack_id)], source, key)
+
+
+def claim(conn: Any, limit: int = 50, key: Optional[str] = None) -> List[Tuple[str, Optional[str]]]:
+    """Reclama hasta `limit` órdenes pendientes (las más viejas primero) -> [(order_id, pack_id)].
+    Las que agotaron ASSIGN_QUEUE_MAX_ATTEMPTS se descartan: quedan para el barrido periódico."""
+    _ensure_table(conn, key)
+    cur = conn.cursor()
+    cur.execute("DELETE FROM dbo.assign_queue WHERE attempts >= ?", ASSIGN_QUEUE_MAX_ATTEMPTS)
+    cur.execute(
+        "WITH cte AS ("
+        " SELECT TOP (?) order_id, pack_id, claimed_at, attempts "
+        " FROM dbo.assign_queue WITH (READPAST, UPDLOCK, ROWLOCK) "
+        " WHERE claimed_at IS NULL OR claimed_at < DATEADD(SECOND, -?, SYSUTCDATETIME()) "
+        " ORDER BY enqueued_at ASC) "
+        "UPDATE cte SET claimed_at = SYSUTCDATETIME(), attempts = attempts + 1 "
+        "OUTPUT inserted.order_id, inserted.pack_id",
+        int(limit), int(ASSIGN_QUEUE_CLAIM_TTL_SECS),
+    )
+    rows = cur.fetchall() or []
+    conn.commit()
+    return [(str(r[0]), (str(r[1]) if r[1] is not None else None)) for r in rows]
+
+
+def ack(conn: Any, order_ids: Iterable[Any]) -> None:
+    ids = [str(x) for x in order_ids or [] if x is not None]
+    if not ids:
+        return
+    cur = conn.cursor()
+    for i in range(0, len(ids), 1000):
+        chunk = ids[i:i + 1000]
+        marks = ",".join(["?"] * len(chunk))
+        # claimed_at NULL = se volvió a encolar mientras se procesaba: dejarla para la próxima vuelta
+        cur.execute(f"DELETE FROM dbo.assign_queue WHERE claimed_at IS NOT NULL AND order_id IN ({marks})", chunk)
+    conn.commit()
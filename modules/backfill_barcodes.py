@@ -17,14 +17,14 @@ import json
 import os
 from typing import Optional, Tuple, List
 
-import pyodbc
-
 # Conexión Dragonfish
 try:
     from .config import SQLSERVER_CONN_STR
 except Exception:
     SQLSERVER_CONN_STR = None  # type: ignore
 
+from .article_resolver import get_resolver
+
 # Conexión App (orders_meli)
 try:
     from PIPELINE_5_CONSOLIDADO.database_utils import get_connection_for_meli
@@ -32,18 +32,6 @@ except Exception as e:  # pragma: no cover
     raise RuntimeError(f"No se pudo importar get_connection_for_meli: {e}")
 
 
-def _dragon_connect() -> pyodbc.Connection:
-    conn_str = SQLSERVER_CONN_STR
-    if not conn_str:
-        raise RuntimeError("SQLSERVER_CONN_STR no configurado (modules/config.py o .env)")
-    return pyodbc.connect(conn_str)
-
-
-def _prefer_order_sql() -> str:
-    # Orden: primero los que inician con dígito, luego más largo
-    return "CASE WHEN equi.CCODIGO LIKE '[0-9]%' THEN 0 ELSE 1 END, LEN(RTRIM(equi.CCODIGO)) DESC"
-
-
 def _split_sku(sku: str) -> Optional[Tuple[str, str, str]]:
     if not sku or sku.count('-') < 2:
         return None
@@ -60,26 +48,14 @@ def _split_sku(sku: str) -> Optional[Tuple[str, str, str]]:
 
 
 def _fetch_barcodes_for_sku(art: str, col: str, tal: str) -> Tuple[Optional[str], List[str]]:
-    """Consulta Dragonfish.EQUI y devuelve (preferred, all_list)."""
-    sql = (
-        "SELECT RTRIM(equi.CCODIGO) AS cc "
-        "FROM ZooLogic.EQUI AS equi "
-        "WHERE RTRIM(equi.CARTICUL)=? AND RTRIM(equi.CCOLOR)=? AND RTRIM(equi.CTALLE)=? "
-        f"ORDER BY {_prefer_order_sql()}"
-    )
-    all_codes: List[str] = []
-    preferred: Optional[str] = None
-    with _dragon_connect() as cn:
-        cur = cn.cursor()
-        cur.execute(sql, (art, col, tal))
-        rows = cur.fetchall() or []
-        for r in rows:
-            c = (r[0] or "").strip()
-            if not c:
-                continue
-            all_codes.append(c)
-        if all_codes:
-            preferred = all_codes[0]
+    """Consulta Dragonfish.EQUI (vía resolver con caché) y devuelve (preferred, all_list)."""
+    if not SQLSERVER_CONN_STR:
+        raise RuntimeError("SQLSERVER_CONN_STR no configurado (modules/config.py o .env)")
+    info = get_resolver().resolve(f"{art}-{col}-{tal}")
+    if not info:
+        return None, []
+    all_codes: List[str] = list(info.get("BARCODES") or [])
+    preferred: Optional[str] = all_codes[0] if all_codes else None
     return preferred, all_codes
 
 
@@ -110,6 +86,11 @@ def backfill_barcode_all(max_rows: int = 100, days_window: int = 60, account: Op
             (int(max_rows), int(days_window)),
         )
         rows = cur.fetchall() or []
+        # Resolver todos los SKUs del lote en una consulta; el loop lee de caché
+        try:
+            get_resolver().resolve_many([str(sku or "") for _rid, sku in rows])
+        except Exception:
+            pass
         for rid, sku in rows:
             try:
                 parts = _split_sku(str(sku or ""))
@@ -102,6 +102,14 @@ MOV_TIPO_DEFAULT: int = int(os.getenv('MOV_TIPO_DEFAULT', '2'))
 # Variables de configuración del pipeline
 SLEEP_BETWEEN_CYCLES: int = int(os.getenv('SLEEP_BETWEEN_CYCLES', '300'))  # 5 minutos
 DEPOSIT_PRIORITY: list[str] = os.getenv('DEPOSIT_PRIORITY', 'DEP1,DEP2,DEP3').split(',')
+# Orden único de prioridad de depósitos: deposito_recomendado en listados
+# (modules/depot_recommender.py), asignación (07_assigner / 08_assign_tx) y cancelaciones.
+# 'DEPO' es el alias de DEP; los deshabilitados de 07_assigner (MDQ, MTGCBA, MTGJBJ, ...)
+# se descartan aunque figuren acá.
+RECOMMEND_DEPOT_ORDER: List[str] = [d.strip().upper() for d in os.getenv(
+    'RECOMMEND_DEPOT_ORDER',
+    'DEPO,MONBAHIA,MUNDOAL,MTGROCA,MTGBBPS,MUNDOROC,MTGCOM,NQNALB,NQNSHOP,MUNDOCAB',
+).split(',') if d.strip()]
 
 # Variables de notificaciones
 WEBHOOK_STOCK_ZERO: Optional[str] = os.getenv('WEBHOOK_STOCK_ZERO')
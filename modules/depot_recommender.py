@@ -0,0 +1,248 @@
+"""
+Recomendador de depósito (single / split / impossible)
+======================================================
+
+Componente reutilizable para calcular `deposito_recomendado` sobre una página entera
+de filas de orders_meli (columnas stock_*), en lugar de un loop por fila:
+
+- El orden de depósitos se carga UNA vez desde config (RECOMMEND_DEPOT_ORDER), sin los
+  deshabilitados del asignador.
+- Cálculo columnar: matriz filas × depósitos (NumPy si está instalado, Python puro si no).
+- Memo por (sku, qty, snapshot de stock): listados grandes y agregaciones del chat
+  no recalculan combinaciones ya vistas.
+
+Reglas (idénticas a las que usaba el listado):
+1) single: primer depósito (en orden) con disponible >= qty.
+2) split: primer par (i < j, en orden) con ambos > 0 y suma >= qty; reparte
+   min(a_i, qty) al primero y el resto al segundo.
+3) impossible: IMPOSSIBLE / 'sin stock suficiente'.
+
+También expone el orden de prioridad del asignador (07_assigner.DEPOSIT_PRIORITY, derivado de
+la misma RECOMMEND_DEPOT_ORDER) para que 08_assign_tx y las cancelaciones no armen su propia lista.
+"""
+
+import os
+import threading
+import importlib.util
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as _np  # opcional
+except Exception:  # pragma: no cover - numpy es opcional
+    _np = None
+
+try:
+    from modules.config import RECOMMEND_DEPOT_ORDER as _CFG_ORDER  # type: ignore
+except Exception:
+    try:
+        from config import RECOMMEND_DEPOT_ORDER as _CFG_ORDER  # type: ignore
+    except Exception:
+        _CFG_ORDER = [d.strip() for d in os.getenv(
+            'RECOMMEND_DEPOT_ORDER',
+            'DEPO,MONBAHIA,MUNDOAL,MTGROCA,MTGBBPS,MUNDOROC,MTGCOM,NQNALB,NQNSHOP,MUNDOCAB',
+        ).split(',') if d.strip()]
+
+# Alias de código de depósito -> columna stock_* de orders_meli
+_COLUMN_ALIASES: Dict[str, str] = {
+    'DEPO': 'stock_dep',
+    'DEP': 'stock_dep',
+    'BBPS': 'stock_mtgbbps',
+}
+
+RecoResult = Tuple[str, str, str]  # (tipo, deposito_recomendado, detalle)
+_IMPOSSIBLE: RecoResult = ("impossible", "IMPOSSIBLE", "sin stock suficiente")
+
+try:
+    _MEMO_MAX = max(100, int(os.getenv('RECOMMEND_MEMO_MAX', '20000')))
+except Exception:
+    _MEMO_MAX = 20000
+
+
+def stock_column_for(depot: str) -> str:
+    """Columna stock_* de orders_meli para un código de depósito."""
+    code = str(depot or '').strip().upper()
+    return _COLUMN_ALIASES.get(code, f"stock_{code.lower()}")
+
+
+class DepotRecommender:
+    """Recomendador para un orden fijo de depósitos."""
+
+    def __init__(self, depots: Sequence[str]):
+        self.depots: List[str] = [str(d).strip().upper() for d in depots if str(d).strip()]
+        self.columns: List[str] = [stock_column_for(d) for d in self.depots]
+        k = len(self.depots)
+        # Pares (i, j) en el mismo orden lexicográfico que el loop original
+        self._pairs: List[Tuple[int, int]] = [(i, j) for i in range(k) for j in range(i + 1, k)]
+        self._memo: "OrderedDict[Tuple[Any, ...], RecoResult]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # ---- núcleo ----
+    def _format(self, qty: int, single: Optional[int], pair: Optional[Tuple[int, int]], avail: Sequence[int]) -> RecoResult:
+        if single is not None:
+            code = self.depots[single]
+            return ("single", code, f"{code}: {qty}")
+        if pair is not None:
+            i, j = pair
+            n1 = min(int(avail[i]), qty)
+            n2 = qty - n1
+            c1, c2 = self.depots[i], self.depots[j]
+            return ("split", f"{c1}+{c2}", f"{c1}: {n1}, {c2}: {n2}")
+        return _IMPOSSIBLE
+
+    def _solve_python(self, avail_rows: List[List[int]], qtys: List[int]) -> List[RecoResult]:
+        out: List[RecoResult] = []
+        for avail, qty in zip(avail_rows, qtys):
+            single = next((i for i, a in enumerate(avail) if a > 0 and a >= qty), None)
+            pair = None
+            if single is None:
+                pair = next(((i, j) for i, j in self._pairs
+                             if avail[i] > 0 and avail[j] > 0 and avail[i] + avail[j] >= qty), None)
+            out.append(self._format(qty, single, pair, avail))
+        return out
+
+    def _solve_numpy(self, avail_rows: List[List[int]], qtys: List[int]) -> List[RecoResult]:
+        A = _np.asarray(avail_rows, dtype=_np.int64)            # n × k
+        Q = _np.asarray(qtys, dtype=_np.int64)[:, None]         # n × 1
+        pos = A > 0
+        ok_single = pos & (A >= Q)
+        has_single = ok_single.any(axis=1)
+        first_single = ok_single.argmax(axis=1)
+        has_pair = _np.zeros(len(qtys), dtype=bool)
+        first_pair = _np.zeros(len(qtys), dtype=_np.int64)
+        if self._pairs:
+            I = _np.fromiter((p[0] for p in self._pairs), dtype=_np.int64, count=len(self._pairs))
+            J = _np.fromiter((p[1] for p in self._pairs), dtype=_np.int64, count=len(self._pairs))
+            ok_pair = pos[:, I] & pos[:, J] & ((A[:, I] + A[:, J]) >= Q)   # n × pares
+            has_pair = ok_pair.any(axis=1)
+            first_pair = ok_pair.argmax(axis=1)
+        out: List[RecoResult] = []
+        for r, qty in enumerate(qtys):
+            single = int(first_single[r]) if has_single[r] else None
+            pair = self._pairs[int(first_pair[r])] if (single is None and has_pair[r]) else None
+            out.append(self._format(qty, single, pair, avail_rows[r]))
+        return out
+
+    # ---- API ----
+    def recommend_many(self, stocks: Sequence[Dict[str, Any]], qtys: Sequence[Any], skus: Optional[Sequence[Any]] = None) -> List[RecoResult]:
+        """Recomendación para N filas. stocks[i] es {depósito: disponible}.
+        Con skus, se memoiza por (sku, qty, snapshot de stock)."""
+        n = len(stocks)
+        keys: List[Optional[Tuple[Any, ...]]] = [None] * n
+        results: List[Optional[RecoResult]] = [None] * n
+        todo_idx: List[int] = []
+        todo_avail: List[List[int]] = []
+        todo_qty: List[int] = []
+        for i in range(n):
+            try:
+                qty = int(qtys[i]) if qtys[i] is not None else 1
+            except Exception:
+                qty = 1
+            if qty < 1:
+                qty = 1
+            st = stocks[i] or {}
+            avail = []
+            for d in self.depots:
+                try:
+                    v = int(st.get(d) or 0)
+                except Exception:
+                    v = 0
+                avail.append(v if v > 0 else 0)
+            key = (skus[i] if skus is not None else None, qty, tuple(avail))
+            keys[i] = key
+            with self._lock:
+                hit = self._memo.get(key)
+                if hit is not None:
+                    self._memo.move_to_end(key)
+                    self.hits += 1
+            if hit is not None:
+                results[i] = hit
+            else:
+                todo_idx.append(i)
+                todo_avail.append(avail)
+                todo_qty.append(qty)
+        if todo_idx:
+            solver = self._solve_numpy if (_np is not None and len(todo_idx) > 1) else self._solve_python
+            solved = solver(todo_avail, todo_qty)
+            with self._lock:
+                for i, res in zip(todo_idx, solved):
+                    results[i] = res
+                    self._memo[keys[i]] = res  # type: ignore[index]
+                    self.misses += 1
+                while len(self._memo) > _MEMO_MAX:
+                    self._memo.popitem(last=False)
+        return [r or _IMPOSSIBLE for r in results]
+
+    def recommend(self, stock: Dict[str, Any], qty: Any, sku: Any = None) -> RecoResult:
+        return self.recommend_many([stock], [qty], [sku])[0]
+
+    def annotate_rows(self, rows: List[Dict[str, Any]]) -> None:
+        """Agrega deposito_recomendado_tipo / deposito_recomendado / deposito_recomendado_detalle
+        a filas de orders_meli (in place), leyendo sus columnas stock_*."""
+        if not rows:
+            return
+        stocks: List[Dict[str, Any]] = []
+        qtys: List[Any] = []
+        skus: List[Any] = []
+        for obj in rows:
+            stocks.append({d: obj.get(c) for d, c in zip(self.depots, self.columns) if c in obj})
+            qtys.append(obj.get("qty") if obj.get("qty") is not None else obj.get("quantity"))
+            skus.append(obj.get("sku") or obj.get("seller_sku"))
+        for obj, (tipo, depo, detalle) in zip(rows, self.recommend_many(stocks, qtys, skus)):
+            obj["deposito_recomendado_tipo"] = tipo
+            obj["deposito_recomendado"] = depo
+            obj["deposito_recomendado_detalle"] = detalle
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"depots": list(self.depots), "memo_size": len(self._memo), "hits": self.hits,
+                    "misses": self.misses, "numpy": _np is not None}
+
+
+_DEFAULT: Optional[DepotRecommender] = None
+_DEFAULT_LOCK = threading.Lock()
+
+
+def get_recommender() -> DepotRecommender:
+    """Instancia compartida con el orden de RECOMMEND_DEPOT_ORDER (cargado una vez), sin los
+    depósitos que el asignador no usa; conserva las etiquetas del listado (p.ej. DEPO)."""
+    global _DEFAULT
+    if _DEFAULT is None:
+        with _DEFAULT_LOCK:
+            if _DEFAULT is None:
+                enabled = set(assign_priority())
+                order = [d for d in _CFG_ORDER if _assign_code(d) in enabled] or list(_CFG_ORDER)
+                _DEFAULT = DepotRecommender(order)
+    return _DEFAULT
+
+
+_ASSIGN_PRIORITY: Optional[List[str]] = None
+
+
+def _assign_code(depot: str) -> str:
+    """Código de depósito del asignador para una etiqueta de RECOMMEND_DEPOT_ORDER."""
+    code = str(depot or '').strip().upper()
+    return 'DEP' if code == 'DEPO' else code
+
+
+def assign_priority() -> List[str]:
+    """Depósitos del asignador en orden de prioridad, sin DISABLED_DEPOTS ni MELI.
+    Es 07_assigner.DEPOSIT_PRIORITY, que sale de RECOMMEND_DEPOT_ORDER: listados, asignación
+    y cancelaciones usan la misma lista. Se calcula una vez por proceso."""
+    global _ASSIGN_PRIORITY
+    if _ASSIGN_PRIORITY is None:
+        order: List[str] = []
+        try:
+            path = os.path.join(os.path.dirname(__file__), '07_assigner.py')
+            spec = importlib.util.spec_from_file_location('modules.07_assigner_reco', path)
+            mod = importlib.util.module_from_spec(spec)  # type: ignore[arg-type]
+            spec.loader.exec_module(mod)  # type: ignore[union-attr]
+            order = [str(d).upper() for d in (getattr(mod, 'DEPOSIT_PRIORITY', None) or [])]
+        except Exception:
+            order = []
+        if not order:
+            order = [c for c in (_assign_code(d) for d in _CFG_ORDER) if c and c != 'MELI']
+        _ASSIGN_PRIORITY = order
+    return list(_ASSIGN_PRIORITY)
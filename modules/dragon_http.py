@@ -0,0 +1,220 @@
+"""
+Cliente HTTP compartido para Dragonfish
+=======================================
+
+Usado por 07_dragon_api (consulta de stock) y 09_dragon_movement (movimientos):
+
+- Una requests.Session con pool de conexiones (keep-alive) para todo el proceso.
+- Timeouts de conexión y lectura acotados (nunca timeout=None):
+  DRAGON_CONNECT_TIMEOUT / DRAGON_READ_TIMEOUT.
+- Memo por propósito ('stock', 'mov') de la última combinación base + credencial +
+  estilo de Authorization (token crudo o 'Bearer') que funcionó: se prueba primero,
+  así no se redescubre en cada ciclo que la credencial primaria devuelve 401.
+- Circuit breaker por base: tras DRAGON_CB_FAILURES errores seguidos (conexión,
+  timeout o 5xx) la base se saltea durante DRAGON_CB_COOLOFF_SECS. Si todas están
+  abiertas se prueban igual (no dejar al proceso sin intentar).
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from modules import pipeline_metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+DRAGON_CONNECT_TIMEOUT = _env_float('DRAGON_CONNECT_TIMEOUT', 5)
+DRAGON_READ_TIMEOUT = _env_float('DRAGON_READ_TIMEOUT', 60)
+DRAGON_CB_FAILURES = max(1, int(_env_float('DRAGON_CB_FAILURES', 3)))
+DRAGON_CB_COOLOFF_SECS = _env_float('DRAGON_CB_COOLOFF_SECS', 60)
+
+# (base, label de credencial, estilo)
+Combo = Tuple[str, str, str]
+
+
+def _auth_value(token: str, style: str) -> str:
+    tok = (token or '').strip()
+    if style == 'bearer' and tok and not tok.lower().startswith('bearer '):
+        return f"Bearer {tok}"
+    return tok
+
+
+class _Breaker:
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0.0
+
+    def is_open(self) -> bool:
+        return self.open_until > time.monotonic()
+
+
+class DragonHttpClient:
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        pipeline_metrics.instrument_session(self.session, 'dragon_api')
+        self._lock = threading.Lock()
+        self._memo: Dict[str, Combo] = {}
+        self._breakers: Dict[str, _Breaker] = {}
+        self.requests = 0
+        self.skipped_open = 0
+
+    # ---- breaker ----
+    def _breaker(self, base: str) -> _Breaker:
+        with self._lock:
+            b = self._breakers.get(base)
+            if b is None:
+                b = _Breaker()
+                self._breakers[base] = b
+            return b
+
+    def _fail(self, base: str, why: str) -> None:
+        b = self._breaker(base)
+        with self._lock:
+            b.failures += 1
+            if b.failures >= DRAGON_CB_FAILURES and not b.is_open():
+                b.open_until = time.monotonic() + DRAGON_CB_COOLOFF_SECS
+                logger.warning(f"Dragonfish {base}: circuito abierto {DRAGON_CB_COOLOFF_SECS:.0f}s ({why})")
+
+    def _ok(self, base: str) -> None:
+        b = self._breaker(base)
+        with self._lock:
+            b.failures = 0
+            b.open_until = 0.0
+
+    # ---- API ----
+    def request(
+        self,
+        method: str,
+        *,
+        purpose: str,
+        urls: Sequence[str],
+        creds: Sequence[Dict[str, str]],
+        styles: Sequence[str] = ('raw',),
+        accept: Iterable[int] = (200,),
+        params: Optional[Dict[str, Any]] = None,
+        data: Any = None,
+        headers: Optional[Dict[str, str]] = None,
+        read_timeout: Optional[float] = None,
+        retry_on: Optional[Iterable[int]] = None,
+    ) -> requests.Response:
+        """Prueba combinaciones url × credencial × estilo (primero la última que funcionó
+        para `purpose`) hasta obtener un status en `accept`.
+
+        creds: [{'IdCliente', 'Token', 'Label'}]. Devuelve la respuesta aceptada o, si
+        ninguna lo fue, la última recibida (el caller decide); levanta la última excepción
+        de red si ninguna combinación respondió.
+
+        retry_on: para POST no idempotentes (movimientos). Si se pasa, sólo se prueba otra
+        combinación ante esos status (p.ej. 400/401 por credencial o estilo); cualquier otro
+        (5xx incluido) se devuelve tal cual y un read timeout se levanta sin reintentar,
+        porque Dragonfish pudo haber registrado el movimiento.
+        """
+        accept = set(accept)
+        retry_set = set(retry_on) if retry_on is not None else None
+        combos: List[Tuple[Combo, Dict[str, str]]] = []
+        for url in urls:
+            if not url:
+                continue
+            for cred in creds:
+                for style in styles:
+                    if style == 'bearer' and not (cred.get('Token') or '').strip():
+                        continue
+                    combos.append(((url, cred.get('Label') or '', style), cred))
+        with self._lock:
+            memo = self._memo.get(purpose)
+        if memo is not None:
+            combos.sort(key=lambda c: 0 if c[0] == memo else 1)
+        # Saltear bases con circuito abierto, salvo que estén todas abiertas
+        usable = [c for c in combos if not self._breaker(c[0][0]).is_open()]
+        if not usable:
+            usable = combos
+        else:
+            self.skipped_open += len(combos) - len(usable)
+        timeout = (DRAGON_CONNECT_TIMEOUT, float(read_timeout or DRAGON_READ_TIMEOUT))
+
+        last_resp: Optional[requests.Response] = None
+        last_exc: Optional[Exception] = None
+        dead_urls = set()
+        for (url, label, style), cred in usable:
+            if url in dead_urls:
+                continue
+            hdrs = {"accept": "application/json", **(headers or {})}
+            hdrs["IdCliente"] = cred.get('IdCliente') or ''
+            hdrs["Authorization"] = _auth_value(cred.get('Token') or '', style)
+            t0 = time.monotonic()
+            try:
+                self.requests += 1
+                resp = self.session.request(method, url, params=params, data=data, headers=hdrs,
+                                            timeout=timeout, allow_redirects=True)
+            except requests.ReadTimeout as e:
+                pipeline_metrics.record('dragon_api', time.monotonic() - t0, ok=False)
+                self._fail(url, type(e).__name__)
+                if retry_set is not None:
+                    raise  # el request llegó: reintentar podría duplicarlo
+                last_exc = e
+                dead_urls.add(url)
+                continue
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # La base no responde: no tiene sentido probar otras credenciales contra ella
+                pipeline_metrics.record('dragon_api', time.monotonic() - t0, ok=False)
+                last_exc = e
+                dead_urls.add(url)
+                self._fail(url, type(e).__name__)
+                continue
+            if resp.status_code >= 500:
+                self._fail(url, f"HTTP {resp.status_code}")
+            else:
+                self._ok(url)
+            if resp.status_code in accept:
+                with self._lock:
+                    self._memo[purpose] = (url, label, style)
+                return resp
+            if resp.status_code in (400, 401, 403):
+                safe_auth = (hdrs.get("Authorization") or "")[0:6] + "..."
+                logger.warning(f"Dragonfish {resp.status_code} en {url} cred={label} auth={style} Auth={safe_auth}")
+            if retry_set is not None and resp.status_code not in retry_set:
+                return resp
+            last_resp = resp
+        if last_resp is not None:
+            return last_resp
+        if last_exc is not None:
+            raise last_exc
+        raise requests.ConnectionError('Dragonfish: sin URLs configuradas')
+
+    def get(self, url: str, headers: Dict[str, str], read_timeout: Optional[float] = None, **kwargs) -> requests.Response:
+        """GET directo (p.ej. seguir 'Siguiente') con la Session compartida y timeouts acotados."""
+        self.requests += 1
+        return self.session.get(url, headers=headers, allow_redirects=True,
+                                timeout=(DRAGON_CONNECT_TIMEOUT, float(read_timeout or DRAGON_READ_TIMEOUT)), **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'skipped_open': self.skipped_open,
+                'memo': {k: {'url': v[0], 'cred': v[1], 'auth': v[2]} for k, v in self._memo.items()},
+                'breakers': {
+                    base: {'failures': b.failures, 'open': b.is_open()}
+                    for base, b in self._breakers.items()
+                },
+            }
+
+
+# Instancia única del proceso (módulo importable normalmente → un solo objeto en sys.modules)
+client = DragonHttpClient()
@@ -0,0 +1,286 @@
+"""
+Stock por depósito vía SQL (fallback cuando la API Dragonfish no responde)
+==========================================================================
+
+Consulta ZooLogic.COMB en todas las bases DRAGONFISH_% ONLINE del servidor
+(DRAGON_SQL_CONN_STR), excluyendo MELI/ADMIN/WOO/TN, igual que el fallback original,
+pero sin recorrerlas de a una:
+
+- Lista de bases cacheada (DRAGON_SQL_DBLIST_TTL, segundos).
+- Fan-out en paralelo por base sobre un pool acotado de conexiones
+  (DRAGON_SQL_MAX_WORKERS) con timeout de consulta por base (DRAGON_SQL_DB_TIMEOUT):
+  una sucursal caída o lenta se omite en lugar de frenar toda la consulta.
+  Las bases que fallan quedan en espera DRAGON_SQL_DB_BACKOFF_SECS antes de reintentarse.
+- stock_per_deposit_many(): un único batch UNION ALL sobre todas las bases para
+  muchos SKUs a la vez (si el batch falla, cae al fan-out por base).
+
+Formato de salida igual que 07_dragon_api: {'DEPOT': {'total': X, 'reserved': 0}}.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+try:
+    from modules import pipeline_metrics as _metrics  # type: ignore
+except Exception:
+    _metrics = None
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+DRAGON_SQL_MAX_WORKERS = max(1, int(_env_float('DRAGON_SQL_MAX_WORKERS', 6)))
+DRAGON_SQL_DB_TIMEOUT = max(1, int(_env_float('DRAGON_SQL_DB_TIMEOUT', 8)))
+DRAGON_SQL_BATCH_TIMEOUT = max(1, int(_env_float('DRAGON_SQL_BATCH_TIMEOUT', 30)))
+DRAGON_SQL_DBLIST_TTL = _env_float('DRAGON_SQL_DBLIST_TTL', 300)
+DRAGON_SQL_DB_BACKOFF_SECS = _env_float('DRAGON_SQL_DB_BACKOFF_SECS', 60)
+# Parámetros por batch: 3 por SKU, SQL Server admite hasta 2100
+DRAGON_SQL_BATCH_MAX_SKUS = 500
+
+_EXCLUDE = {'MELI', 'ADMIN', 'WOO', 'TN'}
+
+_SQL_ONE = (
+    "SELECT RTRIM(BDALTAFW) AS dep, SUM(COCANT) "
+    "FROM   [{base}].[ZooLogic].[COMB] "
+    "WHERE  RTRIM(COART)=? AND RTRIM(COCOL)=? AND RTRIM(TALLE)=? "
+    "GROUP BY BDALTAFW HAVING SUM(COCANT)<>0"
+)
+
+StockMap = Dict[str, Dict[str, int]]
+SkuKey = Tuple[str, str, str]
+
+
+def _split_sku(sku: str) -> SkuKey:
+    parts = str(sku or '').strip().split('-', 2)
+    while len(parts) < 3:
+        parts.append('')
+    return parts[0].strip(), parts[1].strip(), parts[2].strip()
+
+
+def _timed_fetch(cur: Any, sql: str, params) -> List[Any]:
+    """execute+fetchall registrando la llamada como 'dragon_sql' en las métricas del ciclo."""
+    t0 = time.monotonic()
+    ok = False
+    try:
+        rows = cur.execute(sql, *params).fetchall()
+        ok = True
+        return rows
+    finally:
+        if _metrics is not None:
+            _metrics.record('dragon_sql', time.monotonic() - t0, ok)
+
+
+class _ConnPool:
+    """Pool mínimo de conexiones pyodbc (autocommit, sólo lectura) para DRAGON_SQL_CONN_STR."""
+
+    def __init__(self, conn_str: str, max_size: int):
+        self.conn_str = conn_str
+        self.max_size = max_size
+        self._idle: "queue.LifoQueue[Any]" = queue.LifoQueue()
+        self._sem = threading.BoundedSemaphore(max_size)
+
+    def acquire(self, query_timeout: int):
+        import pyodbc
+        if not self._sem.acquire(timeout=max(1, query_timeout)):
+            raise TimeoutError('pool SQL Dragonfish saturado')
+        try:
+            try:
+                cn = self._idle.get_nowait()
+            except queue.Empty:
+                cn = pyodbc.connect(self.conn_str, autocommit=True, timeout=query_timeout)
+            cn.timeout = query_timeout  # timeout de consulta (segundos)
+            return cn
+        except Exception:
+            self._sem.release()
+            raise
+
+    def release(self, cn: Any, broken: bool = False) -> None:
+        try:
+            if broken:
+                try:
+                    cn.close()
+                except Exception:
+                    pass
+            else:
+                self._idle.put(cn)
+        finally:
+            self._sem.release()
+
+
+class DragonSqlStock:
+    def __init__(self, conn_str: str):
+        self.conn_str = conn_str
+        self._pool = _ConnPool(conn_str, DRAGON_SQL_MAX_WORKERS)
+        self._executor = ThreadPoolExecutor(max_workers=DRAGON_SQL_MAX_WORKERS, thread_name_prefix='dragon-sql')
+        self._lock = threading.Lock()
+        self._dbs: List[str] = []
+        self._dbs_at = 0.0
+        self._failed_until: Dict[str, float] = {}
+
+    # ---- bases ----
+    def databases(self, force: bool = False) -> List[str]:
+        now = time.monotonic()
+        with self._lock:
+            if self._dbs and not force and (now - self._dbs_at) < DRAGON_SQL_DBLIST_TTL:
+                return list(self._dbs)
+        cn = self._pool.acquire(DRAGON_SQL_DB_TIMEOUT)
+        broken = False
+        try:
+            cur = cn.cursor()
+            names = [
+                n for (n,) in cur.execute(
+                    "SELECT name FROM sys.databases WHERE name LIKE 'DRAGONFISH_%' AND state_desc='ONLINE'"
+                ).fetchall()
+                if not any(bad in n.upper() for bad in _EXCLUDE)
+            ]
+        except Exception:
+            broken = True
+            raise
+        finally:
+            self._pool.release(cn, broken=broken)
+        with self._lock:
+            self._dbs = names
+            self._dbs_at = time.monotonic()
+        return list(names)
+
+    def _usable(self, dbs: List[str]) -> List[str]:
+        now = time.monotonic()
+        with self._lock:
+            return [d for d in dbs if self._failed_until.get(d, 0) <= now]
+
+    def _mark_failed(self, db: str, err: Exception) -> None:
+        with self._lock:
+            self._failed_until[db] = time.monotonic() + DRAGON_SQL_DB_BACKOFF_SECS
+        logger.warning(f"SQL stock: base {db} omitida por {DRAGON_SQL_DB_BACKOFF_SECS:.0f}s: {err}")
+
+    # ---- fan-out por base ----
+    def _query_db(self, db: str, keys: List[SkuKey]) -> Dict[SkuKey, List[Tuple[str, int]]]:
+        out: Dict[SkuKey, List[Tuple[str, int]]] = {}
+        cn = self._pool.acquire(DRAGON_SQL_DB_TIMEOUT)
+        broken = False
+        try:
+            cur = cn.cursor()
+            sql = _SQL_ONE.format(base=db)
+            for k in keys:
+                rows = _timed_fetch(cur, sql, k)
+                out[k] = [(str(dep or '').strip().upper(), int(qty or 0)) for dep, qty in rows]
+            return out
+        except Exception:
+            broken = True
+            raise
+        finally:
+            self._pool.release(cn, broken=broken)
+
+    def _fan_out(self, keys: List[SkuKey]) -> Dict[SkuKey, StockMap]:
+        res: Dict[SkuKey, StockMap] = {k: {} for k in keys}
+        dbs = self._usable(self.databases())
+        if not dbs:
+            return res
+        futs = {self._executor.submit(self._query_db, db, keys): db for db in dbs}
+        # Presupuesto total: las bases van en paralelo, así que alcanza con un timeout por base
+        # (más holgura por cola si hay más bases que workers y por cantidad de SKUs)
+        waves = (len(dbs) + DRAGON_SQL_MAX_WORKERS - 1) // DRAGON_SQL_MAX_WORKERS
+        budget = DRAGON_SQL_DB_TIMEOUT * max(1, waves) * max(1, len(keys)) + 2
+        done, pending = wait(futs, timeout=budget)
+        for fut in pending:
+            fut.cancel()
+            self._mark_failed(futs[fut], TimeoutError('sin respuesta dentro del presupuesto'))
+        for fut in done:
+            db = futs[fut]
+            try:
+                per_key = fut.result()
+            except Exception as e:
+                self._mark_failed(db, e)
+                continue
+            for k, rows in per_key.items():
+                acc = res[k]
+                for dep, qty in rows:
+                    prev = int((acc.get(dep) or {}).get('total') or 0)
+                    acc[dep] = {'total': prev + qty, 'reserved': 0}
+        return res
+
+    # ---- batch UNION ALL ----
+    def _batch(self, keys: List[SkuKey]) -> Dict[SkuKey, StockMap]:
+        dbs = self._usable(self.databases())
+        res: Dict[SkuKey, StockMap] = {k: {} for k in keys}
+        if not dbs or not keys:
+            return res
+        values = ",".join(["(?,?,?)"] * len(keys))
+        branches = " UNION ALL ".join(
+            "SELECT k.art, k.col, k.tal, RTRIM(c.BDALTAFW) AS dep, SUM(c.COCANT) AS qty "
+            f"FROM [{db}].[ZooLogic].[COMB] c "
+            "JOIN k ON RTRIM(c.COART)=k.art AND RTRIM(c.COCOL)=k.col AND RTRIM(c.TALLE)=k.tal "
+            "GROUP BY k.art, k.col, k.tal, c.BDALTAFW HAVING SUM(c.COCANT)<>0"
+            for db in dbs
+        )
+        sql = f"WITH k(art, col, tal) AS (SELECT art, col, tal FROM (VALUES {values}) v(art, col, tal)) {branches}"
+        params: List[str] = [p for k in keys for p in k]
+        cn = self._pool.acquire(DRAGON_SQL_BATCH_TIMEOUT)
+        broken = False
+        try:
+            rows = _timed_fetch(cn.cursor(), sql, params)
+        except Exception:
+            broken = True
+            raise
+        finally:
+            self._pool.release(cn, broken=broken)
+        for art, col, tal, dep, qty in rows:
+            k = (str(art), str(col), str(tal))
+            if k not in res:
+                continue
+            dep_up = str(dep or '').strip().upper()
+            prev = int((res[k].get(dep_up) or {}).get('total') or 0)
+            res[k][dep_up] = {'total': prev + int(qty or 0), 'reserved': 0}
+        return res
+
+    # ---- API ----
+    def stock_per_deposit(self, sku: str) -> StockMap:
+        k = _split_sku(sku)
+        return self._fan_out([k]).get(k, {})
+
+    def stock_per_deposit_many(self, skus: Iterable[str]) -> Dict[str, StockMap]:
+        by_key: Dict[SkuKey, List[str]] = {}
+        for s in skus or []:
+            if s:
+                by_key.setdefault(_split_sku(s), []).append(s)
+        keys = list(by_key.keys())
+        out: Dict[str, StockMap] = {}
+        for i in range(0, len(keys), DRAGON_SQL_BATCH_MAX_SKUS):
+            chunk = keys[i:i + DRAGON_SQL_BATCH_MAX_SKUS]
+            try:
+                res = self._batch(chunk)
+            except Exception as e:
+                # Una base problemática rompe el UNION ALL: resolver por base con timeouts
+                logger.warning(f"SQL stock batch falló ({len(chunk)} SKUs), fan-out por base: {e}")
+                res = self._fan_out(chunk)
+            for k, stock in res.items():
+                for s in by_key.get(k, []):
+                    out[s] = {d: dict(v) for d, v in stock.items()}
+        return out
+
+
+_ENGINE: Optional[DragonSqlStock] = None
+_ENGINE_LOCK = threading.Lock()
+
+
+def get_engine() -> DragonSqlStock:
+    """Motor compartido del proceso; requiere DRAGON_SQL_CONN_STR."""
+    global _ENGINE
+    conn_str = os.getenv('DRAGON_SQL_CONN_STR')
+    if not conn_str:
+        raise RuntimeError('DRAGON_SQL_CONN_STR no configurado')
+    with _ENGINE_LOCK:
+        if _ENGINE is None or _ENGINE.conn_str != conn_str:
+            _ENGINE = DragonSqlStock(conn_str)
+        return _ENGINE
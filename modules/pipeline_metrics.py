@@ -0,0 +1,206 @@
+"""
+Métricas por ciclo de PIPELINE_10
+=================================
+
+run_cycle abre un ciclo (start_cycle) y envuelve cada etapa con stage('nombre'); los
+clientes externos registran sus llamadas con record('dependencia', segundos, ok):
+
+- 'ml'          API de MercadoLibre (sessions de MeliClient y NotesFetcher, vía requests_hook)
+- 'dragon_api'  API Dragonfish (modules.dragon_http)
+- 'dragon_sql'  SQL Dragonfish (dragon_sql_stock, article_resolver)
+- 'app_db'      escrituras por lote en orders_meli (upsert_orders, notas)
+
+Al cerrar el ciclo (finish_cycle) se calcula por dependencia cantidad de llamadas, errores
+y latencias p50/p95/max, y se agrega una línea JSON a PIPELINE_METRICS_FILE
+(logs/pipeline_metrics.jsonl por defecto). El server lee ese archivo (/pipeline/metrics).
+
+Sin ciclo abierto record() no hace nada: los mismos módulos usados desde el server o
+desde scripts no acumulan muestras.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+_BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+METRICS_FILE = os.getenv('PIPELINE_METRICS_FILE') or os.path.join(_BASE_DIR, 'logs', 'pipeline_metrics.jsonl')
+try:
+    METRICS_MAX_SAMPLES = max(100, int(os.getenv('PIPELINE_METRICS_MAX_SAMPLES', '20000')))
+except Exception:
+    METRICS_MAX_SAMPLES = 20000
+
+
+def _pct(sorted_vals: List[float], p: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    idx = min(len(sorted_vals) - 1, max(0, int(round(p * (len(sorted_vals) - 1)))))
+    return sorted_vals[idx]
+
+
+class _Dep:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.samples: List[float] = []
+
+    def summary(self) -> Dict[str, Any]:
+        vals = sorted(self.samples)
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'p50_ms': round(_pct(vals, 0.50) * 1000, 1),
+            'p95_ms': round(_pct(vals, 0.95) * 1000, 1),
+            'max_ms': round((vals[-1] if vals else 0.0) * 1000, 1),
+            'total_s': round(sum(vals), 3),
+        }
+
+
+class CycleMetrics:
+    def __init__(self, cycle_no: int):
+        self.cycle_no = cycle_no
+        self.started_at = datetime.now().isoformat(timespec='seconds')
+        self._t0 = time.monotonic()
+        self._lock = threading.Lock()
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self.deps: Dict[str, _Dep] = {}
+
+    def record(self, dep: str, secs: float, ok: bool = True) -> None:
+        with self._lock:
+            d = self.deps.get(dep)
+            if d is None:
+                d = _Dep()
+                self.deps[dep] = d
+            d.calls += 1
+            if not ok:
+                d.errors += 1
+            if len(d.samples) < METRICS_MAX_SAMPLES:
+                d.samples.append(max(0.0, float(secs)))
+
+    def set_stage(self, name: str, secs: float, ok: bool, info: Any = None) -> None:
+        with self._lock:
+            st = {'secs': round(secs, 3), 'ok': ok}
+            if info is not None:
+                st['info'] = info
+            self.stages[name] = st
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'cycle': self.cycle_no,
+                'started_at': self.started_at,
+                'total_secs': round(time.monotonic() - self._t0, 3),
+                'stages': dict(self.stages),
+                'deps': {k: v.summary() for k, v in self.deps.items()},
+            }
+
+
+_CURRENT: Optional[CycleMetrics] = None
+
+
+def start_cycle(cycle_no: int) -> CycleMetrics:
+    global _CURRENT
+    _CURRENT = CycleMetrics(cycle_no)
+    return _CURRENT
+
+
+def finish_cycle(path: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Cierra el ciclo en curso, agrega su resumen al JSONL y lo devuelve."""
+    global _CURRENT
+    cyc, _CURRENT = _CURRENT, None
+    if cyc is None:
+        return None
+    out = cyc.summary()
+    try:
+        target = path or METRICS_FILE
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(out, ensure_ascii=False) + '\n')
+    except Exception:
+        pass  # métricas: no romper el ciclo
+    return out
+
+
+def record(dep: str, secs: float, ok: bool = True) -> None:
+    cyc = _CURRENT
+    if cyc is not None:
+        cyc.record(dep, secs, ok)
+
+
+def record_stage(name: str, secs: float, ok: bool = True, info: Any = None) -> None:
+    cyc = _CURRENT
+    if cyc is not None:
+        cyc.set_stage(name, secs, ok, info)
+
+
+@contextmanager
+def timed(dep: str) -> Iterator[None]:
+    """Registra la duración del bloque como una llamada a `dep` (error si levanta)."""
+    t0 = time.monotonic()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        record(dep, time.monotonic() - t0, ok)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[Dict[str, Any]]:
+    """Mide una etapa de run_cycle. En el dict entregado se puede dejar 'info' (resultado)
+    y 'ok' = False si la etapa falló aunque el error se haya capturado."""
+    t0 = time.monotonic()
+    holder: Dict[str, Any] = {}
+    ok = False
+    try:
+        yield holder
+        ok = True
+    finally:
+        cyc = _CURRENT
+        if cyc is not None:
+            cyc.set_stage(name, time.monotonic() - t0, ok and holder.get('ok', True), holder.get('info'))
+
+
+def requests_hook(dep: str):
+    """Hook de respuesta para requests.Session: usa response.elapsed; 429/5xx cuentan como error."""
+    def _hook(resp, *args, **kwargs):
+        try:
+            record(dep, resp.elapsed.total_seconds(), resp.status_code < 500 and resp.status_code != 429)
+        except Exception:
+            pass
+        return resp
+    return _hook
+
+
+def instrument_session(session: Any, dep: str) -> None:
+    try:
+        session.hooks.setdefault('response', []).append(requests_hook(dep))
+    except Exception:
+        pass
+
+
+def recent(n: int = 20, path: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Últimos n resúmenes de ciclo del JSONL (más reciente al final)."""
+    target = path or METRICS_FILE
+    try:
+        with open(target, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            # Leer desde el final lo suficiente para n líneas
+            chunk = min(size, max(64 * 1024, n * 8 * 1024))
+            f.seek(size - chunk)
+            lines = f.read().decode('utf-8', errors='replace').splitlines()
+    except Exception:
+        return []
+    if chunk < size and lines:
+        lines = lines[1:]  # primera línea posiblemente cortada
+    out: List[Dict[str, Any]] = []
+    for ln in lines[-n:]:
+        try:
+            out.append(json.loads(ln))
+        except Exception:
+            continue
+    return out
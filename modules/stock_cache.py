@@ -0,0 +1,157 @@
+"""
+Caché de stock Dragonfish por artículo base
+===========================================
+
+ConsultaStockYPreciosEntreLocales se consulta por ARTÍCULO BASE (lo que va antes del
+primer '-'), así que todas las variantes color/talle de un artículo comparten la misma
+respuesta. Este módulo guarda esa respuesta cruda por base, compartida por todo el proceso
+(server, 08_assign_tx, scripts), aunque 07_dragon_api se cargue varias veces por importlib:
+
+- TTL corto (STOCK_CACHE_TTL, segundos; 0 = deshabilitado).
+- Single-flight: si varios hilos piden la misma base sin caché, sólo uno va a la API
+  y el resto espera su resultado (o su excepción).
+- Invalidación explícita por SKU (invalidate_sku) cuando un movimiento en Dragonfish
+  se confirma, para no asignar sobre stock que ya cambió.
+
+Los errores no se cachean: el siguiente pedido vuelve a intentar.
+"""
+
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+try:
+    STOCK_CACHE_TTL = float(os.getenv('STOCK_CACHE_TTL', '20'))
+except Exception:
+    STOCK_CACHE_TTL = 20.0
+try:
+    STOCK_CACHE_MAX = max(100, int(os.getenv('STOCK_CACHE_MAX', '5000')))
+except Exception:
+    STOCK_CACHE_MAX = 5000
+
+
+def article_base(sku: Optional[str]) -> str:
+    """Artículo base que se envía como 'query' a Dragonfish.
+    Ej: 'NWQRDHBRDV-VCF-04' -> 'NWQRDHBRDV'.
+    """
+    s_in = (sku or '').strip()
+    if s_in.upper().startswith('TDRK20'):
+        return 'TDRK20'
+    return s_in.split('-')[0] if '-' in s_in else s_in
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class StockCache:
+    """Caché TTL con single-flight, clave = artículo base (case-insensitive)."""
+
+    def __init__(self, ttl: float = STOCK_CACHE_TTL, max_entries: int = STOCK_CACHE_MAX):
+        self.ttl = float(ttl)
+        self.max_entries = int(max_entries)
+        self._data: Dict[str, Tuple[float, Any]] = {}
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _key(base: str) -> str:
+        return str(base or '').strip().upper()
+
+    def get_or_load(self, base: str, loader: Callable[[], Any]) -> Any:
+        """Devuelve el valor cacheado para la base o lo carga con loader() (una sola vez
+        aunque haya pedidos concurrentes). Las excepciones de loader se propagan a todos
+        los que esperaban y no quedan en caché."""
+        key = self._key(base)
+        if self.ttl <= 0 or not key:
+            return loader()
+        with self._lock:
+            ent = self._data.get(key)
+            if ent is not None and (time.monotonic() - ent[0]) < self.ttl:
+                self.hits += 1
+                return ent[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+                self.misses += 1
+            else:
+                self.waits += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            value = loader()
+            flight.value = value
+            with self._lock:
+                # Si alguien invalidó mientras cargábamos, no guardar un valor viejo
+                if self._flights.get(key) is flight:
+                    self._data[key] = (time.monotonic(), value)
+                    if len(self._data) > self.max_entries:
+                        self._evict_locked()
+            return value
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    self._flights.pop(key, None)
+            flight.done.set()
+
+    def _evict_locked(self) -> None:
+        now = time.monotonic()
+        for k in [k for k, (ts, _v) in self._data.items() if (now - ts) >= self.ttl]:
+            self._data.pop(k, None)
+        while len(self._data) > self.max_entries:
+            self._data.pop(next(iter(self._data)), None)
+
+    def invalidate(self, base: str) -> None:
+        key = self._key(base)
+        with self._lock:
+            self._data.pop(key, None)
+            # Una carga en curso ya no debe poblar la caché
+            self._flights.pop(key, None)
+            self.invalidations += 1
+
+    def invalidate_sku(self, sku: str) -> None:
+        self.invalidate(article_base(sku))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._flights.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'ttl': self.ttl,
+                'entries': len(self._data),
+                'in_flight': len(self._flights),
+                'hits': self.hits,
+                'misses': self.misses,
+                'waits': self.waits,
+                'invalidations': self.invalidations,
+            }
+
+
+# Instancia única del proceso (módulo importable normalmente → un solo objeto en sys.modules)
+stock_cache = StockCache()
+
+
+def invalidate_sku(sku: str) -> None:
+    try:
+        stock_cache.invalidate_sku(sku)
+    except Exception:
+        pass
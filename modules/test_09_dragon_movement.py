@@ -0,0 +1,74 @@
+"""
+Test de move_stock_lines con una línea inválida en un pack (sin red)
+====================================================================
+
+La línea con SKU inválido se omite y queda en 'skipped'; las demás se postean en un
+solo movimiento con NroItem consecutivo.
+"""
+
+import importlib.util
+import json
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '09_dragon_movement.py')
+_spec = importlib.util.spec_from_file_location('modules.09_dragon_movement_test', _PATH)
+mov = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(mov)  # type: ignore[union-attr]
+
+
+class _Resp:
+    status_code = 201
+    content = b'{"Numero": 12345}'
+
+    def json(self):
+        return {"Numero": 12345}
+
+
+class _FakeHttp:
+    def __init__(self):
+        self.bodies = []
+
+    def request(self, method, **kwargs):
+        self.bodies.append(json.loads(kwargs["data"]))
+        return _Resp()
+
+
+def _patch(monkeypatch):
+    http = _FakeHttp()
+    invalidated = []
+    monkeypatch.setattr(mov, "DRAGON_MOV_URL", "http://dragon.test/Movimientodestock/")
+    monkeypatch.setattr(mov, "_http", http)
+    monkeypatch.setattr(mov, "_invalidate_stock_cache", invalidated.append)
+    return http, invalidated
+
+
+def test_invalid_line_is_skipped_and_rest_posted(monkeypatch):
+    http, invalidated = _patch(monkeypatch)
+    lines = [
+        {"sku": "NDPMB0-NN0-T38", "qty": 1, "articulo_detalle": "ZAPATILLA"},
+        {"sku": "", "qty": 1, "articulo_detalle": "SIN SKU"},
+        {"sku": "TXRB11-AZ0-M", "qty": 2, "articulo_detalle": "REMERA"},
+    ]
+    res = mov.move_stock_lines(lines=lines, observacion="pack_id=1 | depo=DEP", tipo=2)
+
+    assert res["ok"] is True
+    assert res["numero"] == 12345
+    assert res["lines"] == 2
+    assert [s["index"] for s in res["skipped"]] == [1]
+    assert len(http.bodies) == 1
+    detalle = http.bodies[0]["MovimientoDetalle"]
+    assert [d["NroItem"] for d in detalle] == [1, 2]
+    assert [d["Articulo"] for d in detalle] == ["NDPMB0-NN0-T38", "TXRB11-AZ0-M"]
+    assert invalidated == ["NDPMB0-NN0-T38", "TXRB11-AZ0-M"]
+
+
+def test_all_lines_invalid_does_not_post(monkeypatch):
+    http, _ = _patch(monkeypatch)
+    res = mov.move_stock_lines(lines=[{"sku": "", "qty": 1}, {"sku": None, "qty": 1}], observacion="x", tipo=2)
+
+    assert res["ok"] is False
+    assert len(res["skipped"]) == 2
+    assert http.bodies == []
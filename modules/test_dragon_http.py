@@ -0,0 +1,82 @@
+"""
+Test de DragonHttpClient.request con retry_on (sin red)
+=======================================================
+
+Para el POST de movimientos (retry_on=(400, 401)) sólo se prueba otro estilo de
+Authorization si el primero fue rechazado; un 5xx o un read timeout no se reintentan.
+Sin retry_on se mantiene el recorrido completo de combinaciones.
+"""
+
+import os
+import sys
+
+import requests
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules import dragon_http  # noqa: E402
+
+_CREDS = [{"IdCliente": "C1", "Token": "TOK", "Label": "primaria"}]
+
+
+class _Resp:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.content = b""
+
+
+def _client(outcomes):
+    c = dragon_http.DragonHttpClient()
+    auths = []
+
+    def _request(method, url, **kwargs):
+        auths.append(kwargs["headers"]["Authorization"])
+        out = outcomes[len(auths) - 1]
+        if isinstance(out, Exception):
+            raise out
+        return _Resp(out)
+
+    c.session.request = _request
+    return c, auths
+
+
+def _post(c, **kw):
+    return c.request("POST", purpose="mov", urls=["http://dragon.test/mov/"], creds=_CREDS,
+                     styles=("raw", "bearer"), accept=(200, 201, 409), data="{}", **kw)
+
+
+def test_mov_5xx_is_not_retried_with_bearer():
+    c, auths = _client([500, 201])
+    assert _post(c, retry_on=(400, 401)).status_code == 500
+    assert auths == ["TOK"]
+
+
+def test_mov_401_falls_back_to_bearer():
+    c, auths = _client([401, 201])
+    assert _post(c, retry_on=(400, 401)).status_code == 201
+    assert auths == ["TOK", "Bearer TOK"]
+
+
+def test_mov_read_timeout_is_not_retried():
+    c, auths = _client([requests.ReadTimeout("lento"), 201])
+    try:
+        _post(c, retry_on=(400, 401))
+    except requests.ReadTimeout:
+        pass
+    else:
+        raise AssertionError("se esperaba ReadTimeout")
+    assert auths == ["TOK"]
+
+
+def test_without_retry_on_tries_every_combination():
+    c, auths = _client([500, 201])
+    assert _post(c).status_code == 201
+    assert auths == ["TOK", "Bearer TOK"]
+
+
+if __name__ == "__main__":
+    test_mov_5xx_is_not_retried_with_bearer()
+    test_mov_401_falls_back_to_bearer()
+    test_mov_read_timeout_is_not_retried()
+    test_without_retry_on_tries_every_combination()
+    print("OK")
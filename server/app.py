@@ -1,5 +1,5 @@
 from fastapi import FastAPI, Depends, HTTPException, Query, Request, Security
-from fastapi.responses import JSONResponse, RedirectResponse, HTMLResponse, Response
+from fastapi.responses import JSONResponse, RedirectResponse, HTMLResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
@@ -8,6 +8,7 @@ from datetime import datetime
 from decimal import Decimal
 import os
 import time
+import asyncio
 import pyodbc
 from dotenv import load_dotenv
 import json
@@ -15,15 +16,33 @@ import re
 import requests
 from .services import (
     get_orders_service,
+    get_orders_page_service,
+    get_order_changes_service,
     update_order_service,
     run_split_notifier_loop,
+    run_order_feed_publisher_loop,
 )
 from .services import update_order_by_order_or_pack
+from .services import acc2_configured as _services_acc2_configured
+from .services import reload_orders_schema as _reload_orders_schema, ORDERS_SCHEMA as _ORDERS_SCHEMA_META
 from .services import _get_conn as _orders_conn, _col_exists as _orders_col_exists, TABLE as _ORDERS_TABLE  # reutilizar conexión/tabla
 import threading
 
 from .schemas import UpdateOrderRequest, OrdersResponse, UpdateOrderResponse, get_allowed_update_fields
 from .services import get_default_fields as get_default_fields_for_orders
+from . import ml_client as _ml_client
+from . import db_pool as _db_pool
+from .events import order_events as _order_events
+try:
+    from modules.depot_recommender import stock_column_for as _stock_column_for
+except Exception:
+    def _stock_column_for(depot: str) -> str:
+        return f"stock_{str(depot or '').lower()}"
+try:
+    # Cola de asignación inmediata (PIPELINE_10 la consume entre ciclos)
+    from modules import assign_queue as _assign_queue
+except Exception:
+    _assign_queue = None
 
 # Import note publisher
 publish_note_upsert = None
@@ -276,7 +295,7 @@ def _insert_webhook_event(row: Dict[str, Any]) -> int:
         raise RuntimeError("SQLSERVER_WEBHOOK_CONN no configurado (acc1 o acc2)")
     conn = None
     try:
-        conn = pyodbc.connect(conn_str)
+        conn = _db_pool.connect(conn_str, label=f"webhook-{_webhook_acc_label(conn_str)}")
         cur = conn.cursor()
         cur.execute(
             """
@@ -297,6 +316,8 @@ def _insert_webhook_event(row: Dict[str, Any]) -> int:
         )
         new_id = cur.fetchone()[0]
         conn.commit()
+        # Avisar a la pool de workers de esa base para que lo tome sin esperar
+        _wake_webhook_workers(conn_str)
         return int(new_id)
     finally:
         try:
@@ -561,33 +582,74 @@ def _get_token_for_user(user_id: Optional[int]) -> Optional[str]:
     return tok or None
 
 def _ml_get_order(order_id: int, token: str) -> Dict[str, Any]:
-    url = f"https://api.mercadolibre.com/orders/{order_id}"
-    r = requests.get(url, headers={"Authorization": f"Bearer {token}"}, timeout=20)
-    r.raise_for_status()
-    return r.json()
+    return _ml_client.get_order(order_id, token)
 
 def _ml_get_shipment(shipment_id: int, token: str) -> Dict[str, Any]:
-    url = f"https://api.mercadolibre.com/shipments/{shipment_id}"
-    r = requests.get(url, headers={"Authorization": f"Bearer {token}"}, timeout=20)
-    r.raise_for_status()
-    return r.json()
+    return _ml_client.get_shipment(shipment_id, token)
+
+def _prefetch_webhook_batch(evs: List[Dict[str, Any]]) -> Dict[Tuple[str, int], Any]:
+    """Resuelve contra ML todo un batch de eventos en dos olas por seller:
+    1) órdenes (multiget), 2) shipments (de los eventos + los de las órdenes) en paralelo.
+    Devuelve {("order"|"shipment", id): dict|Exception}. Lo que falte se pide on-demand.
+    """
+    cache: Dict[Tuple[str, int], Any] = {}
+    by_user: Dict[Any, List[Dict[str, Any]]] = {}
+    for ev in evs:
+        by_user.setdefault(ev.get("user_id"), []).append(ev)
+    for user_id, items in by_user.items():
+        try:
+            token = _get_token_for_user(user_id)
+            if not token:
+                continue
+            order_ids = [int(e["resource_id"]) for e in items
+                         if (e.get("topic") or "").lower() in ("orders", "orders_v2") and e.get("resource_id")]
+            ship_ids = [int(e["resource_id"]) for e in items
+                        if (e.get("topic") or "").lower() == "shipments" and e.get("resource_id")]
+            if order_ids:
+                for oid, data in _ml_client.get_orders_many(order_ids, token, seller_id=user_id).items():
+                    cache[("order", oid)] = data
+                    if isinstance(data, dict):
+                        sid = ((data.get("shipping") or {}).get("id"))
+                        if sid:
+                            ship_ids.append(int(sid))
+            if ship_ids:
+                for sid, data in _ml_client.get_shipments_many(ship_ids, token).items():
+                    cache[("shipment", sid)] = data
+        except Exception:
+            # No romper: _process_event_row vuelve a pedir lo que no esté en cache
+            pass
+    return cache
+
+def _prefetched_or_fetch(prefetched: Optional[Dict[Tuple[str, int], Any]], kind: str, obj_id: int, token: str) -> Dict[str, Any]:
+    hit = (prefetched or {}).get((kind, int(obj_id)))
+    if isinstance(hit, Exception):
+        raise hit
+    if isinstance(hit, dict):
+        return hit
+    return _ml_get_order(obj_id, token) if kind == "order" else _ml_get_shipment(obj_id, token)
 
-def _orders_apply_update_from_ml(conn: pyodbc.Connection, order_id: int, shipping_id: Optional[int], status: Optional[str], substatus: Optional[str]) -> None:
+def _orders_apply_update_from_ml(conn: pyodbc.Connection, order_id: int, shipping_id: Optional[int], status: Optional[str], substatus: Optional[str], acc: str = "acc1") -> None:
     """Inserta/actualiza en dbo.orders_meli los campos de envío clave y marca WEBHOOK_VISTO=1.
     Hace upsert básico: si no existe la orden, inserta con mínimos; si existe, actualiza.
+    Si cambió estado/subestado publica la transición en el bus de /orders/stream, y si
+    pasó a ready_to_print la encola en dbo.assign_queue para asignación inmediata.
     """
     cur = conn.cursor()
     # 1) ¿Existe la orden?
-    cur.execute("SELECT TOP 1 order_id, shipping_estado, shipping_subestado, printed FROM dbo.orders_meli WHERE order_id = ?", order_id)
+    cur.execute("SELECT TOP 1 order_id, shipping_estado, shipping_subestado, printed, deposito_asignado, pack_id FROM dbo.orders_meli WHERE order_id = ?", order_id)
     row = cur.fetchone()
     prev_estado = None
     prev_sub = None
     prev_printed = None
+    prev_depo = None
+    pack_id = None
     if row:
         try:
             prev_estado = row[1]
             prev_sub = row[2]
             prev_printed = int(row[3]) if row[3] is not None else None
+            prev_depo = row[4]
+            pack_id = row[5]
         except Exception:
             prev_estado = None
             prev_sub = None
@@ -637,9 +699,41 @@ def _orders_apply_update_from_ml(conn: pyodbc.Connection, order_id: int, shippin
             order_id,
         )
     conn.commit()
+    # 3) Publicar transición (sin bloquear el webhook si falla)
+    try:
+        new_estado = status if status is not None else prev_estado
+        new_sub = substatus if substatus is not None else prev_sub
+        if (not row) or new_estado != prev_estado or new_sub != prev_sub:
+            _order_events.publish({
+                "type": "order_update",
+                "source": "webhook",
+                "acc": acc,
+                "order_id": str(order_id),
+                "pack_id": str(pack_id) if pack_id is not None else None,
+                "shipping_id": shipping_id,
+                "deposito_asignado": prev_depo,
+                "deposito_anterior": prev_depo,
+                "shipping_estado": new_estado,
+                "shipping_subestado": new_sub,
+                "shipping_estado_anterior": prev_estado,
+                "shipping_subestado_anterior": prev_sub,
+                "inserted": not bool(row),
+            })
+    except Exception:
+        pass
+    # 4) Transición a ready_to_print: encolar para asignar ya (pack completo), sin esperar el ciclo.
+    #    Sólo en la base que atiende PIPELINE_10 (la de 08_assign_tx): la de acc2 no tiene consumidor.
+    try:
+        new_sub = substatus if substatus is not None else prev_sub
+        if _assign_queue is not None and acc != "acc2" and (new_sub or "").lower() == "ready_to_print" \
+                and (not row or (prev_sub or "").lower() != "ready_to_print"):
+            _assign_queue.enqueue(conn, order_id, pack_id, source="webhook", key=f"webhook:{acc}")
+    except Exception:
+        pass
 
-def _process_event_row(conn: pyodbc.Connection, ev: Dict[str, Any]) -> None:
+def _process_event_row(conn: pyodbc.Connection, ev: Dict[str, Any], prefetched: Optional[Dict[Tuple[str, int], Any]] = None) -> None:
     """Procesa un solo registro de dbo.meli_webhook_events ya bloqueado para procesamiento.
+    Si se pasa prefetched (ver _prefetch_webhook_batch), usa esas respuestas de ML.
     """
     topic = (ev.get("topic") or "").lower()
     user_id = ev.get("user_id")
@@ -657,14 +751,14 @@ def _process_event_row(conn: pyodbc.Connection, ev: Dict[str, Any]) -> None:
 
     if topic in ("orders", "orders_v2"):
         order_id = int(resource_id)
-        order = _ml_get_order(order_id, token)
+        order = _prefetched_or_fetch(prefetched, "order", order_id, token)
         shipping = (order or {}).get("shipping") or {}
         shipping_id = shipping.get("id")
         if shipping_id:
-            sh = _ml_get_shipment(int(shipping_id), token)
+            sh = _prefetched_or_fetch(prefetched, "shipment", int(shipping_id), token)
             status = (sh or {}).get("status")
             substatus = (sh or {}).get("substatus")
-        _orders_apply_update_from_ml(conn, order_id, shipping_id, status, substatus)
+        _orders_apply_update_from_ml(conn, order_id, shipping_id, status, substatus, acc=ev.get("acc") or "acc1")
         # Descuento rápido si aplica
         try:
             _fast_deduct_if_needed(conn, int(order_id))
@@ -677,7 +771,7 @@ def _process_event_row(conn: pyodbc.Connection, ev: Dict[str, Any]) -> None:
             pass
     elif topic == "shipments":
         shipping_id = int(resource_id)
-        sh = _ml_get_shipment(shipping_id, token)
+        sh = _prefetched_or_fetch(prefetched, "shipment", shipping_id, token)
         status = (sh or {}).get("status")
         substatus = (sh or {}).get("substatus")
         # Resolver order_id (puede venir en shipment->orders o shipment->order_id)
@@ -692,7 +786,7 @@ def _process_event_row(conn: pyodbc.Connection, ev: Dict[str, Any]) -> None:
         if order_id is None:
             # Fallback: no se puede actualizar sin order_id; solo continuar
             return
-        _orders_apply_update_from_ml(conn, int(order_id), shipping_id, status, substatus)
+        _orders_apply_update_from_ml(conn, int(order_id), shipping_id, status, substatus, acc=ev.get("acc") or "acc1")
         # Descuento rápido si aplica
         try:
             _fast_deduct_if_needed(conn, int(order_id))
@@ -707,62 +801,461 @@ def _process_event_row(conn: pyodbc.Connection, ev: Dict[str, Any]) -> None:
         # Otros tópicos: por ahora ignorar
         return
 
-def _poll_pending_webhooks(conn: pyodbc.Connection, batch_size: int = 20) -> int:
-    """Toma un batch de eventos pending, los marca como processing y procesa.
-    Devuelve cantidad procesada.
+# ===================== Pool de workers de webhooks =====================
+# N workers por cuenta reclaman filas 'pending' de forma atómica (UPDATE ... OUTPUT con
+# READPAST/UPDLOCK), así varios hilos (o varias instancias del server) no toman el mismo evento.
+# /meli/callback despierta a los workers apenas inserta, en lugar de esperar el sleep fijo.
+try:
+    WEBHOOK_WORKERS_PER_ACC = max(1, int(os.getenv("WEBHOOK_WORKERS_PER_ACC", "4")))
+except Exception:
+    WEBHOOK_WORKERS_PER_ACC = 4
+try:
+    WEBHOOK_CLAIM_BATCH = max(1, int(os.getenv("WEBHOOK_CLAIM_BATCH", "10")))
+except Exception:
+    WEBHOOK_CLAIM_BATCH = 10
+try:
+    WEBHOOK_IDLE_WAIT_SECS = max(1, int(os.getenv("WEBHOOK_IDLE_WAIT_SECS", "20")))
+except Exception:
+    WEBHOOK_IDLE_WAIT_SECS = 20
+# Lease de los eventos 'processing': pasado este tiempo desde el claim se consideran
+# abandonados (worker caído, conexión perdida a mitad del batch) y vuelven a 'pending';
+# tras WEBHOOK_MAX_ATTEMPTS claims quedan en 'error' para no reintentar para siempre.
+try:
+    WEBHOOK_PROCESSING_TTL_SECS = max(60, int(os.getenv("WEBHOOK_PROCESSING_TTL_SECS", "600")))
+except Exception:
+    WEBHOOK_PROCESSING_TTL_SECS = 600
+try:
+    WEBHOOK_MAX_ATTEMPTS = max(1, int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "5")))
+except Exception:
+    WEBHOOK_MAX_ATTEMPTS = 5
+
+_WEBHOOK_WAKE: Dict[str, threading.Event] = {}
+_WEBHOOK_WAKE_LOCK = threading.Lock()
+_WEBHOOK_METRICS: Dict[str, Dict[str, Any]] = {}
+_WEBHOOK_METRICS_LOCK = threading.Lock()
+
+
+def _webhook_acc_label(conn_str: str) -> str:
+    if SQLSERVER_WEBHOOK_CONN_ACC2 and conn_str == SQLSERVER_WEBHOOK_CONN_ACC2 and conn_str != SQLSERVER_WEBHOOK_CONN_ACC1:
+        return "acc2"
+    return "acc1"
+
+
+def _webhook_wake_event(conn_str: str) -> threading.Event:
+    with _WEBHOOK_WAKE_LOCK:
+        ev = _WEBHOOK_WAKE.get(conn_str)
+        if ev is None:
+            ev = threading.Event()
+            _WEBHOOK_WAKE[conn_str] = ev
+        return ev
+
+
+def _wake_webhook_workers(conn_str: Optional[str]) -> None:
+    """Despierta a los workers de la base indicada (llamado tras insertar un evento)."""
+    if not conn_str:
+        return
+    try:
+        _webhook_wake_event(conn_str).set()
+    except Exception:
+        pass
+
+
+def _webhook_metrics_record(acc: str, claimed: int = 0, done: int = 0, errors: int = 0, coalesced: int = 0,
+                            lag_ms: Optional[int] = None, proc_ms: Optional[float] = None, reaped: int = 0) -> None:
+    try:
+        with _WEBHOOK_METRICS_LOCK:
+            m = _WEBHOOK_METRICS.setdefault(acc, {
+                "started_at": time.time(),
+                "claimed": 0, "done": 0, "errors": 0, "coalesced": 0, "reaped": 0,
+                "last_lag_ms": None, "max_lag_ms": 0,
+                "proc_ms_total": 0.0, "last_event_at": None,
+            })
+            m["claimed"] += int(claimed)
+            m["done"] += int(done)
+            m["errors"] += int(errors)
+            m["coalesced"] += int(coalesced)
+            m["reaped"] = int(m.get("reaped") or 0) + int(reaped)
+            if lag_ms is not None:
+                m["last_lag_ms"] = int(lag_ms)
+                if int(lag_ms) > int(m.get("max_lag_ms") or 0):
+                    m["max_lag_ms"] = int(lag_ms)
+            if proc_ms is not None:
+                m["proc_ms_total"] += float(proc_ms)
+            if done or errors:
+                m["last_event_at"] = time.time()
+    except Exception:
+        pass
+
+
+def get_webhook_metrics() -> Dict[str, Any]:
+    """Snapshot de métricas de los workers: throughput (eventos/min), lag de cola y errores."""
+    out: Dict[str, Any] = {"workers_per_acc": WEBHOOK_WORKERS_PER_ACC, "claim_batch": WEBHOOK_CLAIM_BATCH, "accounts": {}}
+    now = time.time()
+    with _WEBHOOK_METRICS_LOCK:
+        for acc, m in _WEBHOOK_METRICS.items():
+            uptime = max(1.0, now - float(m.get("started_at") or now))
+            fetched = int(m.get("done") or 0) + int(m.get("errors") or 0)
+            finished = fetched + int(m.get("coalesced") or 0)
+            out["accounts"][acc] = {
+                "claimed": m.get("claimed"),
+                "done": m.get("done"),
+                "errors": m.get("errors"),
+                "coalesced": m.get("coalesced"),
+                "reaped": m.get("reaped"),
+                "events_per_min": round(finished * 60.0 / uptime, 2),
+                "avg_proc_ms": round(float(m.get("proc_ms_total") or 0.0) / fetched, 1) if fetched else None,
+                "last_lag_ms": m.get("last_lag_ms"),
+                "max_lag_ms": m.get("max_lag_ms"),
+                "last_event_at": datetime.fromtimestamp(m["last_event_at"]).isoformat() if m.get("last_event_at") else None,
+            }
+    return out
+
+
+_WEBHOOK_LEASE_COL: Dict[str, str] = {}
+
+
+def _webhook_lease_col(conn: pyodbc.Connection, acc: str) -> str:
+    """Columna donde se marca el momento del claim: claimed_at (se crea una vez por proceso
+    y cuenta si falta); sin permisos para el ALTER se usa processed_at, que en filas
+    'processing' no tiene otro uso."""
+    col = _WEBHOOK_LEASE_COL.get(acc)
+    if col:
+        return col
+    col = "processed_at"
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            "IF COL_LENGTH('dbo.meli_webhook_events', 'claimed_at') IS NULL "
+            "ALTER TABLE dbo.meli_webhook_events ADD claimed_at DATETIME2 NULL"
+        )
+        conn.commit()
+        col = "claimed_at"
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+    _WEBHOOK_LEASE_COL[acc] = col
+    return col
+
+
+_WEBHOOK_REAP_LAST: Dict[str, float] = {}
+_WEBHOOK_REAP_LOCK = threading.Lock()
+
+
+def _reap_stale_webhooks(conn: pyodbc.Connection, acc: str) -> int:
+    """Devuelve a 'pending' los eventos 'processing' con el lease vencido (o los pasa a
+    'error' si ya agotaron WEBHOOK_MAX_ATTEMPTS). Corre como mucho una vez por minuto y
+    cuenta, desde cualquiera de sus workers. Devuelve cuántas filas tocó."""
+    now = time.monotonic()
+    with _WEBHOOK_REAP_LOCK:
+        if now - _WEBHOOK_REAP_LAST.get(acc, 0.0) < 60:
+            return 0
+        _WEBHOOK_REAP_LAST[acc] = now
+    col = _webhook_lease_col(conn, acc)
+    cur = conn.cursor()
+    cutoff = f"COALESCE({col}, received_at) < DATEADD(SECOND, -?, SYSUTCDATETIME())"
+    cur.execute(
+        "UPDATE dbo.meli_webhook_events WITH (READPAST, ROWLOCK) "
+        "SET status='error', processed_at=SYSUTCDATETIME(), error='lease de procesamiento vencido' "
+        f"WHERE status='processing' AND attempts >= ? AND {cutoff}",
+        WEBHOOK_MAX_ATTEMPTS, WEBHOOK_PROCESSING_TTL_SECS,
+    )
+    n = max(0, cur.rowcount or 0)
+    cur.execute(
+        "UPDATE dbo.meli_webhook_events WITH (READPAST, ROWLOCK) "
+        f"SET status='pending', {col}=NULL "
+        f"WHERE status='processing' AND attempts < ? AND {cutoff}",
+        WEBHOOK_MAX_ATTEMPTS, WEBHOOK_PROCESSING_TTL_SECS,
+    )
+    n += max(0, cur.rowcount or 0)
+    conn.commit()
+    if n:
+        _webhook_metrics_record(acc, reaped=n)
+    return n
+
+
+def _claim_pending_webhooks(conn: pyodbc.Connection, batch_size: int, acc: str = "acc1") -> List[Dict[str, Any]]:
+    """Reclama atómicamente hasta batch_size eventos 'pending' (los más viejos primero).
+    READPAST saltea filas tomadas por otro worker; UPDLOCK evita que dos workers lean la misma.
+    Devuelve los eventos ya marcados 'processing' con su lag (ms) desde received_at.
     """
+    col = _webhook_lease_col(conn, acc)
     cur = conn.cursor()
     cur.execute(
         (
-            "SELECT TOP (?) id, topic, resource_id, user_id FROM dbo.meli_webhook_events WITH (READPAST) "
-            "WHERE status='pending' ORDER BY received_at ASC"
+            "WITH cte AS ("
+            f" SELECT TOP (?) id, topic, resource_id, user_id, received_at, status, attempts, {col} "
+            " FROM dbo.meli_webhook_events WITH (READPAST, UPDLOCK, ROWLOCK) "
+            " WHERE status='pending' ORDER BY received_at ASC, id ASC) "
+            f"UPDATE cte SET status='processing', attempts=attempts+1, {col}=SYSUTCDATETIME() "
+            "OUTPUT inserted.id, inserted.topic, inserted.resource_id, inserted.user_id, "
+            "DATEDIFF(millisecond, inserted.received_at, SYSUTCDATETIME())"
         ),
-        batch_size,
+        int(batch_size),
     )
     rows = cur.fetchall() or []
-    if not rows:
-        return 0
-    ids = [int(r[0]) for r in rows]
-    # Marcar processing
+    conn.commit()
+    out: List[Dict[str, Any]] = []
+    for r in rows:
+        out.append({"id": int(r[0]), "topic": r[1], "resource_id": r[2], "user_id": r[3], "lag_ms": r[4]})
+    # OUTPUT no respeta el ORDER BY de la CTE
+    out.sort(key=lambda e: e["id"])
+    return out
+
+
+def _webhook_topic_key(topic: Optional[str]) -> str:
+    t = (topic or "").lower()
+    return "orders" if t in ("orders", "orders_v2") else t
+
+
+_WEBHOOK_COALESCE_COL: Dict[str, bool] = {}
+
+
+def _ensure_webhook_coalesce_column(conn: pyodbc.Connection, acc: str) -> bool:
+    """Crea (una vez por proceso y cuenta) la columna coalesced_into si falta.
+    Si no hay permisos, se registra la referencia en 'error' como texto.
+    """
+    if acc in _WEBHOOK_COALESCE_COL:
+        return _WEBHOOK_COALESCE_COL[acc]
+    ok = False
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            "IF COL_LENGTH('dbo.meli_webhook_events', 'coalesced_into') IS NULL "
+            "ALTER TABLE dbo.meli_webhook_events ADD coalesced_into INT NULL"
+        )
+        conn.commit()
+        ok = True
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+    _WEBHOOK_COALESCE_COL[acc] = ok
+    return ok
+
+
+def _claim_duplicate_webhooks(conn: pyodbc.Connection, evs: List[Dict[str, Any]], acc: str = "acc1") -> List[Dict[str, Any]]:
+    """Reclama también los 'pending' del mismo resource_id que los ya reclamados,
+    para que una ráfaga de notificaciones del mismo recurso se resuelva en un solo fetch.
+    """
+    res_ids = sorted({int(e["resource_id"]) for e in evs if e.get("resource_id")})
+    if not res_ids:
+        return []
+    col = _webhook_lease_col(conn, acc)
+    cur = conn.cursor()
     cur.execute(
-        f"UPDATE dbo.meli_webhook_events SET status='processing', attempts=attempts+1 WHERE id IN ({','.join(['?']*len(ids))})",
-        *ids,
+        (
+            "UPDATE dbo.meli_webhook_events WITH (READPAST, UPDLOCK, ROWLOCK) "
+            f"SET status='processing', attempts=attempts+1, {col}=SYSUTCDATETIME() "
+            "OUTPUT inserted.id, inserted.topic, inserted.resource_id, inserted.user_id, "
+            "DATEDIFF(millisecond, inserted.received_at, SYSUTCDATETIME()) "
+            f"WHERE status='pending' AND resource_id IN ({','.join(['?'] * len(res_ids))})"
+        ),
+        *res_ids,
     )
+    rows = cur.fetchall() or []
     conn.commit()
-    # Procesar uno por uno
-    processed = 0
-    for r in rows:
-        ev_id = int(r[0])
-        ev = {"id": ev_id, "topic": r[1], "resource_id": r[2], "user_id": r[3]}
+    return [{"id": int(r[0]), "topic": r[1], "resource_id": r[2], "user_id": r[3], "lag_ms": r[4]} for r in rows]
+
+
+def _coalesce_webhook_events(conn: pyodbc.Connection, evs: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Dict[int, int]]:
+    """Agrupa eventos duplicados y devuelve (líderes a procesar, {id_absorbido: id_líder}).
+    1) Mismo (tópico, resource_id, user_id): queda el más nuevo (mayor id); el estado se
+       consulta a ML al procesar, así que el último aviso ya trae lo más reciente.
+    2) Un 'shipments' cuyo envío (según orders_meli) pertenece a una orden que ya tiene un
+       evento 'orders' en el batch se absorbe: procesar la orden ya trae su shipment.
+    """
+    groups: Dict[Tuple[str, Any, Any], List[Dict[str, Any]]] = {}
+    for ev in evs:
+        key = (_webhook_topic_key(ev.get("topic")), ev.get("resource_id"), ev.get("user_id"))
+        groups.setdefault(key, []).append(ev)
+    leaders: List[Dict[str, Any]] = []
+    absorbed: Dict[int, int] = {}
+    for key, items in groups.items():
+        if not key[1]:
+            # Sin resource_id no hay con qué agrupar
+            leaders.extend(items)
+            continue
+        lead = max(items, key=lambda e: e["id"])
+        leaders.append(lead)
+        for it in items:
+            if it["id"] != lead["id"]:
+                absorbed[it["id"]] = lead["id"]
+
+    # 2) shipments -> orden ya presente en el batch
+    order_leaders: Dict[Tuple[int, Any], int] = {}
+    for ev in leaders:
+        if _webhook_topic_key(ev.get("topic")) == "orders" and ev.get("resource_id"):
+            order_leaders[(int(ev["resource_id"]), ev.get("user_id"))] = ev["id"]
+    ship_ids = sorted({int(ev["resource_id"]) for ev in leaders
+                       if _webhook_topic_key(ev.get("topic")) == "shipments" and ev.get("resource_id")})
+    if order_leaders and ship_ids:
+        ship_to_order: Dict[int, int] = {}
         try:
-            _process_event_row(conn, ev)
+            cur = conn.cursor()
+            cur.execute(
+                f"SELECT DISTINCT shipping_id, order_id FROM dbo.orders_meli WITH (NOLOCK) WHERE shipping_id IN ({','.join(['?'] * len(ship_ids))})",
+                *ship_ids,
+            )
+            for r in cur.fetchall() or []:
+                try:
+                    ship_to_order[int(r[0])] = int(r[1])
+                except Exception:
+                    pass
+        except Exception:
+            ship_to_order = {}
+        kept: List[Dict[str, Any]] = []
+        for ev in leaders:
+            if _webhook_topic_key(ev.get("topic")) == "shipments" and ev.get("resource_id"):
+                oid = ship_to_order.get(int(ev["resource_id"]))
+                target = order_leaders.get((oid, ev.get("user_id"))) if oid is not None else None
+                if target is not None:
+                    absorbed[ev["id"]] = target
+                    continue
+            kept.append(ev)
+        leaders = kept
+
+    # Aplanar cadenas (absorbido -> líder absorbido -> líder final)
+    for k in list(absorbed.keys()):
+        tgt = absorbed[k]
+        seen = set()
+        while tgt in absorbed and tgt not in seen:
+            seen.add(tgt)
+            tgt = absorbed[tgt]
+        absorbed[k] = tgt
+    leaders.sort(key=lambda e: e["id"])
+    return leaders, absorbed
+
+
+def _mark_coalesced_webhooks(conn: pyodbc.Connection, acc: str, lead_id: int, ids: List[int], error: Optional[str]) -> None:
+    """Cierra los eventos absorbidos con el mismo resultado que su líder."""
+    if not ids:
+        return
+    cur = conn.cursor()
+    marks = ','.join(['?'] * len(ids))
+    status = 'error' if error else 'done'
+    if _ensure_webhook_coalesce_column(conn, acc):
+        cur.execute(
+            f"UPDATE dbo.meli_webhook_events SET status=?, processed_at=SYSUTCDATETIME(), error=?, coalesced_into=? WHERE id IN ({marks})",
+            status, (error or None), lead_id, *ids,
+        )
+    else:
+        note = f"coalesced_into={lead_id}" + (f"; {error}" if error else "")
+        cur.execute(
+            f"UPDATE dbo.meli_webhook_events SET status=?, processed_at=SYSUTCDATETIME(), error=? WHERE id IN ({marks})",
+            status, note[:800], *ids,
+        )
+    conn.commit()
+
+
+def _poll_pending_webhooks(conn: pyodbc.Connection, batch_size: int = 20, acc: str = "acc1") -> int:
+    """Reclama un batch de eventos pending, agrupa duplicados y procesa un líder por grupo.
+    Devuelve cantidad reclamada (procesados OK + con error + absorbidos).
+    """
+    evs = _claim_pending_webhooks(conn, batch_size, acc)
+    if not evs:
+        return 0
+    try:
+        evs.extend(_claim_duplicate_webhooks(conn, evs, acc))
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+    _webhook_metrics_record(acc, claimed=len(evs))
+    leaders, absorbed = _coalesce_webhook_events(conn, evs)
+    for ev in leaders:
+        ev["acc"] = acc
+    followers: Dict[int, List[int]] = {}
+    for ev_id, lead_id in absorbed.items():
+        followers.setdefault(lead_id, []).append(ev_id)
+    # Resolver todo el batch contra ML en 1-2 olas (multiget órdenes + shipments en paralelo)
+    try:
+        prefetched = _prefetch_webhook_batch(leaders)
+    except Exception:
+        prefetched = {}  # no romper: cada evento pide lo suyo on-demand
+    cur = conn.cursor()
+    for ev in leaders:
+        ev_id = ev["id"]
+        t0 = time.perf_counter()
+        err: Optional[str] = None
+        try:
+            _process_event_row(conn, ev, prefetched)
             cur.execute("UPDATE dbo.meli_webhook_events SET status='done', processed_at=SYSUTCDATETIME(), error=NULL WHERE id=?", ev_id)
-            processed += 1
+            conn.commit()
+            _webhook_metrics_record(acc, done=1, lag_ms=ev.get("lag_ms"), proc_ms=(time.perf_counter() - t0) * 1000.0)
         except Exception as e:
-            cur.execute("UPDATE dbo.meli_webhook_events SET status='error', error=? WHERE id=?", str(e)[:800], ev_id)
-        conn.commit()
-    return processed
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            err = str(e)[:800]
+            try:
+                cur.execute("UPDATE dbo.meli_webhook_events SET status='error', error=? WHERE id=?", err, ev_id)
+                conn.commit()
+            except Exception:
+                # Queda en 'processing': el reaper la devuelve a 'pending' cuando vence el lease
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+            _webhook_metrics_record(acc, errors=1, lag_ms=ev.get("lag_ms"), proc_ms=(time.perf_counter() - t0) * 1000.0)
+        dup_ids = followers.get(ev_id) or []
+        if dup_ids:
+            try:
+                _mark_coalesced_webhooks(conn, acc, ev_id, dup_ids, err)
+                _webhook_metrics_record(acc, coalesced=len(dup_ids))
+            except Exception:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+    return len(evs)
 
-def _webhook_worker_loop(conn_str: str, interval_secs: int = 20):
-    """Loop simple que procesa eventos pending a intervalos regulares en una base concreta.
+
+def _webhook_worker_loop(conn_str: str, interval_secs: int = WEBHOOK_IDLE_WAIT_SECS, worker_no: int = 0):
+    """Worker de la pool: reclama y procesa batches mientras haya cola; si queda vacía,
+    espera el aviso de /meli/callback (o interval_secs como red de seguridad).
+    La conexión se toma del pool compartido por batch y se devuelve al terminarlo.
     Tolerante a errores: nunca levanta excepciones hacia el hilo principal.
     """
     if not conn_str:
         return
+    acc = _webhook_acc_label(conn_str)
+    wake = _webhook_wake_event(conn_str)
     while True:
+        claimed = 0
+        conn = None
         try:
-            conn = pyodbc.connect(conn_str)
+            conn = _db_pool.connect(conn_str, label=f"webhook-{acc}")
             try:
-                _ = _poll_pending_webhooks(conn, batch_size=25)
-            finally:
+                _reap_stale_webhooks(conn, acc)
+            except Exception:
                 try:
-                    conn.close()
+                    conn.rollback()
                 except Exception:
                     pass
+            claimed = _poll_pending_webhooks(conn, batch_size=WEBHOOK_CLAIM_BATCH, acc=acc)
+            conn.close()
         except Exception:
-            # No matar el loop por errores transitorios (DB caída, etc.)
-            pass
-        time.sleep(max(5, int(interval_secs or 20)))
+            # No matar el loop por errores transitorios (DB caída, etc.): descartar la conexión
+            try:
+                if conn is not None:
+                    if hasattr(conn, "invalidate"):
+                        conn.invalidate()
+                    else:
+                        conn.close()
+            except Exception:
+                pass
+            time.sleep(min(5, max(1, int(interval_secs or 5))))
+            continue
+        if claimed >= WEBHOOK_CLAIM_BATCH:
+            # Batch lleno: probablemente quede cola, seguir sin esperar
+            continue
+        wake.wait(timeout=max(1, int(interval_secs or WEBHOOK_IDLE_WAIT_SECS)))
+        wake.clear()
 
 # Auth dependency must be defined before it's referenced in route signatures
 def require_token(credentials: Optional[HTTPAuthorizationCredentials] = Security(security)):
@@ -775,21 +1268,57 @@ def require_token(credentials: Optional[HTTPAuthorizationCredentials] = Security
         raise HTTPException(status_code=403, detail="Invalid token")
 
 
+@app.on_event("startup")
+def _preload_orders_schema():
+    # Cargar el esquema de orders_meli (acc1/acc2) una vez al inicio
+    try:
+        _reload_orders_schema(["acc1", "acc2"] if _services_acc2_configured() else ["acc1"])
+    except Exception:
+        pass
+
+
+@app.post("/admin/schema/reload")
+def admin_schema_reload(acc: Optional[str] = Query(None, regex="^acc1|acc2$"), _=Depends(require_token)):
+    """Recarga el snapshot de columnas/tipos/largos de orders_meli (p.ej. tras un ALTER TABLE)."""
+    res = _reload_orders_schema([acc] if acc else None)
+    return {"ok": all(v.get("ok") for v in res.values()), "reloaded": res, "status": _ORDERS_SCHEMA_META.status()}
+
+
 @app.on_event("startup")
 def _start_background_jobs():
     # Lanzar el notificador de 'DEBE_PARTIRSE' cada 60s en hilo daemon
+    # (único emisor de esas alertas: GET /orders ya no notifica por fila)
     try:
         t = threading.Thread(target=run_split_notifier_loop, kwargs={"interval_secs": 60}, daemon=True)
         t.start()
+        if _services_acc2_configured():
+            threading.Thread(target=run_split_notifier_loop, kwargs={"interval_secs": 60, "acc": "acc2"}, daemon=True).start()
     except Exception:
         # No bloquear inicio del server por errores en background
         pass
+    # Asignaciones hechas por PIPELINE_10 (otro proceso) -> /orders/stream, vía change feed
+    try:
+        accs = ["acc1", "acc2"] if _services_acc2_configured() else ["acc1"]
+        for acc in accs:
+            threading.Thread(target=run_order_feed_publisher_loop, kwargs={"acc": acc},
+                             name=f"orders-feed-{acc}", daemon=True).start()
+    except Exception:
+        pass
     # Lanzar workers de webhooks (acc1/acc2 según config)
     try:
+        conn_strs = []
         if SQLSERVER_WEBHOOK_CONN_ACC1:
-            threading.Thread(target=_webhook_worker_loop, kwargs={"conn_str": SQLSERVER_WEBHOOK_CONN_ACC1, "interval_secs": 20}, daemon=True).start()
-        if SQLSERVER_WEBHOOK_CONN_ACC2:
-            threading.Thread(target=_webhook_worker_loop, kwargs={"conn_str": SQLSERVER_WEBHOOK_CONN_ACC2, "interval_secs": 20}, daemon=True).start()
+            conn_strs.append(SQLSERVER_WEBHOOK_CONN_ACC1)
+        if SQLSERVER_WEBHOOK_CONN_ACC2 and SQLSERVER_WEBHOOK_CONN_ACC2 not in conn_strs:
+            conn_strs.append(SQLSERVER_WEBHOOK_CONN_ACC2)
+        for cs in conn_strs:
+            for n in range(WEBHOOK_WORKERS_PER_ACC):
+                threading.Thread(
+                    target=_webhook_worker_loop,
+                    kwargs={"conn_str": cs, "interval_secs": WEBHOOK_IDLE_WAIT_SECS, "worker_no": n},
+                    name=f"webhook-{_webhook_acc_label(cs)}-{n}",
+                    daemon=True,
+                ).start()
     except Exception:
         # No bloquear el inicio si falla el worker
         pass
@@ -1659,6 +2188,11 @@ def list_orders(
     q_title: Optional[str] = Query(None, description="LIKE on nombre"),
     # Extra flags
     include_printed: Optional[int] = Query(1, description="0 to exclude printed=1, 1 to include"),
+    # Keyset pagination / count
+    cursor: Optional[str] = Query(None, description="Opaque next_cursor/prev_cursor from a previous response"),
+    after_id: Optional[int] = Query(None, description="Seek: rows after this [id] in sort_dir order"),
+    before_id: Optional[int] = Query(None, description="Seek: rows before this [id] in sort_dir order"),
+    with_total: str = Query("1", regex="^(0|1|estimate)$", description="1 exact COUNT, 0 skip, estimate cached/approx"),
     acc: str = Query("acc1", regex="^acc1|acc2$", description="Cuenta/base de datos a usar: acc1 o acc2"),
     _=Depends(require_token),
 ):
@@ -1667,14 +2201,89 @@ def list_orders(
     Ejemplos:
     - /orders?fields=nombre&deposito_asignado_in=DEPO,MUNDOAL,MTGBBL,BBPS,MONBAHIA,MTGBBPS
     - /orders?fields=all&desde=2025-08-01&hasta=2025-08-18&include_printed=0
+    - /orders?limit=200&with_total=0 → luego /orders?cursor=<next_cursor>&with_total=0
     """
     try:
         selected = None
         if fields:
             selected = [f.strip() for f in fields.split(",") if f.strip()]
         params: Dict[str, Any] = dict(request.query_params)
-        items, total = get_orders_service(selected_fields=selected, params=params, acc=acc)
-        return {"orders": items, "page": page, "limit": limit, "total": total}
+        res = get_orders_page_service(selected_fields=selected, params=params, acc=acc)
+        return {
+            "orders": res["items"],
+            "page": page,
+            "limit": limit,
+            "total": res["total"],
+            "total_estimated": res["total_estimated"],
+            "next_cursor": res["next_cursor"],
+            "prev_cursor": res["prev_cursor"],
+        }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/orders/stream")
+async def stream_orders(
+    request: Request,
+    acc: Optional[str] = Query(None, regex="^acc1|acc2$", description="Filtrar por cuenta; vacío = ambas"),
+    deposito: Optional[str] = Query(None, description="CSV de depósitos (contains sobre deposito_asignado actual o anterior)"),
+    _=Depends(require_token),
+):
+    """Server-Sent Events con las transiciones de órdenes (webhooks, updates de la API y, vía
+    change feed, las asignaciones de depósito que hace PIPELINE_10 con source='change_feed').
+
+    Cada evento es `event: order_update` con JSON (order_id, pack_id, acc, deposito_asignado,
+    shipping_subestado y sus valores anteriores, source). Cada 15s se envía un comentario
+    de keep-alive. Pensado para pickers conectados: reemplaza el polling de /orders.
+    """
+    depots = [d for d in (deposito or "").split(",") if d.strip()]
+    sub = _order_events.subscribe(acc=acc, depots=depots)
+
+    async def _gen():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                if await request.is_disconnected():
+                    break
+                try:
+                    ev = await asyncio.wait_for(sub.queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if sub.dropped:
+                    yield f"event: dropped\ndata: {json.dumps({'dropped': sub.dropped})}\n\n"
+                    sub.dropped = 0
+                yield f"id: {ev.get('seq')}\nevent: {ev.get('type') or 'order_update'}\ndata: {json.dumps(ev, ensure_ascii=False, default=str)}\n\n"
+        finally:
+            _order_events.unsubscribe(sub)
+
+    return StreamingResponse(_gen(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/orders/changes")
+def list_order_changes(
+    since: Optional[str] = Query(None, description="Watermark devuelto por la llamada anterior; vacío = solo obtener watermark actual"),
+    fields: Optional[str] = Query(None, description="Campos separados por coma o 'all'"),
+    limit: int = Query(500, ge=1, le=5000),
+    after_id: Optional[int] = Query(None, description="Solo modo timestamp: continuar un feed truncado (next_after_id)"),
+    acc: str = Query("acc1", regex="^acc1|acc2$", description="Cuenta/base de datos a usar: acc1 o acc2"),
+    _=Depends(require_token),
+):
+    """Feed de cambios de `orders_meli` para clientes que hoy refrescan la lista completa.
+
+    Uso: pedir /orders/changes sin since → guardar watermark → carga completa con /orders →
+    luego /orders/changes?since=<watermark> en cada refresh y upsert por id.
+    Con has_more=true, repetir enseguida con el watermark (o next_after_id) recibido.
+    """
+    try:
+        selected = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+        return get_order_changes_service(since, selected, acc=acc, limit=limit, after_id=after_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except HTTPException:
         raise
     except Exception as e:
@@ -1908,7 +2517,7 @@ def _parse_natural_range(text: str) -> Optional[Dict[str, str]]:
 
 def _max_date_created() -> Optional[str]:
     try:
-        items, _ = get_orders_service(["date_created"], {"page": 1, "limit": 1, "sort_by": "date_created", "sort_dir": "DESC"})
+        items, _ = get_orders_service(["date_created"], {"with_total": 0, "page": 1, "limit": 1, "sort_by": "date_created", "sort_dir": "DESC"})
         if items:
             dt = items[0].get("date_created")
             if isinstance(dt, str):
@@ -1940,14 +2549,14 @@ def _today_range() -> Dict[str, Any]:
 
 
 def _order_title(order_id: int) -> Optional[str]:
-    items, _ = get_orders_service(["order_id", "nombre"], {"order_id": order_id, "page": 1, "limit": 1})
+    items, _ = get_orders_service(["order_id", "nombre"], {"with_total": 0, "order_id": order_id, "page": 1, "limit": 1})
     if not items:
         return None
     return items[0].get("nombre")
 
 
 def _printed_status(order_id: int) -> str:
-    items, _ = get_orders_service(["order_id", "ready_to_print", "printed"], {"order_id": order_id, "page": 1, "limit": 1})
+    items, _ = get_orders_service(["order_id", "ready_to_print", "printed"], {"with_total": 0, "order_id": order_id, "page": 1, "limit": 1})
     if not items:
         return f"No encontré la orden {order_id}."
     it = items[0]
@@ -2006,25 +2615,8 @@ def _stock_by_sku_and_depo(sku: str, depo: str) -> str:
     if not latest:
         return f"No encuentro registros para SKU {sku}."
     key = f"stock_{depo.lower()}" if not depo.islower() else f"stock_{depo}"
-    # Normalizar algunos alias conocidos
-    aliases = {
-        "DEP": ["stock_dep"],
-        "MDQ": ["stock_mdq"],
-        "MUNDOAL": ["stock_mundoal"],
-        "MONBAHIA": ["stock_monbahia"],
-        "MTGBBPS": ["stock_mtgbbps"],
-        "MTGCBA": ["stock_mtgcba"],
-        "MTGCOM": ["stock_mtgcom"],
-        "MTGJBJ": ["stock_mtgjbj"],
-        "MTGROCA": ["stock_mtgroca"],
-        "MUNDOROC": ["stock_mundoroc"],
-        "NQNSHOP": ["stock_nqnshop"],
-        "NQNALB": ["stock_nqnalb"],
-        "MUNDOCAB": ["stock_mundocab"],
-    }
-    cand_keys = [key]
-    for k in aliases.get(depo.upper(), []):
-        cand_keys.append(k)
+    # Normalizar alias conocidos (DEP/DEPO -> stock_dep, BBPS -> stock_mtgbbps)
+    cand_keys = [key, _stock_column_for(depo)]
     for k in cand_keys:
         if k in latest and latest[k] is not None:
             return f"Stock en {depo} para {sku}: {latest[k]} (último registro)."
@@ -2035,7 +2627,7 @@ def _stock_by_sku_and_depo(sku: str, depo: str) -> str:
 
 def _order_multiventa_or_individual(order_id: int) -> str:
     # Traer la orden
-    items, _ = get_orders_service(["order_id", "pack_id"], {"order_id": order_id, "page": 1, "limit": 1})
+    items, _ = get_orders_service(["order_id", "pack_id"], {"with_total": 0, "order_id": order_id, "page": 1, "limit": 1})
     if not items:
         return f"No encuentro la orden {order_id}."
     pack_id = items[0].get("pack_id")
@@ -2049,7 +2641,7 @@ def _order_multiventa_or_individual(order_id: int) -> str:
 
 
 def _order_delivered(order_id: int) -> str:
-    items, _ = get_orders_service(["order_id", "shipping_estado", "shipping_subestado", "date_closed"], {"order_id": order_id, "page": 1, "limit": 1})
+    items, _ = get_orders_service(["order_id", "shipping_estado", "shipping_subestado", "date_closed"], {"with_total": 0, "order_id": order_id, "page": 1, "limit": 1})
     if not items:
         return f"No encuentro la orden {order_id}."
     it = items[0]
@@ -2190,7 +2782,7 @@ def _order_status(order_id: int) -> str:
 
 def _order_rejection_reason(order_id: int) -> str:
     fields = ["order_id", "_estado", "shipping_estado", "shipping_subestado", "q_comentario"] if 'q_comentario' in globals() else ["order_id", "_estado", "shipping_estado", "shipping_subestado"]
-    items, _ = get_orders_service(fields, {"order_id": order_id, "limit": 1, "page": 1})
+    items, _ = get_orders_service(fields, {"with_total": 0, "order_id": order_id, "limit": 1, "page": 1})
     if not items:
         return f"No encuentro la orden {order_id}."
     it = items[0]
@@ -2528,7 +3120,7 @@ def try_answer_locally(t: str) -> Optional[str]:
     if ("cuantos" in lower or "cuánto" in lower or "vendieron" in lower or "ventas" in lower) and m_sku:
         sku = m_sku[0]
         try:
-            items, _ = get_orders_service(["*"], {"page": 1, "limit": 200, "sku": sku, "sort_by": "date_created", "sort_dir": "DESC"})  # type: ignore[name-defined]
+            items, _ = get_orders_service(["*"], {"with_total": 0, "page": 1, "limit": 200, "sku": sku, "sort_by": "date_created", "sort_dir": "DESC"})  # type: ignore[name-defined]
             total_qty = sum(int(x.get("qty") or 1) for x in items)
             return f"Vendidos de {sku}: {total_qty} (sobre {len(items)} órdenes coincidentes)."
         except Exception:
@@ -2609,7 +3201,53 @@ def api_chat(payload: Dict[str, Any]):
 
 @app.get("/health")
 def health():
-    return {"ok": True, "time": datetime.now().isoformat()}
+    out: Dict[str, Any] = {"ok": True, "time": datetime.now().isoformat()}
+    try:
+        out["webhooks"] = get_webhook_metrics()
+    except Exception:
+        pass
+    try:
+        out["db_pool"] = _db_pool.pool_metrics()
+    except Exception:
+        pass
+    try:
+        out["orders_stream"] = _order_events.metrics()
+    except Exception:
+        pass
+    try:
+        from modules.stock_cache import stock_cache as _stock_cache
+        out["stock_cache"] = _stock_cache.stats()
+    except Exception:
+        pass
+    try:
+        from modules.dragon_http import client as _dragon_http
+        out["dragon_http"] = _dragon_http.stats()
+    except Exception:
+        pass
+    return out
+
+
+@app.get("/webhooks/metrics")
+def webhooks_metrics():
+    """Throughput, lag de cola y errores de la pool de workers de webhooks por cuenta."""
+    return get_webhook_metrics()
+
+
+@app.get("/pipeline/metrics")
+def pipeline_metrics(n: int = Query(20, ge=1, le=500, description="Cantidad de ciclos recientes")):
+    """Resumen de los últimos ciclos de PIPELINE_10 (etapas y dependencias), leído de su JSONL."""
+    from modules import pipeline_metrics as _pm
+    cycles = _pm.recent(n)
+    out: Dict[str, Any] = {"file": _pm.METRICS_FILE, "count": len(cycles), "cycles": cycles}
+    if cycles:
+        # Promedio por etapa en la ventana, para ver de un vistazo cuál domina
+        acc: Dict[str, List[float]] = {}
+        for c in cycles:
+            for name, st in (c.get("stages") or {}).items():
+                acc.setdefault(name, []).append(float(st.get("secs") or 0))
+        out["stage_avg_secs"] = {k: round(sum(v) / len(v), 3) for k, v in sorted(acc.items(), key=lambda kv: -sum(kv[1]))}
+        out["last"] = cycles[-1]
+    return out
 
 
 @app.get("/orders", response_model=OrdersResponse)
@@ -2936,7 +3574,7 @@ def _resolve_full_title(row: Dict[str, Any], title_sources_csv: Optional[str] =
 @app.get("/orders/resolve-by-barcode")
 def resolve_by_barcode(barcode: str = Query(...), deposito: Optional[str] = None, debug_nombre: int = Query(0, ge=0, le=1), acc: str = Query("acc1", regex="^acc1|acc2$"), _=Depends(require_token)):
     try:
-        params: Dict[str, Any] = {"page": 1, "limit": 1, "sort_by": "id", "sort_dir": "DESC"}
+        params: Dict[str, Any] = {"page": 1, "limit": 1, "sort_by": "id", "sort_dir": "DESC", "with_total": 0}
         if barcode:
             params["barcode"] = barcode
         if deposito:
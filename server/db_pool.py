@@ -0,0 +1,281 @@
+"""
+Pool de conexiones pyodbc por cuenta (acc1/acc2) para el backend.
+
+Compartido por los endpoints (services._get_conn), los workers de webhooks y
+run_split_notifier_loop. Cada conexión prestada se usa igual que una de pyodbc:
+
+    with pool.acquire() as cn:   # commit al salir OK, rollback si hubo excepción
+        cur = cn.cursor()
+        ...
+
+Al devolverla se hace rollback de lo pendiente, se resetea el nivel de aislamiento y se
+limpia SESSION_CONTEXT('ALLOW_DEPO_CHANGE') (el override del trigger write-once de
+deposito_asignado no debe heredarlo el próximo que la tome); si eso falla se descarta.
+También se descarta si superó la vida máxima o si dio error de conexión, y si estuvo
+ociosa más de DB_POOL_HEALTH_IDLE_SECS se valida con SELECT 1 antes de prestarla.
+
+Config por env:
+- DB_POOL_ENABLED (1): 0 vuelve al comportamiento anterior (connect por uso)
+- DB_POOL_MAX_SIZE (10): conexiones máximas por cuenta (prestadas + ociosas)
+- DB_POOL_MAX_LIFETIME_SECS (1800): reciclar conexiones más viejas
+- DB_POOL_CHECKOUT_TIMEOUT (15): segundos de espera si el pool está saturado
+- DB_POOL_HEALTH_IDLE_SECS (30): ociosidad a partir de la cual se valida
+"""
+
+import os
+import time
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+import pyodbc
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+DB_POOL_ENABLED = str(os.getenv("DB_POOL_ENABLED", "1")).lower() in ("1", "true", "yes")
+DB_POOL_MAX_SIZE = max(1, _env_int("DB_POOL_MAX_SIZE", 10))
+DB_POOL_MAX_LIFETIME_SECS = max(0, _env_int("DB_POOL_MAX_LIFETIME_SECS", 1800))
+DB_POOL_CHECKOUT_TIMEOUT = max(1, _env_int("DB_POOL_CHECKOUT_TIMEOUT", 15))
+DB_POOL_HEALTH_IDLE_SECS = max(0, _env_int("DB_POOL_HEALTH_IDLE_SECS", 30))
+
+
+class PoolTimeout(RuntimeError):
+    """No se consiguió conexión del pool dentro del checkout timeout."""
+
+
+class PooledConnection:
+    """Envoltorio de una conexión prestada. Delegá todo a la conexión real;
+    close() / salida del with la devuelven al pool en lugar de cerrarla.
+    """
+
+    def __init__(self, pool: "ConnectionPool", raw: Any, created_at: float):
+        self._pool = pool
+        self._raw = raw
+        self._created_at = created_at
+        self._released = False
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._raw, name)
+
+    def __enter__(self) -> "PooledConnection":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if self._released:
+            return
+        broken = False
+        try:
+            if exc_type is None:
+                self._raw.commit()
+            else:
+                self._raw.rollback()
+        except Exception:
+            broken = True
+        if exc_type is not None and issubclass(exc_type, (pyodbc.OperationalError, pyodbc.InterfaceError)):
+            broken = True
+        self._release(broken=broken)
+
+    def close(self) -> None:
+        self._release(broken=False)
+
+    def invalidate(self) -> None:
+        """Devolver marcando la conexión como rota (se cierra en lugar de reutilizarse)."""
+        self._release(broken=True)
+
+    def _release(self, broken: bool) -> None:
+        if self._released:
+            return
+        self._released = True
+        self._pool._release(self._raw, self._created_at, broken)
+
+    def __del__(self):
+        # Red de seguridad: si el caller perdió la referencia sin cerrar, no filtrar el cupo
+        try:
+            if not self._released:
+                self._release(broken=False)
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """Pool acotado de conexiones pyodbc para una cadena de conexión."""
+
+    def __init__(self, conn_str: str, label: str = "", max_size: int = DB_POOL_MAX_SIZE,
+                 max_lifetime_secs: int = DB_POOL_MAX_LIFETIME_SECS,
+                 checkout_timeout: int = DB_POOL_CHECKOUT_TIMEOUT,
+                 health_idle_secs: int = DB_POOL_HEALTH_IDLE_SECS):
+        self.conn_str = conn_str
+        self.label = label or "db"
+        self.max_size = max(1, int(max_size))
+        self.max_lifetime_secs = int(max_lifetime_secs)
+        self.checkout_timeout = int(checkout_timeout)
+        self.health_idle_secs = int(health_idle_secs)
+        # (conexión, creada_en, devuelta_en)
+        self._idle: Deque[Tuple[Any, float, float]] = deque()
+        self._size = 0  # prestadas + ociosas
+        self._cond = threading.Condition(threading.Lock())
+        self._m: Dict[str, float] = {
+            "checkouts": 0, "waits": 0, "wait_ms_total": 0.0, "max_wait_ms": 0.0,
+            "timeouts": 0, "created": 0, "recycled": 0, "discarded": 0, "health_failed": 0,
+        }
+
+    # ---- internos ----
+    def _close_quiet(self, raw: Any) -> None:
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    def _expired(self, created_at: float) -> bool:
+        return bool(self.max_lifetime_secs) and (time.time() - created_at) > self.max_lifetime_secs
+
+    def _healthy(self, raw: Any) -> bool:
+        try:
+            cur = raw.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            cur.close()
+            return True
+        except Exception:
+            return False
+
+    def _release(self, raw: Any, created_at: float, broken: bool) -> None:
+        if not broken:
+            try:
+                # Sesión limpia para el próximo: sin transacción abierta, aislamiento heredado
+                # ni bandera de override del trigger de deposito_asignado
+                raw.rollback()
+                cur = raw.cursor()
+                cur.execute(
+                    "SET TRANSACTION ISOLATION LEVEL READ COMMITTED; "
+                    "EXEC sp_set_session_context N'ALLOW_DEPO_CHANGE', NULL;"
+                )
+                cur.close()
+            except Exception:
+                broken = True
+        recycle = (not broken) and self._expired(created_at)
+        with self._cond:
+            if broken or recycle:
+                self._size -= 1
+                self._m["discarded" if broken else "recycled"] += 1
+            else:
+                self._idle.append((raw, created_at, time.time()))
+            self._cond.notify()
+        if broken or recycle:
+            self._close_quiet(raw)
+
+    # ---- API ----
+    def acquire(self, timeout: Optional[float] = None) -> PooledConnection:
+        """Presta una conexión; espera hasta timeout (default checkout_timeout) si está saturado."""
+        deadline = time.monotonic() + float(timeout if timeout is not None else self.checkout_timeout)
+        t0 = time.monotonic()
+        waited = False
+        while True:
+            candidate = None
+            create = False
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._m["timeouts"] += 1
+                        raise PoolTimeout(f"Pool {self.label} saturado ({self.max_size} conexiones en uso)")
+                    waited = True
+                    self._cond.wait(remaining)
+                if self._idle:
+                    candidate = self._idle.pop()  # LIFO: la más recientemente usada
+                else:
+                    self._size += 1
+                    create = True
+            if create:
+                try:
+                    raw = pyodbc.connect(self.conn_str)
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                created_at = time.time()
+                with self._cond:
+                    self._m["created"] += 1
+                break
+            raw, created_at, returned_at = candidate
+            stale = self._expired(created_at)
+            if not stale and self.health_idle_secs and (time.time() - returned_at) > self.health_idle_secs:
+                if not self._healthy(raw):
+                    with self._cond:
+                        self._m["health_failed"] += 1
+                    stale = True
+            if stale:
+                self._close_quiet(raw)
+                with self._cond:
+                    self._size -= 1
+                    self._m["recycled"] += 1
+                    self._cond.notify()
+                continue
+            break
+        wait_ms = (time.monotonic() - t0) * 1000.0
+        with self._cond:
+            self._m["checkouts"] += 1
+            if waited:
+                self._m["waits"] += 1
+                self._m["wait_ms_total"] += wait_ms
+                if wait_ms > self._m["max_wait_ms"]:
+                    self._m["max_wait_ms"] = wait_ms
+        return PooledConnection(self, raw, created_at)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._cond:
+            idle = len(self._idle)
+            in_use = self._size - idle
+            m = dict(self._m)
+        return {
+            "max_size": self.max_size,
+            "size": in_use + idle,
+            "in_use": in_use,
+            "idle": idle,
+            "saturation": round(in_use / float(self.max_size), 2),
+            "checkouts": int(m["checkouts"]),
+            "waits": int(m["waits"]),
+            "avg_wait_ms": round(m["wait_ms_total"] / m["waits"], 1) if m["waits"] else 0.0,
+            "max_wait_ms": round(m["max_wait_ms"], 1),
+            "timeouts": int(m["timeouts"]),
+            "created": int(m["created"]),
+            "recycled": int(m["recycled"]),
+            "discarded": int(m["discarded"]),
+            "health_failed": int(m["health_failed"]),
+        }
+
+
+_POOLS: Dict[str, ConnectionPool] = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def get_pool(conn_str: str, label: str = "") -> ConnectionPool:
+    """Pool único por cadena de conexión (así endpoints y workers de la misma base lo comparten)."""
+    with _POOLS_LOCK:
+        p = _POOLS.get(conn_str)
+        if p is None:
+            p = ConnectionPool(conn_str, label=label)
+            _POOLS[conn_str] = p
+        elif label and label not in p.label.split("+"):
+            p.label = f"{p.label}+{label}"
+        return p
+
+
+def connect(conn_str: str, label: str = "", timeout: Optional[float] = None):
+    """Conexión prestada del pool (o pyodbc.connect directo si DB_POOL_ENABLED=0)."""
+    if not DB_POOL_ENABLED:
+        return pyodbc.connect(conn_str)
+    return get_pool(conn_str, label).acquire(timeout=timeout)
+
+
+def pool_metrics() -> Dict[str, Any]:
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+    return {"enabled": DB_POOL_ENABLED, "pools": {p.label: p.metrics() for p in pools}}
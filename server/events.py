@@ -0,0 +1,114 @@
+"""
+Bus de eventos en proceso para transiciones de órdenes.
+
+Los publicadores (webhooks, update_order_service, etc.) corren en hilos comunes;
+los suscriptores son los streams SSE de /orders/stream, que viven en el event loop
+de FastAPI. publish() es thread-safe y entrega a cada suscriptor vía
+loop.call_soon_threadsafe sobre su asyncio.Queue (acotada: si un cliente lento la
+llena, se descartan los eventos más viejos y se le avisa con 'dropped').
+"""
+
+import asyncio
+import itertools
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+try:
+    SUBSCRIBER_QUEUE_MAX = max(10, int(os.getenv("ORDERS_STREAM_QUEUE_MAX", "500")))
+except Exception:
+    SUBSCRIBER_QUEUE_MAX = 500
+
+
+class _Subscriber:
+    def __init__(self, sub_id: int, loop: asyncio.AbstractEventLoop, acc: Optional[str], depots: Optional[Set[str]]):
+        self.id = sub_id
+        self.loop = loop
+        self.acc = acc
+        self.depots = depots  # None = todos
+        self.queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_MAX)
+        self.dropped = 0
+
+    def matches(self, ev: Dict[str, Any]) -> bool:
+        if self.acc and ev.get("acc") and ev.get("acc") != self.acc:
+            return False
+        if not self.depots:
+            return True
+        # Entregar si el depósito actual o el anterior coincide (la orden entra o sale del depósito)
+        for key in ("deposito_asignado", "deposito_anterior"):
+            val = str(ev.get(key) or "").upper()
+            if val and any(d in val for d in self.depots):
+                return True
+        return False
+
+    def _put(self, ev: Dict[str, Any]) -> None:
+        # Corre dentro del loop del suscriptor
+        if self.queue.full():
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except Exception:
+                pass
+        try:
+            self.queue.put_nowait(ev)
+        except Exception:
+            self.dropped += 1
+
+
+class OrderEventBus:
+    def __init__(self):
+        self._subs: Dict[int, _Subscriber] = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._seq = itertools.count(1)
+        self.published = 0
+
+    def subscribe(self, acc: Optional[str] = None, depots: Optional[Iterable[str]] = None) -> _Subscriber:
+        """Registrar un suscriptor; llamar desde el event loop (endpoint async)."""
+        loop = asyncio.get_running_loop()
+        dep = {d.strip().upper() for d in (depots or []) if d and d.strip()} or None
+        sub = _Subscriber(next(self._ids), loop, acc, dep)
+        with self._lock:
+            self._subs[sub.id] = sub
+        return sub
+
+    def unsubscribe(self, sub: _Subscriber) -> None:
+        with self._lock:
+            self._subs.pop(sub.id, None)
+
+    def has_subscribers(self, acc: Optional[str] = None) -> bool:
+        with self._lock:
+            if acc is None:
+                return bool(self._subs)
+            return any((s.acc in (None, acc)) for s in self._subs.values())
+
+    def publish(self, ev: Dict[str, Any]) -> None:
+        """Publicar un evento desde cualquier hilo. Nunca levanta excepciones."""
+        try:
+            ev = dict(ev)
+            ev.setdefault("ts", time.time())
+            ev["seq"] = next(self._seq)
+            with self._lock:
+                targets: List[_Subscriber] = [s for s in self._subs.values() if s.matches(ev)]
+                self.published += 1
+            for s in targets:
+                try:
+                    s.loop.call_soon_threadsafe(s._put, ev)
+                except RuntimeError:
+                    # loop cerrado: el stream se fue sin desuscribirse
+                    self.unsubscribe(s)
+        except Exception:
+            pass
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            subs = list(self._subs.values())
+        return {
+            "subscribers": len(subs),
+            "published": self.published,
+            "dropped": sum(s.dropped for s in subs),
+        }
+
+
+order_events = OrderEventBus()
@@ -0,0 +1,172 @@
+"""
+Cliente MercadoLibre para el camino de webhooks.
+
+- Una requests.Session con keep-alive por token de seller (evita renegociar TLS por evento).
+- Multiget de órdenes vía /orders/search?seller=&q= (ids CSV) cuando la API lo permite,
+  con fallback a GET /orders/{id} para las que no vengan. q= es búsqueda libre: si un 200
+  no devuelve exactamente las órdenes pedidas, el multiget se apaga para el proceso.
+- Shipments en paralelo bajo un semáforo global acotado (ML_MAX_CONCURRENCY) y
+  reintento corto ante 429 respetando Retry-After.
+"""
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+ML_API_BASE = "https://api.mercadolibre.com"
+
+try:
+    ML_MAX_CONCURRENCY = max(1, int(os.getenv("ML_MAX_CONCURRENCY", "4")))
+except Exception:
+    ML_MAX_CONCURRENCY = 4
+try:
+    ML_HTTP_TIMEOUT = float(os.getenv("ML_HTTP_TIMEOUT", "20"))
+except Exception:
+    ML_HTTP_TIMEOUT = 20.0
+try:
+    ML_MULTIGET_MAX = max(1, int(os.getenv("ML_MULTIGET_MAX", "20")))
+except Exception:
+    ML_MULTIGET_MAX = 20
+
+_SESSIONS: Dict[str, requests.Session] = {}
+_SESSIONS_LOCK = threading.Lock()
+# Semáforo global: todas las cuentas comparten el mismo presupuesto de llamadas simultáneas
+_ML_SEM = threading.BoundedSemaphore(ML_MAX_CONCURRENCY)
+# Si la API rechaza el multiget (400/403/404) o responde otra cosa que las órdenes pedidas,
+# no volver a intentarlo en este proceso
+_MULTIGET_DISABLED = {"v": False}
+
+
+def get_session(token: str) -> requests.Session:
+    """Session reutilizable (keep-alive) para un token dado."""
+    with _SESSIONS_LOCK:
+        s = _SESSIONS.get(token)
+        if s is None:
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max(4, ML_MAX_CONCURRENCY))
+            s.mount("https://", adapter)
+            s.headers.update({"Authorization": f"Bearer {token}"})
+            # Evitar crecer sin límite si los tokens rotan (refresh cada 6h)
+            if len(_SESSIONS) > 32:
+                try:
+                    old_tok = next(iter(_SESSIONS))
+                    _SESSIONS.pop(old_tok).close()
+                except Exception:
+                    pass
+            _SESSIONS[token] = s
+        return s
+
+
+def _get_json(token: str, path: str, params: Optional[Dict[str, Any]] = None, retries: int = 2) -> Dict[str, Any]:
+    """GET con la Session del token, bajo el semáforo global. Reintenta 429/5xx brevemente."""
+    sess = get_session(token)
+    url = path if path.startswith("http") else f"{ML_API_BASE}{path}"
+    attempt = 0
+    while True:
+        with _ML_SEM:
+            r = sess.get(url, params=params, timeout=ML_HTTP_TIMEOUT)
+        if r.status_code == 429 or r.status_code >= 500:
+            if attempt < retries:
+                attempt += 1
+                try:
+                    wait = float(r.headers.get("Retry-After") or 0)
+                except Exception:
+                    wait = 0.0
+                time.sleep(min(10.0, wait or (0.5 * (2 ** attempt))))
+                continue
+        r.raise_for_status()
+        return r.json()
+
+
+def get_order(order_id: int, token: str) -> Dict[str, Any]:
+    return _get_json(token, f"/orders/{int(order_id)}")
+
+
+def get_shipment(shipment_id: int, token: str) -> Dict[str, Any]:
+    return _get_json(token, f"/shipments/{int(shipment_id)}")
+
+
+def _chunks(seq: List[int], n: int) -> Iterable[List[int]]:
+    for i in range(0, len(seq), n):
+        yield seq[i:i + n]
+
+
+def _parallel(fn, ids: List[int], token: str) -> Dict[int, Any]:
+    """Ejecuta fn(id, token) en paralelo; el semáforo global limita la concurrencia real.
+    Devuelve {id: json} y {id: Exception} para los que fallaron.
+    """
+    out: Dict[int, Any] = {}
+    if not ids:
+        return out
+    if len(ids) == 1:
+        try:
+            out[ids[0]] = fn(ids[0], token)
+        except Exception as e:
+            out[ids[0]] = e
+        return out
+    with ThreadPoolExecutor(max_workers=min(len(ids), ML_MAX_CONCURRENCY)) as ex:
+        futs = {ex.submit(fn, i, token): i for i in ids}
+        for fut, i in futs.items():
+            try:
+                out[i] = fut.result()
+            except Exception as e:
+                out[i] = e
+    return out
+
+
+def get_orders_many(order_ids: Iterable[int], token: str, seller_id: Optional[int] = None) -> Dict[int, Any]:
+    """Trae varias órdenes en una ola. Con seller_id intenta /orders/search con q=id1,id2...
+    (multiget); las que no vengan se piden por GET /orders/{id} en paralelo.
+    Devuelve {order_id: dict} o {order_id: Exception}.
+    """
+    ids = sorted({int(x) for x in order_ids if x})
+    out: Dict[int, Any] = {}
+    if not ids:
+        return out
+    if seller_id and len(ids) > 1 and not _MULTIGET_DISABLED["v"]:
+        for chunk in _chunks(ids, ML_MULTIGET_MAX):
+            try:
+                data = _get_json(token, "/orders/search", params={
+                    "seller": int(seller_id),
+                    "q": ",".join(str(i) for i in chunk),
+                    "limit": len(chunk),
+                }, retries=1)
+                wanted = set(chunk)
+                got = set()
+                for o in (data or {}).get("results") or []:
+                    try:
+                        oid = int(o.get("id"))
+                    except Exception:
+                        got.add(None)
+                        continue
+                    got.add(oid)
+                    if oid in wanted:
+                        out[oid] = o
+                if got != wanted:
+                    # Vacío, parcial u órdenes ajenas: q= no se comporta como multiget por id
+                    _MULTIGET_DISABLED["v"] = True
+                    break
+            except requests.HTTPError as e:
+                code = getattr(getattr(e, "response", None), "status_code", None)
+                if code in (400, 403, 404):
+                    _MULTIGET_DISABLED["v"] = True
+                    break
+            except Exception:
+                # No romper: el fallback individual cubre lo que falte
+                pass
+    missing = [i for i in ids if i not in out]
+    out.update(_parallel(get_order, missing, token))
+    return out
+
+
+def get_shipments_many(shipment_ids: Iterable[int], token: str) -> Dict[int, Any]:
+    """Trae varios shipments en paralelo (acotado por ML_MAX_CONCURRENCY).
+    Devuelve {shipment_id: dict} o {shipment_id: Exception}.
+    """
+    ids = sorted({int(x) for x in shipment_ids if x})
+    return _parallel(get_shipment, ids, token)
@@ -0,0 +1,120 @@
+"""
+Metadatos de esquema de orders_meli (columnas, tipo y largo máximo) por cuenta.
+
+Una sola consulta a INFORMATION_SCHEMA por cuenta, al arrancar o cuando vence el TTL
+(SCHEMA_CACHE_TTL, segundos; 0 = no vence) o se pide /admin/schema/reload.
+Ningún request vuelve a tocar INFORMATION_SCHEMA en el camino caliente:
+_col_exists, _truncate_to_column, list_orders_columns y los chequeos de app.py leen de acá.
+Si la recarga falla se conserva el snapshot anterior.
+"""
+
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    SCHEMA_CACHE_TTL = int(os.getenv("SCHEMA_CACHE_TTL", "900"))
+except Exception:
+    SCHEMA_CACHE_TTL = 900
+
+
+class _Snapshot:
+    def __init__(self, rows: List[tuple]):
+        # rows: (COLUMN_NAME, DATA_TYPE, CHARACTER_MAXIMUM_LENGTH) en ORDINAL_POSITION
+        self.columns: List[str] = [r[0] for r in rows]
+        self.names = set(self.columns)
+        self.lower: Dict[str, str] = {c.lower(): c for c in self.columns}
+        self.types: Dict[str, str] = {r[0].lower(): str(r[1] or "") for r in rows}
+        self.maxlen: Dict[str, Optional[int]] = {}
+        for r in rows:
+            ml = r[2]
+            # SQL Server usa -1 para tipos MAX: sin límite
+            self.maxlen[r[0].lower()] = int(ml) if isinstance(ml, int) and ml >= 0 else None
+        self.loaded_at = time.time()
+
+
+class SchemaMeta:
+    def __init__(self, table: str, conn_factory: Callable[[str], Any], ttl: int = SCHEMA_CACHE_TTL):
+        self.table = table
+        self._conn_factory = conn_factory
+        self.ttl = int(ttl)
+        self._snaps: Dict[str, _Snapshot] = {}
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.errors = 0
+
+    def _load(self, acc: str) -> Optional[_Snapshot]:
+        try:
+            with self._conn_factory(acc) as cn:
+                cur = cn.cursor()
+                cur.execute(
+                    "SELECT COLUMN_NAME, DATA_TYPE, CHARACTER_MAXIMUM_LENGTH FROM INFORMATION_SCHEMA.COLUMNS "
+                    "WHERE TABLE_NAME = ? ORDER BY ORDINAL_POSITION",
+                    self.table,
+                )
+                snap = _Snapshot([tuple(r) for r in cur.fetchall()])
+            self.loads += 1
+            return snap
+        except Exception:
+            self.errors += 1
+            return None
+
+    def _get(self, acc: str) -> Optional[_Snapshot]:
+        snap = self._snaps.get(acc)
+        if snap is not None and (self.ttl <= 0 or (time.time() - snap.loaded_at) < self.ttl):
+            return snap
+        with self._lock:
+            snap = self._snaps.get(acc)
+            if snap is not None and (self.ttl <= 0 or (time.time() - snap.loaded_at) < self.ttl):
+                return snap
+            fresh = self._load(acc)
+            if fresh is not None:
+                self._snaps[acc] = fresh
+                return fresh
+            if snap is not None:
+                # Conservar el anterior y no reintentar en cada request
+                snap.loaded_at = time.time()
+            return snap
+
+    # ---- API ----
+    def reload(self, accs: Optional[List[str]] = None) -> Dict[str, Any]:
+        out: Dict[str, Any] = {}
+        for acc in (accs or list(self._snaps.keys()) or ["acc1"]):
+            fresh = self._load(acc)
+            with self._lock:
+                if fresh is not None:
+                    self._snaps[acc] = fresh
+            out[acc] = {"ok": fresh is not None, "columns": len(fresh.columns) if fresh else None}
+        return out
+
+    def columns(self, acc: str = "acc1") -> List[str]:
+        snap = self._get(acc)
+        return list(snap.columns) if snap else []
+
+    def has(self, name: str, acc: str = "acc1") -> bool:
+        snap = self._get(acc)
+        return bool(snap) and name in snap.names
+
+    def has_ci(self, name: str, acc: str = "acc1") -> bool:
+        snap = self._get(acc)
+        return bool(snap) and str(name).lower() in snap.lower
+
+    def maxlen(self, name: str, acc: str = "acc1") -> Optional[int]:
+        snap = self._get(acc)
+        return snap.maxlen.get(str(name).lower()) if snap else None
+
+    def data_type(self, name: str, acc: str = "acc1") -> Optional[str]:
+        snap = self._get(acc)
+        return snap.types.get(str(name).lower()) if snap else None
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "ttl": self.ttl,
+            "loads": self.loads,
+            "errors": self.errors,
+            "accounts": {
+                acc: {"columns": len(s.columns), "loaded_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(s.loaded_at))}
+                for acc, s in self._snaps.items()
+            },
+        }
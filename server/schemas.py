@@ -10,7 +10,12 @@ class OrderItem(RootModel[Dict[str, Any]]):
 class OrdersResponse(BaseModel):
     orders: List[Dict[str, Any]]
     page: int
-    total: int
+    # None cuando se pide with_total=0
+    total: Optional[int] = None
+    total_estimated: bool = False
+    # Paginación por cursor (keyset sobre [id]); opacos, reenviar tal cual en ?cursor=
+    next_cursor: Optional[str] = None
+    prev_cursor: Optional[str] = None
 
 
 class UpdateOrderRequest(BaseModel):
@@ -6,8 +6,21 @@ from dotenv import load_dotenv
 import requests
 from urllib.parse import quote_plus
 import time
+import base64
+import threading
+from collections import OrderedDict
 
 from .schemas import get_allowed_update_fields
+from . import db_pool as _db_pool
+from .events import order_events
+from .schema_meta import SchemaMeta
+
+try:
+    from modules.depot_recommender import get_recommender
+except Exception:
+    import sys as _sys
+    _sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    from modules.depot_recommender import get_recommender
 
 load_dotenv()
 
@@ -38,8 +51,14 @@ _NOTIF_TABLE = "split_notifications_sent"
 # track readiness per account ("acc1"/"acc2")
 _notif_table_ready: Dict[str, bool] = {"acc1": False, "acc2": False}
 
-# Cache for column max lengths, per account
-_COL_MAXLEN_CACHE: Dict[str, Dict[str, Optional[int]]] = {"acc1": {}, "acc2": {}}
+# order_ids already notified as DEBE_PARTIRSE, per account (kept fresh by run_split_notifier_loop)
+_SPLIT_NOTIFIED: Dict[str, set] = {"acc1": set(), "acc2": set()}
+
+
+
+def acc2_configured() -> bool:
+    """True if a secondary (acc2) database is configured."""
+    return bool(ORDERS2_CONN_STR or SQL_DB2 or SQL_SERVER2)
 
 
 def _build_conn_str(acc: str) -> str:
@@ -62,7 +81,15 @@ def _build_conn_str(acc: str) -> str:
 
 
 def _get_conn(acc: str = "acc1"):
-    return pyodbc.connect(_build_conn_str(acc))
+    """Conexión prestada del pool de la cuenta (ver db_pool). Usar con `with`:
+    al salir hace commit/rollback y la devuelve al pool.
+    """
+    return _db_pool.connect(_build_conn_str(acc), label=acc)
+
+
+# Columns/types/max lengths of orders_meli per account: one INFORMATION_SCHEMA query per
+# account, refreshed on TTL or via /admin/schema/reload
+ORDERS_SCHEMA = SchemaMeta(TABLE, _get_conn)
 
 
 def _ensure_notif_table(acc: str = "acc1"):
@@ -87,33 +114,11 @@ END
 
 def _get_col_maxlen(col_name: str, acc: str = "acc1") -> Optional[int]:
     """Return CHARACTER_MAXIMUM_LENGTH for NVARCHAR/VARCHAR columns, or None.
-    Caches results per process to avoid repeated queries.
+    Served from the shared schema snapshot (no INFORMATION_SCHEMA query per column).
     """
-    key = col_name.lower()
-    cache = _COL_MAXLEN_CACHE.setdefault(acc, {})
-    if key in cache:
-        return cache[key]
     try:
-        with _get_conn(acc) as cn:
-            cur = cn.cursor()
-            cur.execute(
-                """
-SELECT CHARACTER_MAXIMUM_LENGTH
-FROM INFORMATION_SCHEMA.COLUMNS
-WHERE TABLE_NAME = ? AND COLUMN_NAME = ?
-                """,
-                TABLE,
-                col_name,
-            )
-            row = cur.fetchone()
-            maxlen = row[0] if row else None
-            # SQL Server uses -1 for MAX types; interpret as unlimited (None)
-            if isinstance(maxlen, int) and maxlen < 0:
-                maxlen = None
-            cache[key] = maxlen
-            return maxlen
+        return ORDERS_SCHEMA.maxlen(col_name, acc)
     except Exception:
-        cache[key] = None
         return None
 
 
@@ -137,6 +142,31 @@ def _was_split_notified(order_id: str, acc: str = "acc1") -> bool:
         return cur.fetchone() is not None
 
 
+def _split_notified_subset(order_ids: List[str], acc: str = "acc1") -> set:
+    """Set-based version of _was_split_notified: returns which of order_ids were already
+    notified, using the in-memory set first and a single IN (...) query for the rest.
+    """
+    known = _SPLIT_NOTIFIED.setdefault(acc, set())
+    out = {oid for oid in order_ids if oid in known}
+    pending = [oid for oid in dict.fromkeys(order_ids) if oid not in known]
+    if not pending:
+        return out
+    _ensure_notif_table(acc)
+    with _get_conn(acc) as cn:
+        cur = cn.cursor()
+        # chunks to stay far below the 2100 parameter limit
+        for i in range(0, len(pending), 500):
+            chunk = pending[i:i + 500]
+            cur.execute(
+                f"SELECT order_id FROM {_NOTIF_TABLE} WHERE order_id IN ({','.join(['?'] * len(chunk))})",
+                *chunk,
+            )
+            for r in cur.fetchall():
+                out.add(str(r[0]))
+    known.update(out)
+    return out
+
+
 def _mark_split_notified(order_id: str, acc: str = "acc1"):
     _ensure_notif_table(acc)
     with _get_conn(acc) as cn:
@@ -147,6 +177,7 @@ def _mark_split_notified(order_id: str, acc: str = "acc1"):
         except Exception:
             # ignore duplicates/races
             pass
+    _SPLIT_NOTIFIED.setdefault(acc, set()).add(str(order_id))
 
 
 def _send_callmebot_message(text: str) -> bool:
@@ -164,24 +195,20 @@ def _send_callmebot_message(text: str) -> bool:
 
 
 def list_orders_columns(acc: str = "acc1") -> List[str]:
-    """Return all column names of orders_meli from INFORMATION_SCHEMA."""
-    with _get_conn(acc) as cn:
-        cur = cn.cursor()
-        cur.execute(
-            "SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = ? ORDER BY ORDINAL_POSITION",
-            TABLE,
-        )
-        return [r[0] for r in cur.fetchall()]
+    """Return all column names of orders_meli (shared schema snapshot, see schema_meta)."""
+    cols = ORDERS_SCHEMA.columns(acc)
+    if not cols:
+        raise RuntimeError(f"No se pudo leer el esquema de {TABLE} ({acc})")
+    return cols
 
 
-_ALL_COLUMNS_CACHE: Dict[str, Optional[List[str]]] = {"acc1": None, "acc2": None}
+def _all_columns(acc: str = "acc1") -> List[str]:
+    return list_orders_columns(acc)
 
 
-def _all_columns(acc: str = "acc1") -> List[str]:
-    if _ALL_COLUMNS_CACHE.get(acc) is None:
-        _ALL_COLUMNS_CACHE[acc] = list_orders_columns(acc)
-    # mypy: we're sure it's set now
-    return _ALL_COLUMNS_CACHE[acc] or []
+def reload_orders_schema(accs: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Force a reload of the orders_meli schema snapshot (all loaded accounts by default)."""
+    return ORDERS_SCHEMA.reload(accs)
 
 
 def get_default_fields() -> List[str]:
@@ -239,7 +266,7 @@ def get_default_fields() -> List[str]:
 
 def _col_exists(name: str, acc: str = "acc1") -> bool:
     try:
-        return name in _all_columns(acc)
+        return ORDERS_SCHEMA.has(name, acc)
     except Exception:
         return False
 
@@ -301,14 +328,17 @@ def run_split_notifier_loop(interval_secs: int = 60, acc: str = "acc1"):
     while True:
         start = datetime.utcnow()
         try:
-            candidates = _poll_split_required_since(last_seen, acc)
+            candidates = [
+                obj for obj in _poll_split_required_since(last_seen, acc)
+                if obj.get("order_id") and obj.get("DEBE_PARTIRSE") == 1
+            ]
+            # One set-based lookup per cycle instead of one query per candidate
+            already = _split_notified_subset([str(o.get("order_id")) for o in candidates], acc) if candidates else set()
             for obj in candidates:
                 order_id = obj.get("order_id")
-                debe = obj.get("DEBE_PARTIRSE")
-                if not order_id or debe != 1:
-                    continue
-                if _was_split_notified(str(order_id), acc):
+                if str(order_id) in already:
                     continue
+                already.add(str(order_id))
                 sku = str(obj.get("sku") or obj.get("seller_sku") or "")
                 nombre = str(obj.get("nombre") or obj.get("ARTICULO") or "")
                 msg = f"ALERTA: Orden {order_id} requiere PARTIRSE. SKU {sku}. {nombre[:100]}"
@@ -324,7 +354,10 @@ def run_split_notifier_loop(interval_secs: int = 60, acc: str = "acc1"):
 
 
 def _validate_fields(selected_fields: Optional[List[str]], acc: str = "acc1") -> List[str]:
-    cols = _all_columns(acc)
+    # The rowversion column is raw bytes (not JSON-serializable) and only meaningful as the
+    # change-feed watermark, which exposes it hex-encoded: never return it as a field.
+    rv = ORDERS_ROWVERSION_COL.lower()
+    cols = [c for c in _all_columns(acc) if c.lower() != rv]
     if not selected_fields or len(selected_fields) == 0:
         # default subset si no piden nada
         fields = [c for c in get_default_fields() if c in cols]
@@ -535,11 +568,105 @@ def _build_filters(params: Dict[str, Any], acc: str = "acc1") -> Tuple[str, List
     return "", args
 
 
-def get_orders_service(
+# Cached COUNT(*) per (acc, filter signature) for with_total=estimate: small LRU, entries
+# older than ORDERS_COUNT_CACHE_TTL are dropped (filters with free text would grow it forever)
+_COUNT_CACHE: "OrderedDict[Tuple[str, str], Tuple[float, int]]" = OrderedDict()
+_COUNT_CACHE_LOCK = threading.Lock()
+try:
+    ORDERS_COUNT_CACHE_TTL = int(os.getenv("ORDERS_COUNT_CACHE_TTL", "60"))
+except Exception:
+    ORDERS_COUNT_CACHE_TTL = 60
+try:
+    ORDERS_COUNT_CACHE_MAX = max(1, int(os.getenv("ORDERS_COUNT_CACHE_MAX", "256")))
+except Exception:
+    ORDERS_COUNT_CACHE_MAX = 256
+
+
+def _count_cache_get(sig: Tuple[str, str]) -> Optional[int]:
+    with _COUNT_CACHE_LOCK:
+        hit = _COUNT_CACHE.get(sig)
+        if hit is None:
+            return None
+        if (time.time() - hit[0]) >= ORDERS_COUNT_CACHE_TTL:
+            del _COUNT_CACHE[sig]
+            return None
+        _COUNT_CACHE.move_to_end(sig)
+        return hit[1]
+
+
+def _count_cache_put(sig: Tuple[str, str], total: int) -> None:
+    now = time.time()
+    with _COUNT_CACHE_LOCK:
+        _COUNT_CACHE[sig] = (now, int(total))
+        _COUNT_CACHE.move_to_end(sig)
+        if len(_COUNT_CACHE) > ORDERS_COUNT_CACHE_MAX:
+            for k in [k for k, (ts, _t) in _COUNT_CACHE.items() if (now - ts) >= ORDERS_COUNT_CACHE_TTL]:
+                del _COUNT_CACHE[k]
+        while len(_COUNT_CACHE) > ORDERS_COUNT_CACHE_MAX:
+            _COUNT_CACHE.popitem(last=False)
+
+
+def encode_orders_cursor(direction: str, key: Any) -> str:
+    """Opaque cursor for keyset pagination: 'a' (after) / 'b' (before) + [id]."""
+    raw = f"{'b' if direction == 'before' else 'a'}:{int(key)}".encode("ascii")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_orders_cursor(cursor: str) -> Optional[Tuple[str, int]]:
+    try:
+        pad = "=" * (-len(cursor) % 4)
+        kind, key = base64.urlsafe_b64decode((cursor + pad).encode("ascii")).decode("ascii").split(":", 1)
+        return ("before" if kind == "b" else "after"), int(key)
+    except Exception:
+        return None
+
+
+def _count_signature(where_sql: str, where_args: List[Any]) -> str:
+    return where_sql + "|" + "|".join(repr(a) for a in where_args)
+
+
+def _estimate_total(cur, acc: str, where_sql: str, where_args: List[Any], count_sql: str) -> Tuple[int, bool]:
+    """Returns (total, is_estimate). Uses the cached count for this filter signature when
+    fresh; without filters, row count from partition stats; otherwise exact COUNT (cached).
+    """
+    sig = (acc, _count_signature(where_sql, where_args))
+    hit = _count_cache_get(sig)
+    if hit is not None:
+        return hit, True
+    if not where_sql:
+        try:
+            cur.execute(
+                "SELECT SUM(row_count) FROM sys.dm_db_partition_stats "
+                "WHERE object_id = OBJECT_ID(?) AND index_id IN (0, 1)",
+                f"dbo.{TABLE}",
+            )
+            row = cur.fetchone()
+            if row and row[0] is not None:
+                return int(row[0]), True
+        except Exception:
+            pass
+    cur.execute(count_sql, *where_args)
+    total = int(cur.fetchone()[0])
+    _count_cache_put(sig, total)
+    return total, False
+
+
+def get_orders_page_service(
     selected_fields: Optional[List[str]],
     params: Dict[str, Any],
     acc: str = "acc1",
-) -> Tuple[List[Dict[str, Any]], int]:
+) -> Dict[str, Any]:
+    """Like get_orders_service, plus keyset pagination and optional count.
+
+    Extra params:
+    - after_id / before_id (or an opaque `cursor` from a previous response): seek on the
+      clustered key [id] instead of OFFSET; order is always by [id] in sort_dir, so a
+      sort_by other than id is rejected (ValueError -> 400) instead of silently ignored.
+    - with_total: 1 (default, exact COUNT), 0 (skip count, total=None) or estimate
+      (cached count per filter signature, partition stats when unfiltered).
+
+    Returns {"items", "total", "total_estimated", "next_cursor", "prev_cursor"}.
+    """
     fields = _validate_fields(selected_fields, acc)
     page = int(params.get("page", 1))
     limit = int(params.get("limit", 200))
@@ -547,8 +674,6 @@ def get_orders_service(
 
     where_sql, where_args = _build_filters(params, acc)
 
-    select_cols = ", ".join(f"[{c}]" for c in fields)
-
     # Ordenamiento seguro
     sort_by = params.get("sort_by") or "id"
     sort_dir = (params.get("sort_dir") or "DESC").upper()
@@ -558,9 +683,49 @@ def get_orders_service(
     if sort_by not in _all_columns(acc) and sort_by != "id":
         sort_by = "id"
 
-    sql = f"SELECT {select_cols} FROM {TABLE} WITH (NOLOCK){where_sql} ORDER BY [{sort_by}] {sort_dir} OFFSET ? ROWS FETCH NEXT ? ROWS ONLY"
+    # Keyset mode
+    seek: Optional[Tuple[str, int]] = None
+    if params.get("cursor"):
+        seek = decode_orders_cursor(str(params.get("cursor")))
+    if seek is None:
+        for direction in ("after", "before"):
+            v = params.get(f"{direction}_id")
+            if v not in (None, ""):
+                try:
+                    seek = (direction, int(v))
+                except Exception:
+                    seek = None
+                break
+    if seek is not None and (params.get("sort_by") or "id") != "id":
+        raise ValueError("sort_by no soportado con cursor/after_id/before_id: la paginación por cursor ordena por id")
+
+    with_total = str(params.get("with_total", "1")).strip().lower()
+    if with_total in ("true", "yes"):
+        with_total = "1"
+    elif with_total in ("false", "no"):
+        with_total = "0"
+
+    if seek is not None:
+        if "id" not in fields:
+            fields = fields + ["id"]
+        direction, key = seek
+        # 'after' = next page in the requested order; 'before' = previous page
+        forward = direction == "after"
+        op = "<" if (sort_dir == "DESC") == forward else ">"
+        scan_dir = sort_dir if forward else ("ASC" if sort_dir == "DESC" else "DESC")
+        seek_sql = f"[id] {op} ?"
+        page_where = f"{where_sql} AND {seek_sql}" if where_sql else f" WHERE {seek_sql}"
+        select_cols = ", ".join(f"[{c}]" for c in fields)
+        sql = f"SELECT TOP (?) {select_cols} FROM {TABLE} WITH (NOLOCK){page_where} ORDER BY [id] {scan_dir}"
+        page_args: List[Any] = [limit + 1] + list(where_args) + [key]
+    else:
+        select_cols = ", ".join(f"[{c}]" for c in fields)
+        sql = f"SELECT {select_cols} FROM {TABLE} WITH (NOLOCK){where_sql} ORDER BY [{sort_by}] {sort_dir} OFFSET ? ROWS FETCH NEXT ? ROWS ONLY"
+        page_args = list(where_args) + [offset, limit]
     count_sql = f"SELECT COUNT(*) FROM {TABLE} WITH (NOLOCK){where_sql}"
 
+    total: Optional[int] = None
+    total_estimated = False
     with _get_conn(acc) as cn:
         cur = cn.cursor()
         # Reducir bloqueos y colas de espera por escrituras concurrentes
@@ -574,13 +739,39 @@ def get_orders_service(
         except Exception:
             pass
         # total
-        cur.execute(count_sql, *where_args)
-        total = cur.fetchone()[0]
+        if with_total == "estimate":
+            total, total_estimated = _estimate_total(cur, acc, where_sql, where_args, count_sql)
+        elif with_total != "0":
+            cur.execute(count_sql, *where_args)
+            total = cur.fetchone()[0]
+            _count_cache_put((acc, _count_signature(where_sql, where_args)), int(total))
         # page
-        cur.execute(sql, *where_args, offset, limit)
+        cur.execute(sql, *page_args)
         rows = cur.fetchall()
         col_names = [c[0] for c in cur.description]
 
+    next_cursor: Optional[str] = None
+    prev_cursor: Optional[str] = None
+    if seek is not None:
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if seek[0] == "before":
+            rows = list(reversed(rows))
+        id_idx = col_names.index("id")
+        if rows:
+            first_id, last_id = rows[0][id_idx], rows[-1][id_idx]
+            # Going forward, 'has_more' tells if there is a next page; going back, we came from one
+            if seek[0] == "after":
+                next_cursor = encode_orders_cursor("after", last_id) if has_more else None
+                prev_cursor = encode_orders_cursor("before", first_id)
+            else:
+                next_cursor = encode_orders_cursor("after", last_id)
+                prev_cursor = encode_orders_cursor("before", first_id) if has_more else None
+    elif rows and sort_by == "id" and "id" in col_names:
+        # Offset mode: offer a cursor so clients can switch to seeking from page 2 on
+        if len(rows) >= limit:
+            next_cursor = encode_orders_cursor("after", rows[-1][col_names.index("id")])
+
     items: List[Dict[str, Any]] = []
     for r in rows:
         obj = {}
@@ -595,98 +786,286 @@ def get_orders_service(
         except Exception:
             pass
 
-        # Computed recommendation: deposito_recomendado (single/split/impossible)
+        # DEBE_PARTIRSE notifications are sent only by run_split_notifier_loop (background),
+        # so listing latency does not depend on how many split orders are on the page.
+        # Add computed account indicator for UI
         try:
-            # Quantity required
-            qty_req = obj.get("qty") if obj.get("qty") is not None else obj.get("quantity")
-            qty = int(qty_req) if qty_req is not None else 1
-            if qty < 1:
-                qty = 1
-
-            # Build availability map from known stock_* columns
-            candidates: List[Tuple[str, int]] = []
-            def add(code: str, field: str):
-                if field in obj:
-                    try:
-                        v = int(obj.get(field) or 0)
-                        if v > 0:
-                            candidates.append((code, v))
-                    except Exception:
-                        pass
-
-            # Priority order (customizable)
-            add("DEPO", "stock_dep")
-            add("MTGBBPS", "stock_mtgbbps")
-            add("MONBAHIA", "stock_monbahia")
-            add("MUNDOAL", "stock_mundoal")
-            add("MUNDOROC", "stock_mundoroc")
-            # EXCLUIDO: MTGCBA no debe usarse para asignación/recomendación
-            # add("MTGCBA", "stock_mtgcba")
-            add("MTGJBJ", "stock_mtgjbj")
-            # NQNSHOP: usar nombre completo (antes se etiquetaba como "NQN")
-            add("NQNSHOP", "stock_nqnshop")
-            # NQNALB: incluir si existe la columna
-            add("NQNALB", "stock_nqnalb")
-            add("MTGROCA", "stock_mtgroca")
-            add("MTGCOM", "stock_mtgcom")
-            add("MUNDOCAB", "stock_mundocab")
-            # EXCLUIDO: MDQ no debe usarse para asignación/recomendación
-            # add("MDQ", "stock_mdq")
-
-            # Prefer single-depo that can fulfill qty
-            single = next(((code, avail) for code, avail in candidates if avail >= qty), None)
-            if single:
-                obj["deposito_recomendado_tipo"] = "single"
-                obj["deposito_recomendado"] = single[0]
-                obj["deposito_recomendado_detalle"] = f"{single[0]}: {qty}"
-            else:
-                # Try split between two depos
-                split_found = False
-                for i1 in range(len(candidates)):
-                    for i2 in range(i1 + 1, len(candidates)):
-                        c1, a1 = candidates[i1]
-                        c2, a2 = candidates[i2]
-                        if a1 + a2 >= qty:
-                            n1 = min(a1, qty)
-                            n2 = qty - n1
-                            obj["deposito_recomendado_tipo"] = "split"
-                            obj["deposito_recomendado"] = f"{c1}+{c2}"
-                            obj["deposito_recomendado_detalle"] = f"{c1}: {n1}, {c2}: {n2}"
-                            split_found = True
-                            break
-                    if split_found:
-                        break
-                if not split_found:
-                    obj["deposito_recomendado_tipo"] = "impossible"
-                    obj["deposito_recomendado"] = "IMPOSSIBLE"
-                    obj["deposito_recomendado_detalle"] = "sin stock suficiente"
+            obj["meli_account"] = acc
         except Exception:
-            # Do not block listing if computation fails
             pass
+        items.append(obj)
+
+    # Computed recommendation: deposito_recomendado (single/split/impossible), whole page at once
+    try:
+        get_recommender().annotate_rows(items)
+    except Exception:
+        # Do not block listing if computation fails
+        pass
 
-        # One-time notification when DEBE_PARTIRSE == 1
+    return {
+        "items": items,
+        "total": total,
+        "total_estimated": total_estimated,
+        "next_cursor": next_cursor,
+        "prev_cursor": prev_cursor,
+    }
+
+
+def get_orders_service(
+    selected_fields: Optional[List[str]],
+    params: Dict[str, Any],
+    acc: str = "acc1",
+) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    res = get_orders_page_service(selected_fields, params, acc)
+    return res["items"], res["total"]
+
+
+ORDERS_ROWVERSION_COL = os.getenv("ORDERS_ROWVERSION_COL", "row_ver")
+# Timestamp columns considered by the fallback change feed (only those that exist are used)
+_CHANGE_TS_COLS = ["fecha_actualizacion", "last_update", "printed_at", "mov_depo_ts", "MOV_LOCAL_TS"]
+
+
+def get_order_changes_service(
+    since: Optional[str],
+    selected_fields: Optional[List[str]],
+    acc: str = "acc1",
+    limit: int = 500,
+    after_id: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Change feed for orders_meli: rows modified after the 'since' watermark.
+
+    - rowversion mode (column ORDERS_ROWVERSION_COL exists, see sql/add_row_ver_to_orders_meli.sql):
+      exact; rows ordered by rowversion, up to 'limit', capped at MIN_ACTIVE_ROWVERSION() so
+      in-flight transactions are not skipped. Watermark 'rv:<hex>'.
+    - timestamp mode (fallback): OR over the timestamp columns that exist, watermark
+      'ts:<server local time>'. Over-inclusive on purpose (mixed UTC/local stamps);
+      clients must upsert by id. If truncated, the watermark does not advance and
+      'next_after_id' is returned: repeat the call with the same since + after_id.
+
+    Without 'since' returns no rows, only the current watermark (take it before a full load).
+    Returns {"changes", "watermark", "mode", "has_more"}.
+    """
+    fields = _validate_fields(selected_fields, acc)
+    for c in ("id", "order_id"):
+        if c not in fields and _col_exists(c, acc):
+            fields = fields + [c]
+    limit = max(1, min(int(limit or 500), 5000))
+    use_rv = _col_exists(ORDERS_ROWVERSION_COL, acc)
+    rv_col = ORDERS_ROWVERSION_COL
+    select_cols = ", ".join(f"[{c}]" for c in fields if c != rv_col)
+
+    with _get_conn(acc) as cn:
+        cur = cn.cursor()
         try:
-            debe = obj.get("DEBE_PARTIRSE")
-            order_id = obj.get("order_id")
-            if debe == 1 and order_id:
-                if not _was_split_notified(str(order_id), acc):
-                    sku = str(obj.get("sku") or obj.get("seller_sku") or "")
-                    nombre = str(obj.get("nombre") or obj.get("ARTICULO") or "")
-                    msg = f"ALERTA: Orden {order_id} requiere PARTIRSE. SKU {sku}. {nombre[:100]}"
-                    ok = _send_callmebot_message(msg)
-                    if ok:
-                        _mark_split_notified(str(order_id), acc)
+            cur.timeout = int(os.getenv("DB_QUERY_TIMEOUT", "20"))
         except Exception:
-            # never break the listing
             pass
-        # Add computed account indicator for UI
+        if use_rv:
+            # Upper bound: anything below MIN_ACTIVE_ROWVERSION is committed or rolled back
+            cur.execute("SELECT CONVERT(BINARY(8), MIN_ACTIVE_ROWVERSION())")
+            upper = bytes(cur.fetchone()[0])
+            if not since:
+                last = bytes.fromhex("%016x" % (int.from_bytes(upper, "big") - 1))
+                return {"changes": [], "watermark": f"rv:{last.hex()}", "mode": "rowversion", "has_more": False}
+            try:
+                low = bytes.fromhex(str(since).split(":", 1)[1] if str(since).startswith("rv:") else str(since))
+            except Exception:
+                raise ValueError("watermark inválido para modo rowversion")
+            cur.execute(
+                f"SELECT TOP (?) {select_cols}, CONVERT(BINARY(8), [{rv_col}]) AS __rv FROM {TABLE} WITH (NOLOCK) "
+                f"WHERE [{rv_col}] > CONVERT(BINARY(8), ?) AND [{rv_col}] < CONVERT(BINARY(8), ?) ORDER BY [{rv_col}] ASC",
+                limit + 1, low, upper,
+            )
+            rows = cur.fetchall()
+            col_names = [c[0] for c in cur.description]
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            rv_idx = col_names.index("__rv")
+            if rows:
+                watermark = f"rv:{bytes(rows[-1][rv_idx]).hex()}"
+            else:
+                watermark = f"rv:{low.hex()}"
+            changes = []
+            for r in rows:
+                obj = {col_names[i]: r[i] for i in range(len(col_names)) if i != rv_idx}
+                obj["meli_account"] = acc
+                changes.append(obj)
+            return {"changes": changes, "watermark": watermark, "mode": "rowversion", "has_more": has_more}
+
+        # Fallback: timestamp columns
+        cur.execute("SELECT SYSDATETIME()")
+        now_local = cur.fetchone()[0]
+        watermark = f"ts:{now_local.isoformat()}"
+        if not since:
+            return {"changes": [], "watermark": watermark, "mode": "timestamp", "has_more": False}
+        ts_cols = [c for c in _CHANGE_TS_COLS if _col_exists(c, acc)]
+        if not ts_cols:
+            raise ValueError("orders_meli sin columnas de timestamp ni rowversion para el feed de cambios")
         try:
-            obj["meli_account"] = acc
+            since_dt = datetime.fromisoformat(str(since).split(":", 1)[1] if str(since).startswith("ts:") else str(since))
         except Exception:
-            pass
-        items.append(obj)
+            raise ValueError("watermark inválido para modo timestamp")
+        where = "(" + " OR ".join(f"[{c}] >= ?" for c in ts_cols) + ")"
+        args: List[Any] = [since_dt] * len(ts_cols)
+        if after_id is not None:
+            where += " AND [id] > ?"
+            args.append(int(after_id))
+        cur.execute(
+            f"SELECT TOP (?) {select_cols} FROM {TABLE} WITH (NOLOCK) WHERE {where} ORDER BY [id] ASC",
+            limit + 1, *args,
+        )
+        rows = cur.fetchall()
+        col_names = [c[0] for c in cur.description]
+    has_more = len(rows) > limit
+    next_after_id = None
+    if has_more:
+        # No hay orden total por timestamp: no avanzar el watermark hasta drenar (seguir por id)
+        watermark = f"ts:{since_dt.isoformat()}"
+        rows = rows[:limit]
+        next_after_id = rows[-1][col_names.index("id")]
+    changes = []
+    for r in rows:
+        obj = {col_names[i]: r[i] for i in range(len(col_names))}
+        obj["meli_account"] = acc
+        changes.append(obj)
+    return {"changes": changes, "watermark": watermark, "mode": "timestamp", "has_more": has_more, "next_after_id": next_after_id}
 
-    return items, total
+
+def _json_safe(v: Any) -> Any:
+    if isinstance(v, datetime):
+        return v.isoformat()
+    if v is None or isinstance(v, (int, float, str, bool)):
+        return v
+    return str(v)
+
+
+def _snapshot_for_events(cur, where_sql: str, where_args: List[Any], acc: str) -> Dict[Any, Dict[str, Any]]:
+    """Minimal state (by [id]) of the rows matched by where_sql, used to publish transitions.
+    Only called when someone is listening on /orders/stream.
+    """
+    cols = [c for c in ("id", "order_id", "pack_id", "deposito_asignado", "shipping_estado",
+                        "shipping_subestado", "printed", "ready_to_print") if _col_exists(c, acc)]
+    if "id" not in cols:
+        return {}
+    cur.execute(f"SELECT TOP 200 {', '.join(f'[{c}]' for c in cols)} FROM {TABLE} WHERE {where_sql}", *where_args)
+    names = [c[0] for c in cur.description]
+    out: Dict[Any, Dict[str, Any]] = {}
+    for r in cur.fetchall():
+        obj = {names[i]: _json_safe(r[i]) for i in range(len(names))}
+        out[obj.get("id")] = obj
+    return out
+
+
+def _publish_order_updates(before: Dict[Any, Dict[str, Any]], after: Dict[Any, Dict[str, Any]],
+                           updates: Dict[str, Any], acc: str, source: str) -> None:
+    for row_id, now in after.items():
+        prev = before.get(row_id) or {}
+        ev: Dict[str, Any] = dict(now)
+        ev.update({
+            "type": "order_update",
+            "source": source,
+            "acc": acc,
+            "fields": sorted(updates.keys()),
+            "deposito_anterior": prev.get("deposito_asignado"),
+            "shipping_subestado_anterior": prev.get("shipping_subestado"),
+        })
+        order_events.publish(ev)
+        # Already published: the change-feed publisher must not repeat it
+        _feed_remember(acc, row_id, now.get("deposito_asignado"))
+
+
+# Depot transitions made outside this process (PIPELINE_10 / modules/08_assign_tx) reach
+# /orders/stream through run_order_feed_publisher_loop. 0 disables it.
+try:
+    ORDERS_FEED_PUBLISH_SECS = float(os.getenv("ORDERS_FEED_PUBLISH_SECS", "3"))
+except Exception:
+    ORDERS_FEED_PUBLISH_SECS = 3.0
+_FEED_DEPOTS_MAX = 20000
+_feed_depots: Dict[str, "OrderedDict[Any, Any]"] = {}
+_feed_lock = threading.Lock()
+
+
+def _feed_remember(acc: str, row_id: Any, depot: Any) -> Tuple[bool, Any]:
+    """Store the last deposito_asignado seen for row_id (bounded LRU per account).
+    Returns (known, previous value)."""
+    if row_id is None:
+        return False, None
+    with _feed_lock:
+        seen = _feed_depots.setdefault(acc, OrderedDict())
+        known = row_id in seen
+        prev = seen.get(row_id)
+        seen[row_id] = depot
+        seen.move_to_end(row_id)
+        while len(seen) > _FEED_DEPOTS_MAX:
+            seen.popitem(last=False)
+    return known, prev
+
+
+def _publish_feed_row(row: Dict[str, Any], acc: str, watch_start_utc: datetime) -> bool:
+    depot = row.get("deposito_asignado")
+    known, prev = _feed_remember(acc, row.get("id"), depot)
+    if known:
+        if (prev or None) == (depot or None):
+            return False
+    else:
+        # Unseen row: only an assignment made since the watch started (previous depot unknown)
+        ts = row.get("fecha_asignacion")
+        if not depot or not isinstance(ts, datetime) or ts < watch_start_utc:
+            return False
+        prev = None
+    ev: Dict[str, Any] = {k: _json_safe(v) for k, v in row.items() if k not in ("fecha_asignacion", "meli_account")}
+    ev.update({
+        "type": "order_update",
+        "source": "change_feed",
+        "acc": acc,
+        "fields": ["deposito_asignado"],
+        "deposito_anterior": prev,
+        "shipping_subestado_anterior": None,
+    })
+    order_events.publish(ev)
+    return True
+
+
+def run_order_feed_publisher_loop(interval_secs: float = ORDERS_FEED_PUBLISH_SECS, acc: str = "acc1"):
+    """Background loop that publishes deposito_asignado transitions written by other processes
+    (the assignment pipeline) on the /orders/stream bus, derived from the orders_meli change feed.
+
+    Only polls while someone listens for the account; the watermark is taken when the first
+    subscriber arrives. A row already seen publishes when its depot differs from the last value
+    seen (or published by this process); an unseen row publishes when its fecha_asignacion is
+    newer than the start of the watch. Runs forever in a daemon thread.
+    """
+    if interval_secs <= 0:
+        return
+    watermark: Optional[str] = None
+    after_id: Optional[int] = None
+    watch_start = datetime.utcnow()
+    while True:
+        try:
+            if not order_events.has_subscribers(acc):
+                if watermark is not None:
+                    watermark, after_id = None, None
+                    with _feed_lock:
+                        _feed_depots.pop(acc, None)
+            else:
+                fields = [c for c in ("id", "order_id", "pack_id", "deposito_asignado", "shipping_estado",
+                                      "shipping_subestado", "fecha_asignacion") if _col_exists(c, acc)]
+                if watermark is None:
+                    watch_start = datetime.utcnow()
+                    watermark = get_order_changes_service(None, fields, acc)["watermark"]
+                else:
+                    for _ in range(20):  # drain a backlog, bounded per tick
+                        res = get_order_changes_service(watermark, fields, acc, limit=500, after_id=after_id)
+                        for row in res["changes"]:
+                            _publish_feed_row(row, acc, watch_start)
+                        watermark = res["watermark"]
+                        after_id = res.get("next_after_id")
+                        if not res.get("has_more"):
+                            break
+        except Exception:
+            # swallow and continue (DB down, schema without change-feed columns, ...)
+            pass
+        time.sleep(max(0.5, float(interval_secs)))
 
 
 def update_order_service(order_id: int, update, acc: str = "acc1") -> int:
@@ -756,10 +1135,25 @@ def update_order_service(order_id: int, update, acc: str = "acc1") -> int:
 
     with _get_conn(acc) as cn:
         cur = cn.cursor()
+        listening = order_events.has_subscribers(acc)
+        before: Dict[Any, Dict[str, Any]] = {}
+        if listening:
+            try:
+                before = _snapshot_for_events(cur, "[id] = ?", [order_id], acc)
+            except Exception:
+                # never block the update because of the event bus
+                before = {}
         # Intento 1: actualizar por order_id
         cur.execute(sql, *args)
         cn.commit()
         affected = cur.rowcount
+        if listening and affected:
+            try:
+                after = _snapshot_for_events(cur, "[id] = ?", [order_id], acc)
+                _publish_order_updates(before, after, updates, acc, "update_order_service")
+            except Exception:
+                # never break the update because of the event bus
+                pass
         # Fallback anterior por pack_id se deshabilita para evitar conversiones implícitas problemáticas
         # ya que el parámetro proviene como id numérico.
         if affected == 0:
@@ -833,6 +1227,22 @@ def update_order_by_order_or_pack(order_or_pack: str, update, acc: str = "acc1")
 
     with _get_conn(acc) as cn:
         cur = cn.cursor()
+        listening = order_events.has_subscribers(acc)
+        key_where = "[order_id] = ? OR [pack_id] = ?"
+        key_args = [str(order_or_pack), str(order_or_pack)]
+        before: Dict[Any, Dict[str, Any]] = {}
+        if listening:
+            try:
+                before = _snapshot_for_events(cur, key_where, key_args, acc)
+            except Exception:
+                before = {}
         cur.execute(sql, *args)
         cn.commit()
-        return cur.rowcount or 0
+        affected = cur.rowcount or 0
+        if listening and affected:
+            try:
+                after = _snapshot_for_events(cur, key_where, key_args, acc)
+                _publish_order_updates(before, after, updates, acc, "update_order_by_order_or_pack")
+            except Exception:
+                pass
+        return affected
@@ -0,0 +1,11 @@
+-- Adds the claim (lease) timestamp for events taken by a webhook worker.
+-- Rows left in 'processing' with an expired lease (worker crash, DB drop mid-batch) are
+-- reset to 'pending' by the server's reaper (WEBHOOK_PROCESSING_TTL_SECS).
+-- Safe to run multiple times: checks for column existence
+
+IF COL_LENGTH('dbo.meli_webhook_events', 'claimed_at') IS NULL
+BEGIN
+    ALTER TABLE dbo.meli_webhook_events
+    ADD claimed_at DATETIME2 NULL;
+END
+GO
@@ -0,0 +1,10 @@
+-- Adds a reference to the event that absorbed a duplicate notification
+-- (same topic/resource_id/user_id, or a shipment resolved to an order already in the batch).
+-- Safe to run multiple times: checks for column existence
+
+IF COL_LENGTH('dbo.meli_webhook_events', 'coalesced_into') IS NULL
+BEGIN
+    ALTER TABLE dbo.meli_webhook_events
+    ADD coalesced_into INT NULL;
+END
+GO
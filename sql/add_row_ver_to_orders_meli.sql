@@ -0,0 +1,18 @@
+-- Adds a ROWVERSION column used by GET /orders/changes as an exact change watermark.
+-- SQL Server bumps it on every INSERT/UPDATE (webhooks, pipeline, GUI), no trigger needed.
+-- Safe to run multiple times: checks for column existence
+
+IF COL_LENGTH('dbo.orders_meli', 'row_ver') IS NULL
+BEGIN
+    ALTER TABLE dbo.orders_meli
+    ADD row_ver ROWVERSION;
+END
+GO
+
+IF NOT EXISTS (
+    SELECT 1 FROM sys.indexes WHERE name = 'IX_orders_meli_row_ver' AND object_id = OBJECT_ID('dbo.orders_meli')
+)
+BEGIN
+    CREATE INDEX IX_orders_meli_row_ver ON dbo.orders_meli(row_ver);
+END
+GO